@@ -0,0 +1,49 @@
+"""Stored word counts of posts, for the word clouds of ideas
+
+Revision ID: 3e7a9c41d2f8
+Revises: 8d4f0b2c6e19
+Create Date: 2026-10-18 14:26:03.118342
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e7a9c41d2f8'
+down_revision = '8d4f0b2c6e19'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'post_stem_index',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('post_id', sa.Integer, sa.ForeignKey(
+                'content.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('lang', sa.String(20), nullable=False),
+            sa.Column('subject_entry_id', sa.Integer),
+            sa.Column('body_entry_id', sa.Integer),
+            sa.Column('subject_digest', sa.String(40)),
+            sa.UniqueConstraint('post_id', 'lang'))
+        op.create_table(
+            'post_stem_count',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('index_id', sa.Integer, sa.ForeignKey(
+                'post_stem_index.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('stem', sa.UnicodeText, nullable=False),
+            sa.Column('word', sa.UnicodeText, nullable=False),
+            sa.Column('subject_count', sa.Float, nullable=False),
+            sa.Column('body_count', sa.Float, nullable=False))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('post_stem_count')
+        op.drop_table('post_stem_index')
@@ -0,0 +1,69 @@
+"""Compact sets of the posts read by each user in a discussion
+
+Revision ID: 3e8b5d1f6a27
+Revises: 9a4e1c7d2b58
+Create Date: 2026-10-18 19:24:51.630417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e8b5d1f6a27'
+down_revision = '9a4e1c7d2b58'
+
+from alembic import context, op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'post_read_set',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('user_id', sa.Integer, sa.ForeignKey(
+                'user.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('bounds', ARRAY(sa.Integer), nullable=False,
+                      server_default='{}'),
+            sa.UniqueConstraint('user_id', 'discussion_id'))
+        # The live views, as ranges of posts consecutive in their
+        # discussion, whatever the posts of other discussions in between
+        op.execute("""
+WITH ordinals AS (
+    SELECT id, discussion_id, row_number() OVER (
+        PARTITION BY discussion_id ORDER BY id) AS ordinal
+    FROM content
+), views AS (
+    SELECT DISTINCT action.actor_id, ordinals.discussion_id,
+        ordinals.id AS post_id, ordinals.ordinal
+    FROM action
+    JOIN action_on_post ON action_on_post.id = action.id
+    JOIN ordinals ON ordinals.id = action_on_post.post_id
+    WHERE action.type = 'version:ReadStatusChange_P'
+        AND action.tombstone_date IS NULL
+), islands AS (
+    SELECT actor_id, discussion_id, post_id, ordinal - row_number() OVER (
+        PARTITION BY actor_id, discussion_id ORDER BY post_id) AS island
+    FROM views
+), ranges AS (
+    SELECT actor_id, discussion_id,
+        min(post_id) AS start_id, max(post_id) + 1 AS end_id
+    FROM islands
+    GROUP BY actor_id, discussion_id, island
+)
+INSERT INTO post_read_set (user_id, discussion_id, bounds)
+SELECT actor_id, discussion_id, array_agg(bound ORDER BY bound)
+FROM ranges, unnest(ARRAY[start_id, end_id]) AS bound
+GROUP BY actor_id, discussion_id""")
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('post_read_set')
@@ -0,0 +1,58 @@
+"""Daily activity rollups for the time series analytics
+
+Revision ID: 5c0d7e3a9b42
+Revises: e2c85f7a31d0
+Create Date: 2026-10-18 19:02:37.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c0d7e3a9b42'
+down_revision = 'e2c85f7a31d0'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'daily_activity_state',
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('last_post_id', sa.Integer, nullable=False,
+                      server_default='0'),
+            sa.Column('last_vote_id', sa.Integer, nullable=False,
+                      server_default='0'),
+            sa.Column('last_action_id', sa.Integer, nullable=False,
+                      server_default='0'),
+            sa.Column('refreshed', sa.DateTime))
+        op.create_table(
+            'daily_activity',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False),
+            sa.Column('day', sa.Date, nullable=False),
+            sa.Column('actor_id', sa.Integer, sa.ForeignKey(
+                'agent_profile.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False),
+            sa.Column('posts', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('top_posts', sa.Integer, nullable=False,
+                      server_default='0'),
+            sa.Column('votes', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('actions', sa.Integer, nullable=False,
+                      server_default='0'),
+            sa.Column('views', sa.Integer, nullable=False, server_default='0'),
+            sa.UniqueConstraint('discussion_id', 'day', 'actor_id'))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('daily_activity')
+        op.drop_table('daily_activity_state')
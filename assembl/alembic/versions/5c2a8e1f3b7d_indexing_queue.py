@@ -0,0 +1,46 @@
+"""Queue of pending changes to the elasticsearch index
+
+Revision ID: 5c2a8e1f3b7d
+Revises: a3dc2d6f7562
+Create Date: 2026-10-18 09:12:41.318205
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c2a8e1f3b7d'
+down_revision = 'a3dc2d6f7562'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'indexing_queue',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('uid', sa.String(100), nullable=False),
+            sa.Column('operation', sa.String(10), nullable=False),
+            sa.Column('doc_type', sa.String(20), nullable=False),
+            sa.Column('parent', sa.String(100)),
+            sa.Column('source', sa.Text),
+            sa.Column('created', sa.DateTime, nullable=False),
+            sa.Column('attempts', sa.SmallInteger, nullable=False,
+                      server_default='0'),
+            sa.Column('next_attempt', sa.DateTime, nullable=False),
+            sa.Column('last_error', sa.Text),
+            sa.Column('dead_letter', sa.Boolean, nullable=False,
+                      server_default='false'))
+        op.create_index(
+            'ix_indexing_queue_next_attempt', 'indexing_queue',
+            ['dead_letter', 'next_attempt'])
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_index('ix_indexing_queue_next_attempt', 'indexing_queue')
+        op.drop_table('indexing_queue')
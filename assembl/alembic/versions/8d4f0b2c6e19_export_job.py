@@ -0,0 +1,53 @@
+"""Background export jobs and their cached artifacts
+
+Revision ID: 8d4f0b2c6e19
+Revises: 5c2a8e1f3b7d
+Create Date: 2026-10-18 11:02:17.540913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d4f0b2c6e19'
+down_revision = '5c2a8e1f3b7d'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'export_job',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('requester_id', sa.Integer, sa.ForeignKey(
+                'agent_profile.id', ondelete='SET NULL', onupdate='CASCADE')),
+            sa.Column('export_type', sa.String(60), nullable=False),
+            sa.Column('params', sa.Text, nullable=False),
+            sa.Column('watermark', sa.String(64), nullable=False),
+            sa.Column('cache_key', sa.String(64), nullable=False),
+            sa.Column('status', sa.String(20), nullable=False),
+            sa.Column('progress', sa.Integer, nullable=False,
+                      server_default='0'),
+            sa.Column('file_identity', sa.String(64)),
+            sa.Column('file_size', sa.Integer),
+            sa.Column('mime_type', sa.String(100)),
+            sa.Column('filename', sa.Unicode(255)),
+            sa.Column('error', sa.Text),
+            sa.Column('created', sa.DateTime, nullable=False),
+            sa.Column('started', sa.DateTime),
+            sa.Column('finished', sa.DateTime))
+        op.create_index(
+            'ix_export_job_cache_key', 'export_job', ['cache_key', 'status'])
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_index('ix_export_job_cache_key', 'export_job')
+        op.drop_table('export_job')
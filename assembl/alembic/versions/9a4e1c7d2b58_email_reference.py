@@ -0,0 +1,77 @@
+"""Index of the messages referenced by emails, for incremental threading
+
+Revision ID: 9a4e1c7d2b58
+Revises: 5c0d7e3a9b42
+Create Date: 2026-10-18 19:12:37.402815
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9a4e1c7d2b58'
+down_revision = '5c0d7e3a9b42'
+
+import email
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+from assembl.lib.sqla import mark_changed
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'email_reference',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('email_id', sa.Integer, sa.ForeignKey(
+                'email.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False),
+            sa.Column('message_id', sa.Unicode, nullable=False),
+            sa.Column('depth', sa.Integer, nullable=False))
+        op.create_index(
+            'ix_email_reference_discussion_message_id', 'email_reference',
+            ['discussion_id', 'message_id'])
+
+    # Index the existing emails, a page of blobs at a time
+    from assembl import models as m
+    db = m.get_session_maker()()
+    with transaction.manager:
+        last_id = 0
+        while True:
+            page = db.execute(
+                """SELECT email.id, content.discussion_id, post.message_id,
+                    imported_post.imported_blob
+                FROM email
+                JOIN imported_post ON imported_post.id = email.id
+                JOIN post ON post.id = email.id
+                JOIN content ON content.id = email.id
+                WHERE email.id > :last_id
+                ORDER BY email.id LIMIT 500""",
+                {"last_id": last_id}).fetchall()
+            if not page:
+                break
+            last_id = page[-1][0]
+            rows = []
+            for (email_id, discussion_id, message_id, blob) in page:
+                if not blob:
+                    continue
+                references = m.AbstractMailbox.references_of(
+                    email.message_from_string(str(blob)), message_id)
+                rows.extend(dict(
+                    email_id=email_id, discussion_id=discussion_id,
+                    message_id=reference, depth=depth)
+                    for (depth, reference) in enumerate(references, 1))
+            if rows:
+                db.execute(m.EmailReference.__table__.insert(), rows)
+        mark_changed(db)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('email_reference')
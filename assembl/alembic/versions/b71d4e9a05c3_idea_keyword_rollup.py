@@ -0,0 +1,62 @@
+"""Materialized keyword rollups of ideas
+
+Revision ID: b71d4e9a05c3
+Revises: 3e7a9c41d2f8
+Create Date: 2026-10-18 15:48:22.603517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b71d4e9a05c3'
+down_revision = '3e7a9c41d2f8'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_keyword_rollup_state',
+            sa.Column('idea_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('dirty', sa.Boolean, nullable=False,
+                      server_default='true'),
+            sa.Column('changed', sa.DateTime, nullable=False),
+            sa.Column('refreshed', sa.DateTime))
+        op.create_index(
+            'ix_idea_keyword_rollup_state_dirty', 'idea_keyword_rollup_state',
+            ['dirty', 'refreshed'])
+        op.create_table(
+            'idea_keyword_rollup',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('idea_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False),
+            sa.Column('tag_id', sa.Integer, sa.ForeignKey(
+                'tag.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False),
+            sa.Column('score', sa.Float, nullable=False),
+            sa.Column('count', sa.Integer),
+            sa.UniqueConstraint('idea_id', 'tag_id'))
+        op.create_index(
+            'ix_idea_keyword_rollup_idea_score', 'idea_keyword_rollup',
+            ['idea_id', 'score'])
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_index('ix_idea_keyword_rollup_idea_score',
+                      'idea_keyword_rollup')
+        op.drop_table('idea_keyword_rollup')
+        op.drop_index('ix_idea_keyword_rollup_state_dirty',
+                      'idea_keyword_rollup_state')
+        op.drop_table('idea_keyword_rollup_state')
@@ -0,0 +1,38 @@
+"""Translation memory shared by the machine translation of discussions
+
+Revision ID: e2c85f7a31d0
+Revises: b71d4e9a05c3
+Create Date: 2026-10-18 17:05:41.270186
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2c85f7a31d0'
+down_revision = 'b71d4e9a05c3'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'translation_memory',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('service', sa.String(60), nullable=False),
+            sa.Column('digest', sa.String(40), nullable=False),
+            sa.Column('source_locale', sa.String(32), nullable=False),
+            sa.Column('target_locale', sa.String(32), nullable=False),
+            sa.Column('value', sa.UnicodeText, nullable=False),
+            sa.Column('created', sa.DateTime, nullable=False),
+            sa.UniqueConstraint(
+                'digest', 'source_locale', 'target_locale', 'service'))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('translation_memory')
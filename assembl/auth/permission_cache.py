@@ -0,0 +1,263 @@
+"""Caching of the roles and permissions of users in discussions.
+
+:py:func:`assembl.auth.util.get_roles`, :py:func:`assembl.auth.util.get_permissions`
+and :py:func:`assembl.auth.util.user_has_permission` are called many times
+per request, with the same (user_id, discussion_id). Their results are cached
+in two layers:
+
+1. On the current request, for the duration of the request.
+2. Optionally, across requests, in process memory or in redis, for
+   ``permission_cache_ttl`` seconds (``permission_cache`` setting.)
+
+Cross-request entries are keyed by generation numbers of the user and of the
+discussion, which are incremented when a :py:class:`assembl.models.auth.UserRole`,
+:py:class:`assembl.models.auth.LocalUserRole` or
+:py:class:`assembl.models.auth.DiscussionPermission` changes.
+The memory backend only sees the changes made by its own process,
+so use the redis backend with multiple workers.
+Pending changes of the session are flushed before reading the cache,
+as the queries would be, so that these listeners see them.
+"""
+import threading
+from collections import defaultdict
+from time import time
+
+import transaction
+from anyjson import dumps, loads
+from sqlalchemy import event
+from pyramid.threadlocal import get_current_request
+
+from ..lib import config, metrics
+from ..lib.logging import getLogger
+from ..models.auth import UserRole, LocalUserRole, DiscussionPermission
+
+
+class MemoryPermissionBackend(object):
+    """Keeps cached permissions in process memory."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._values = {}
+        self._generations = defaultdict(int)
+
+    def get(self, key):
+        entry = self._values.get(key, None)
+        if entry is None:
+            return None
+        value, expiry = entry
+        if expiry < time():
+            with self._lock:
+                self._values.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            if len(self._values) >= self.max_size:
+                now = time()
+                self._values = {k: v for (k, v) in self._values.iteritems()
+                                if v[1] >= now}
+                if len(self._values) >= self.max_size:
+                    self._values = {}
+            self._values[key] = (value, time() + ttl)
+
+    def generations(self, names):
+        return [self._generations[name] for name in names]
+
+    def bump_generations(self, names):
+        with self._lock:
+            for name in names:
+                self._generations[name] += 1
+
+
+class RedisPermissionBackend(object):
+    """Keeps cached permissions in redis, shared by all processes."""
+
+    prefix = "assembl:permissions:"
+    generation_prefix = "assembl:permissions_generation:"
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        if value is not None:
+            return loads(value)
+
+    def set(self, key, value, ttl):
+        self.redis.setex(self.prefix + key, ttl, dumps(value))
+
+    def generations(self, names):
+        return [int(g or 0) for g in self.redis.mget(
+            [self.generation_prefix + name for name in names])]
+
+    def bump_generations(self, names):
+        pipe = self.redis.pipeline()
+        for name in names:
+            pipe.incr(self.generation_prefix + name)
+        pipe.execute()
+
+
+class PermissionCache(object):
+    """Caches roles and permissions by (user_id, discussion_id),
+    on the request and optionally in a shared backend."""
+
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self._pending = threading.local()
+
+    @staticmethod
+    def request_cache(create=True):
+        request = get_current_request()
+        if request is None:
+            return None
+        cache = getattr(request, "permission_cache", None)
+        if cache is None and create:
+            cache = request.permission_cache = {}
+        return cache
+
+    @staticmethod
+    def generation_names(user_id, discussion_id):
+        return ("user:%s" % (user_id,), "discussion:%s" % (discussion_id,))
+
+    def get(self, kind, user_id, discussion_id, compute):
+        """The cached value of compute(), which gives the roles or permissions
+        (according to kind) of the user in the discussion."""
+        self.flush()
+        key = (kind, user_id, discussion_id)
+        request_cache = self.request_cache()
+        if request_cache is not None and key in request_cache:
+            metrics.counter("permissions.cache_hit.request").inc()
+            return list(request_cache[key])
+        value = None
+        shared_key = None
+        if self.backend is not None:
+            try:
+                generations = self.backend.generations(
+                    self.generation_names(user_id, discussion_id))
+                shared_key = "%s:%s:%s:%d:%d" % (
+                    kind, user_id, discussion_id,
+                    generations[0], generations[1])
+                value = self.backend.get(shared_key)
+            except Exception as e:
+                getLogger().error(
+                    "Could not read the permission cache", exc_info=e)
+                shared_key = None
+        if value is not None:
+            metrics.counter("permissions.cache_hit.shared").inc()
+        else:
+            metrics.counter("permissions.cache_miss").inc()
+            value = compute()
+            if shared_key is not None:
+                try:
+                    self.backend.set(shared_key, value, self.ttl)
+                except Exception as e:
+                    getLogger().error(
+                        "Could not write the permission cache", exc_info=e)
+        if request_cache is not None:
+            request_cache[key] = value
+        # callers may modify the list
+        return list(value)
+
+    @staticmethod
+    def flush():
+        """Flush the session, as the queries of compute() would, so the
+        listeners below invalidate the entries of unflushed changes."""
+        db = UserRole.default_db
+        if db.autoflush:
+            db.flush()
+
+    def invalidate(self, user_id=None, discussion_id=None):
+        """Forget the roles and permissions of the user (in all discussions)
+        or of the discussion (for all users.)"""
+        request_cache = self.request_cache(False)
+        if request_cache:
+            request_cache.clear()
+        if self.backend is None:
+            return
+        names = []
+        if user_id is not None:
+            names.append("user:%s" % (user_id,))
+        if discussion_id is not None:
+            names.append("discussion:%s" % (discussion_id,))
+        if names:
+            # Now, so this transaction sees the change, and again after
+            # commit, in case another request cached the previous state.
+            self._bump(names)
+            self._schedule(names)
+
+    def _bump(self, names):
+        try:
+            self.backend.bump_generations(names)
+        except Exception as e:
+            getLogger().error(
+                "Could not invalidate the permission cache", exc_info=e)
+
+    def _schedule(self, names):
+        from ..lib.sqla import is_zopish
+        if not is_zopish():
+            return
+        txn = transaction.get()
+        pending = getattr(self._pending, "names", None)
+        if pending is None or pending[0] is not txn:
+            pending = self._pending.names = (txn, set())
+            txn.addAfterCommitHook(self._bump_pending, (pending[1],))
+        pending[1].update(names)
+
+    def _bump_pending(self, status, names):
+        self._pending.names = None
+        if status:
+            self._bump(list(names))
+
+
+def hit_ratio():
+    "The proportion of permission lookups answered by a cache layer"
+    hits = (metrics.counter("permissions.cache_hit.request").value +
+            metrics.counter("permissions.cache_hit.shared").value)
+    total = hits + metrics.counter("permissions.cache_miss").value
+    return (float(hits) / total) if total else 0.0
+
+
+_permission_cache = None
+
+
+def get_permission_cache():
+    """The process-wide :py:class:`PermissionCache`, according to the
+    ``permission_cache`` (``memory``, ``redis``; default request only)
+    and ``permission_cache_ttl`` settings."""
+    global _permission_cache
+    if _permission_cache is None:
+        backend_name = config.get('permission_cache', None)
+        if backend_name == 'memory':
+            backend = MemoryPermissionBackend()
+        elif backend_name == 'redis':
+            from ..lib.caching import get_redis_client
+            backend = RedisPermissionBackend(get_redis_client())
+        else:
+            backend = None
+        _permission_cache = PermissionCache(
+            backend, int(config.get('permission_cache_ttl', 300)))
+    return _permission_cache
+
+
+@event.listens_for(UserRole, 'after_insert', propagate=True)
+@event.listens_for(UserRole, 'after_update', propagate=True)
+@event.listens_for(UserRole, 'after_delete', propagate=True)
+def user_role_changed(mapper, connection, target):
+    get_permission_cache().invalidate(user_id=target.user_id)
+
+
+@event.listens_for(LocalUserRole, 'after_insert', propagate=True)
+@event.listens_for(LocalUserRole, 'after_update', propagate=True)
+@event.listens_for(LocalUserRole, 'after_delete', propagate=True)
+def local_user_role_changed(mapper, connection, target):
+    get_permission_cache().invalidate(user_id=target.user_id)
+
+
+@event.listens_for(DiscussionPermission, 'after_insert', propagate=True)
+@event.listens_for(DiscussionPermission, 'after_update', propagate=True)
+@event.listens_for(DiscussionPermission, 'after_delete', propagate=True)
+def discussion_permission_changed(mapper, connection, target):
+    get_permission_cache().invalidate(discussion_id=target.discussion_id)
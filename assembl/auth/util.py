@@ -13,6 +13,7 @@ from assembl.lib.locale import _
 from ..lib.sqla import get_session_maker
 from . import R_SYSADMIN, P_READ, SYSTEM_ROLES
 from .password import verify_data_token, Validity
+from .permission_cache import get_permission_cache
 from ..models.auth import (
     User, Role, UserRole, LocalUserRole, Permission,
     DiscussionPermission, AgentProfile,
@@ -28,6 +29,12 @@ def get_user(request):
 def get_roles(user_id, discussion_id=None):
     if user_id in SYSTEM_ROLES:
         return [user_id]
+    return get_permission_cache().get(
+        "roles", user_id, discussion_id,
+        lambda: _get_roles(user_id, discussion_id))
+
+
+def _get_roles(user_id, discussion_id):
     session = get_session_maker()()
     roles = session.query(Role.name).join(UserRole).filter(
         UserRole.user_id == user_id)
@@ -43,6 +50,12 @@ def get_roles(user_id, discussion_id=None):
 
 def get_permissions(user_id, discussion_id):
     user_id = user_id or Everyone
+    return get_permission_cache().get(
+        "permissions", user_id, discussion_id,
+        lambda: _get_permissions(user_id, discussion_id))
+
+
+def _get_permissions(user_id, discussion_id):
     session = get_session_maker()()
     if user_id == Everyone:
         if not discussion_id:
@@ -298,51 +311,8 @@ def roles_with_permissions(discussion, *permissions):
 
 
 def user_has_permission(discussion_id, user_id, permission):
-    from ..models import Discussion
     # assume all ids valid
-    user_id = user_id or Everyone
-    db = Discussion.default_db
-    if user_id == Everyone:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name == user_id).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    elif user_id == Authenticated:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    sysadmin = db.query(UserRole).filter_by(
-        user_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-    if sysadmin:
-        return True
-    permission = db.query(DiscussionPermission).join(
-            Permission, Role, UserRole).filter(
-            DiscussionPermission.discussion_id == discussion_id).filter(
-                UserRole.user_id == user_id).filter(
-                    Permission.name == permission
-                ).union(
-                    db.query(DiscussionPermission
-                        ).join(Permission, Role, LocalUserRole).filter(and_(
-                            # Virtuoso disregards this explicit condition
-                            DiscussionPermission.discussion_id == discussion_id,
-                            # So I have to add this one as well.
-                            LocalUserRole.discussion_id == discussion_id,
-                            LocalUserRole.user_id == user_id,
-                            LocalUserRole.requested == False,  # noqa: E712
-                            Permission.name == permission))
-                ).union(
-                    db.query(DiscussionPermission).join(
-                        Permission, Role).filter(
-                        DiscussionPermission.discussion_id == discussion_id).filter(
-                        Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission)
-                ).first()
-    return permission is not None
+    return permission in get_permissions(user_id, discussion_id)
 
 
 def users_with_permission(discussion_id, permission, id_only=True):
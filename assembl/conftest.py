@@ -11,6 +11,7 @@ from assembl.tests.fixtures.base import *  # noqa: F401
 from assembl.tests.fixtures.auth import *  # noqa: F401
 from assembl.tests.fixtures.discussion import *  # noqa: F401
 from assembl.tests.fixtures.documents import *  # noqa: F401
+from assembl.tests.fixtures.elasticsearch import *  # noqa: F401
 from assembl.tests.fixtures.creativity_session import *  # noqa: F401
 from assembl.tests.fixtures.graphql import *  # noqa: F401
 from assembl.tests.fixtures.idea_content_links import *  # noqa: F401
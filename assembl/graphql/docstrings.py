@@ -420,6 +420,16 @@ class Idea:
     ancestors = """A list of Relay.Node ID's representing the parents Ideas of the Idea."""
     vote_results = """The VoteResult object showing the status and result of a VoteSession on Idea."""
     questions = """A list of Question objects that are bound to the Thematic."""
+    thread = """The Posts of the Idea in the order of the thread view, with their place in the reply tree."""
+
+
+class ThreadPost:
+    __doc__ = """The place of a Post in the reply tree of a thread Idea."""
+    post_id = Default.node_id % ("Post",)
+    parent_id = """The parent of the Post in the tree, if it is a reply. """ + Default.node_id % ("Post",)
+    indentation = """The path of the Post in the tree, e.g. 1.2.1 for the first reply to the second reply to the first top Post. x if the Post is not published."""
+    number_of_answers = """The number of direct replies to the Post."""
+    latest_date = """The latest creation date of the Post and its live replies, used to order top Posts."""
 
 
 class Question:
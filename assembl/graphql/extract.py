@@ -7,6 +7,7 @@ import assembl.graphql.docstrings as docs
 from assembl.auth import CrudPermissions
 from assembl import models
 
+from .loaders import get_loaders
 from .permissions_helpers import require_instance_permission
 from .types import SecureObjectType, SQLAlchemyInterface
 from .utils import abort_transaction_on_exception, DateTime
@@ -61,8 +62,10 @@ class Extract(SecureObjectType, SQLAlchemyObjectType):
     tags = graphene.List(Tag, description=docs.ExtractInterface.tags)
 
     def resolve_creator(self, args, context, info):
-        if self.creator_id is not None:
-            return models.AgentProfile.get(self.creator_id)
+        return get_loaders(context, info).users.load(self.creator_id)
+
+    def resolve_tags(self, args, context, info):
+        return get_loaders(context, info).extract_tags.load(self.id)
 
     def resolve_comments(self, args, context, info):
         return models.ExtractComment.query.filter(
@@ -1,4 +1,3 @@
-from collections import defaultdict
 from itertools import takewhile
 from random import sample as random_sample
 from random import shuffle as random_shuffle
@@ -15,11 +14,11 @@ from sqlalchemy.orm import joinedload
 from assembl import models
 from assembl.auth import P_MODERATE, CrudPermissions
 from assembl.auth.util import user_has_permission
-from assembl.models.action import SentimentOfPost
 from assembl.models import Phases
 from assembl.models.idea import MessageView
 from .permissions_helpers import require_cls_permission, require_instance_permission
 from .attachment import Attachment
+from .loaders import get_loaders
 from .document import Document
 from .langstring import (LangStringEntry, LangStringEntryInput,
                          langstring_from_input_entries, resolve_langstring,
@@ -30,7 +29,8 @@ from .user import AgentProfile
 from .utils import (
     abort_transaction_on_exception, get_fields, get_root_thematic_for_phase,
     create_root_thematic, create_attachment,
-    update_attachment, create_idea_announcement, get_attachments_with_purpose)
+    update_attachment, create_idea_announcement, get_attachments_with_purpose,
+    DateTime)
 import assembl.graphql.docstrings as docs
 
 
@@ -83,13 +83,23 @@ class IdeaInterface(graphene.Interface):
     announcement = graphene.Field(lambda: IdeaAnnouncement, description=docs.Idea.announcement)
     message_columns = graphene.List(lambda: IdeaMessageColumn, description=docs.Idea.message_columns)
 
+    @staticmethod
+    def _load_langstrings(idea, context, info):
+        # Load the titles and descriptions of the ideas together,
+        # idea.title and idea.description then come from the session.
+        loaders = get_loaders(context, info)
+        loaders.langstrings.load_many([idea.title_id, idea.description_id])
+
     def resolve_title(self, args, context, info):
+        IdeaInterface._load_langstrings(self, context, info)
         return resolve_langstring(self.title, args.get('lang'))
 
     def resolve_title_entries(self, args, context, info):
+        IdeaInterface._load_langstrings(self, context, info)
         return resolve_langstring_entries(self, 'title')
 
     def resolve_description(self, args, context, info):
+        IdeaInterface._load_langstrings(self, context, info)
         description = resolve_langstring(self.description, args.get('lang'))
         if description is None:
             return u''
@@ -97,10 +107,11 @@ class IdeaInterface(graphene.Interface):
         return description
 
     def resolve_description_entries(self, args, context, info):
+        IdeaInterface._load_langstrings(self, context, info)
         return resolve_langstring_entries(self, 'description')
 
     def resolve_top_keywords(self, args, context, info):
-        result = self.top_keywords()
+        result = self.rolled_up_keywords()
         return [TagResult(score=r.score, value=r.value, count=r.count) for r in result]
 
     def resolve_nlp_sentiment(self, args, context, info):
@@ -316,6 +327,16 @@ class VoteResults(graphene.ObjectType):
         return participants
 
 
+class ThreadPost(graphene.ObjectType):
+    __doc__ = docs.ThreadPost.__doc__
+
+    post_id = graphene.ID(required=True, description=docs.ThreadPost.post_id)
+    parent_id = graphene.ID(description=docs.ThreadPost.parent_id)
+    indentation = graphene.String(required=True, description=docs.ThreadPost.indentation)
+    number_of_answers = graphene.Int(required=True, description=docs.ThreadPost.number_of_answers)
+    latest_date = graphene.Field(DateTime, description=docs.ThreadPost.latest_date)
+
+
 class Idea(SecureObjectType, SQLAlchemyObjectType):
     __doc__ = docs.IdeaInterface.__doc__
 
@@ -331,6 +352,20 @@ class Idea(SecureObjectType, SQLAlchemyObjectType):
     posts = SQLAlchemyConnectionField('assembl.graphql.post.PostConnection', description=docs.Idea.posts)  # use dotted name to avoid circular import  # noqa: E501
     contributors = graphene.List(AgentProfile, description=docs.Idea.contributors)
     vote_results = graphene.Field(VoteResults, required=True, description=docs.Idea.vote_results)
+    thread = graphene.List(ThreadPost, description=docs.Idea.thread)
+
+    def resolve_thread(self, args, context, info):
+        tree = models.ThreadTree.get_for_idea(self, context)
+        thread = []
+        for post_id in tree.display_order():
+            parent_id = tree.parent_id(post_id)
+            thread.append(ThreadPost(
+                post_id=Node.to_global_id('Post', post_id),
+                parent_id=Node.to_global_id('Post', parent_id) if parent_id else None,
+                indentation=tree.indentation(post_id),
+                number_of_answers=tree.number_of_answers(post_id),
+                latest_date=tree.latest_date(post_id)))
+        return thread
 
     def resolve_vote_results(self, args, context, info):
         vote_specifications = self.criterion_for
@@ -418,32 +453,15 @@ class Idea(SecureObjectType, SQLAlchemyObjectType):
                 query = query.options(*models.Content.subqueryload_options())
             else:
                 query = query.options(*models.Content.joinedload_options())
-            post_ids = query.with_entities(models.Post.id).subquery()
         else:
             query = query.with_entities(models.Post.id, models.Post.publication_state)
             query = query.all()  # execute the query only once, we iter again below
-            post_ids = [id for id, _ in query]
-
-        # do only one sql query to calculate sentiment_counts
-        # instead of doing one query for each post
-        if 'sentimentCounts' in fields.get('edges', {}).get('node', {}):
-            sentiment_counts = discussion.db.query(
-                models.Post.id, models.SentimentOfPost.type, func.count(
-                    models.SentimentOfPost.id)
-            ).join(models.SentimentOfPost).filter(
-                models.Post.id.in_(post_ids),
-                models.SentimentOfPost.tombstone_condition()
-            ).group_by(models.Post.id, models.SentimentOfPost.type)
-            sentiment_counts_by_post_id = defaultdict(dict)
-            for (post_id, sentiment_type, sentiment_count) in sentiment_counts:
-                sentiment_counts_by_post_id[post_id][
-                    sentiment_type[SentimentOfPost.TYPE_PREFIX_LEN:]
-                ] = sentiment_count
-            # set sentiment_counts_by_post_id on the request to use it
-            # in Post's resolve_sentiment_counts
-            context.sentiment_counts_by_post_id = sentiment_counts_by_post_id
 
         if sentiments_only:
+            # These posts are not in the session, expect them so that their
+            # sentiment counts are loaded in one batch all the same
+            get_loaders(context, info).sentiment_counts.expect(
+                [id for id, _ in query])
             from .post import Post
             query = [Post(id=id, publication_state=publication_state) for id, publication_state in query]
             return query
@@ -37,8 +37,7 @@ def resolve_langstring(langstring, locale_code):
             if english:
                 return english.value
 
-        return langstring.best_lang(
-            LanguagePreferenceCollection.getCurrent(), False).value
+        return langstring.best_entry_in_request().value
 
     except Exception:
         # Anything that goes wrong with clean_input, return the original
@@ -64,7 +63,11 @@ def resolve_langstring_entries(obj, attr):
     return entries
 
 
-def resolve_best_langstring_entries(langstring, target_locale=None):
+def resolve_best_langstring_entries(
+        langstring, target_locale=None, loaders=None):
+    """The entries to show, according to the target_locale or to the
+    language preferences of the request. With the loaders of the operation,
+    the best entries of the langstrings of the page are chosen together."""
     if langstring is None or langstring is models.LangString.EMPTY:
         return []
 
@@ -84,6 +87,8 @@ def resolve_best_langstring_entries(langstring, target_locale=None):
         return entries
 
     # use request's idea of target_locale
+    if loaders is not None and langstring.id:
+        loaders.best_langstring_entries.load(langstring.id)
     lsentries = langstring.best_entries_in_request_with_originals()
     lp = LanguagePreferenceCollection.getCurrent()
     for entry in lsentries:
@@ -0,0 +1,299 @@
+"""Batch loaders for the objects related to the posts and ideas of a
+GraphQL query.
+
+Resolving a list of posts field by field would load the creator, the
+extracts, the tags... of each post with its own queries. The loaders of
+an operation load them for a batch of keys with one ``IN`` query per type
+instead: on a cache miss, a loader loads the missing key together with the
+keys it expects (see :py:meth:`Loader.expect`) and the keys of the same
+kind found on the instances already in the session, which are usually the
+page of posts or ideas being resolved.
+
+Use :py:func:`get_loaders` in the resolvers::
+
+    def resolve_creator(self, args, context, info):
+        return get_loaders(context, info).users.load(self.creator_id)
+"""
+from collections import defaultdict
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, subqueryload
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import instance_state
+
+from assembl import models
+from assembl.models.action import SentimentOfPost
+
+# Keep the IN clauses of a reasonable size
+BATCH_SIZE = 500
+
+
+def loaded_values(*attributes):
+    """A function giving the values of the given attributes
+    on the instances in the session, e.g. (Content, 'creator_id').
+
+    The loaders call it on each cache miss, so it only scans the session
+    again when its number of instances changed, and gives nothing
+    otherwise: the values found in the previous scan were loaded then."""
+    scanned = {'size': None}
+
+    def values():
+        identity_map = attributes[0][0].default_db.identity_map
+        size = len(identity_map)
+        if size == scanned['size']:
+            return ()
+        scanned['size'] = size
+        found = set()
+        for obj in identity_map.values():
+            for cls, name in attributes:
+                if isinstance(obj, cls):
+                    value = obj.__dict__.get(name, None)
+                    if value is not None:
+                        found.add(value)
+        return found
+    return values
+
+
+class Loader(object):
+    """Loads values by key, in batches, and caches them.
+
+    ``batch_load`` takes a list of keys and returns a dict of the
+    values found; ``default`` gives the value of the keys not found
+    (e.g. ``list`` for one-to-many relations.) ``siblings`` gives the
+    keys of the same kind in the session, loaded along with a missing key.
+    """
+
+    def __init__(self, batch_load, default=None, siblings=None):
+        self.batch_load = batch_load
+        self.default = default
+        self.siblings = siblings
+        self._cache = {}
+        self._expected = set()
+
+    def expect(self, keys):
+        "Load these keys with the next batch"
+        self._expected.update(
+            key for key in keys
+            if key is not None and key not in self._cache)
+
+    def prime(self, key, value):
+        self._cache[key] = value
+
+    def load(self, key):
+        if key is None:
+            return self.default() if self.default else None
+        if key not in self._cache:
+            self._expected.add(key)
+            if self.siblings is not None:
+                self.expect(self.siblings())
+            self.dispatch()
+        return self._cache[key]
+
+    def load_many(self, keys):
+        self.expect(keys)
+        return [self.load(key) for key in keys]
+
+    def dispatch(self):
+        keys = [key for key in self._expected if key not in self._cache]
+        self._expected = set()
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start:start + BATCH_SIZE]
+            values = self.batch_load(batch)
+            for key in batch:
+                if key in values:
+                    self._cache[key] = values[key]
+                else:
+                    self._cache[key] = self.default() if self.default else None
+
+
+class ModelLoader(Loader):
+    """Loads instances of a model by id, using the identity map of the
+    session first. ``options`` are applied to the query, and ``loaded``
+    tells if an instance found in the session has everything needed."""
+
+    def __init__(self, cls, options=(), loaded=None, siblings=None):
+        super(ModelLoader, self).__init__(
+            self.load_instances, siblings=siblings)
+        self.cls = cls
+        self.options = options
+        self.loaded = loaded
+
+    def from_session(self, key):
+        obj = self.cls.default_db.identity_map.get(identity_key(self.cls, key))
+        if (obj is not None and not instance_state(obj).expired_attributes and
+                (self.loaded is None or self.loaded(obj))):
+            return obj
+
+    def load(self, key):
+        if key is not None and key not in self._cache:
+            obj = self.from_session(key)
+            if obj is not None:
+                self._cache[key] = obj
+        return super(ModelLoader, self).load(key)
+
+    def load_instances(self, keys):
+        instances = {}
+        missing = []
+        for key in keys:
+            obj = self.from_session(key)
+            if obj is None:
+                missing.append(key)
+            else:
+                instances[key] = obj
+        if missing:
+            query = self.cls.default_db.query(self.cls).filter(
+                self.cls.id.in_(missing))
+            if self.options:
+                query = query.options(*self.options)
+            instances.update((obj.id, obj) for obj in query)
+        return instances
+
+
+def entries_loaded(langstring):
+    return 'entries' not in instance_state(langstring).unloaded
+
+
+def batch_load_sentiment_counts(post_ids):
+    counts = defaultdict(dict)
+    for (post_id, sentiment_type, sentiment_count) in models.Post.default_db.query(
+            SentimentOfPost.post_id, SentimentOfPost.type,
+            func.count(SentimentOfPost.id)
+            ).filter(SentimentOfPost.post_id.in_(post_ids),
+                     SentimentOfPost.tombstone_condition()
+            ).group_by(SentimentOfPost.post_id, SentimentOfPost.type):
+        counts[post_id][
+            sentiment_type[SentimentOfPost.TYPE_PREFIX_LEN:]] = sentiment_count
+    return counts
+
+
+def group_by(rows, key):
+    groups = defaultdict(list)
+    for row in rows:
+        groups[key(row)].append(row)
+    return groups
+
+
+class Loaders(object):
+    """The loaders of a GraphQL operation"""
+
+    def __init__(self, operation, user_id):
+        self.operation = operation
+        self.user_id = user_id
+
+        # Each loader scans the session on its own
+        def post_ids():
+            return loaded_values((models.Content, 'id'))
+
+        def langstring_ids():
+            return loaded_values(
+                (models.Content, 'subject_id'),
+                (models.Content, 'body_id'),
+                (models.Idea, 'title_id'),
+                (models.Idea, 'description_id'))
+
+        self.users = ModelLoader(
+            models.AgentProfile,
+            siblings=loaded_values(
+                (models.Content, 'creator_id'),
+                (models.Extract, 'creator_id')))
+        self.posts = ModelLoader(
+            models.Content,
+            siblings=loaded_values((models.Post, 'parent_id')))
+        self.ideas = ModelLoader(models.Idea)
+        self.langstrings = ModelLoader(
+            models.LangString,
+            options=(subqueryload(models.LangString.entries),),
+            loaded=entries_loaded,
+            siblings=langstring_ids())
+        # The best entries are memoized by LangString.best_entries_in_request
+        # with their entries, and computed again after a translation;
+        # this loader only resolves those of the page together.
+        self.best_langstring_entries = Loader(
+            self.batch_load_best_langstring_entries, siblings=langstring_ids())
+        self.sentiment_counts = Loader(
+            batch_load_sentiment_counts, dict, post_ids())
+        self.my_sentiments = Loader(self.batch_load_my_sentiments,
+                                    siblings=post_ids())
+        self.extracts = Loader(self.batch_load_extracts, list, post_ids())
+        self.post_tags = Loader(self.batch_load_post_tags, list, post_ids())
+        self.extract_tags = Loader(
+            self.batch_load_extract_tags, list,
+            loaded_values((models.Extract, 'id')))
+        self.attachments = Loader(
+            self.batch_load_attachments, list, post_ids())
+        self.idea_content_links_above_post = Loader(
+            self.batch_load_idea_content_links_above_post, unicode,
+            loaded_values((models.Post, 'id')))
+
+    def batch_load_best_langstring_entries(self, langstring_ids):
+        langstrings = [ls for ls in self.langstrings.load_many(langstring_ids)
+                       if ls is not None]
+        return dict(zip(
+            [ls.id for ls in langstrings],
+            models.LangString.best_entries_in_request(langstrings)))
+
+    def batch_load_my_sentiments(self, post_ids):
+        if self.user_id is None:
+            return {}
+        return {sentiment.post_id: sentiment
+                for sentiment in SentimentOfPost.default_db.query(
+                    SentimentOfPost).filter(
+                    SentimentOfPost.actor_id == self.user_id,
+                    SentimentOfPost.post_id.in_(post_ids),
+                    SentimentOfPost.tombstone_date == None)}  # noqa: E711
+
+    def batch_load_extracts(self, post_ids):
+        Extract = models.Extract
+        return group_by(Extract.default_db.query(Extract).filter(
+            Extract.content_id.in_(post_ids)).options(
+            joinedload(Extract.text_fragment_identifiers)).order_by(
+            Extract.creation_date), lambda e: e.content_id)
+
+    def batch_load_tags(self, association_cls, key_column, keys):
+        # Load the associations with their tags,
+        # so the tags of the entities are loaded too
+        return {
+            key: [association.tag for association in associations]
+            for (key, associations) in group_by(
+                association_cls.default_db.query(association_cls).filter(
+                    key_column.in_(keys)).options(
+                    joinedload(association_cls.tag)).order_by(
+                    association_cls.id),
+                lambda a: getattr(a, key_column.key)).iteritems()}
+
+    def batch_load_post_tags(self, post_ids):
+        return self.batch_load_tags(
+            models.PostsTagsAssociation,
+            models.PostsTagsAssociation.post_id, post_ids)
+
+    def batch_load_extract_tags(self, extract_ids):
+        return self.batch_load_tags(
+            models.ExtractsTagsAssociation,
+            models.ExtractsTagsAssociation.extract_id, extract_ids)
+
+    def batch_load_attachments(self, post_ids):
+        PostAttachment = models.PostAttachment
+        return group_by(PostAttachment.default_db.query(PostAttachment).filter(
+            PostAttachment.post_id.in_(post_ids)).options(
+            joinedload(PostAttachment.document)).order_by(
+            PostAttachment.id), lambda a: a.post_id)
+
+    def batch_load_idea_content_links_above_post(self, post_ids):
+        Post = models.Post
+        return {post_id: links or u'' for (post_id, links) in
+                Post.default_db.query(
+                    Post.id, Post.idea_content_links_above_post).filter(
+                    Post.id.in_(post_ids))}
+
+
+def get_loaders(context, info):
+    """The loaders of the current GraphQL operation, kept on the request.
+
+    A request may execute several operations (e.g. in tests), and a
+    mutation may change what an earlier operation loaded, so the loaders
+    are renewed for each operation."""
+    loaders = getattr(context, 'graphql_loaders', None)
+    if loaders is None or loaders.operation is not info.operation:
+        loaders = context.graphql_loaders = Loaders(
+            info.operation, context.authenticated_userid)
+    return loaders
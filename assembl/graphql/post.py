@@ -7,7 +7,6 @@ from graphene.relay import Node
 from graphene_sqlalchemy import SQLAlchemyObjectType
 from pyramid.httpexceptions import HTTPUnauthorized
 from pyramid.i18n import TranslationStringFactory
-from sqlalchemy.orm import joinedload
 from sqlalchemy import exists
 
 from assembl import models
@@ -26,6 +25,7 @@ from .attachment import Attachment
 from .idea import Idea, TagResult
 from .langstring import (LangStringEntry, resolve_best_langstring_entries,
                          resolve_langstring)
+from .loaders import get_loaders
 from .sentiment import SentimentCounts, SentimentTypes
 from .types import SecureObjectType, SQLAlchemyInterface
 from .user import AgentProfile
@@ -55,18 +55,16 @@ class IdeaContentLink(graphene.ObjectType):
 
     def resolve_idea(self, args, context, info):
         if self.idea_id is not None:
-            idea = models.Idea.get(self.idea_id)
+            idea = get_loaders(context, info).ideas.load(self.idea_id)
             # only resolve if it's an Idea, not a Question
             if type(idea) == models.Idea:
                 return idea
 
     def resolve_post(self, args, context, info):
-        if self.post_id is not None:
-            return models.Post.get(self.post_id)
+        return get_loaders(context, info).posts.load(self.post_id)
 
     def resolve_creator(self, args, context, info):
-        if self.creator_id is not None:
-            return models.AgentProfile.get(self.creator_id)
+        return get_loaders(context, info).users.load(self.creator_id)
 
 
 class PostInterface(SQLAlchemyInterface):
@@ -107,27 +105,36 @@ class PostInterface(SQLAlchemyInterface):
     def resolve_db_id(self, args, context, info):
         return self.id
 
+    def resolve_creator(self, args, context, info):
+        return get_loaders(context, info).users.load(self.creator_id)
+
     def resolve_extracts(self, args, context, info):
-        return self.db.query(models.Extract
-                             ).join(models.Content, models.Extract.content == self
-                                    ).options(joinedload(models.Extract.text_fragment_identifiers)
-                                              ).order_by(models.Extract.creation_date
-                                                         ).all()
+        return get_loaders(context, info).extracts.load(self.id)
+
+    @staticmethod
+    def _load_langstrings(post, context, info):
+        # Load the subjects and bodies of the posts together,
+        # post.subject and post.body then come from the session.
+        loaders = get_loaders(context, info)
+        loaders.langstrings.load_many([post.subject_id, post.body_id])
 
     def resolve_subject(self, args, context, info):
         # Use self.subject and not self.get_subject() because we still
         # want the subject even when the post is deleted.
+        PostInterface._load_langstrings(self, context, info)
         subject = resolve_langstring(self.subject, args.get('lang'))
         return subject
 
     def resolve_body(self, args, context, info):
+        PostInterface._load_langstrings(self, context, info)
         body = resolve_langstring(self.get_body(), args.get('lang'))
         return body
 
     def resolve_parent_post_creator(self, args, context, info):
         if self.parent_id:
-            post = models.Content.get(self.parent_id)
-            return post.creator
+            loaders = get_loaders(context, info)
+            post = loaders.posts.load(self.parent_id)
+            return loaders.users.load(post.creator_id)
 
     @staticmethod
     def _maybe_translate(post, locale, request):
@@ -151,28 +158,25 @@ class PostInterface(SQLAlchemyInterface):
     def resolve_subject_entries(self, args, context, info):
         # Use self.subject and not self.get_subject() because we still
         # want the subject even when the post is deleted.
+        PostInterface._load_langstrings(self, context, info)
         PostInterface._maybe_translate(self, args.get('lang'), context)
         subject = resolve_best_langstring_entries(
-            self.subject, args.get('lang'))
+            self.subject, args.get('lang'), get_loaders(context, info))
         return subject
 
     def resolve_body_entries(self, args, context, info):
+        PostInterface._load_langstrings(self, context, info)
         PostInterface._maybe_translate(self, args.get('lang'), context)
         body = resolve_best_langstring_entries(
-            self.get_body(), args.get('lang'))
+            self.get_body(), args.get('lang'), get_loaders(context, info))
         return body
 
     def resolve_sentiment_counts(self, args, context, info):
-        # get the sentiment counts from the cache if it exists instead of
-        # tiggering a sql query
-        cache = getattr(context, 'sentiment_counts_by_post_id', None)
-        if cache is not None:
-            sentiment_counts = {
-                name: 0 for name in models.SentimentOfPost.all_sentiments
-            }
-            sentiment_counts.update(cache[self.id])
-        else:
-            sentiment_counts = self.sentiment_counts
+        sentiment_counts = {
+            name: 0 for name in models.SentimentOfPost.all_sentiments
+        }
+        sentiment_counts.update(
+            get_loaders(context, info).sentiment_counts.load(self.id))
 
         return SentimentCounts(
             dont_understand=sentiment_counts['dont_understand'],
@@ -182,7 +186,7 @@ class PostInterface(SQLAlchemyInterface):
         )
 
     def resolve_my_sentiment(self, args, context, info):
-        my_sentiment = self.my_sentiment
+        my_sentiment = get_loaders(context, info).my_sentiments.load(self.id)
         if my_sentiment is None:
             return None
 
@@ -203,8 +207,10 @@ class PostInterface(SQLAlchemyInterface):
             post_id=models.Post.get_database_id(link['idPost']),
             type=link['@type'],
             creation_date=link['created'],
-            creator_id=link['idCreator'])
-            for link in self.indirect_idea_content_links_with_cache()]
+            creator_id=models.AgentProfile.get_database_id(link['idCreator']))
+            for link in self.indirect_idea_content_links_with_cache(
+                get_loaders(context, info).idea_content_links_above_post.load(
+                    self.id))]
         # only return links with the IdeaRelatedPostLink type
         return [link for link in links if link.type == 'IdeaRelatedPostLink']
 
@@ -250,7 +256,10 @@ class PostInterface(SQLAlchemyInterface):
             return sentiments[0].sentiment
 
     def resolve_tags(self, args, context, info):
-        return self.tags
+        return get_loaders(context, info).post_tags.load(self.id)
+
+    def resolve_attachments(self, args, context, info):
+        return get_loaders(context, info).attachments.load(self.id)
 
 
 class Post(SecureObjectType, SQLAlchemyObjectType):
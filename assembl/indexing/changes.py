@@ -39,6 +39,11 @@ The indexing in elasticsearch is then done asynchronously.
 If by any bad luck, the elasticsearch is not responding, the postgres database
 and elasticsearch will be out of sync. We can always reindex completely the
 elasticsearch index to sync it again with the postgres database.
+
+With ``elasticsearch_indexing_queue = true``, tpc_vote() instead writes the
+changes to the indexing queue table, in the postgres transaction, and
+tpc_finish() only asks a celery worker to send them to elasticsearch.
+See :py:mod:`assembl.indexing.indexer`.
 """
 
 import threading
@@ -47,10 +52,12 @@ from transaction.interfaces import ISavepointDataManager, IDataManagerSavepoint
 from zope.interface import implementer
 import transaction
 from elasticsearch.helpers import bulk
+from pyramid.settings import asbool
 
 from assembl.lib import config, logging
 from .settings import get_index_settings
 from .utils import (
+    building_index,
     connect,
 #    create_index_and_mapping,
     get_uid,
@@ -89,6 +96,7 @@ class ElasticChanges(threading.local):
         self._settings = None
         self._doc_types = set()
         self._settings = get_index_settings(config)
+        self._queued = asbool(config.get('elasticsearch_indexing_queue', False))
         self._activated = False
 
     def _join(self):
@@ -139,19 +147,34 @@ class ElasticChanges(threading.local):
         pass
 
     def tpc_vote(self, transaction):
-        pass
+        if self._queued and (self._index or self._unindex):
+            from assembl.lib.sqla import get_session_maker
+            from .indexer import enqueue
+            # Sorted before the sqlalchemy data manager, which commits
+            # in its tpc_vote.
+            enqueue(get_session_maker()(), self._index, self._unindex)
 # the mapping is static
 #        if self._index or self._unindex:
 #            create_index_and_mapping(index_name=self._settings['index_name'],
 #                                     doc_types=self._doc_types)
 
     def tpc_finish(self, transaction):
-        if self._index or self._unindex:
+        if self._queued:
+            if self._index or self._unindex:
+                self._notify_indexer()
+        elif self._index or self._unindex:
             index_name = self._settings['index_name']
+            es = connect()
+            index_names = [index_name]
+            building = building_index(index_name, es)
+            if building:
+                # A full reindex in a new index also gets the live changes
+                index_names.append(building)
 
-            def get_actions(index, unindex):
+            def get_actions(index_name, index, unindex):
                 for uid, data in index.iteritems():
                     doc_type = get_doc_type_from_uid(uid)
+                    data = dict(data)
                     parent = data.pop('_parent', None)
                     action = {'_op_type': 'index',
                               '_index': index_name,
@@ -175,10 +198,10 @@ class ElasticChanges(threading.local):
 
                     yield action
 
-            actions = get_actions(self._index, self._unindex)
-            es = connect()
-            bulk(es, actions, chunk_size=self._settings['chunk_size'],
-                raise_on_error=False)
+            for name in index_names:
+                actions = get_actions(name, self._index, self._unindex)
+                bulk(es, actions, chunk_size=self._settings['chunk_size'],
+                    raise_on_error=False)
             # set raise_on_error=False to not raise a BulkIndexError and so a transaction error (shouldn't happen in tpc_finish)
             # when we try to unindex an idea that was not indexed (this is
             # the case for hidden ideas associated to a synthesis)
@@ -191,6 +214,14 @@ class ElasticChanges(threading.local):
 
         self._clear()
 
+    def _notify_indexer(self):
+        try:
+            from assembl.tasks.indexing import process_indexing_queue
+            process_indexing_queue.delay()
+        except Exception as e:
+            # The periodic task will process the queue anyway
+            logger.error("Could not notify the indexer", exc_info=e)
+
     def tpc_abort(self, transaction):
         self._clear()
 
@@ -0,0 +1,333 @@
+"""Full reindex of the contents in elasticsearch, in parallel and resumable.
+
+Each doc type is split in chunks of about ``chunk_size`` contents, delimited
+by ids (keyset pagination). Chunks are read and indexed by a pool of
+processes, each with its own database session and elasticsearch connection.
+After each chunk, the list of completed chunks is saved to a checkpoint file,
+so an interrupted reindex can be resumed with the same checkpoint.
+
+When reindexing into a new index, the index is created with the mapping,
+filled, and the alias (``elasticsearch_index``) is switched to it.
+Meanwhile, the new index also has a building alias, and live changes are
+written to both indices, so none is lost by the switch.
+"""
+import os
+import signal
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing import Pool
+from time import time
+
+import simplejson as json
+import transaction
+from sqlalchemy import func
+from sqlalchemy.orm import with_polymorphic, joinedload
+from elasticsearch.helpers import streaming_bulk
+
+from assembl.lib import config, logging, metrics
+from assembl.lib.sqla import get_session_maker, is_zopish
+from .settings import get_index_settings
+from .utils import (
+    connect, create_index_and_mapping, delete_index, get_data,
+    get_doc_type_from_uid, switch_alias, building_alias)
+from . import utils
+
+logger = logging.getLogger()
+
+
+class IndexableSource(object):
+    "The contents of a doc type, as a filtered query ordered by id."
+
+    def __init__(self, doc_type):
+        self.doc_type = doc_type
+
+    def entity(self):
+        raise NotImplementedError()
+
+    def loading_entity(self):
+        "The entity used to load contents, if it differs"
+        return self.entity()
+
+    def filter(self, query, entity):
+        return query
+
+    def options(self, entity):
+        return []
+
+    def chunk_boundaries(self, session, chunk_size):
+        """The ids at which to split the contents in chunks of
+        chunk_size contents, in one query."""
+        entity = self.entity()
+        ids = self.filter(session.query(
+            entity.id.label('id'),
+            func.row_number().over(order_by=entity.id).label('rownum')),
+            entity).subquery()
+        return [id for (id,) in session.query(ids.c.id).filter(
+            ids.c.rownum % chunk_size == 0).order_by(ids.c.id)]
+
+    def chunk(self, session, after_id, last_id):
+        "The contents with after_id < id <= last_id (None for unbounded)"
+        entity = self.loading_entity()
+        query = self.filter(session.query(entity), entity)
+        if after_id is not None:
+            query = query.filter(entity.id > after_id)
+        if last_id is not None:
+            query = query.filter(entity.id <= last_id)
+        return query.options(*self.options(entity)).order_by(entity.id)
+
+
+class IdeaSource(IndexableSource):
+
+    def entity(self):
+        from assembl.models import Idea
+        return Idea
+
+    def filter(self, query, entity):
+        return query.filter(entity.tombstone_condition()).filter(
+            entity.hidden == False)  # noqa: E712
+
+    def options(self, entity):
+        return [joinedload(entity.title).joinedload("entries"),
+                joinedload(entity.synthesis_title).joinedload("entries"),
+                joinedload(entity.description).joinedload("entries")]
+
+
+class AgentProfileSource(IndexableSource):
+
+    def entity(self):
+        from assembl.models import AgentProfile
+        return AgentProfile
+
+
+class PostSource(IndexableSource):
+
+    def entity(self):
+        from assembl.models import Post
+        return Post
+
+    def loading_entity(self):
+        return with_polymorphic(self.entity(), '*')
+
+    def filter(self, query, entity):
+        from assembl.models.post import PublicationStates
+        return query.filter(entity.tombstone_condition()).filter(
+            entity.hidden == False).filter(  # noqa: E712
+            entity.publication_state == PublicationStates.PUBLISHED)
+
+    def options(self, entity):
+        return [joinedload(entity.subject).joinedload("entries"),
+                joinedload(entity.body).joinedload("entries"),
+                joinedload(entity.creator)]
+
+
+class ExtractSource(IndexableSource):
+    "The extracts of indexed posts"
+
+    def entity(self):
+        from assembl.models import Extract
+        return Extract
+
+    def filter(self, query, entity):
+        from assembl.models import Post
+        from assembl.models.post import PublicationStates
+        return query.join(Post, entity.content_id == Post.id).filter(
+            Post.tombstone_condition()).filter(
+            Post.hidden == False).filter(  # noqa: E712
+            Post.publication_state == PublicationStates.PUBLISHED)
+
+
+SOURCES = OrderedDict((source.doc_type, source) for source in (
+    IdeaSource('idea'), AgentProfileSource('user'),
+    PostSource('post'), ExtractSource('extract')))
+
+
+def plan_chunks(session, chunk_size, doc_types=None):
+    """The list of chunks to reindex, as (doc_type, after_id, last_id)"""
+    chunks = []
+    for doc_type in (doc_types or SOURCES.keys()):
+        boundaries = SOURCES[doc_type].chunk_boundaries(session, chunk_size)
+        after_id = None
+        for last_id in boundaries:
+            chunks.append((doc_type, after_id, last_id))
+            after_id = last_id
+        # also takes contents created since planning
+        chunks.append((doc_type, after_id, None))
+    return chunks
+
+
+def index_actions(contents, index_name):
+    for content in contents:
+        uid, data = get_data(content)
+        if not data:
+            continue
+        doc_type = get_doc_type_from_uid(uid)
+        action = {'_op_type': 'index',
+                  '_index': index_name,
+                  '_type': doc_type,
+                  '_id': uid,
+                  '_source': data}
+        parent = data.pop('_parent', None)
+        if parent is not None:
+            action['_parent'] = parent
+        yield action
+
+
+def reindex_chunk(args):
+    """Read and index a chunk of contents, in this process.
+
+    :returns: (chunk number, number of indexed contents, number of errors)"""
+    (num, (doc_type, after_id, last_id), index_name, bulk_size) = args
+    session = get_session_maker()()
+    indexed = errors = 0
+    try:
+        contents = SOURCES[doc_type].chunk(session, after_id, last_id)
+        for ok, item in streaming_bulk(
+                connect(), index_actions(contents, index_name),
+                chunk_size=bulk_size, raise_on_error=False,
+                raise_on_exception=False):
+            if ok:
+                indexed += 1
+            else:
+                errors += 1
+                if errors <= 3:
+                    logger.error("Could not index", item=item)
+    except Exception as e:
+        logger.error("Could not reindex chunk", chunk=num, exc_info=e)
+        errors += 1
+    finally:
+        if is_zopish():
+            transaction.abort()
+        else:
+            session.rollback()
+        session.expunge_all()
+    return (num, indexed, errors)
+
+
+def init_worker():
+    # Each process needs its own connections
+    utils._es = None
+    # Let the parent handle interruptions
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class Checkpoint(object):
+    "The state of a reindex, saved in a JSON file after each chunk."
+
+    def __init__(self, path, index_name, chunks, done=()):
+        self.path = path
+        self.index_name = index_name
+        self.chunks = chunks
+        self.done = set(done)
+
+    @classmethod
+    def load(cls, path):
+        if not path or not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return cls(path, data['index_name'],
+                   [tuple(chunk) for chunk in data['chunks']], data['done'])
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'index_name': self.index_name,
+                       'chunks': self.chunks,
+                       'done': sorted(self.done)}, f)
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def pending(self):
+        return [(num, chunk) for (num, chunk) in enumerate(self.chunks)
+                if num not in self.done]
+
+
+def new_index_name(alias):
+    return '%s_%s' % (alias, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+
+
+def full_reindex(session, processes=None, chunk_size=5000,
+                 checkpoint_path=None, new_index=False, delete=True):
+    """Reindex all contents.
+
+    :param processes: the size of the process pool;
+        None or 1 to reindex in this process.
+    :param chunk_size: the number of contents read in a transaction
+    :param checkpoint_path: where to save progress. An existing checkpoint
+        is resumed.
+    :param new_index: reindex in a new index, then point the
+        ``elasticsearch_index`` alias to it.
+    :param delete: delete and recreate the index first (without new_index)
+    :returns: the number of errors
+    """
+    settings = get_index_settings(config)
+    alias = settings['index_name']
+    checkpoint = Checkpoint.load(checkpoint_path)
+    if checkpoint is not None:
+        logger.info("Resuming reindex", index=checkpoint.index_name,
+                    done=len(checkpoint.done), total=len(checkpoint.chunks))
+    else:
+        index_name = new_index_name(alias) if new_index else alias
+        if new_index or delete:
+            if not new_index:
+                delete_index(index_name)
+            create_index_and_mapping(index_name)
+            if new_index:
+                # Before reading any content: later changes go to both
+                connect().indices.put_alias(
+                    index=index_name, name=building_alias(alias))
+        checkpoint = Checkpoint(
+            checkpoint_path, index_name, plan_chunks(session, chunk_size))
+        checkpoint.save()
+    index_name = checkpoint.index_name
+    es = connect()
+    # No refresh while loading
+    es.indices.put_settings(
+        index=index_name, body={'index': {'refresh_interval': '-1'}})
+    tasks = [(num, chunk, index_name, settings['chunk_size'])
+             for (num, chunk) in checkpoint.pending()]
+    # Do not share connections with the worker processes
+    session.close()
+    if is_zopish():
+        transaction.abort()
+    pool = None
+    if processes is not None and processes > 1:
+        session.bind.dispose()
+        pool = Pool(processes, initializer=init_worker)
+        results = pool.imap_unordered(reindex_chunk, tasks)
+    else:
+        results = (reindex_chunk(task) for task in tasks)
+    start = time()
+    indexed = errors = 0
+    try:
+        for (num, chunk_indexed, chunk_errors) in results:
+            indexed += chunk_indexed
+            errors += chunk_errors
+            metrics.counter("indexing.reindexed").inc(chunk_indexed)
+            if not chunk_errors:
+                checkpoint.done.add(num)
+                checkpoint.save()
+            logger.info("Reindexed chunk", chunk=num, indexed=indexed,
+                        errors=errors, done=len(checkpoint.done),
+                        total=len(checkpoint.chunks),
+                        per_second=int(indexed / max(time() - start, 1)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    es.indices.put_settings(
+        index=index_name, body={'index': {'refresh_interval': '1s'}})
+    es.indices.refresh(index=index_name)
+    if errors:
+        logger.error("Reindex incomplete, run it again to resume",
+                     errors=errors, checkpoint=checkpoint_path)
+        return errors
+    if index_name != alias:
+        switch_alias(alias, index_name)
+    checkpoint.remove()
+    return 0
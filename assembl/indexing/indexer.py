@@ -0,0 +1,258 @@
+"""Asynchronous indexing, through the :py:class:`assembl.models.indexing_queue.IndexingQueueItem` table.
+
+With ``elasticsearch_indexing_queue = true``,
+:py:class:`assembl.indexing.changes.ElasticChanges` writes its actions to the
+queue table in the transaction of the change, instead of sending them to
+elasticsearch after commit. The
+:py:func:`assembl.tasks.indexing.process_indexing_queue` celery task then sends
+them to elasticsearch in bulk, with an :py:class:`IndexingQueueWorker`.
+Failed actions are retried with exponential backoff, and set aside as
+dead letters after ``elasticsearch_queue_max_attempts`` attempts.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import time
+
+import transaction
+from sqlalchemy import and_, or_, select, func
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch.serializer import JSONSerializer
+
+from assembl.lib import config, logging, metrics
+from assembl.lib.sqla import mark_changed
+from .settings import get_index_settings
+from .utils import building_index, connect, get_doc_type_from_uid
+
+logger = logging.getLogger()
+
+_serializer = JSONSerializer()
+
+
+def queue_table():
+    from ..models.indexing_queue import IndexingQueueItem
+    return IndexingQueueItem.__table__
+
+
+def queue_rows(index, unindex):
+    """The rows of the indexing queue for these changes.
+
+    :param index: documents to index, by uid
+    :param unindex: doc_type and _parent of documents to delete, by uid
+    """
+    now = datetime.utcnow()
+    rows = []
+    for uid, data in index.iteritems():
+        data = dict(data)
+        parent = data.pop('_parent', None)
+        rows.append(dict(
+            uid=uid, operation='index',
+            doc_type=get_doc_type_from_uid(uid), parent=parent,
+            source=_serializer.dumps(data), created=now, next_attempt=now,
+            attempts=0, dead_letter=False))
+    for uid, data in unindex.iteritems():
+        rows.append(dict(
+            uid=uid, operation='delete', doc_type=data['doc_type'],
+            parent=data['_parent'], source=None, created=now,
+            next_attempt=now, attempts=0, dead_letter=False))
+    return rows
+
+
+def enqueue(db, index, unindex):
+    "Write these changes to the indexing queue, in the current transaction."
+    rows = queue_rows(index, unindex)
+    if rows:
+        db.execute(queue_table().insert(), rows)
+        metrics.counter("indexing.enqueued").inc(len(rows))
+
+
+def queue_stats(db):
+    """The number of pending and dead actions in the indexing queue,
+    and the age in seconds of the oldest pending action."""
+    table = queue_table()
+    (pending, oldest) = db.execute(select(
+        [func.count(table.c.id), func.min(table.c.created)]).where(
+        table.c.dead_letter == False)).first()  # noqa: E712
+    (dead,) = db.execute(select([func.count(table.c.id)]).where(
+        table.c.dead_letter == True)).first()  # noqa: E712
+    return {
+        "pending": pending,
+        "dead_letter": dead,
+        "lag": (datetime.utcnow() - oldest).total_seconds() if oldest else 0}
+
+
+class IndexingQueueWorker(object):
+    """Sends the actions of the indexing queue to elasticsearch in bulk.
+
+    Only one worker processes the queue at a time, so actions on a document
+    are applied in order."""
+
+    # Key of the postgres advisory lock held while processing a batch
+    lock_key = 0x6573717565756531
+
+    def __init__(self, es, index_name, batch_size=1000, chunk_size=500,
+                 max_attempts=10, retry_delay=10, max_retry_delay=3600):
+        self.es = es
+        self.index_name = index_name
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    def next_attempt(self, attempts, now):
+        "When to retry an action after that many failed attempts"
+        delay = min(self.retry_delay * (2 ** (attempts - 1)),
+                    self.max_retry_delay)
+        return now + timedelta(seconds=delay)
+
+    def action(self, row, index_name=None):
+        action = {'_op_type': row.operation,
+                  '_index': index_name or self.index_name,
+                  '_type': row.doc_type,
+                  '_id': row.uid}
+        if row.operation == 'index':
+            # already serialized
+            action['_source'] = row.source
+        if row.parent is not None:
+            action['_parent'] = row.parent
+        return action
+
+    @staticmethod
+    def succeeded(ok, item):
+        if ok:
+            return True
+        op_type, info = item.items()[0]
+        # Deleting a document which was not indexed, e.g. a hidden idea
+        return op_type == 'delete' and info.get('status', None) == 404
+
+    def send(self, actions):
+        """Send the actions to elasticsearch.
+
+        :returns: a list of (ok, item) for each action"""
+        results = []
+        try:
+            for result in streaming_bulk(
+                    self.es, actions, chunk_size=self.chunk_size,
+                    raise_on_error=False, raise_on_exception=False):
+                results.append(result)
+        except Exception as e:
+            logger.error("Could not send actions to elasticsearch", exc_info=e)
+            error = repr(e)
+        else:
+            error = "no response"
+        for action in actions[len(results):]:
+            results.append((False, {action['_op_type']: {'error': error}}))
+        return results
+
+    def send_to_building_index(self, rows):
+        """Also send the actions to the index being built by a full reindex
+        with a new index, if any, so they are not lost when it replaces
+        the current index. Failures there are only logged."""
+        try:
+            building = building_index(self.index_name, self.es)
+        except Exception as e:
+            logger.error("Could not check for an index being built",
+                         exc_info=e)
+            return
+        if not building:
+            return
+        failed = [item for (ok, item) in self.send(
+                  [self.action(row, building) for row in rows])
+                  if not self.succeeded(ok, item)]
+        if failed:
+            logger.error("Could not index in the index being built",
+                         index=building, failed=len(failed), error=failed[0])
+
+    def process_batch(self, db):
+        """Send a batch of ready actions to elasticsearch, and remove them
+        from the queue, or schedule them for retry.
+
+        :returns: the number of processed actions, or None if another worker
+            holds the queue."""
+        table = queue_table()
+        if not db.execute(select([
+                func.pg_try_advisory_xact_lock(self.lock_key)])).scalar():
+            return None
+        now = datetime.utcnow()
+        rows = db.execute(select([table]).where(and_(
+            table.c.dead_letter == False,  # noqa: E712
+            table.c.next_attempt <= now)).order_by(table.c.id).limit(
+            self.batch_size)).fetchall()
+        if not rows:
+            return 0
+        # Only send the last action on each document
+        latest = OrderedDict()
+        for row in rows:
+            latest.pop(row.uid, None)
+            latest[row.uid] = row
+        latest_rows = latest.values()
+        start = time()
+        results = self.send([self.action(row) for row in latest_rows])
+        metrics.timer("indexing.bulk").record(time() - start)
+        self.send_to_building_index(latest_rows)
+        done = []
+        failed = []
+        for row, (ok, item) in zip(latest_rows, results):
+            if self.succeeded(ok, item):
+                done.append(row)
+                metrics.timer("indexing.lag").record(
+                    (now - row.created).total_seconds())
+            else:
+                failed.append((row, item))
+        # Remove processed actions, and older actions on the same documents
+        superseded = [and_(table.c.uid == row.uid, table.c.id < row.id)
+                      for row in latest_rows]
+        db.execute(table.delete().where(or_(
+            table.c.id.in_([row.id for row in done]), *superseded)))
+        for row, item in failed:
+            attempts = row.attempts + 1
+            dead = attempts >= self.max_attempts
+            db.execute(table.update().where(table.c.id == row.id).values(
+                attempts=attempts, dead_letter=dead,
+                next_attempt=self.next_attempt(attempts, now),
+                last_error=repr(item)[:10000]))
+            if dead:
+                metrics.counter("indexing.dead_letter").inc()
+                logger.error("Giving up indexing", uid=row.uid, error=item)
+        mark_changed(db)
+        metrics.counter("indexing.indexed").inc(len(done))
+        metrics.counter("indexing.failed").inc(len(failed))
+        logger.debug("Processed indexing queue batch", num_rows=len(rows),
+                     indexed=len(done), failed=len(failed))
+        return len(rows)
+
+    def run(self, max_batches=100):
+        """Process batches until the queue has no ready actions.
+
+        :returns: the number of processed actions"""
+        from ..models import IndexingQueueItem
+        total = 0
+        for i in range(max_batches):
+            with transaction.manager:
+                count = self.process_batch(IndexingQueueItem.default_db)
+            if not count:
+                break
+            total += count
+        return total
+
+    @staticmethod
+    def requeue_dead_letters(db):
+        "Give another chance to the actions that were set aside."
+        table = queue_table()
+        db.execute(table.update().where(
+            table.c.dead_letter == True).values(  # noqa: E712
+            dead_letter=False, attempts=0, next_attempt=datetime.utcnow()))
+        mark_changed(db)
+
+
+def get_indexing_queue_worker():
+    """An :py:class:`IndexingQueueWorker`, configured by
+    ``elasticsearch_queue_batch_size``, ``elasticsearch_queue_max_attempts``
+    and ``elasticsearch_queue_retry_delay`` (seconds, doubled at each attempt.)"""
+    settings = get_index_settings(config)
+    return IndexingQueueWorker(
+        connect(), settings['index_name'],
+        batch_size=int(config.get('elasticsearch_queue_batch_size', 1000)),
+        chunk_size=settings['chunk_size'],
+        max_attempts=int(config.get('elasticsearch_queue_max_attempts', 10)),
+        retry_delay=float(config.get('elasticsearch_queue_retry_delay', 10)))
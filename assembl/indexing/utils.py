@@ -50,6 +50,47 @@ def delete_index(index_name):
     return es.indices.delete(index_name, ignore=[400, 404])
 
 
+def building_alias(alias):
+    """The alias of the index being built to replace the one behind this
+    alias, while it exists. Live changes are also written to it."""
+    return alias + '_building'
+
+
+def building_index(alias, es=None):
+    "The building alias of this alias, if an index is being built."
+    es = es or connect()
+    name = building_alias(alias)
+    if es.indices.exists_alias(name=name):
+        return name
+
+
+def switch_alias(alias, index_name, delete_previous=True):
+    """Point the alias to this index, and delete the indices it pointed to.
+    The building alias is removed from the index in the same operation,
+    so no live change is lost.
+
+    If there is an index named like the alias, from before aliases were
+    used, it is deleted first."""
+    es = connect()
+    previous = []
+    actions = []
+    building = building_index(alias, es)
+    if building:
+        actions.append({'remove': {'index': index_name, 'alias': building}})
+    if es.indices.exists_alias(name=alias):
+        previous = [name for name in es.indices.get_alias(name=alias).keys()
+                    if name != index_name]
+        actions.extend({'remove': {'index': name, 'alias': alias}}
+                       for name in previous)
+    elif es.indices.exists(alias):
+        delete_index(alias)
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    if delete_previous:
+        for name in previous:
+            delete_index(name)
+
+
 def populate_from_langstring(ls, data, dataPropName):
     langs = index_languages()
     if ls:
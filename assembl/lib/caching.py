@@ -1,7 +1,12 @@
 from dogpile.cache import make_region
+import redis
+
 from .config import get_config
 
 
+_redis_client = None
+
+
 def create_analytics_region():
     config = get_config()
     visit_analytics_region = make_region().configure(
@@ -13,4 +18,16 @@ def create_analytics_region():
             'db': config.get('redis_socket')
         }
     )
-    return visit_analytics_region
\ No newline at end of file
+    return visit_analytics_region
+
+
+def get_redis_client():
+    """A process-wide redis client, using the same database as celery."""
+    global _redis_client
+    if _redis_client is None:
+        config = get_config()
+        _redis_client = redis.StrictRedis(
+            host=config.get('redis_host'),
+            port=6379,
+            db=config.get('redis_socket'))
+    return _redis_client
@@ -0,0 +1,316 @@
+"""Serialization and publication of changed objects to the changes router.
+
+Changed objects are collected by :py:meth:`assembl.lib.sqla.BaseOps.send_to_changes`
+in ``connection.info['cdict']``. Before commit,
+:py:func:`assembl.lib.sqla.before_commit_listener` hands them to the
+:py:class:`ChangesPublisher`, and after commit
+:py:func:`assembl.lib.sqla.after_commit_listener` asks it to publish them
+through 0MQ to the :py:mod:`assembl.tasks.changes_router`.
+
+The publisher:
+
+1. Serializes objects in bulk, by class and view_def, after prefetching
+   the relationships the view_def uses.
+2. Splits the changes of a discussion in messages of bounded size.
+3. Optionally (``changes_coalesce_window``, in seconds) holds changes for
+   a short time, so that successive updates to the same object are only sent
+   once, with the latest value.
+4. Optionally (``changes_background_serialization``) only records which
+   objects changed before commit, and serializes them in a background thread
+   after commit, with its own session.
+"""
+import atexit
+import threading
+from Queue import Queue, Empty
+from collections import defaultdict, OrderedDict
+from time import time
+
+from anyjson import dumps
+from pyramid.settings import asbool
+from sqlalchemy import inspect
+from sqlalchemy.orm import selectinload
+
+from ..view_def import get_view_def, view_defs_cached
+from .zmqlib import get_pub_socket, send_changes
+from . import config, logging, metrics
+
+
+log = logging.getLogger()
+
+# relationships used by a view_def, by (class, view_def_name)
+_prefetch_relationships = {}
+
+
+def view_def_relationships(cls, view_def_name):
+    """The names of the relationships of this class that the view_def
+    will traverse, and should be prefetched."""
+    key = (cls, view_def_name)
+    if key not in _prefetch_relationships or not view_defs_cached():
+        relns = set()
+        view_def = get_view_def(view_def_name or 'default')
+        local_view = cls.expand_view_def(view_def) if view_def else None
+        if local_view:
+            mapper_relns = {r.key: r for r in cls.__mapper__.relationships}
+            for name, spec in local_view.iteritems():
+                if name == "_default" or spec is False:
+                    continue
+                if isinstance(spec, list):
+                    spec = spec[0] if spec else True
+                elif isinstance(spec, dict):
+                    spec = spec.get("@id", True)
+                if spec is True:
+                    prop_name = name
+                elif not isinstance(spec, basestring) or spec[:1] == "'":
+                    continue
+                else:
+                    prop_name = spec.split(':', 1)[0] or name
+                reln = mapper_relns.get(prop_name, None)
+                # Many-to-one relations are often serialized as a foreign key
+                if reln is not None and (
+                        reln.uselist or ':' in (spec if spec is not True else '')):
+                    relns.add(prop_name)
+        _prefetch_relationships[key] = frozenset(relns)
+    return _prefetch_relationships[key]
+
+
+def prefetch(db, cls, objects, view_def_name):
+    """Load the relationships used by the view_def on these objects,
+    with one query per relationship rather than one per object."""
+    relns = view_def_relationships(cls, view_def_name)
+    pk = cls.__mapper__.primary_key
+    if not relns or len(pk) != 1 or len(objects) < 2:
+        return objects
+    ids = [inspect(ob).identity[0] for ob in objects
+           if inspect(ob).identity]
+    if not ids:
+        return objects
+    db.query(cls).filter(pk[0].in_(ids)).options(
+        *[selectinload(getattr(cls, reln)) for reln in relns]).all()
+    return objects
+
+
+def load_objects(db, cls, ids, view_def_name):
+    "Load objects by id, with the relationships used by the view_def."
+    pk = cls.__mapper__.primary_key
+    relns = view_def_relationships(cls, view_def_name)
+    return db.query(cls).filter(pk[0].in_(ids)).options(
+        *[selectinload(getattr(cls, reln)) for reln in relns]).all()
+
+
+def serialize_changes(db, entries):
+    """Serialize changed objects in bulk.
+
+    :param entries: list of (uri, discussion, view_def, target), where
+        target is an object or a tombstone, and uri identifies it.
+    :returns: an OrderedDict of (uri, view_def) -> (discussion, json)"""
+    start = time()
+    by_class = defaultdict(list)
+    for (uri, discussion, view_def, target) in entries:
+        by_class[(target.__class__, view_def)].append(
+            (uri, discussion, target))
+    results = OrderedDict()
+    count = 0
+    for (cls, view_def), targets in by_class.iteritems():
+        if getattr(cls, '__mapper__', None) is not None:
+            prefetch(db, cls, [t for (u, d, t) in targets], view_def)
+        for uri, discussion, target in targets:
+            json = target.generic_json(view_def)
+            count += 1
+            if json:
+                results[(uri, view_def)] = (discussion, json)
+    record_serialization(count, time() - start)
+    return results
+
+
+def record_serialization(count, duration):
+    metrics.counter("changes.serialized_objects").inc(count)
+    metrics.timer("changes.serialization").record(duration)
+    if count:
+        log.debug("Serialized changes", num_objects=count, seconds=duration)
+
+
+def chunk_changes(changes, max_count, max_size):
+    """Split a list of serialized json changes in lists of at most max_count
+    changes, whose serialization as a json list is at most max_size bytes
+    (unless a single change is larger.)"""
+    chunk = []
+    size = 2
+    for change in changes:
+        change_size = len(change) + 1
+        if chunk and (len(chunk) >= max_count or
+                      size + change_size > max_size):
+            yield chunk
+            chunk = []
+            size = 2
+        chunk.append(change)
+        size += change_size
+    if chunk:
+        yield chunk
+
+
+class ChangesPublisher(object):
+    """Serializes changed objects and sends them to the changes router."""
+
+    def __init__(self, max_batch=500, max_message_size=1000000,
+                 coalesce_window=0, background=False):
+        self.max_batch = max_batch
+        self.max_message_size = max_message_size
+        self.coalesce_window = coalesce_window
+        self.background = background
+        self._queue = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def threaded(self):
+        return self.background or self.coalesce_window > 0
+
+    def collect(self, db, cdict):
+        """Called before commit with the content of ``connection.info['cdict']``.
+
+        Returns what should be given to :py:meth:`publish` after commit:
+        either serialized changes, or references to the changed objects."""
+        entries = []
+        refs = []
+        for ((uri, view_def), (discussion, target)) in cdict.iteritems():
+            if uri is None:
+                # in tests, the object was created and then deleted
+                continue
+            discussion = bytes(discussion or "*")
+            if self.background and getattr(
+                    target, '__mapper__', None) is not None:
+                identity = inspect(target).identity
+                if identity and len(identity) == 1:
+                    refs.append((uri, discussion, view_def,
+                                 target.__class__, identity[0]))
+                    continue
+            entries.append((uri, discussion, view_def, target))
+        return (serialize_changes(db, entries), refs)
+
+    def publish(self, socket, collected):
+        """Called after commit, with the result of :py:meth:`collect`."""
+        changes, refs = collected
+        if self.threaded:
+            self._ensure_thread()
+            self._queue.put((changes, refs))
+        else:
+            self.send(socket, self.by_discussion(changes))
+
+    def by_discussion(self, changes):
+        by_discussion = defaultdict(list)
+        for (discussion, json) in changes.itervalues():
+            by_discussion[discussion].append(json)
+        return by_discussion
+
+    def send(self, socket, by_discussion):
+        for discussion, changes in by_discussion.iteritems():
+            # serialized once, to measure and to send
+            for chunk in chunk_changes(
+                    [dumps(change) for change in changes],
+                    self.max_batch, self.max_message_size):
+                send_changes(socket, discussion, "[%s]" % ",".join(chunk))
+                metrics.counter("changes.messages").inc()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._queue = Queue()
+                self._thread = threading.Thread(
+                    target=self._run, name="changes_publisher")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _serialize_refs(self, refs):
+        "Load and serialize the changed objects, in this thread's session."
+        from .sqla import get_session_maker, is_zopish
+        import transaction
+        by_class = defaultdict(list)
+        for (uri, discussion, view_def, cls, id) in refs:
+            by_class[(cls, view_def)].append((uri, discussion, id))
+        results = OrderedDict()
+        start = time()
+        count = 0
+        db = get_session_maker()()
+        try:
+            for (cls, view_def), targets in by_class.iteritems():
+                by_id = dict((id, (u, d)) for (u, d, id) in targets)
+                for ob in load_objects(db, cls, by_id.keys(), view_def):
+                    json = ob.generic_json(view_def)
+                    count += 1
+                    if json:
+                        uri, discussion = by_id[inspect(ob).identity[0]]
+                        results[(uri, view_def)] = (discussion, json)
+        finally:
+            if is_zopish():
+                transaction.abort()
+            else:
+                db.rollback()
+        record_serialization(count, time() - start)
+        return results
+
+    def _run(self):
+        socket = get_pub_socket()
+        pending = OrderedDict()
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(
+                0, deadline - time())
+            try:
+                changes, refs = self._queue.get(timeout=timeout)
+            except Empty:
+                changes = refs = None
+            if changes is not None:
+                try:
+                    if refs:
+                        changes.update(self._serialize_refs(refs))
+                except Exception as e:
+                    log.error("Could not serialize changes", exc_info=e)
+                for key, value in changes.iteritems():
+                    if key in pending:
+                        # superseded by a later update
+                        del pending[key]
+                        metrics.counter("changes.coalesced").inc()
+                    pending[key] = value
+                if deadline is None:
+                    deadline = time() + self.coalesce_window
+            if pending and (deadline is None or time() >= deadline):
+                try:
+                    self.send(socket, self.by_discussion(pending))
+                except Exception as e:
+                    log.error("Could not send changes", exc_info=e)
+                pending = OrderedDict()
+                deadline = None
+
+    def flush(self, timeout=5):
+        "Wait until the background thread has consumed its queue."
+        if self._queue is not None:
+            end = time() + timeout
+            while not self._queue.empty() and time() < end:
+                threading.Event().wait(0.01)
+
+
+_publisher = None
+
+
+def get_changes_publisher():
+    """The process-wide :py:class:`ChangesPublisher`, configured by
+    ``changes_max_batch``, ``changes_max_message_size``,
+    ``changes_coalesce_window`` and ``changes_background_serialization``."""
+    global _publisher
+    if _publisher is None:
+        _publisher = ChangesPublisher(
+            max_batch=int(config.get('changes_max_batch', 500)),
+            max_message_size=int(config.get(
+                'changes_max_message_size', 1000000)),
+            coalesce_window=float(config.get('changes_coalesce_window', 0)),
+            background=asbool(config.get(
+                'changes_background_serialization', False)))
+    return _publisher
+
+
+@atexit.register
+def flush_changes():
+    if _publisher is not None:
+        _publisher.flush()
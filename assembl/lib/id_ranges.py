@@ -0,0 +1,92 @@
+"""Compact sets of integer ids, stored as sorted ranges.
+
+Used by :py:class:`assembl.models.read_status.PostReadSet` for the posts
+read by a user: posts are read by threads and by ideas, so the ids of the
+posts a user read form few ranges, even in a large discussion.
+"""
+from bisect import bisect_right
+from itertools import izip
+
+
+class IdRangeSet(object):
+    """A set of integer ids, as the sorted list of the bounds of its
+    ranges: ``[start, end, start, end...]``, ends excluded.
+
+    An id is in the set if an odd number of bounds are lower or equal to
+    it; postgres' ``width_bucket`` can test that on the same list (see
+    :py:meth:`assembl.models.read_status.PostReadSet.read_clause`)."""
+
+    def __init__(self, bounds=()):
+        self.bounds = list(bounds)
+
+    @classmethod
+    def from_ids(cls, ids):
+        return cls(cls.bounds_of(ids))
+
+    @staticmethod
+    def bounds_of(ids):
+        bounds = []
+        for id in sorted(set(ids)):
+            if bounds and bounds[-1] == id:
+                bounds[-1] = id + 1
+            else:
+                bounds.extend((id, id + 1))
+        return bounds
+
+    @staticmethod
+    def combine(bounds_a, bounds_b, operation):
+        """The bounds of the ids where operation(in a, in b) is true"""
+        result = []
+        for bound in sorted(set(bounds_a).union(bounds_b)):
+            inside = operation(bisect_right(bounds_a, bound) % 2 == 1,
+                               bisect_right(bounds_b, bound) % 2 == 1)
+            if inside != (len(result) % 2 == 1):
+                result.append(bound)
+        return result
+
+    def ranges(self):
+        """The (start, end) pairs, end excluded"""
+        return zip(self.bounds[::2], self.bounds[1::2])
+
+    def update(self, ids):
+        """Add the ids.
+
+        :returns: the ids that were not in the set, sorted"""
+        added = sorted({id for id in ids if id not in self})
+        if added:
+            self.bounds = self.combine(
+                self.bounds, self.bounds_of(added), lambda a, b: a or b)
+        return added
+
+    def difference_update(self, ids):
+        """Remove the ids.
+
+        :returns: the ids that were in the set, sorted"""
+        removed = sorted({id for id in ids if id in self})
+        if removed:
+            self.bounds = self.combine(
+                self.bounds, self.bounds_of(removed),
+                lambda a, b: a and not b)
+        return removed
+
+    def __contains__(self, id):
+        return bisect_right(self.bounds, id) % 2 == 1
+
+    def __len__(self):
+        return sum(end - start for (start, end) in self.ranges())
+
+    def __iter__(self):
+        for start, end in izip(self.bounds[::2], self.bounds[1::2]):
+            for id in xrange(start, end):
+                yield id
+
+    def __eq__(self, other):
+        return isinstance(other, IdRangeSet) and self.bounds == other.bounds
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<IdRangeSet %s>" % " ".join(
+            "%d" % start if end == start + 1 else "%d-%d" % (start, end - 1)
+            for (start, end) in self.ranges())
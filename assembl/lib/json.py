@@ -2,7 +2,10 @@
 
 from __future__ import absolute_import
 
+import tempfile
 from datetime import date, datetime
+
+from pyramid.response import FileIter
 from simplejson import dumps, JSONEncoder
 
 
@@ -18,8 +21,32 @@ class DateJSONEncoder(JSONEncoder):
             return super(DateJSONEncoder, self).default(obj)
 
 
+class JSONArrayStream(object):
+    """Rows that the json renderer writes as a JSON array one at a time,
+    e.g. as they come from a server-side cursor, instead of a list
+    built beforehand."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def write_json_array(rows, output):
+    """Write the rows to the file as a JSON array."""
+    output.write('[')
+    separator = ''
+    for row in rows:
+        output.write(separator)
+        output.write(dumps(row, cls=DateJSONEncoder))
+        separator = ', '
+    output.write(']')
+
+
 def json_renderer_factory(info):
-    """ Same factory from pyramid.renderers, but with a custom encoder. """
+    """ Same factory from pyramid.renderers, but with a custom encoder.
+    A :py:class:`JSONArrayStream` is rendered without building the list. """
     def _render(value, system):
         request = system.get('request')
         if request is not None:
@@ -27,5 +54,17 @@ def json_renderer_factory(info):
             ct = response.content_type
             if ct == response.default_content_type:
                 response.content_type = 'application/json'
+            if isinstance(value, JSONArrayStream):
+                # The transaction is over when the body is sent, so the
+                # rows are written to a temporary file while the cursor
+                # is open, and the response sends the file.
+                output = tempfile.TemporaryFile()
+                write_json_array(value, output)
+                response.content_length = output.tell()
+                output.seek(0)
+                response.app_iter = FileIter(output)
+                return None
+        if isinstance(value, JSONArrayStream):
+            value = list(value)
         return dumps(value, cls=DateJSONEncoder)
     return _render
@@ -0,0 +1,356 @@
+"""Concurrent delivery of many emails through a pool of SMTP connections.
+
+Used by :py:func:`assembl.tasks.notify.process_pending_notifications`.
+Mails are grouped by recipient domain, and the minimum delays between
+emails to a domain (``SMTP_DOMAIN_DELAYS``) are enforced with token
+buckets shared by all workers (in redis, with
+``celery_tasks.notify.smtp_buckets = redis``)
+instead of sleeping in the worker: the :py:class:`DomainDispatcher` sends
+to other domains while one waits.
+"""
+import smtplib
+import threading
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from Queue import Queue, Empty
+from time import time
+
+from . import config, metrics
+from .logging import getLogger
+
+
+# A mail to send; the key identifies it in the results
+OutgoingMail = namedtuple('OutgoingMail', ['key', 'message', 'recipient'])
+
+
+def domain_rule(email, delays):
+    """The most specific rule of the domain delays that applies to the
+    email address, as (rule, timedelta); None if there is none"""
+    domain = email.split("@")[-1].lower().split('.')
+    for i in range(len(domain) + 1):
+        dom = '.'.join(domain[i:])
+        if dom in delays:
+            return dom, delays[dom]
+
+
+class MemoryTokenBuckets(object):
+    """Token buckets for a single process"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, name, interval, capacity=1, reserve=False):
+        """Take a token from the bucket, which gets one every interval
+        seconds. Returns the seconds to wait for a token; if reserve, the
+        token is taken anyway, and the caller has to wait that long."""
+        now = time()
+        with self._lock:
+            tokens, last = self._buckets.get(name, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) / interval)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) * interval
+                if reserve:
+                    tokens -= 1
+            self._buckets[name] = (tokens, now)
+        return wait
+
+
+class RedisTokenBuckets(object):
+    """Token buckets shared by all the processes using the redis server"""
+
+    script = """
+local capacity = tonumber(ARGV[2])
+local interval = tonumber(ARGV[1])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(state[1]) or capacity
+local last = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) / interval)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) * interval
+    if ARGV[4] == '1' then
+        tokens = tokens - 1
+    end
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(interval * (capacity + 1)) + 60)
+return tostring(wait)
+"""
+
+    def __init__(self, redis, prefix="smtp_bucket:"):
+        self.redis = redis
+        self.prefix = prefix
+        self._script = redis.register_script(self.script)
+
+    def acquire(self, name, interval, capacity=1, reserve=False):
+        return float(self._script(
+            keys=[self.prefix + name],
+            args=[interval, capacity, repr(time()), '1' if reserve else '0']))
+
+
+_token_buckets = None
+
+
+def get_token_buckets():
+    """The :py:class:`MemoryTokenBuckets` of the process, or shared
+    :py:class:`RedisTokenBuckets`, according to
+    ``celery_tasks.notify.smtp_buckets``"""
+    global _token_buckets
+    if _token_buckets is None:
+        if config.get(
+                'celery_tasks.notify.smtp_buckets', None) == 'redis':
+            from .caching import get_redis_client
+            _token_buckets = RedisTokenBuckets(get_redis_client())
+        else:
+            _token_buckets = MemoryTokenBuckets()
+    return _token_buckets
+
+
+class SMTPConnectionPool(object):
+    """Keeps up to ``size`` SMTP connections open between mails.
+    A connection is closed after ``max_messages`` mails, or on error.
+
+    As repoze.sendmail's SMTPMailer, connections use STARTTLS whenever
+    the server offers it, unless ``no_tls``; with ``force_tls``, a server
+    that does not offer it is an error."""
+
+    def __init__(self, hostname='localhost', port=25, username=None,
+                 password=None, force_tls=False, no_tls=False, ssl=False,
+                 size=4, max_messages=100, timeout=30):
+        self.hostname = hostname
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.force_tls = force_tls
+        self.no_tls = no_tls
+        self.ssl = ssl
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self._idle = Queue(size)
+
+    @classmethod
+    def from_mailer(cls, mailer, **kwargs):
+        """A pool with the SMTP settings of a pyramid_mailer Mailer"""
+        smtp = mailer.smtp_mailer
+        return cls(
+            smtp.hostname, smtp.port, getattr(smtp, 'username', None),
+            getattr(smtp, 'password', None),
+            force_tls=getattr(smtp, 'force_tls', False),
+            no_tls=getattr(smtp, 'no_tls', False),
+            ssl=isinstance(getattr(smtp, 'smtp', None), type) and
+            issubclass(smtp.smtp, smtplib.SMTP_SSL), **kwargs)
+
+    def connect(self):
+        if self.ssl:
+            connection = smtplib.SMTP_SSL(
+                self.hostname, self.port, timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(
+                self.hostname, self.port, timeout=self.timeout)
+        connection.ehlo()
+        if connection.has_extn('starttls'):
+            if not self.no_tls:
+                connection.starttls()
+                connection.ehlo()
+        elif self.force_tls:
+            connection.close()
+            raise RuntimeError('TLS required but not supported')
+        if self.username and self.password:
+            connection.login(self.username, self.password)
+        metrics.counter("smtp.connections").inc()
+        # (connection, number of mails sent)
+        return [connection, 0]
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection[0].quit()
+        except Exception:
+            connection[0].close()
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self._idle.get_nowait()
+        except Empty:
+            connection = self.connect()
+        try:
+            yield connection[0]
+        except Exception:
+            self.close(connection)
+            raise
+        connection[1] += 1
+        if connection[1] >= self.max_messages or self._idle.full():
+            self.close(connection)
+        else:
+            self._idle.put_nowait(connection)
+
+    def send(self, sender, recipients, message):
+        with self.connection() as connection:
+            connection.sendmail(sender, recipients, message)
+
+    def close_all(self):
+        while True:
+            try:
+                self.close(self._idle.get_nowait())
+            except Empty:
+                return
+
+
+class SMTPPoolTransport(object):
+    """Sends pyramid_mailer messages through a :py:class:`SMTPConnectionPool`"""
+
+    def __init__(self, pool, default_sender=None):
+        self.pool = pool
+        self.default_sender = default_sender
+
+    def send(self, message):
+        self.pool.send(
+            message.sender or self.default_sender, list(message.send_to),
+            message.to_message().as_string())
+
+    def close(self):
+        self.pool.close_all()
+
+
+class MailerTransport(object):
+    """Sends through a pyramid_mailer mailer, e.g. a DummyMailer in tests"""
+
+    def __init__(self, mailer):
+        self.mailer = mailer
+
+    def send(self, message):
+        self.mailer.send_immediately(message, fail_silently=False)
+
+    def close(self):
+        pass
+
+
+def transport_for_mailer(mailer, size=4):
+    if getattr(mailer, 'smtp_mailer', None) is None:
+        return MailerTransport(mailer)
+    return SMTPPoolTransport(
+        SMTPConnectionPool.from_mailer(mailer, size=size),
+        getattr(mailer, 'default_sender', None))
+
+
+class DomainDispatcher(object):
+    """Sends mails with ``concurrency`` threads, one mail at a time per
+    domain rule, taking a token from the bucket of the rule before each."""
+
+    def __init__(self, transport, delays, buckets=None, concurrency=4):
+        self.transport = transport
+        self.delays = delays
+        self.buckets = buckets or get_token_buckets()
+        self.concurrency = max(1, concurrency)
+
+    def _worker(self, jobs, results):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            rule, mail = job
+            try:
+                with metrics.timer("notifications.send").time():
+                    self.transport.send(mail.message)
+                results.put((rule, mail, None))
+            except Exception as e:
+                results.put((rule, mail, e))
+
+    def send(self, mails):
+        """Send the :py:data:`OutgoingMail` mails.
+
+        :returns: a dictionary of mail key -> exception or None if sent"""
+        queues = {}
+        for mail in mails:
+            rule = domain_rule(mail.recipient, self.delays)
+            if rule is not None and rule[1].total_seconds() <= 0:
+                rule = None
+            queues.setdefault(rule, deque()).append(mail)
+        if not queues:
+            return {}
+        jobs = Queue()
+        results = Queue()
+        threads = [threading.Thread(target=self._worker, args=(jobs, results))
+                   for _ in range(min(self.concurrency, len(mails)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        outcome = {}
+        # Undelayed mails can be sent in parallel
+        unlimited = queues.pop(None, ())
+        for mail in unlimited:
+            jobs.put((None, mail))
+        in_flight = len(unlimited)
+        busy = set()
+        ready_at = {}
+        try:
+            while queues or in_flight:
+                now = time()
+                for rule in list(queues):
+                    if rule in busy or ready_at.get(rule, 0) > now:
+                        continue
+                    wait = self.buckets.acquire(
+                        rule[0], rule[1].total_seconds())
+                    if wait > 0:
+                        ready_at[rule] = now + wait
+                        metrics.counter("notifications.throttled").inc()
+                        continue
+                    mail = queues[rule].popleft()
+                    if not queues[rule]:
+                        del queues[rule]
+                    busy.add(rule)
+                    jobs.put((rule, mail))
+                    in_flight += 1
+                # Wait for a result, or until a domain gets a token
+                timeout = None
+                if queues:
+                    waits = [ready_at[rule] - now for rule in queues
+                             if rule not in busy and rule in ready_at]
+                    timeout = max(0.01, min(waits)) if waits else None
+                if not in_flight and timeout is None:
+                    continue
+                try:
+                    rule, mail, error = results.get(
+                        timeout=timeout if timeout is not None else 60)
+                except Empty:
+                    continue
+                in_flight -= 1
+                busy.discard(rule)
+                outcome[mail.key] = error
+                metrics.counter(
+                    "notifications.failed" if error else "notifications.sent"
+                ).inc()
+        finally:
+            for thread in threads:
+                jobs.put(None)
+        return outcome
+
+
+def deliver(mails, mailer, delays, concurrency=None):
+    """Send mails with a new transport for the mailer, and log the
+    throughput. Returns a dictionary of mail key -> exception or None."""
+    if concurrency is None:
+        concurrency = int(config.get(
+            'celery_tasks.notify.smtp_concurrency', 4))
+    transport = transport_for_mailer(mailer, concurrency)
+    start = time()
+    try:
+        outcome = DomainDispatcher(
+            transport, delays, concurrency=concurrency).send(mails)
+    finally:
+        transport.close()
+    elapsed = time() - start
+    if outcome:
+        getLogger().info(
+            "Delivered mails", count=len(outcome),
+            failed=len([e for e in outcome.itervalues() if e is not None]),
+            seconds=elapsed, per_second=len(outcome) / max(elapsed, 1e-3))
+    return outcome
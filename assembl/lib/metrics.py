@@ -0,0 +1,86 @@
+"""Simple in-process metrics.
+
+Counters and timers are kept in a process-wide registry, and can be
+read with :py:func:`snapshot`, e.g. from a pshell or a debug view.
+"""
+import threading
+from time import time
+from contextlib import contextmanager
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Counter(object):
+    "A monotonic counter"
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def as_dict(self):
+        return {"value": self.value}
+
+
+class Timer(object):
+    "Accumulates durations, in seconds"
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, duration):
+        with self._lock:
+            self.count += 1
+            self.total += duration
+            self.max = max(self.max, duration)
+
+    @contextmanager
+    def time(self):
+        start = time()
+        try:
+            yield
+        finally:
+            self.record(time() - start)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "mean": (self.total / self.count) if self.count else 0.0}
+
+
+def _get_metric(cls, name):
+    metric = _registry.get(name, None)
+    if metric is None:
+        with _registry_lock:
+            metric = _registry.get(name, None)
+            if metric is None:
+                metric = _registry[name] = cls(name)
+    assert isinstance(metric, cls), "%s is not a %s" % (name, cls.__name__)
+    return metric
+
+
+def counter(name):
+    "Get or create the named :py:class:`Counter`"
+    return _get_metric(Counter, name)
+
+
+def timer(name):
+    "Get or create the named :py:class:`Timer`"
+    return _get_metric(Timer, name)
+
+
+def snapshot():
+    "The current value of all metrics, as a dictionary"
+    return {name: metric.as_dict() for (name, metric) in _registry.items()}
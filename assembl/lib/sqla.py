@@ -20,7 +20,8 @@ from anyjson import dumps, loads
 from colanderalchemy import SQLAlchemySchemaNode
 from sqlalchemy import (
     DateTime, MetaData, engine_from_config, event, Column, Integer,
-    inspect)
+    inspect, select, func, cast, literal)
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import NoInspectionAvailable, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import AssociationProxy
@@ -39,7 +40,8 @@ from graphene.relay import Node
 
 from .parsedatetime import parse_datetime
 from ..view_def import get_view_def
-from .zmqlib import get_pub_socket, send_changes
+from .zmqlib import get_pub_socket
+from .changes import get_changes_publisher
 from ..auth import *
 from .decl_enums import EnumSymbol, DeclEnumType
 from .utils import get_global_base_url
@@ -211,6 +213,306 @@ class TableLockCreationThread(Thread):
             self.exception = e
 
 
+def translate_to_json(v, view_name, user_id, permissions, base_uri):
+    """Translate a value for :py:meth:`BaseOps.generic_json`.
+    Objects are given as a URI, or as JSON with the view_def if any."""
+    if isinstance(v, Base):
+        p = getattr(v, 'user_can', None)
+        if p and not v.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            return None
+        if view_name:
+            return v.generic_json(
+                view_name, user_id, permissions, base_uri)
+        else:
+            return v.uri(base_uri)
+    elif isinstance(v, (
+            str, unicode, int, long, float, bool, types.NoneType)):
+        return v
+    elif isinstance(v, EnumSymbol):
+        return v.name
+    elif isinstance(v, datetime):
+        return v.isoformat() + "Z"
+    elif isinstance(v, dict):
+        v = {translate_to_json(k, view_name, user_id, permissions, base_uri):
+             translate_to_json(val, view_name, user_id, permissions, base_uri)
+             for k, val in v.items()}
+        return {k: val for (k, val) in v.items()
+                if val is not None}
+    elif isinstance(v, Iterable):
+        v = [translate_to_json(i, view_name, user_id, permissions, base_uri)
+             for i in v]
+        return [x for x in v if x is not None]
+    else:
+        raise NotImplementedError("Cannot translate", v)
+
+
+# (class, view_def name) -> (view_def, ViewDefPlan)
+_view_def_plans = {}
+
+
+class ViewDefPlan(object):
+    """How to represent the instances of a class as JSON according to
+    a view_def, compiled once by :py:meth:`BaseOps.view_def_plan`.
+
+    The view_def specification is interpreted, and the mapper and class
+    inspected, when the plan is made; serializing an instance then only
+    runs one accessor per field of the view, and reads the default columns.
+    """
+
+    def __init__(self, cls, view_def_name, view_def, local_view):
+        self.view_def_name = view_def_name
+        my_typename = cls.external_typename()
+        mapper = cls.__mapper__
+        self.relns = {r.key: r for r in mapper.relationships}
+        self.cols = {c.key: c for c in mapper.columns}
+        self.fkeys = {c for c in mapper.columns if c.foreign_keys}
+        reln_of_fkeys = {
+            frozenset(r._calculated_foreign_keys): r
+            for r in mapper.relationships
+        }
+        self.fkey_of_reln = {r.key: r._calculated_foreign_keys
+                             for r in mapper.relationships}
+        self.methods = dict(pyinspect.getmembers(
+            cls, lambda m: pyinspect.ismethod(m)
+            and m.func_code.co_argcount == 1))
+        self.properties = dict(pyinspect.getmembers(
+            cls, lambda p: pyinspect.isdatadescriptor(p)))
+        self.known = set()
+        # functions of (instance, result, user_id, permissions, base_uri)
+        self.steps = []
+        for name, spec in local_view.iteritems():
+            if name == "_default":
+                continue
+            step = self.compile_field(name, spec, my_typename)
+            if step is not None:
+                self.steps.append(step)
+        # (name, column key, class of the relation or None)
+        self.default_columns = []
+        if local_view.get('_default') is not False:
+            for name, col in self.cols.items():
+                if name in self.known:
+                    continue  # already done
+                as_rel = reln_of_fkeys.get(frozenset((col, )))
+                if as_rel:
+                    if as_rel.key not in self.known:
+                        self.default_columns.append(
+                            (as_rel.key, col.key, as_rel.mapper.class_))
+                else:
+                    self.default_columns.append((name, name, None))
+
+    def compile_field(self, name, spec, my_typename):
+        view_def_name = self.view_def_name
+        if spec is False:
+            self.known.add(name)
+            return None
+        elif type(spec) is list:
+            if not spec:
+                spec = [True]
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(list) > 1" % (
+                    view_def_name, my_typename, name)
+            subspec = spec[0]
+        elif type(spec) is dict:
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(dict) > 1" % (
+                    view_def_name, my_typename, name)
+            assert "@id" in spec,\
+                "in viewdef %s, class %s, name %s, key should be '@id'" % (
+                    view_def_name, my_typename, name)
+            subspec = spec["@id"]
+        else:
+            subspec = spec
+        if subspec is True:
+            prop_name = name
+            view_name = None
+        else:
+            assert isinstance(subspec, types.StringTypes),\
+                "in viewdef %s, class %s, name %s, spec not a string" % (
+                    view_def_name, my_typename, name)
+            if subspec[0] == "'":
+                # literals.
+                literal = subspec[1:]
+
+                def literal_step(ob, result, user_id, permissions, base_uri):
+                    result[name] = loads(literal)
+                return literal_step
+            if ':' in subspec:
+                prop_name, view_name = subspec.split(':', 1)
+                if not view_name:
+                    view_name = view_def_name
+                if not prop_name:
+                    prop_name = name
+            else:
+                prop_name = subspec
+                view_name = None
+        if view_name:
+            assert get_view_def(view_name),\
+                "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
+                    view_def_name, my_typename, name, view_name)
+
+        def value_step(ob, result, user_id, permissions, base_uri):
+            val = getattr(ob, prop_name)
+            if val is not None:
+                val = translate_to_json(
+                    val, view_name, user_id, permissions, base_uri)
+            if val is not None:
+                result[name] = val
+
+        if prop_name == 'self':
+            def self_step(ob, result, user_id, permissions, base_uri):
+                if view_name:
+                    r = ob.generic_json(
+                        view_name, user_id, permissions, base_uri)
+                    if r is not None:
+                        result[name] = r
+                else:
+                    result[name] = ob.uri()
+            return self_step
+        elif prop_name == '@view':
+            def view_step(ob, result, user_id, permissions, base_uri):
+                result[name] = view_def_name
+            return view_step
+        elif prop_name[0] == '&':
+            prop_name = prop_name[1:]
+            assert prop_name in self.methods,\
+                "in viewdef %s, class %s, name %s, unknown method %s" % (
+                    view_def_name, my_typename, name, prop_name)
+
+            def method_step(ob, result, user_id, permissions, base_uri):
+                # Function call. PLEASE RETURN JSON, Base objects,
+                # or list or dicts thereof
+                val = getattr(ob, prop_name)()
+                result[name] = translate_to_json(
+                    val, view_name, user_id, permissions, base_uri)
+            return method_step
+        elif prop_name in self.cols:
+            assert not view_name,\
+                "in viewdef %s, class %s, viewdef for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, list),\
+                "in viewdef %s, class %s, list for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, dict),\
+                "in viewdef %s, class %s, dict for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            self.known.add(prop_name)
+            return value_step
+        elif prop_name in self.properties:
+            self.known.add(prop_name)
+            if view_name or (prop_name not in self.fkey_of_reln) or (
+                    self.relns[prop_name].direction != MANYTOONE):
+                return value_step
+            fkeys = list(self.fkey_of_reln[prop_name])
+            assert(len(fkeys) == 1)
+            fkey_name = fkeys[0].key
+            target_cls = self.relns[prop_name].mapper.class_
+
+            def fkey_step(ob, result, user_id, permissions, base_uri):
+                result[name] = target_cls.uri_generic(getattr(ob, fkey_name))
+            return fkey_step
+        assert prop_name in self.relns,\
+            "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
+                view_def_name, my_typename, prop_name)
+        self.known.add(prop_name)
+        # Add derived prop?
+        reln = self.relns[prop_name]
+        if reln.uselist:
+            if not view_name:
+                assert not isinstance(spec, dict),\
+                    "in viewdef %s, class %s, dict without viewname for %s" % (
+                        view_def_name, my_typename, name)
+
+            def list_step(ob, result, user_id, permissions, base_uri):
+                vals = getattr(ob, prop_name)
+                if view_name:
+                    if isinstance(spec, dict):
+                        result[name] = {
+                            v.uri(base_uri):
+                            v.generic_json(
+                                view_name, user_id, permissions, base_uri)
+                            for v in vals
+                            if v.user_can(
+                                user_id, CrudPermissions.READ, permissions)}
+                    else:
+                        result[name] = [
+                            v.generic_json(
+                                view_name, user_id, permissions, base_uri)
+                            for v in vals
+                            if v.user_can(
+                                user_id, CrudPermissions.READ, permissions)]
+                else:
+                    result[name] = [
+                        v.uri(base_uri) for v in vals
+                        if v.user_can(
+                            user_id, CrudPermissions.READ, permissions)]
+            return list_step
+        assert not isinstance(spec, dict),\
+            "in viewdef %s, class %s, dict for non-list relation %s" % (
+                view_def_name, my_typename, prop_name)
+        is_list = isinstance(spec, list)
+        if view_name:
+            def relation_step(ob, result, user_id, permissions, base_uri):
+                target = getattr(ob, prop_name)
+                if target and target.user_can(
+                        user_id, CrudPermissions.READ, permissions):
+                    val = target.generic_json(
+                        view_name, user_id, permissions, base_uri)
+                    if val is not None:
+                        if is_list:
+                            result[name] = [val]
+                        else:
+                            result[name] = val
+                else:
+                    result[name] = [] if is_list else None
+            return relation_step
+        if len(reln._calculated_foreign_keys) == 1 \
+                and reln._calculated_foreign_keys < self.fkeys:
+            # shortcut, avoid fetch
+            fkey_name = list(reln._calculated_foreign_keys)[0].name
+            target_cls = reln.mapper.class_
+
+            def uri_of(ob, base_uri):
+                ob_id = getattr(ob, fkey_name)
+                if ob_id:
+                    return target_cls.uri_generic(ob_id, base_uri)
+        else:
+            def uri_of(ob, base_uri):
+                target = getattr(ob, prop_name)
+                if target:
+                    return target.uri(base_uri)
+
+        def uri_step(ob, result, user_id, permissions, base_uri):
+            uri = uri_of(ob, base_uri)
+            if uri:
+                if is_list:
+                    result[name] = [uri]
+                else:
+                    result[name] = uri
+            else:
+                result[name] = [] if is_list else None
+        return uri_step
+
+    def serialize(self, ob, user_id, permissions, base_uri):
+        result = {}
+        for step in self.steps:
+            step(ob, result, user_id, permissions, base_uri)
+        for name, key, target_cls in self.default_columns:
+            val = getattr(ob, key)
+            if target_cls is not None:
+                if val:
+                    result[name] = target_cls.uri_generic(val, base_uri)
+                else:
+                    result[name] = None
+            elif val:
+                if type(val) == datetime:
+                    val = val.isoformat() + "Z"
+                result[name] = val
+            else:
+                result[name] = None
+        return result
+
+
 class BaseOps(object):
     """Base class for SQLAlchemy models in Assembl.
 
@@ -393,11 +695,17 @@ class BaseOps(object):
         and will express that this object has been deleted."""
         return Tombstone(self)
 
+    # False for internal bookkeeping, which is not sent to the frontend
+    sent_to_changes = True
+
     def send_to_changes(self, connection=None, operation=CrudOperation.UPDATE,
                         discussion_id=None, view_def="changes"):
-        """Ask for this object to be sent on the changes websocket.
+        """Ask for this object to be sent on the changes websocket,
+        unless its class is not :py:attr:`sent_to_changes`.
 
         See :py:mod:`assembl.tasks.changes_router`."""
+        if not self.sent_to_changes:
+            return
         if not connection:
             # WARNING: invalidate has to be called within an active transaction.
             # This should be the case in general, no need to add a transaction manager.
@@ -637,6 +945,24 @@ class BaseOps(object):
             view_def[my_typename] = local_view
         return local_view
 
+    @classmethod
+    def view_def_plan(cls, view_def_name):
+        """The :py:class:`ViewDefPlan` of this class for a view_def, or None
+        if the view_def does not represent this class.
+
+        Made once, and again only if the view_def was reloaded."""
+        view_def = get_view_def(view_def_name)
+        key = (cls, view_def_name)
+        cached = _view_def_plans.get(key, None)
+        if cached is not None and cached[0] is view_def:
+            return cached[1]
+        local_view = cls.expand_view_def(view_def)
+        plan = None
+        if local_view:
+            plan = ViewDefPlan(cls, view_def_name, view_def, local_view)
+        _view_def_plans[key] = (view_def, plan)
+        return plan
+
     def generic_json(
             self, view_def_name='default', user_id=None,
             permissions=(P_READ, ), base_uri='local:'):
@@ -645,264 +971,10 @@ class BaseOps(object):
         user_id = user_id or Everyone
         if not self.user_can(user_id, CrudPermissions.READ, permissions):
             return None
-        view_def = get_view_def(view_def_name or 'default')
-        my_typename = self.external_typename()
-        result = {}
-        local_view = self.expand_view_def(view_def)
-        if not local_view:
+        plan = self.view_def_plan(view_def_name or 'default')
+        if plan is None:
             return None
-        mapper = self.__class__.__mapper__
-        relns = {r.key: r for r in mapper.relationships}
-        cols = {c.key: c for c in mapper.columns}
-        fkeys = {c for c in mapper.columns if c.foreign_keys}
-        reln_of_fkeys = {
-            frozenset(r._calculated_foreign_keys): r
-            for r in mapper.relationships
-        }
-        fkey_of_reln = {r.key: r._calculated_foreign_keys
-                        for r in mapper.relationships}
-        methods = dict(pyinspect.getmembers(
-            self.__class__, lambda m: pyinspect.ismethod(m)
-            and m.func_code.co_argcount == 1))
-        properties = dict(pyinspect.getmembers(
-            self.__class__, lambda p: pyinspect.isdatadescriptor(p)))
-        known = set()
-        for name, spec in local_view.iteritems():
-            if name == "_default":
-                continue
-            elif spec is False:
-                known.add(name)
-                continue
-            elif type(spec) is list:
-                if not spec:
-                    spec = [True]
-                assert len(spec) == 1,\
-                    "in viewdef %s, class %s, name %s, len(list) > 1" % (
-                        view_def_name, my_typename, name)
-                subspec = spec[0]
-            elif type(spec) is dict:
-                assert len(spec) == 1,\
-                    "in viewdef %s, class %s, name %s, len(dict) > 1" % (
-                        view_def_name, my_typename, name)
-                assert "@id" in spec,\
-                    "in viewdef %s, class %s, name %s, key should be '@id'" % (
-                        view_def_name, my_typename, name)
-                subspec = spec["@id"]
-            else:
-                subspec = spec
-            if subspec is True:
-                prop_name = name
-                view_name = None
-            else:
-                assert isinstance(subspec, types.StringTypes),\
-                    "in viewdef %s, class %s, name %s, spec not a string" % (
-                        view_def_name, my_typename, name)
-                if subspec[0] == "'":
-                    # literals.
-                    result[name] = loads(subspec[1:])
-                    continue
-                if ':' in subspec:
-                    prop_name, view_name = subspec.split(':', 1)
-                    if not view_name:
-                        view_name = view_def_name
-                    if not prop_name:
-                        prop_name = name
-                else:
-                    prop_name = subspec
-                    view_name = None
-            if view_name:
-                assert get_view_def(view_name),\
-                    "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
-                        view_def_name, my_typename, name, view_name)
-            #print prop_name, name, view_name
-
-            def translate_to_json(v):
-                if isinstance(v, Base):
-                    p = getattr(v, 'user_can', None)
-                    if p and not v.user_can(
-                            user_id, CrudPermissions.READ, permissions):
-                        return None
-                    if view_name:
-                        return v.generic_json(
-                            view_name, user_id, permissions, base_uri)
-                    else:
-                        return v.uri(base_uri)
-                elif isinstance(v, (
-                        str, unicode, int, long, float, bool, types.NoneType)):
-                    return v
-                elif isinstance(v, EnumSymbol):
-                    return v.name
-                elif isinstance(v, datetime):
-                    return v.isoformat() + "Z"
-                elif isinstance(v, dict):
-                    v = {translate_to_json(k): translate_to_json(val)
-                         for k, val in v.items()}
-                    return {k: val for (k, val) in v.items()
-                            if val is not None}
-                elif isinstance(v, Iterable):
-                    v = [translate_to_json(i) for i in v]
-                    return [x for x in v if x is not None]
-                else:
-                    raise NotImplementedError("Cannot translate", v)
-
-            if prop_name == 'self':
-                if view_name:
-                    r = self.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if r is not None:
-                        result[name] = r
-                else:
-                    result[name] = self.uri()
-                continue
-            elif prop_name == '@view':
-                result[name] = view_def_name
-                continue
-            elif prop_name[0] == '&':
-                prop_name = prop_name[1:]
-                assert prop_name in methods,\
-                    "in viewdef %s, class %s, name %s, unknown method %s" % (
-                        view_def_name, my_typename, name, prop_name)
-                # Function call. PLEASE RETURN JSON, Base objects,
-                # or list or dicts thereof
-                val = getattr(self, prop_name)()
-                result[name] = translate_to_json(val)
-                continue
-            elif prop_name in cols:
-                assert not view_name,\
-                    "in viewdef %s, class %s, viewdef for literal property %s" % (
-                        view_def_name, my_typename, prop_name)
-                assert not isinstance(spec, list),\
-                    "in viewdef %s, class %s, list for literal property %s" % (
-                        view_def_name, my_typename, prop_name)
-                assert not isinstance(spec, dict),\
-                    "in viewdef %s, class %s, dict for literal property %s" % (
-                        view_def_name, my_typename, prop_name)
-                known.add(prop_name)
-                val = getattr(self, prop_name)
-                if val is not None:
-                    val = translate_to_json(val)
-                if val is not None:
-                    result[name] = val
-                continue
-            elif prop_name in properties:
-                known.add(prop_name)
-                if view_name or (prop_name not in fkey_of_reln) or (
-                        relns[prop_name].direction != MANYTOONE):
-                    val = getattr(self, prop_name)
-                    if val is not None:
-                        val = translate_to_json(val)
-                    if val is not None:
-                        result[name] = val
-                else:
-                    fkeys = list(fkey_of_reln[prop_name])
-                    assert(len(fkeys) == 1)
-                    fkey = fkeys[0]
-                    result[name] = relns[prop_name].mapper.class_.uri_generic(
-                        getattr(self, fkey.key))
-
-                continue
-            assert prop_name in relns,\
-                    "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
-                        view_def_name, my_typename, prop_name)
-            known.add(prop_name)
-            # Add derived prop?
-            reln = relns[prop_name]
-            if reln.uselist:
-                vals = getattr(self, prop_name)
-                if view_name:
-                    if isinstance(spec, dict):
-                        result[name] = {
-                            ob.uri(base_uri):
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)}
-                    else:
-                        result[name] = [
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)]
-                else:
-                    assert not isinstance(spec, dict),\
-                        "in viewdef %s, class %s, dict without viewname for %s" % (
-                            view_def_name, my_typename, name)
-                    result[name] = [
-                        ob.uri(base_uri) for ob in vals
-                        if ob.user_can(
-                            user_id, CrudPermissions.READ, permissions)]
-                continue
-            assert not isinstance(spec, dict),\
-                "in viewdef %s, class %s, dict for non-list relation %s" % (
-                    view_def_name, my_typename, prop_name)
-            if view_name:
-                ob = getattr(self, prop_name)
-                if ob and ob.user_can(
-                        user_id, CrudPermissions.READ, permissions):
-                    val = ob.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if val is not None:
-                        if isinstance(spec, list):
-                            result[name] = [val]
-                        else:
-                            result[name] = val
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
-            else:
-                uri = None
-                if len(reln._calculated_foreign_keys) == 1 \
-                        and reln._calculated_foreign_keys < fkeys:
-                    # shortcut, avoid fetch
-                    fkey = list(reln._calculated_foreign_keys)[0]
-                    ob_id = getattr(self, fkey.name)
-                    if ob_id:
-                        uri = reln.mapper.class_.uri_generic(
-                            ob_id, base_uri)
-                else:
-                    ob = getattr(self, prop_name)
-                    if ob:
-                        uri = ob.uri(base_uri)
-                if uri:
-                    if isinstance(spec, list):
-                        result[name] = [uri]
-                    else:
-                        result[name] = uri
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
-
-        if local_view.get('_default') is not False:
-            for name, col in cols.items():
-                if name in known:
-                    continue  # already done
-                as_rel = reln_of_fkeys.get(frozenset((col, )))
-                if as_rel:
-                    name = as_rel.key
-                    if name in known:
-                        continue
-                    else:
-                        ob_id = getattr(self, col.key)
-                        if ob_id:
-                            result[name] = as_rel.mapper.class_.uri_generic(
-                                ob_id, base_uri)
-                        else:
-                            result[name] = None
-                else:
-                    ob = getattr(self, name)
-                    if ob:
-                        if type(ob) == datetime:
-                            ob = ob.isoformat() + "Z"
-                        result[name] = ob
-                    else:
-                        result[name] = None
-        return result
+        return plan.serialize(self, user_id, permissions, base_uri)
 
     dummy_context = DummyContext()
 
@@ -1749,31 +1821,24 @@ def orm_delete_listener(mapper, connection, target):
     if getattr(target, '__history_table__', None):
         return
     reindex_content(target, 'delete')
-    target.tombstone().send_to_changes(connection, CrudOperation.DELETE)
+    if getattr(target, 'sent_to_changes', True):
+        target.tombstone().send_to_changes(connection, CrudOperation.DELETE)
 
 
 def before_commit_listener(session):
     """Create the Json representation of changed objects which will be
     sent to the :py:mod:`assembl.tasks.changes_router`
 
-    We have to do this before commit, while objects are still attached."""
+    We have to do this before commit, while objects are still attached,
+    unless serialization is deferred to the :py:class:`assembl.lib.changes.ChangesPublisher`
+    thread."""
     # If there hasn't been a flush yet, make sure any sql error occur BEFORE
     # we send changes to the socket.
     session.flush()
     info = session.connection().info
     if 'cdict' in info:
-        changes = defaultdict(list)
-        for ((uri, view_def), (discussion, target)) in \
-                info['cdict'].iteritems():
-            discussion = bytes(discussion or "*")
-            if uri is None:
-                # in tests, the object was created and then deleted
-                continue
-            json = target.generic_json(view_def)
-            if json:
-                changes[discussion].append(json)
-        del info['cdict']
-        session.cdict2 = changes
+        cdict = info.pop('cdict')
+        session.cdict2 = get_changes_publisher().collect(session, cdict)
     else:
         print "EMPTY CDICT!"
 
@@ -1784,8 +1849,7 @@ def after_commit_listener(session):
     if not getattr(session, 'zsocket', None):
         session.zsocket = get_pub_socket()
     if getattr(session, 'cdict2', None):
-        for discussion, changes in session.cdict2.iteritems():
-            send_changes(session.zsocket, discussion, changes)
+        get_changes_publisher().publish(session.zsocket, session.cdict2)
         del session.cdict2
 
 
@@ -1848,6 +1912,22 @@ def mark_changed(session=None):
     z_mark_changed(session)
 
 
+def id_mapping(mapping, name="id_mapping"):
+    """A selectable of the (old_id, new_id) pairs of a dictionary of ids,
+    to join with when copying rows in bulk. Postgres only."""
+    old_ids = list(mapping)
+    new_ids = [mapping[old_id] for old_id in old_ids]
+
+    def ids_array(ids):
+        # one parameter for the whole array
+        return cast(literal(ids, ARRAY(Integer)), ARRAY(Integer))
+    # unnest of arrays of the same length in the same select zips them
+    return select([
+        func.unnest(ids_array(old_ids)).label('old_id'),
+        func.unnest(ids_array(new_ids)).label('new_id')
+    ]).alias(name)
+
+
 def get_metadata():
     global _metadata
     return _metadata
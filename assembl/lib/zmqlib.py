@@ -60,10 +60,14 @@ def get_pub_socket():
 
 
 def send_changes(socket, discussion, changeset):
+    "Send a list of changes, or its json serialization"
     order = _counter.next()
     socket.send(discussion, zmq.SNDMORE)
     socket.send(str(order), zmq.SNDMORE)
-    socket.send_json(changeset)
+    if isinstance(changeset, basestring):
+        socket.send(changeset)
+    else:
+        socket.send_json(changeset)
     print "sent", order, discussion, changeset
 
 
@@ -179,6 +179,7 @@ from .mail import (  # noqa: E402, F401
     AbstractFilesystemMailbox,
     AbstractMailbox,
     Email,
+    EmailReference,
     IMAPMailbox,
     MaildirMailbox,
     MailingList,
@@ -372,6 +373,25 @@ from .tag import (  # noqa: E402, F401
 
 from .resource import Resource  # noqa: E402, F401
 
+from .indexing_queue import IndexingQueueItem  # noqa: E402, F401
+
+from .export_job import ExportJob, ExportJobStatus  # noqa: E402, F401
+
+from .thread_tree import ThreadTree  # noqa: E402, F401
+
+from .stem_index import PostStemIndex, PostStemCount  # noqa: E402, F401
+
+from .translation_memory import TranslationMemory  # noqa: E402, F401
+
+from .keyword_rollup import (  # noqa: E402, F401
+    IdeaKeywordRollup,
+    IdeaKeywordRollupState
+)
+
+from .activity_rollup import DailyActivity, DailyActivityState  # noqa: E402, F401
+
+from .read_status import PostReadSet  # noqa: E402, F401
+
 from .section import Section  # noqa: E402, F401
 
 from .vote_session import VoteSession, VoteProposal  # noqa: E402, F401
@@ -0,0 +1,516 @@
+"""Daily activity of participants, for the time series analytics.
+
+:py:func:`assembl.views.api2.discussion.get_time_series_analytics` joined
+posts, votes, actions and visits to a temporary table of intervals through
+correlated subqueries, and rescanned the discussion from its start for
+each interval of the cumulative counts.
+:py:class:`DailyActivity` keeps one row per participant and day where they
+posted, voted or acted, and :py:meth:`DailyActivity.time_series`
+re-aggregates those rows into intervals of whole days, computing the
+cumulative counts with window functions.
+
+The days which got new events since the last refresh are recomputed by
+:py:meth:`DailyActivity.refresh`: :py:class:`DailyActivityState` keeps the
+highest ids seen in the source tables, so posts imported with past dates
+are counted in their own day. Ids are taken when rows are inserted, but
+seen at commit, so a refresh also rescans the last ``RESCAN_IDS`` ids below
+its marks, and the removals of the last ``RESCAN_DELAY``, for the rows of
+transactions which committed after it. Without new ids, it does nothing
+until ``RESCAN_DELAY`` after the last refresh, so that frequent reads of
+the analytics do not rewrite the recent days.
+Hard deletions leave no trace to scan: they reset the state of the
+discussion, so that its next refresh recomputes all days.
+"""
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    Date,
+    DateTime,
+    ForeignKey,
+    UniqueConstraint,
+    and_,
+    case,
+    cast,
+    distinct,
+    event,
+    func,
+    literal,
+    or_,
+    select,
+    union_all,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, array
+
+from . import Base
+from .action import Action, ActionOnPost, ActionOnIdea, ViewPost
+from .auth import AgentProfile, AgentStatusInDiscussion
+from .discussion import Discussion
+from .generic import Content
+from .idea import Idea
+from .post import Post
+from .votes import AbstractIdeaVote
+from ..lib.sqla import is_zopish, mark_changed
+
+# Key of the postgres advisory lock held while refreshing a discussion
+LOCK_KEY = 0x64616c79
+
+# How many ids below the marks are scanned again at each refresh
+RESCAN_IDS = 1000
+
+# How long before the last refresh removals are scanned again
+RESCAN_DELAY = timedelta(hours=1)
+
+# The columns counting the events of an actor in a day
+EVENT_COLUMNS = ('posts', 'top_posts', 'votes', 'actions', 'views')
+
+
+def day_boundaries(start, end, interval):
+    """The dates bounding consecutive intervals from the day of start to
+    the end of the day of end.
+
+    :param interval: a timedelta or an isodate Duration
+    :returns: the dates, or None if the intervals are not whole days"""
+    first = start.date()
+    last = end.date()
+    if end.time() != time(0):
+        last += timedelta(days=1)
+    delta = getattr(interval, 'tdelta', interval)
+    if delta.seconds or delta.microseconds or first + interval <= first:
+        return None
+    if start + interval > end:
+        return [first, last]
+    boundaries = [first]
+    while boundaries[-1] < last:
+        boundaries.append(min(boundaries[-1] + interval, last))
+    return boundaries
+
+
+class DailyActivityState(Base):
+    """How far the daily activity of a discussion was computed"""
+    __tablename__ = 'daily_activity_state'
+
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    last_post_id = Column(Integer, nullable=False, default=0)
+    last_vote_id = Column(Integer, nullable=False, default=0)
+    last_action_id = Column(Integer, nullable=False, default=0)
+    # Actions removed since then are counted on the day of their removal.
+    # None to recompute all days.
+    refreshed = Column(DateTime)
+
+    sent_to_changes = False
+
+
+class DailyActivity(Base):
+    """The number of events of an actor in a discussion on a day"""
+    __tablename__ = 'daily_activity'
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False)
+    day = Column(Date, nullable=False)
+    actor_id = Column(Integer, ForeignKey(
+        AgentProfile.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False)
+    posts = Column(Integer, nullable=False, default=0)
+    # Posts without a parent
+    top_posts = Column(Integer, nullable=False, default=0)
+    votes = Column(Integer, nullable=False, default=0)
+    # Actions on posts and ideas, created or removed that day
+    actions = Column(Integer, nullable=False, default=0)
+    # Posts viewed
+    views = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('discussion_id', 'day', 'actor_id'),
+    )
+
+    sent_to_changes = False
+
+    @staticmethod
+    def events(discussion_id, days=None):
+        """A union of (day, actor_id, posts, top_posts, votes, actions, views)
+        rows, one per event of the discussion (on the given days)"""
+        content = Content.__table__
+        post = Post.__table__
+        vote = AbstractIdeaVote.__table__
+        idea = Idea.__table__
+        action = Action.__table__
+        action_on_post = ActionOnPost.__table__
+        action_on_idea = ActionOnIdea.__table__
+
+        def part(date_column, actor_column, from_, condition, **counts):
+            day = cast(date_column, Date)
+            if days is not None:
+                condition = and_(condition, day.in_(days))
+            columns = [day.label('day'), actor_column.label('actor_id')]
+            for name in EVENT_COLUMNS:
+                count = counts.get(name, 0)
+                columns.append((
+                    count if hasattr(count, 'label') else literal(count)
+                ).label(name))
+            return select(columns).select_from(from_).where(condition)
+
+        post_from = content.join(post, post.c.id == content.c.id)
+        vote_from = vote.join(idea, idea.c.id == vote.c.idea_id)
+        action_on_post_from = action.join(
+            action_on_post, action_on_post.c.id == action.c.id).join(
+            content, content.c.id == action_on_post.c.post_id)
+        action_on_idea_from = action.join(
+            action_on_idea, action_on_idea.c.id == action.c.id).join(
+            idea, idea.c.id == action_on_idea.c.idea_id)
+        is_view = case([(
+            action.c.type == ViewPost.__mapper__.polymorphic_identity, 1)],
+            else_=0)
+        return union_all(
+            part(content.c.creation_date, post.c.creator_id, post_from,
+                 content.c.discussion_id == discussion_id, posts=1,
+                 top_posts=case([(post.c.parent_id == None, 1)],  # noqa: E711
+                                else_=0)),
+            part(vote.c.vote_date, vote.c.voter_id, vote_from, and_(
+                idea.c.discussion_id == discussion_id,
+                vote.c.vote_date != None), votes=1),  # noqa: E711
+            part(action.c.creation_date, action.c.actor_id,
+                 action_on_post_from,
+                 content.c.discussion_id == discussion_id,
+                 actions=1, views=is_view),
+            part(action.c.tombstone_date, action.c.actor_id,
+                 action_on_post_from, and_(
+                     content.c.discussion_id == discussion_id,
+                     action.c.tombstone_date != None),  # noqa: E711
+                 actions=1),
+            part(action.c.creation_date, action.c.actor_id,
+                 action_on_idea_from,
+                 idea.c.discussion_id == discussion_id, actions=1),
+            part(action.c.tombstone_date, action.c.actor_id,
+                 action_on_idea_from, and_(
+                     idea.c.discussion_id == discussion_id,
+                     action.c.tombstone_date != None),  # noqa: E711
+                 actions=1))
+
+    @staticmethod
+    def changed_days(db, discussion_id, state, marks):
+        """The days with events added since the state, up to the marks
+        (last_post_id, last_vote_id, last_action_id), and the days of the
+        rescanned events"""
+        content = Content.__table__
+        post = Post.__table__
+        vote = AbstractIdeaVote.__table__
+        idea = Idea.__table__
+        action = Action.__table__
+        action_on_post = ActionOnPost.__table__
+        action_on_idea = ActionOnIdea.__table__
+        last_post_id, last_vote_id, last_action_id = marks
+
+        def since(mark):
+            return max(mark - RESCAN_IDS, 0) + 1
+
+        new_actions = action.c.id.between(
+            since(state.last_action_id), last_action_id)
+        if state.refreshed is not None:
+            new_actions = or_(new_actions, action.c.tombstone_date >= (
+                state.refreshed - RESCAN_DELAY))
+        queries = [
+            select([cast(content.c.creation_date, Date)]).select_from(
+                content.join(post, post.c.id == content.c.id)).where(and_(
+                    content.c.discussion_id == discussion_id,
+                    content.c.id.between(
+                        since(state.last_post_id), last_post_id))),
+            select([cast(vote.c.vote_date, Date)]).select_from(
+                vote.join(idea, idea.c.id == vote.c.idea_id)).where(and_(
+                    idea.c.discussion_id == discussion_id,
+                    vote.c.id.between(since(state.last_vote_id), last_vote_id),
+                    vote.c.vote_date != None)),  # noqa: E711
+        ]
+        for (target, from_) in (
+                (content, action.join(
+                    action_on_post, action_on_post.c.id == action.c.id).join(
+                    content, content.c.id == action_on_post.c.post_id)),
+                (idea, action.join(
+                    action_on_idea, action_on_idea.c.id == action.c.id).join(
+                    idea, idea.c.id == action_on_idea.c.idea_id))):
+            for date_column in (action.c.creation_date,
+                                action.c.tombstone_date):
+                queries.append(select([cast(date_column, Date)]).select_from(
+                    from_).where(and_(
+                        target.c.discussion_id == discussion_id,
+                        date_column != None,  # noqa: E711
+                        new_actions)))
+        return {day for (day,) in db.execute(union_all(*queries))}
+
+    @staticmethod
+    def marks(db, discussion_id):
+        """The highest ids of the posts, votes and actions of the discussion"""
+        content = Content.__table__
+        post = Post.__table__
+        vote = AbstractIdeaVote.__table__
+        idea = Idea.__table__
+        action = Action.__table__
+        action_on_post = ActionOnPost.__table__
+        action_on_idea = ActionOnIdea.__table__
+        last_post_id = db.execute(
+            select([func.max(content.c.id)]).select_from(
+                content.join(post, post.c.id == content.c.id)).where(
+                content.c.discussion_id == discussion_id)).scalar()
+        last_vote_id = db.execute(
+            select([func.max(vote.c.id)]).select_from(
+                vote.join(idea, idea.c.id == vote.c.idea_id)).where(
+                idea.c.discussion_id == discussion_id)).scalar()
+        last_action_id = max(db.execute(
+            select([func.max(action_on_post.c.id)]).select_from(
+                action_on_post.join(
+                    content, content.c.id == action_on_post.c.post_id)
+            ).where(content.c.discussion_id == discussion_id)).scalar() or 0,
+            db.execute(
+            select([func.max(action_on_idea.c.id)]).select_from(
+                action_on_idea.join(
+                    idea, idea.c.id == action_on_idea.c.idea_id)
+            ).where(idea.c.discussion_id == discussion_id)).scalar() or 0)
+        return (last_post_id or 0, last_vote_id or 0, last_action_id)
+
+    @classmethod
+    def refresh(cls, db, discussion_id):
+        """Recompute the days of the discussion with new events.
+
+        :returns: the number of days recomputed, None for all"""
+        now = datetime.utcnow()
+        marks = cls.marks(db, discussion_id)
+
+        def get_state():
+            # may have been reset by a deletion, see reset_state
+            state = db.query(DailyActivityState).populate_existing().get(
+                discussion_id)
+            recent = (
+                state is not None and state.refreshed is not None and
+                now - state.refreshed < RESCAN_DELAY and all(
+                    mark <= last for (mark, last) in zip(marks, (
+                        state.last_post_id, state.last_vote_id,
+                        state.last_action_id))))
+            return state, recent
+
+        state, recent = get_state()
+        if recent:
+            return 0
+        db.execute(select([
+            func.pg_advisory_xact_lock(LOCK_KEY, discussion_id)]))
+        # or refreshed while waiting for the lock
+        state, recent = get_state()
+        if recent:
+            return 0
+        table = cls.__table__
+        if state is None:
+            state = DailyActivityState(discussion_id=discussion_id)
+            db.add(state)
+            days = None
+        elif state.refreshed is None:
+            days = None
+        else:
+            days = cls.changed_days(db, discussion_id, state, marks)
+            if not days:
+                (state.last_post_id, state.last_vote_id,
+                 state.last_action_id) = marks
+                state.refreshed = now
+                return 0
+        condition = table.c.discussion_id == discussion_id
+        if days is not None:
+            days = sorted(days)
+            condition = and_(condition, table.c.day.in_(days))
+        db.execute(table.delete().where(condition))
+        events = cls.events(discussion_id, days).alias()
+        db.execute(table.insert().from_select(
+            ('discussion_id', 'day', 'actor_id') + EVENT_COLUMNS,
+            select([literal(discussion_id), events.c.day, events.c.actor_id] +
+                   [func.sum(events.c[name]) for name in EVENT_COLUMNS]
+                   ).group_by(events.c.day, events.c.actor_id)))
+        (state.last_post_id, state.last_vote_id,
+         state.last_action_id) = marks
+        state.refreshed = now
+        if is_zopish():
+            mark_changed(db)
+        return None if days is None else len(days)
+
+    @classmethod
+    def time_series(cls, db, discussion_id, boundaries):
+        """The statistics of the discussion in the intervals of days
+        between the boundaries, as dictionaries with the columns of
+        :py:func:`assembl.views.api2.discussion.get_time_series_analytics`.
+        """
+        table = cls.__table__
+        status = AgentStatusInDiscussion.__table__
+        thresholds = cast(array(boundaries), ARRAY(Date))
+        num_intervals = len(boundaries) - 1
+
+        def bucket(day):
+            # 0 before the first interval, i + 1 in interval i
+            return func.width_bucket(cast(day, Date), thresholds)
+
+        in_discussion = and_(table.c.discussion_id == discussion_id,
+                             table.c.day < boundaries[-1])
+        day_bucket = bucket(table.c.day)
+
+        def actors(condition):
+            return func.count(distinct(case([(condition, table.c.actor_id)])))
+
+        # Counts by interval, and cumulative sums since the first day
+        per_interval = [
+            ('count_posts', func.sum(table.c.posts)),
+            ('count_top_posts', func.sum(table.c.top_posts)),
+            ('count_votes', func.sum(table.c.votes)),
+            ('count_post_authors', actors(table.c.posts > 0)),
+            ('count_top_post_authors', actors(table.c.top_posts > 0)),
+            ('count_voters', actors(table.c.votes > 0)),
+            ('count_actors', actors(or_(
+                table.c.posts > 0, table.c.actions > 0))),
+            ('UNRELIABLE_count_post_viewers', actors(table.c.views > 0)),
+        ]
+        cumulative = [
+            ('count_cumulative_posts', table.c.posts),
+            ('count_cumulative_top_posts', table.c.top_posts),
+            ('count_cumulative_votes', table.c.votes),
+        ]
+        by_bucket = {}
+        for row in db.execute(select(
+                [day_bucket.label('bucket')] +
+                [column.label(name) for (name, column) in per_interval] +
+                [func.sum(func.sum(column)).over(order_by=day_bucket).label(
+                    name) for (name, column) in cumulative]
+                ).where(in_discussion).group_by(day_bucket)):
+            by_bucket[row['bucket']] = row
+
+        # Events counted once per actor or status: the first day an actor
+        # did something, or status changes. Weights sum to the count of
+        # the interval, and the cumulative count.
+        firsts = select([table.c.actor_id] + [
+            func.min(case([(condition, table.c.day)])).label(name)
+            for (name, condition) in (
+                ('post', table.c.posts > 0),
+                ('top_post', table.c.top_posts > 0),
+                ('vote', table.c.votes > 0),
+                ('action', or_(table.c.posts > 0, table.c.actions > 0)))]
+        ).where(in_discussion).group_by(table.c.actor_id).alias()
+
+        def kind(name, day, condition=None, weight=1, from_=None):
+            query = select([literal(name).label('kind'),
+                            bucket(day).label('bucket'),
+                            literal(weight).label('weight')])
+            if from_ is not None:
+                query = query.select_from(from_)
+            if condition is None:
+                condition = day != None  # noqa: E711
+            return query.where(condition)
+
+        in_status = status.c.discussion_id == discussion_id
+        subscribed = bucket(status.c.first_subscribed)
+        unsubscribed = bucket(status.c.last_unsubscribed)
+        # A member from the first interval ending after they subscribed,
+        # until the first interval ending after they unsubscribed
+        was_member = or_(status.c.first_subscribed == None,  # noqa: E711
+                         status.c.last_unsubscribed == None,  # noqa: E711
+                         unsubscribed > subscribed)
+        events = union_all(*([
+            kind(name, firsts.c[name], from_=firsts)
+            for name in ('post', 'top_post', 'vote', 'action')] + [
+            kind(name, status.c[name], and_(
+                in_status, status.c[name] != None))  # noqa: E711
+            for name in ('first_visit', 'first_subscribed', 'last_visit',
+                         'last_unsubscribed')] + [
+            kind('members', func.coalesce(
+                status.c.first_subscribed,
+                datetime.combine(date.min, time(0))), and_(
+                in_status, was_member)),
+            kind('members', status.c.last_unsubscribed, and_(
+                in_status, was_member,
+                status.c.last_unsubscribed != None),  # noqa: E711
+                weight=-1)])).alias()
+        first_events = {}
+        for (name, bucket_id, count, total) in db.execute(select([
+                events.c.kind, events.c.bucket, func.sum(events.c.weight),
+                func.sum(func.sum(events.c.weight)).over(
+                    partition_by=events.c.kind, order_by=events.c.bucket)]
+                ).group_by(events.c.kind, events.c.bucket)):
+            first_events[(name, bucket_id)] = (int(count), int(total))
+
+        results = []
+        # Cumulative counts are carried over intervals without events,
+        # starting from the events before the first interval (bucket 0)
+        totals = {}
+        for bucket_id in range(num_intervals + 1):
+            row = by_bucket.get(bucket_id)
+            result = {}
+            if bucket_id:
+                result = dict(
+                    interval_id=bucket_id,
+                    interval_start=datetime.combine(
+                        boundaries[bucket_id - 1], time(0)),
+                    interval_end=datetime.combine(
+                        boundaries[bucket_id], time(0)))
+            for (name, _) in per_interval:
+                result[name] = int(row[name]) if row is not None else 0
+            for (name, _) in cumulative:
+                if row is not None:
+                    totals[name] = int(row[name])
+                result[name] = totals.get(name, 0)
+            for (name, field, total_field) in (
+                    ('post', None, 'count_cumulative_post_authors'),
+                    ('top_post', None, 'count_cumulative_top_post_authors'),
+                    ('vote', None, 'count_cumulative_voters'),
+                    ('action', None, 'count_cumulative_actors'),
+                    ('first_visit', 'recruitment_count_first_visit_in_period',
+                     'count_cumulative_logged_in_visitors'),
+                    ('first_subscribed',
+                     'recruitment_count_first_subscribed_in_period', None),
+                    ('last_visit', 'retention_count_last_visit_in_period',
+                     None),
+                    ('last_unsubscribed',
+                     'retention_count_last_unsubscribed_in_period', None),
+                    ('members', None, 'count_approximate_members')):
+                values = first_events.get((name, bucket_id))
+                if values is not None:
+                    totals[name] = values[1]
+                if field:
+                    result[field] = values[0] if values is not None else 0
+                if total_field:
+                    result[total_field] = totals.get(name, 0)
+            if not bucket_id:
+                continue
+            for (field, total_field) in (
+                    ('fraction_cumulative_authors_who_posted_in_period',
+                     'count_cumulative_post_authors'),
+                    ('fraction_cumulative_logged_in_visitors_who_posted_in_period',
+                     'count_cumulative_logged_in_visitors')):
+                result[field] = (
+                    float(result['count_post_authors']) / result[total_field]
+                    if result[total_field] else None)
+            results.append(result)
+        return results
+
+
+def reset_state(connection, discussion_id):
+    "Make the next refresh of the discussion recompute all its days"
+    table = DailyActivityState.__table__
+    connection.execute(table.update().where(
+        table.c.discussion_id == discussion_id).values(refreshed=None))
+
+
+@event.listens_for(Post, 'after_delete', propagate=True)
+def post_deleted(mapper, connection, target):
+    reset_state(connection, target.discussion_id)
+
+
+@event.listens_for(AbstractIdeaVote, 'after_delete', propagate=True)
+@event.listens_for(ActionOnIdea, 'after_delete', propagate=True)
+def idea_event_deleted(mapper, connection, target):
+    idea = Idea.__table__
+    reset_state(connection, select([idea.c.discussion_id]).where(
+        idea.c.id == target.idea_id).as_scalar())
+
+
+@event.listens_for(ActionOnPost, 'after_delete', propagate=True)
+def post_action_deleted(mapper, connection, target):
+    content = Content.__table__
+    reset_state(connection, select([content.c.discussion_id]).where(
+        content.c.id == target.post_id).as_scalar())
@@ -358,7 +358,7 @@ class AgentProfile(Base):
                 get('available_languages', 'fr_CA en_CA').split()[0]
             assert prefs[0]
             return prefs[0]
-        return Locale.locale_collection_byid[prefs[0].locale_id]
+        return Locale.code_for_id(prefs[0].locale_id)
 
     def successful_social_login(self):
         self.successful_login(True)
@@ -2028,6 +2028,11 @@ class LanguagePreferenceCollection(object):
     def known_languages(self):
         return []
 
+    @abstractmethod
+    def signature(self):
+        "A hashable value, equal for collections with the same preferences"
+        pass
+
 
 class LanguagePreferenceCollectionWithDefault(LanguagePreferenceCollection):
     """A LanguagePreferenceCollection with a fallback language."""
@@ -2054,6 +2059,9 @@ class LanguagePreferenceCollectionWithDefault(LanguagePreferenceCollection):
     def known_languages(self):
         return [self.default_locale]
 
+    def signature(self):
+        return ('default', self.default_locale.id)
+
 
 class UserLanguagePreferenceCollection(LanguagePreferenceCollection):
     """A LanguagePreferenceCollection that represent one user's preferences."""
@@ -2107,6 +2115,7 @@ class UserLanguagePreferenceCollection(LanguagePreferenceCollection):
             # As it stands, the cookie is the fallback.
             default_pref = (
                 prefs_without_trans[0] if prefs_without_trans else None)
+        self.user_id = user_id
         self.user_prefs = prefs_by_locale
         self.default_pref = default_pref
 
@@ -2134,6 +2143,13 @@ class UserLanguagePreferenceCollection(LanguagePreferenceCollection):
         return list({pref.translate_to_code or pref.locale_code
                      for pref in self.user_prefs.itervalues()})
 
+    def signature(self):
+        default_pref = self.default_pref
+        return ('user', self.user_id, tuple(sorted(
+            (code, pref.id, pref.locale_id, pref.translate_to)
+            for (code, pref) in self.user_prefs.iteritems())),
+            default_pref.locale_id if default_pref else None)
+
 
 class UserLanguagePreference(Base):
     """Does this user wants data in this language to be displayed or translated?"""
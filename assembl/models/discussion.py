@@ -220,14 +220,11 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
 
     def read_post_ids(self, user_id):
         from .post import Post
-        from .action import ViewPost
-        return (x[0] for x in self.db.query(Post.id).join(
-            ViewPost
-        ).filter(
+        from .read_status import PostReadSet
+        read_ids = PostReadSet.get_read_ids(self.db, user_id, self.id)
+        return (x[0] for x in self.db.query(Post.id).filter(
             Post.discussion_id == self.id,
-            ViewPost.actor_id == user_id,
-            ViewPost.post_id == Post.id
-        ))
+            PostReadSet.read_clause(Post.id, read_ids)))
 
     def get_read_posts_ids_preload(self, user_id):
         from .post import Post
@@ -0,0 +1,207 @@
+"""Background exports of discussion reports, and their cached artifacts."""
+from datetime import datetime, timedelta
+from hashlib import sha256
+
+import simplejson as json
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Unicode,
+    Text,
+    DateTime,
+    ForeignKey,
+    Index,
+    func,
+    select,
+)
+
+from . import Base
+
+
+class ExportJobStatus(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class ExportJob(Base):
+    """An export of a discussion report, run by
+    :py:func:`assembl.tasks.export.run_export_job`.
+
+    The artifact is kept in the attachment service, and reused by later
+    jobs with the same cache_key, i.e. the same discussion, export type,
+    parameters and discussion watermark."""
+    __tablename__ = 'export_job'
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    requester_id = Column(Integer, ForeignKey(
+        'agent_profile.id', ondelete='SET NULL', onupdate='CASCADE'))
+    export_type = Column(String(60), nullable=False)
+    # The export parameters, as canonical JSON
+    params = Column(Text, nullable=False, default='{}')
+    watermark = Column(String(64), nullable=False)
+    cache_key = Column(String(64), nullable=False)
+    status = Column(String(20), nullable=False,
+                    default=ExportJobStatus.PENDING)
+    # Number of rows written so far
+    progress = Column(Integer, nullable=False, default=0)
+    file_identity = Column(String(64))
+    file_size = Column(Integer)
+    mime_type = Column(String(100))
+    filename = Column(Unicode(255))
+    error = Column(Text)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_export_job_cache_key', 'cache_key', 'status'),
+    )
+
+    sent_to_changes = False
+
+    @property
+    def parameters(self):
+        return json.loads(self.params)
+
+    @staticmethod
+    def canonical_params(params):
+        return json.dumps(params, sort_keys=True)
+
+    @staticmethod
+    def make_cache_key(discussion_id, export_type, params, watermark):
+        return sha256(json.dumps(
+            [discussion_id, export_type, params, watermark],
+            sort_keys=True)).hexdigest()
+
+    @classmethod
+    def discussion_watermark(cls, discussion_id, db=None):
+        """A digest of the latest changes to the contents, ideas, extracts,
+        sentiments and votes of the discussion.
+
+        Changes that do not create or tombstone a row (e.g. editing an idea
+        title) do not change the watermark; cached artifacts also have a
+        maximum age for those."""
+        from .generic import Content
+        from .post import Post
+        from .idea import Idea
+        from .idea_content_link import Extract, IdeaContentLink
+        from .action import Action, ActionOnPost
+        from .votes import AbstractIdeaVote
+        db = db or cls.default_db
+        content = Content.__table__
+        post = Post.__table__
+        idea = Idea.__table__
+        extract = Extract.__table__
+        link = IdeaContentLink.__table__
+        action = Action.__table__
+        action_on_post = ActionOnPost.__table__
+        vote = AbstractIdeaVote.__table__
+
+        def aggregates(columns, from_obj, condition):
+            return [select([agg]).select_from(from_obj).where(
+                condition).as_scalar() for agg in columns]
+
+        values = db.execute(select(
+            aggregates(
+                [func.count(content.c.id), func.max(content.c.creation_date),
+                 func.max(content.c.tombstone_date),
+                 func.max(post.c.modification_date)],
+                content.outerjoin(post, post.c.id == content.c.id),
+                content.c.discussion_id == discussion_id) +
+            aggregates(
+                [func.count(idea.c.id), func.max(idea.c.creation_date),
+                 func.max(idea.c.tombstone_date)],
+                idea, idea.c.discussion_id == discussion_id) +
+            aggregates(
+                [func.count(extract.c.id), func.max(link.c.creation_date)],
+                extract.join(link, link.c.id == extract.c.id),
+                extract.c.discussion_id == discussion_id) +
+            aggregates(
+                [func.count(action.c.id), func.max(action.c.creation_date),
+                 func.max(action.c.tombstone_date)],
+                action.join(action_on_post,
+                            action_on_post.c.id == action.c.id).join(
+                    content, content.c.id == action_on_post.c.post_id),
+                content.c.discussion_id == discussion_id) +
+            aggregates(
+                [func.count(vote.c.id), func.max(vote.c.vote_date),
+                 func.max(vote.c.tombstone_date)],
+                vote.join(idea, idea.c.id == vote.c.idea_id),
+                idea.c.discussion_id == discussion_id))).first()
+        return sha256(repr(tuple(values))).hexdigest()
+
+    @classmethod
+    def find_reusable(cls, cache_key, max_age, timeout):
+        """The latest job with this cache_key which is done and recent enough,
+        or pending or running for less than timeout seconds."""
+        from ..lib.attachment_service import AttachmentService
+        now = datetime.utcnow()
+        jobs = cls.default_db.query(cls).filter(
+            cls.cache_key == cache_key,
+            cls.status != ExportJobStatus.FAILED).order_by(cls.id.desc())
+        for job in jobs:
+            if job.status == ExportJobStatus.DONE:
+                if (job.finished > now - timedelta(seconds=max_age) and
+                        AttachmentService.get_service().exists(
+                            job.file_identity)):
+                    return job
+            elif (job.started or job.created) > now - timedelta(
+                    seconds=timeout):
+                return job
+
+    @classmethod
+    def update_state(cls, job_id, from_status=None, **values):
+        """Update the job outside of the current transaction, so pollers
+        see its progress while the export runs.
+
+        :param from_status: only update the job if it has this status
+        :returns: whether the job was updated"""
+        table = cls.__table__
+        condition = table.c.id == job_id
+        if from_status is not None:
+            condition = condition & (table.c.status == from_status)
+        result = cls.default_db.bind.execute(
+            table.update().where(condition).values(**values))
+        return result.rowcount > 0
+
+    @classmethod
+    def purge(cls, max_age):
+        """Delete the jobs older than max_age seconds, and the artifacts
+        no longer used by a job or an attachment."""
+        from ..lib.attachment_service import AttachmentService
+        from .attachment import File
+        db = cls.default_db
+        old_jobs = db.query(cls).filter(
+            cls.created < datetime.utcnow() - timedelta(seconds=max_age))
+        identities = {job.file_identity for job in old_jobs
+                      if job.file_identity}
+        count = old_jobs.delete(synchronize_session=False)
+        if identities:
+            used = set(ident for (ident,) in db.query(cls.file_identity).filter(
+                cls.file_identity.in_(identities)))
+            used.update(ident for (ident,) in db.query(File.file_identity).filter(
+                File.file_identity.in_(identities)))
+            service = AttachmentService.get_service()
+            for identity in identities - used:
+                service.delete_file(identity)
+        return count
+
+    def as_json(self):
+        return {
+            "id": self.id,
+            "export_type": self.export_type,
+            "params": self.parameters,
+            "status": self.status,
+            "progress": self.progress,
+            "file_size": self.file_size,
+            "error": self.error,
+            "created": self.created.isoformat() + 'Z',
+            "finished": (self.finished.isoformat() + 'Z'
+                         if self.finished else None),
+        }
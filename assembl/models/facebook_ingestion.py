@@ -0,0 +1,382 @@
+"""Concurrent, incremental ingestion of Facebook sources.
+
+:py:class:`FacebookIngestion` follows the pagination of the posts of a
+source, and fetches the comment trees and attachments of the posts on a
+bounded thread pool, all requests going through a shared rate limiter
+(:py:class:`RateLimitedGraphAPI`). What is already imported is known from
+a :py:class:`SourceIndex` of facebook ids, and the new accounts, posts and
+attachments are written by batches.
+"""
+from collections import deque, namedtuple
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from time import sleep
+
+import simplejson as json
+import transaction
+from pytz import utc
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ..lib import config, logging, metrics
+from ..lib.sqla import is_zopish
+from ..lib.mail_delivery import MemoryTokenBuckets
+from ..lib.parsedatetime import parse_datetime
+from .attachment import Document, PostAttachment
+from .auth import AgentProfile
+from .social_auth import SocialAuthAccount
+
+log = logging.getLogger()
+
+# A post or comment, with its raw attachment (None if unknown or absent)
+# and the facebook id of its parent (None for a top-level post)
+FetchedPost = namedtuple('FetchedPost', ['data', 'attachment', 'parent_id'])
+
+
+class RateLimitedGraphAPI(object):
+    """Proxy to a facebook.GraphAPI which takes a token from the rate
+    limiter before each request, waiting if necessary."""
+
+    request_methods = {
+        'get_object', 'get_objects', 'get_connections', 'request',
+        'put_object'}
+
+    def __init__(self, api, calls_per_second, burst=1, buckets=None,
+                 name='facebook'):
+        self.api = api
+        self.interval = 1.0 / calls_per_second
+        self.burst = burst
+        self.buckets = buckets or MemoryTokenBuckets()
+        self.name = name
+
+    def wait(self):
+        delay = self.buckets.acquire(
+            self.name, self.interval, self.burst, reserve=True)
+        if delay > 0:
+            metrics.counter("facebook.throttled").inc()
+            sleep(delay)
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if name not in self.request_methods:
+            return attr
+
+        def call(*args, **kwargs):
+            self.wait()
+            metrics.counter("facebook.requests").inc()
+            return attr(*args, **kwargs)
+        return call
+
+
+class SourceIndex(object):
+    """What a facebook source already imported, by facebook id: the
+    (id, ancestry) of its posts, and the (account id, profile id) of the
+    facebook accounts, looked up as needed."""
+
+    def __init__(self, source, chunk_size=500):
+        from .facebook_integration import FacebookPost
+        self.db = source.db
+        self.chunk_size = chunk_size
+        self.posts = {
+            source_post_id: (id, ancestry)
+            for (source_post_id, id, ancestry) in self.db.query(
+                FacebookPost.source_post_id, FacebookPost.id,
+                FacebookPost.ancestry).filter(
+                FacebookPost.source_id == source.id)}
+        self.users = {}
+
+    def lookup_users(self, uids):
+        """Load the facebook accounts with these uids.
+        Returns the uids which have no account."""
+        from .facebook_integration import DOMAIN
+        missing = [uid for uid in set(uids) if uid not in self.users]
+        for start in range(0, len(missing), self.chunk_size):
+            for (uid, id, profile_id) in self.db.query(
+                    SocialAuthAccount.uid, SocialAuthAccount.id,
+                    SocialAuthAccount.profile_id).filter(
+                    SocialAuthAccount.provider_domain == DOMAIN,
+                    SocialAuthAccount.uid.in_(
+                        missing[start:start + self.chunk_size])):
+                self.users[uid] = (id, profile_id)
+        return {uid for uid in missing if uid not in self.users}
+
+
+class FacebookIngestion(object):
+    """Imports the posts of a :py:class:`.facebook_integration.FacebookGenericSource`
+    and their comments.
+
+    Top-level posts come from the (sequential) pagination of the source;
+    the comment tree and attachments of each post are fetched on a pool of
+    ``concurrency`` threads, at most ``2 * concurrency`` posts ahead.
+    Posts are written ``batch_size`` top-level posts at a time, in a
+    transaction each. Known posts are skipped, unless reimporting.
+    The ``should_stop`` callable is checked before each fetched post; the
+    current batch is then written and the pending fetches dropped.
+    """
+
+    def __init__(self, source, parser, reimport=False, concurrency=None,
+                 batch_size=None, calls_per_second=None, should_stop=None):
+        self.source = source
+        self.db = source.db
+        self.parser = parser
+        self.reimport = reimport
+        self.should_stop = should_stop or (lambda: False)
+        self.concurrency = max(1, int(
+            concurrency or config.get('facebook.ingestion_concurrency', 4)))
+        self.batch_size = int(
+            batch_size or config.get('facebook.ingestion_batch_size', 50))
+        calls_per_second = float(
+            calls_per_second or config.get('facebook.calls_per_second', 10))
+        if not isinstance(parser.api, RateLimitedGraphAPI):
+            parser.api = RateLimitedGraphAPI(parser.api, calls_per_second)
+        self.source_id = source.id
+        self.discussion_id = source.discussion_id
+        self.index = SourceIndex(source)
+        # Posts which are not facebook posts of this source, but receive
+        # comments (see :py:meth:`ingest_comments`)
+        self.external_parents = set()
+        self.created_ids = []
+
+    def in_bounds(self, post, upper=None, lower=None):
+        created = parse_datetime(post.get('created_time'))
+        return not ((upper and created > upper) or
+                    (lower and created < lower))
+
+    # ------------------------- fetching (thread pool) -----------------------
+
+    def fetch_attachment(self, data, getter):
+        if data['id'] in self.index.posts and not self.reimport:
+            return None
+        try:
+            return getter(data['id'])
+        except Exception:
+            log.warning("Could not get the attachment of facebook post %s",
+                        data['id'])
+            return None
+
+    def fetch_thread(self, post):
+        """Fetch the attachment and the comments of a top-level post.
+        Returns a list of :py:data:`FetchedPost`, parents first.
+        Runs on the pool: does not use the database."""
+        parser = self.parser
+        post_id = post['id']
+        fetched = [FetchedPost(post, self.fetch_attachment(
+            post, parser.get_post_attachments), None)]
+        for comment in parser.get_comments_paginated(post):
+            fetched.append(FetchedPost(comment, self.fetch_attachment(
+                comment, parser.get_comment_attachments), post_id))
+            for sub_comment in parser.get_comments_on_comment_paginated(
+                    comment):
+                fetched.append(FetchedPost(sub_comment, self.fetch_attachment(
+                    sub_comment, parser.get_comment_attachments),
+                    comment['id']))
+        return fetched
+
+    # ------------------------------ writing ---------------------------------
+
+    def commit(self):
+        if is_zopish():
+            transaction.commit()
+        else:
+            self.db.commit()
+
+    def write_users(self, users):
+        """Create the missing facebook accounts of the {uid: user json}
+        users, and update the others when reimporting"""
+        from .auth import IdentityProvider
+        from .facebook_integration import DOMAIN
+        missing = self.index.lookup_users(users)
+        if self.reimport:
+            known = [self.index.users[uid][0] for uid in users
+                     if uid not in missing]
+            for account in self.db.query(SocialAuthAccount).filter(
+                    SocialAuthAccount.id.in_(known)) if known else ():
+                user = users[account.uid]
+                account.full_name = user.get('name')
+                account.extra_data = user
+        if not missing:
+            return
+        provider = IdentityProvider.get_by_type('facebook')
+        accounts = []
+        for uid in missing:
+            user = users[uid]
+            account = SocialAuthAccount(
+                profile=AgentProfile(name=user.get('name')),
+                identity_provider=provider,
+                provider_domain=DOMAIN,
+                uid=uid,
+                full_name=user.get('name'),
+                extra_data=user)
+            self.db.add(account)
+            accounts.append(account)
+        self.db.flush()
+        for account in accounts:
+            self.index.users[account.uid] = (account.id, account.profile_id)
+        metrics.counter("facebook.accounts_created").inc(len(accounts))
+
+    def write_documents(self, attachments):
+        """Upsert the documents of the {url: parsed attachment}
+        attachments, and return their ids by url"""
+        if not attachments:
+            return {}
+        now = datetime.utcnow()
+        table = Document.__table__
+        self.db.execute(pg_insert(table).values([
+            dict(type='document', uri_id=url, creation_date=now,
+                 discussion_id=self.discussion_id,
+                 title=attachment.get('title') or '',
+                 description=attachment.get('description'),
+                 thumbnail_url=attachment.get('thumbnail', None))
+            for (url, attachment) in attachments.iteritems()
+        ]).on_conflict_do_nothing())
+        return dict(self.db.query(Document.uri_id, Document.id).filter(
+            Document.discussion_id == self.discussion_id,
+            Document.uri_id.in_(list(attachments))))
+
+    def write(self, fetched):
+        """Write a batch of :py:data:`FetchedPost`, parents first"""
+        from assembl.lib.frontend_urls import ATTACHMENT_PURPOSES
+        from .facebook_integration import FacebookPost
+        if not fetched:
+            return
+        # The commit of the previous batch closed the session
+        self.source = self.db.query(type(self.source)).get(self.source_id)
+        parser = self.parser
+        index = self.index
+        users = {}
+        for item in fetched:
+            creator = parser.get_user_post_creator(item.data)
+            if creator:
+                users[creator['id']] = creator
+            for user in parser.get_users_post_to(item.data):
+                users.setdefault(user['id'], user)
+        self.write_users(users)
+
+        # Posts
+        new_posts = []
+        updated = {}
+        for item in fetched:
+            data = item.data
+            post_id = data['id']
+            if post_id in index.posts:
+                if self.reimport and post_id not in self.external_parents:
+                    updated[index.posts[post_id][0]] = item
+                continue
+            creator = parser.get_user_post_creator(data)
+            if not creator or (item.parent_id is not None and
+                               item.parent_id not in index.posts):
+                continue
+            post = FacebookPost.create(
+                self.source, data, creator_id=index.users[creator['id']][1])
+            if item.attachment:
+                post.attachment_blob = json.dumps({u'data': item.attachment})
+            self.db.add(post)
+            new_posts.append((item, post))
+            # Children come later in the batch
+            index.posts[post_id] = (post, None)
+        if updated:
+            for post in self.db.query(FacebookPost).filter(
+                    FacebookPost.id.in_(list(updated))):
+                item = updated[post.id]
+                post.update_fields(item.data, None, reprocess=True)
+                post.creator_id = index.users[
+                    parser.get_user_post_creator(item.data)['id']][1]
+                if item.attachment:
+                    post.attachment_blob = json.dumps(
+                        {u'data': item.attachment})
+                    self.source.clear_post_attachments(post)
+                new_posts.append((item, post))
+        self.db.flush()
+        for (item, post) in new_posts:
+            if isinstance(index.posts[item.data['id']][0], FacebookPost):
+                parent_ancestry = None
+                if item.parent_id is not None:
+                    (parent_id, parent_ancestry) = index.posts[item.parent_id]
+                    if isinstance(parent_id, FacebookPost):
+                        (parent_id, parent_ancestry) = (
+                            parent_id.id, parent_id.ancestry)
+                    post.parent_id = parent_id
+                    post.ancestry = "%s%d," % (parent_ancestry or '',
+                                               parent_id)
+                index.posts[item.data['id']] = (post.id, post.ancestry or '')
+
+        # Attachments
+        attachments = []
+        for (item, post) in new_posts:
+            attachment = parser.parse_attachment(item.attachment)
+            if attachment and attachment.get('url'):
+                attachments.append((post, attachment))
+        document_ids = self.write_documents({
+            attachment['url']: attachment
+            for (post, attachment) in attachments})
+        creator_id = self.source.creator.profile_id \
+            if self.source.creator else None
+        for (post, attachment) in attachments:
+            self.db.add(PostAttachment(
+                post=post,
+                discussion_id=self.discussion_id,
+                title=attachment.get('title'),
+                description=attachment.get('description'),
+                document_id=document_ids[attachment['url']],
+                creator_id=creator_id or post.creator_id,
+                attachmentPurpose=ATTACHMENT_PURPOSES.get(
+                    'EMBED_ATTACHMENT')))
+        self.db.flush()
+        created = [post.id for (item, post) in new_posts]
+        self.commit()
+        metrics.counter("facebook.posts_written").inc(len(created))
+        self.created_ids.extend(created)
+        if created:
+            from ..tasks.translate import translate_discussion
+            translate_discussion.delay(self.discussion_id, post_ids=created)
+
+    # ------------------------------ pipeline --------------------------------
+
+    def ingest(self, posts, upper=None, lower=None):
+        """Import the top-level posts, from an iterator of post json
+        in reverse chronological order, within the bounds, and their
+        comments. Returns the ids of the written posts."""
+        # Post dates are naive UTC
+        (upper, lower) = [
+            bound.astimezone(utc).replace(tzinfo=None)
+            if bound is not None and bound.tzinfo is not None else bound
+            for bound in (upper, lower)]
+        pool = ThreadPool(self.concurrency)
+        pending = deque()
+        batch = []
+        batch_posts = 0
+        try:
+            posts = iter(posts)
+            exhausted = False
+            while pending or not exhausted:
+                if self.should_stop():
+                    # Write what is batched, drop what is being fetched
+                    log.info("Stopping the ingestion of facebook source %d",
+                             self.source_id)
+                    break
+                while not exhausted and len(pending) < 2 * self.concurrency:
+                    post = next(posts, None)
+                    if post is None or not self.in_bounds(post, upper, lower):
+                        # Bound reached: do not read further back
+                        exhausted = True
+                        break
+                    pending.append(pool.apply_async(self.fetch_thread, (post,)))
+                if not pending:
+                    break
+                batch.extend(pending.popleft().get())
+                batch_posts += 1
+                if batch_posts >= self.batch_size:
+                    self.write(batch)
+                    batch = []
+                    batch_posts = 0
+            self.write(batch)
+        finally:
+            pool.terminate()
+        return self.created_ids
+
+    def ingest_comments(self, post, parent_post):
+        """Import the comments of a facebook post under an existing post
+        which is not a facebook post of this source."""
+        self.index.posts[post['id']] = (
+            parent_post.id, parent_post.ancestry or '')
+        self.external_parents.add(post['id'])
+        return self.ingest([post])
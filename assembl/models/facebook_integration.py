@@ -518,11 +518,13 @@ class FacebookGenericSource(PostSource):
     }
 
     @abstractmethod
-    def fetch_content(self, lower_bound=None, upper_bound=None):
+    def fetch_content(self, lower_bound=None, upper_bound=None,
+                      reimport=False, should_stop=None):
         """ The entry point of creating posts
 
         :param DateTime lower_bound: Read posts up to this back in time
         :param DateTime uppder_bound: Read future posts up to this time
+        :param should_stop: a callable, true when the reading must stop
         """
         self._setup_reading()
 
@@ -601,45 +603,6 @@ class FacebookGenericSource(PostSource):
             filter_by(discussion=self.discussion).all()
         return results
 
-    def _create_fb_user(self, user, db):
-        if user['id'] not in db:
-            # avatar_url = self.parser.get_user_profile_photo(user)
-            userid = user.get('id')
-            new_user = SocialAuthAccount(
-                profile=user,
-                identity_provider=self.provider,
-                full_name=user.get("name"),
-                userid=userid,
-                provider_domain=self.parser.get_app_id(),
-                picture_url='http://graph.facebook.com/%s/picture' % (userid,)
-            )
-            self.db.add(new_user)
-            self.db.flush()
-            db[user['id']] = new_user
-
-    def _create_or_update_fb_user(self, user, db):
-        user_id = user['id']
-        if user_id in db:
-            account = db.get(user_id)
-            account.update_fields(user)
-        else:
-            self._create_fb_user(user, db)
-
-    def _create_post(self, post, user, db):
-        # Utility method that creates the post and populates the local
-        # cache.
-        # Returns True if succesfull. False if post is not created.
-        post_id = post.get('id')
-        if post_id in db:
-            return True
-        new_post = FacebookPost.create(self, post, user)
-        if not new_post:
-            return False
-        self.db.add(new_post)
-        self.db.flush()
-        db[post_id] = new_post
-        return True
-
     def _url_exists(self, url, ls):
         "Internal function for attachment management"
         for l in ls:
@@ -728,260 +691,46 @@ class FacebookGenericSource(PostSource):
         for attach in attachs:
             self.db.delete(attach)
 
-    def _create_or_update_attachment(self, post, assembl_post, reimport,
-                                     getter):
-        if reimport:
-            # This makes the underlying assumption that a facebook
-            # post only has ONE attachment
-            self.clear_post_attachments(assembl_post)
-            self._create_attachments(post, assembl_post, getter)
-
-        else:
-            self._create_attachments(post, assembl_post, getter)
-
-    def _manage_user(self, creator, users_db, reimport):
-        if reimport:
-            self._create_or_update_fb_user(creator, users_db)
-        else:
-            self._create_fb_user(creator, users_db)
-
-    def _create_or_update_post(self, post, creator, posts_db, reimport):
-        from ..tasks.translate import translate_content
-        post_id = post.get('id')
-        assembl_post = posts_db.get(post_id, None)
-        if assembl_post:
-            if reimport:
-                assembl_post.update_fields(post, creator)
-                # An update was made
-        else:
-            assembl_post = self._create_post(post, creator, posts_db)
-        # Note: I wish this machinery had been put in the SourceReader,
-        # instead of in the Source... I could then call
-        # SourceReader.handle_new_content() instead of copying it.
-        translate_content(assembl_post)  # should delay
-        return assembl_post
-
-    def _manage_post(self, post, obj_id, posts_db, users_db,
-                     upper, lower, reimport=False):
-        """ Method that parses the json parsed facebook post and delegates
-        the creation of an Assembl post
-
-        :param post - The json parsed post data
-        :param obj_id - The facebook ID of the creator of the content
-        :param posts_db - The cache of all posts currently imported from
-                            this source
-        :param users_db - The cache of all SocialAuthAccounts in the database
-        :param upper - DateTime object describing up to which datetime
-                        new messages are accepted.
-        :param lower - DateTime object describing up to which datetime
-                        old messages are accepted.
-        :param reimport - Boolean to describe if current action is to reimport
-
-        """
-        cont = True
-        post_created_time = parse_datetime(post.get('created_time'))
-        if not upper:
-            upper = self.upper_bound
-        if not lower:
-            lower = self.lower_bound
-        if upper:
-            if post_created_time > upper:
-                cont = False
-        if lower:
-            if post_created_time < lower:
-                cont = False
-
-        if cont:
-            post_id = post.get('id')
-            creator = self.parser.get_user_post_creator(post)
-            self._manage_user(creator, users_db, reimport)
-
-            # Get all of the tagged users instead?
-            for user in self.parser.get_users_post_to_sans_self(post, obj_id):
-                self._manage_user(user, users_db, reimport)
-
-            creator_id = creator.get('id', None)
-            creator_agent = users_db.get(creator_id)
-            result = self._create_or_update_post(post, creator_agent,
-                                                 posts_db, reimport)
-
-            if not result:
-                return
-
-            assembl_post = posts_db.get(post_id)
-            self._create_or_update_attachment(post, assembl_post, reimport,
-                                              self.parser.get_post_attachments)
-            # self._create_attachments(post, assembl_post, reimport,
-            #                          self.parser.get_post_attachments)
-            self.db.commit()
-            # Refresh the instance
-            self.db.query(self.__class__).populate_existing().get(self.id)
-            return assembl_post, cont
-
-        else:
-            return None, cont
-
-    def _manage_comment(self, comment, parent_post, posts_db, users_db,
-                        reimport=False):
-        user = self.parser.get_user_from_comment(comment)
-        user_id = user.get('id')
-        comment_id = comment.get('id')
-        self._manage_user(user, users_db, reimport)
-        # self._create_fb_user(user, users_db)
-        for usr in self.parser.get_users_from_mention(comment):
-            # self._create_fb_user(usr, users_db)
-            self._manage_user(user, users_db, reimport)
-        self.db.commit()
-        # Refresh the instance
-        self.db.query(self.__class__).populate_existing().get(self.id)
-        self.db.query(parent_post.__class__).populate_existing(
-            ).get(parent_post.id)
-
-        cmt_creator_agent = users_db.get(user_id)
-        # cmt_result = self._create_post(comment, cmt_creator_agent, posts_db)
-        cmt_result = self._create_or_update_post(comment, cmt_creator_agent,
-                                                 posts_db, reimport)
-
-        if not cmt_result:
-            return
-
-        self.db.flush()
-        comment_post = posts_db.get(comment_id)
-        comment_post.set_parent(parent_post)
-        # self._create_attachments(comment, comment_post,
-        #                          self.parser.get_comment_attachments)
-        self._create_or_update_attachment(comment, comment_post, reimport,
-                                          self.parser.get_comment_attachments)
-        self.db.commit()
-        # Refresh the instance
-        self.db.query(self.__class__).populate_existing().get(self.id)
-        return comment_post
-
-    def _manage_comment_subcomments(self, comment, parent_post,
-                                    posts_db, users_db,
-                                    sub_comments=False,
-                                    reimport=False):
-        comment_post = self._manage_comment(comment, parent_post,
-                                            posts_db, users_db, reimport)
-        if comment_post and sub_comments:
-            for cmt in self.parser.get_comments_on_comment_paginated(comment):
-                self._manage_comment(cmt, comment_post, posts_db, users_db,
-                                     reimport=reimport)
-                if self.read_status == ReaderStatus.SHUTDOWN:
-                    break
-
-    def feed(self, upper_bound=None, lower_bound=None, reimport=False):
-        users_db = self._get_current_users()
-        posts_db = self._get_current_posts()
+    def _ingestion(self, reimport=False, should_stop=None):
+        from .facebook_ingestion import FacebookIngestion
+        return FacebookIngestion(self, self.parser, reimport=reimport,
+                                 should_stop=should_stop)
 
-        object_info = self.parser.get_object_info(self.fb_source_id)
+    def feed(self, upper_bound=None, lower_bound=None, reimport=False,
+             should_stop=None):
+        self._ingestion(reimport, should_stop).ingest(
+            self.parser.get_feed_paginated(self.fb_source_id),
+            upper_bound or self.upper_bound, lower_bound or self.lower_bound)
 
-        self._manage_user(
-            self.parser.get_user_object_creator(object_info),
-            users_db,
-            reimport
-        )
-
-        for post in self.parser.get_feed_paginated(self.fb_source_id):
-            assembl_post, cont = self._manage_post(post, self.fb_source_id,
-                                                   posts_db, users_db,
-                                                   upper_bound,
-                                                   lower_bound,
-                                                   reimport=reimport
-                                                   )
-
-            if not assembl_post:
-                # If a bound is reached, there is no post created, so do
-                # not continue any further
-                if not cont:
-                    break
-                continue
-
-            if self.read_status == ReaderStatus.SHUTDOWN:
-                break
-            for comment in self.parser.get_comments_paginated(post):
-                self._manage_comment_subcomments(comment, assembl_post,
-                                                 posts_db, users_db,
-                                                 reimport=reimport,
-                                                 sub_comments=True)
-                if self.read_status == ReaderStatus.SHUTDOWN:
-                    return
-
-    def posts(self, upper=None, lower=None, reimport=False):
-        users_db = self._get_current_users()
-        posts_db = self._get_current_posts()
-
-        for post in self.parser.get_posts_paginated(self.fb_source_id):
-            assembl_post, cont = self._manage_post(post, self.fb_source_id,
-                                                   posts_db, users_db,
-                                                   upper, lower,
-                                                   reimport=reimport)
-            if not assembl_post:
-                # If a bound is reached, there is no post created, so do
-                # not continue any further
-                if not cont:
-                    break
-                continue
-
-            if self.read_status == ReaderStatus.SHUTDOWN:
-                break
-            for comment in self.parser.get_comments_paginated(post):
-                self._manage_comment_subcomments(comment, assembl_post,
-                                                 posts_db, users_db,
-                                                 reimport=reimport,
-                                                 sub_comments=True)
-                if self.read_status == ReaderStatus.SHUTDOWN:
-                    return
+    def posts(self, upper=None, lower=None, reimport=False,
+              should_stop=None):
+        self._ingestion(reimport, should_stop).ingest(
+            self.parser.get_posts_paginated(self.fb_source_id),
+            upper or self.upper_bound, lower or self.lower_bound)
 
     def single_post(self, upper_bound=None, lower_bound=None,
-                    reimport=False):
+                    reimport=False, should_stop=None):
         # Only use if the content source is a single post
-        users_db = self._get_current_users()
-        posts_db = self._get_current_posts()
-
-        # Get the post, then iterate through the comments of the post
         post = self.parser.get_single_post(self.fb_source_id)
 
         if not post:
             # Post was deleted, or some other error occured
             return
 
-        entity_id = post.get('from', {}).get('id', None)
-        assembl_post, cont = self._manage_post(post, entity_id,
-                                               posts_db, users_db,
-                                               upper_bound, lower_bound,
-                                               reimport=reimport)
-
-        if not cont:
-            # If a bound has been reached, do not continue parsing the
-            # comments
-            return
-
-        if assembl_post:
-            for comment in self.parser.get_comments_paginated(post):
-                self._manage_comment_subcomments(comment, assembl_post,
-                                                 posts_db, users_db,
-                                                 reimport=reimport,
-                                                 sub_comments=True)
-                if self.read_status == ReaderStatus.SHUTDOWN:
-                    return
-
-    def single_post_comments_only(self, parent_post, reimport=False):
-        users_db = self._get_current_users()
-        posts_db = self._get_current_posts()
+        self._ingestion(reimport, should_stop).ingest(
+            [post], upper_bound or self.upper_bound,
+            lower_bound or self.lower_bound)
 
+    def single_post_comments_only(self, parent_post, reimport=False,
+                                  should_stop=None):
         post = self.parser.get_single_post(self.fb_source_id)
+        if not post:
+            return
 
         # The root post will not be a FacebookPost, but all of the comments
         # will be.
-
-        for comment in self.parser.get_comments_paginated(post):
-            self._manage_comment_subcomments(comment, parent_post,
-                                             posts_db, users_db,
-                                             reimport=reimport,
-                                             sub_comments=True)
-            if self.read_status == ReaderStatus.SHUTDOWN:
-                return
+        self._ingestion(reimport, should_stop).ingest_comments(
+            post, parent_post)
 
     def reprocess(self):
         "Update all posts/users from this source without hitting the network"
@@ -1046,12 +795,12 @@ class FacebookGroupSource(FacebookGenericSource):
     }
 
     def fetch_content(self, lower_bound=None, upper_bound=None,
-                      reimport=False):
+                      reimport=False, should_stop=None):
         self._setup_reading()
         lower_bound = lower_bound or self.lower_bound
         upper_bound = upper_bound or self.upper_bound
         self.feed(lower_bound=lower_bound, upper_bound=upper_bound,
-                  reimport=reimport)
+                  reimport=reimport, should_stop=should_stop)
 
 
 class FacebookGroupSourceFromUser(FacebookGenericSource):
@@ -1060,12 +809,12 @@ class FacebookGroupSourceFromUser(FacebookGenericSource):
     }
 
     def fetch_content(self, lower_bound=None, upper_bound=None,
-                      reimport=False):
+                      reimport=False, should_stop=None):
         self._setup_reading()
         lower_bound = lower_bound or self.lower_bound
         upper_bound = upper_bound or self.upper_bound
         self.feed(lower_bound=lower_bound, upper_bound=upper_bound,
-                  reimport=reimport)
+                  reimport=reimport, should_stop=should_stop)
 
 
 class FacebookPagePostsSource(FacebookGenericSource):
@@ -1074,12 +823,12 @@ class FacebookPagePostsSource(FacebookGenericSource):
     }
 
     def fetch_content(self, lower_bound=None, upper_bound=None,
-                      reimport=False):
+                      reimport=False, should_stop=None):
         self._setup_reading()
         lower_bound = lower_bound or self.lower_bound
         upper_bound = upper_bound or self.upper_bound
-        self.posts(lower_bound=lower_bound, upper_bound=upper_bound,
-                   reimport=reimport)
+        self.posts(upper=upper_bound, lower=lower_bound, reimport=reimport,
+                   should_stop=should_stop)
 
 
 class FacebookPageFeedSource(FacebookGenericSource):
@@ -1088,12 +837,12 @@ class FacebookPageFeedSource(FacebookGenericSource):
     }
 
     def fetch_content(self, lower_bound=None, upper_bound=None,
-                      reimport=False):
+                      reimport=False, should_stop=None):
         self._setup_reading()
         lower_bound = lower_bound or self.lower_bound
         upper_bound = upper_bound or self.upper_bound
         self.feed(lower_bound=lower_bound, upper_bound=upper_bound,
-                  reimport=reimport)
+                  reimport=reimport, should_stop=should_stop)
 
 
 class FacebookSinglePostSource(FacebookGenericSource):
@@ -1102,17 +851,18 @@ class FacebookSinglePostSource(FacebookGenericSource):
     }
 
     def fetch_content(self, lower_bound=None, upper_bound=None,
-                      reimport=False):
+                      reimport=False, should_stop=None):
         # Limit should not apply here, unless the limit is in reference to
         # number of comments brought in
         is_sink, cs = self.content_sink()
         if is_sink:
             parent_post = cs.post
             self._setup_reading()
-            self.single_post_comments_only(parent_post, reimport=reimport)
+            self.single_post_comments_only(
+                parent_post, reimport=reimport, should_stop=should_stop)
         else:
             self._setup_reading()
-            self.single_post(reimport=reimport)
+            self.single_post(reimport=reimport, should_stop=should_stop)
 
 
 class FacebookAccessToken(Base):
@@ -1265,16 +1015,21 @@ class FacebookPost(ImportedPost):
     }
 
     @classmethod
-    def create(cls, source, post, user):
+    def create(cls, source, post, user=None, creator_id=None):
+        """A post from its json, created by the account user,
+        or the profile with creator_id"""
         import_date = datetime.utcnow()
         source_post_id = post.get('id')
         creation_date = parse_datetime(post.get('created_time'))
         discussion = source.discussion
-        creator_agent = user.profile
         blob = json.dumps(post)
         body = post.get('message')
         subject = post.get('story', None)
         # TODO AY: Can we get the post language from facebook?
+        if user is not None:
+            creator = dict(creator=user.profile)
+        else:
+            creator = dict(creator_id=creator_id)
 
         return cls(
             # attachment=attachment,
@@ -1285,11 +1040,11 @@ class FacebookPost(ImportedPost):
             source=source,
             creation_date=creation_date,
             discussion=discussion,
-            creator=creator_agent,
             # post_type=post_type,
             imported_blob=blob,
             subject=LangString.create(subject),
-            body=LangString.create(body)
+            body=LangString.create(body),
+            **creator
         )
 
     def update_from_imported_json(self):
@@ -1300,8 +1055,8 @@ class FacebookPost(ImportedPost):
         _now = datetime.utcnow()
         fb_id = post.get('id')
         self.import_date = _now
-        self.body = post.get('message')
-        self.subject = post.get('story', None)
+        self.body = LangString.create(post.get('message'))
+        self.subject = LangString.create(post.get('story', None))
         self.source_post_id = fb_id
         self.creation_date = parse_datetime(post.get('created_time'))
         self.message_id = self.source.generate_message_id(fb_id)
@@ -1347,7 +1102,8 @@ class FacebookReader(PullSourceReader):
                              hour=23, minute=59, second=59, tzinfo=pytz.UTC)
 
         if not reprocess:
-            self.source.fetch_content(upper_bound=upper, lower_bound=lower,
-                                      reimport=reimport)
+            self.source.fetch_content(
+                upper_bound=upper, lower_bound=lower, reimport=reimport,
+                should_stop=lambda: self.status == ReaderStatus.SHUTDOWN)
         else:
             self.source.reprocess()
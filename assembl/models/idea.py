@@ -21,6 +21,7 @@ from sqlalchemy import (
     ForeignKey,
     select,
     func,
+    inspect,
 )
 from sqlalchemy.ext.associationproxy import association_proxy
 from pyramid.i18n import TranslationStringFactory
@@ -101,11 +102,13 @@ class AppendingVisitor(IdeaVisitor):
 
 
 class WordCountVisitor(IdeaVisitor):
-    """A Visitor that counts words related to an idea"""
+    """A Visitor that counts words related to an idea.
+    The posts are counted from their stored counts, see
+    :py:mod:`assembl.models.stem_index`."""
 
     def __init__(self, langs, count_posts=True):
         self.counter = WordCounter(langs)
-        self.count_posts = True
+        self.count_posts = count_posts
 
     def cleantext(self, text):
         return sanitize_text(text)
@@ -119,22 +122,13 @@ class WordCountVisitor(IdeaVisitor):
             self.counter.add_text(self.cleantext(idea.definition))
         if self.count_posts and level == 0:
             from .generic import Content
-            query = idea.db.query(Content)
+            from .stem_index import PostStemIndex
             related = idea.get_related_posts_query(True, include_moderating=False)
-            query = query.join(related, Content.id == related.c.post_id
+            post_ids = idea.db.query(Content.id.label('post_id')).join(
+                related, Content.id == related.c.post_id
                 ).filter(Content.hidden == False,  # noqa: E712
-                         Content.tombstone_condition()).options(
-                    Content.subqueryload_options())
-            titles = set()
-            # TODO maparent: Group langstrings by language.
-            for content in query:
-                body = content.body.first_original().value
-                self.counter.add_text(self.cleantext(body), 0.5)
-                title = content.subject.first_original().value
-                title = self.cleantext(title)
-                if title not in titles:
-                    self.counter.add_text(title)
-                    titles.add(title)
+                         Content.tombstone_condition())
+            PostStemIndex.add_counts(idea.db, post_ids, self.counter)
 
     def best(self, num=8):
         return self.counter.best(num)
@@ -491,12 +485,14 @@ class Idea(HistoryMixin, DiscussionBoundBase):
             return counters.paths[root_idea_id].as_clause(
                 cls.default_db(), discussion_id, counters.user_id, Content,
                 include_deleted=include_deleted,
-                include_moderating=include_moderating)
+                include_moderating=include_moderating,
+                read_ids=counters.read_ids if counters.user_id else None)
 
-    def top_keywords(
-            self, limit=30, group=True, display_lang='en', filter_lang=None):
+    def keyword_scores_query(self, group=True, filter_lang=None):
+        """The (score, count, id) of the tags of the related posts,
+        best first. The tag id is that of the group if grouped."""
         from .nlp import PostKeywordAnalysis, Tag
-        from .langstrings import LangStringEntry, Locale
+        from .langstrings import Locale
 
         group = group and not filter_lang  # Cannot filter and group
 
@@ -517,9 +513,19 @@ class Idea(HistoryMixin, DiscussionBoundBase):
 
         if filter_lang:
             sq = sq.join(Locale).filter(Locale.code == filter_lang)
-        sq = sq.group_by(
+        return sq.group_by(
             tag_col
         ).order_by(func.sum(PostKeywordAnalysis.score).desc())
+
+    def top_keywords(
+            self, limit=30, group=True, display_lang='en', filter_lang=None,
+            translate=True):
+        from .nlp import Tag
+        from .langstrings import LangStringEntry, Locale
+
+        group = group and not filter_lang  # Cannot filter and group
+
+        sq = self.keyword_scores_query(group, filter_lang)
         if limit:
             sq = sq.limit(limit)
         sq = sq.subquery()
@@ -532,7 +538,7 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         else:
             label_cond = (Locale.code == display_lang) \
                 | (Locale.code.like(display_lang + '-x-mtfrom-%'))
-            if display_lang != 'en':
+            if translate and display_lang != 'en':
                 untranslated = self.db.query(
                     LangString
                 ).join(
@@ -559,6 +565,20 @@ class Idea(HistoryMixin, DiscussionBoundBase):
             q = q.add_columns(Locale.code)
         return q.all()
 
+    def rolled_up_keywords(self, limit=30, display_lang='en'):
+        """The grouped top keywords of the idea, as materialized by
+        :py:class:`assembl.models.keyword_rollup.IdeaKeywordRollup`,
+        possibly stale until the refresh task recomputes it.
+        Falls back to :py:meth:`top_keywords`, without translating
+        the labels, until the rollup is computed."""
+        from .keyword_rollup import IdeaKeywordRollup
+        result = IdeaKeywordRollup.top_keywords(
+            self.db, self.id, limit, display_lang)
+        if result is None:
+            result = self.top_keywords(
+                limit, display_lang=display_lang, translate=False)
+        return result
+
     def sentiments(self):
         from .nlp import PostWatsonV1SentimentAnalysis
 
@@ -621,20 +641,22 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         """ Requires discussion_id bind parameters
         Excludes synthesis posts """
         counters = cls.prepare_counters(discussion_id)
+        read_status = get_read_status and counters.user_id
         return counters.orphan_clause(
             counters.user_id if get_read_status else None,
             content_alias, include_deleted=include_deleted,
-            include_moderating=include_moderating)
+            include_moderating=include_moderating,
+            read_ids=counters.read_ids if read_status else None)
 
     @property
     def num_posts(self):
         counters = self.prepare_counters(self.discussion_id)
-        return counters.get_counts(self.id)[0]
+        return counters.get_post_counts(self.id)[0]
 
     @property
     def num_contributors(self):
         counters = self.prepare_counters(self.discussion_id)
-        return counters.get_counts(self.id)[1]
+        return counters.get_post_counts(self.id)[1]
 
     @property
     def num_read_posts(self):
@@ -763,13 +785,23 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         return idea_visitor.end_visit(self, level, prev_result, child_results)
 
     def most_common_words(self, lang=None, num=8):
+        from .stem_index import get_keywords_cache
         if lang:
             langs = (lang,)
         else:
             langs = self.discussion.discussion_locales
+        cache = get_keywords_cache()
+        if cache is not None:
+            key = cache.key(self.discussion_id, self.id, langs, num)
+            words = cache.get(key)
+            if words is not None:
+                return words
         word_counter = WordCountVisitor(langs)
         self.visit_ideas_depth_first(word_counter)
-        return word_counter.best(num)
+        words = word_counter.best(num)
+        if cache is not None:
+            cache.set(key, words)
+        return words
 
     @property
     def most_common_words_prop(self):
@@ -872,6 +904,11 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         else:
             super(Idea, self).send_to_changes(
                 connection, operation, discussion_id, view_def)
+        if operation != CrudOperation.UPDATE or any(
+                inspect(self).attrs[attr].history.has_changes()
+                for attr in ('tombstone_date', 'messages_in_parent')):
+            self.reset_discussion_counters(
+                discussion_id or self.discussion_id)
         watcher = get_model_watcher()
         if operation == CrudOperation.UPDATE:
             watcher.processIdeaModified(self.id, 0)  # no versions yet.
@@ -880,6 +917,14 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         elif operation == CrudOperation.CREATE:
             watcher.processIdeaCreated(self.id)
 
+    @staticmethod
+    def reset_discussion_counters(discussion_id):
+        "The idea hierarchy changed; discussion counters must be rebuilt."
+        from .path_utils import get_counter_store
+        counter_store = get_counter_store()
+        if counter_store is not None:
+            counter_store.hierarchy_changed(discussion_id)
+
     def __repr__(self):
         r = super(Idea, self).__repr__()
         title = self.short_title or ""
@@ -892,42 +937,64 @@ class Idea(HistoryMixin, DiscussionBoundBase):
     @classmethod
     def get_idea_ids_showing_post(cls, post_id):
         "Given a post, give the ID of the ideas that show this message"
+        return cls.get_idea_ids_showing_posts([post_id])
+
+    @classmethod
+    def get_idea_ids_showing_posts(cls, post_ids):
+        """Given posts of a discussion, give the ID of the ideas that show
+        any of those messages"""
         from sqlalchemy.sql.functions import func
         from .idea_content_link import IdeaContentPositiveLink
         from .post import Post
-        (ancestry, discussion_id, idea_link_ids) = cls.default_db.query(
-            Post.ancestry, Post.discussion_id,
-            func.idea_content_links_above_post(Post.id)
-            ).filter(Post.id == post_id).first()
-        post_path = "%s%d," % (ancestry, post_id)
-        if not idea_link_ids:
+        post_ids = list(post_ids)
+        if not post_ids:
+            return []
+        idea_link_ids_by_path = {}
+        for (post_id, ancestry, discussion_id, idea_link_ids) in \
+                cls.default_db.query(
+                    Post.id, Post.ancestry, Post.discussion_id,
+                    func.idea_content_links_above_post(Post.id)
+                ).filter(Post.id.in_(post_ids)):
+            if idea_link_ids:
+                idea_link_ids_by_path["%s%d," % (ancestry, post_id)] = [
+                    int(id) for id in idea_link_ids.split(',') if id]
+        if not idea_link_ids_by_path:
             return []
-        idea_link_ids = [int(id) for id in idea_link_ids.split(',') if id]
         # This could be combined with previous in postgres.
-        root_ideas = cls.default_db.query(
-            IdeaContentPositiveLink.idea_id.distinct()
+        idea_id_by_link_id = dict(cls.default_db.query(
+            IdeaContentPositiveLink.id, IdeaContentPositiveLink.idea_id
             ).filter(
                 IdeaContentPositiveLink.idea_id != None,  # noqa: E711
-                IdeaContentPositiveLink.id.in_(idea_link_ids)).all()
-        if not root_ideas:
+                IdeaContentPositiveLink.id.in_(set(chain(
+                    *idea_link_ids_by_path.itervalues())))))
+        if not idea_id_by_link_id:
             return []
-        root_ideas = [x for (x,) in root_ideas]
         discussion_data = cls.get_discussion_data(discussion_id)
         counter = cls.prepare_counters(discussion_id)
-        idea_contains = {}
-        for root_idea_id in root_ideas:
-            for idea_id in discussion_data.idea_ancestry(root_idea_id):
-                if idea_id in idea_contains:
-                    break
-                idea_contains[idea_id] = counter.paths[idea_id].includes_post(post_path)
-        ideas = [id for (id, incl) in idea_contains.iteritems() if incl]
-        return ideas
+        ideas = set()
+        for post_path, idea_link_ids in idea_link_ids_by_path.iteritems():
+            root_ideas = {idea_id_by_link_id[id] for id in idea_link_ids
+                          if id in idea_id_by_link_id}
+            idea_contains = {}
+            for root_idea_id in root_ideas:
+                for idea_id in discussion_data.idea_ancestry(root_idea_id):
+                    if idea_id in idea_contains:
+                        break
+                    idea_contains[idea_id] = counter.paths[idea_id].includes_post(post_path)
+            ideas.update(id for (id, incl) in idea_contains.iteritems() if incl)
+        return list(ideas)
 
     @classmethod
     def idea_read_counts(cls, discussion_id, post_id, user_id):
         """Given a post and a user, give the total and read count
             of posts for each affected idea"""
-        idea_ids = cls.get_idea_ids_showing_post(post_id)
+        return cls.ideas_read_counts(discussion_id, [post_id], user_id)
+
+    @classmethod
+    def ideas_read_counts(cls, discussion_id, post_ids, user_id):
+        """Given posts and a user, give the read count
+            of posts for each idea showing any of the posts"""
+        idea_ids = cls.get_idea_ids_showing_posts(post_ids)
         if not idea_ids:
             return []
         ideas = cls.default_db.query(cls).filter(cls.id.in_(idea_ids))
@@ -1286,16 +1353,16 @@ class RootIdea(Idea):
     def num_read_posts(self):
         """ In the root idea, num_read_posts is the count of all non-deleted read mesages in the discussion """
         from .post import Post, countable_publication_states
-        from .action import ViewPost
+        from .read_status import PostReadSet
         discussion_data = self.get_discussion_data(self.discussion_id)
+        if not discussion_data.user_id:
+            return 0
         result = self.db.query(Post).filter(
             Post.publication_state.in_(countable_publication_states),
             Post.discussion_id == self.discussion_id,
             Post.hidden == False,  # noqa: E712
-            Post.tombstone_condition()
-        ).join(
-            ViewPost,
-            (ViewPost.post_id == Post.id) & (ViewPost.tombstone_date == None) & (ViewPost.actor_id == discussion_data.user_id)
+            Post.tombstone_condition(),
+            PostReadSet.read_clause(Post.id, discussion_data.read_ids)
         ).count()
         return int(result)
 
@@ -1319,7 +1386,7 @@ class RootIdea(Idea):
     def num_orphan_posts(self):
         "The number of posts unrelated to any idea in the current discussion"
         counters = self.prepare_counters(self.discussion_id)
-        return counters.get_orphan_counts()[0]
+        return counters.get_orphan_post_counts()[0]
 
     @property
     def num_synthesis_posts(self):
@@ -1419,6 +1486,8 @@ class IdeaLink(HistoryMixin, DiscussionBoundBase):
         else:
             super(IdeaLink, self).send_to_changes(
                 connection, operation, discussion_id, view_def)
+        Idea.reset_discussion_counters(
+            discussion_id or self.get_discussion_id())
 
     @classmethod
     def get_discussion_conditions(cls, discussion_id, alias_maker=None):
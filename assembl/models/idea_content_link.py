@@ -8,6 +8,7 @@ from enum import Enum
 import assembl.graphql.docstrings as docs
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy import (
+    inspect,
     Column,
     Boolean,
     Integer,
@@ -95,6 +96,31 @@ class IdeaContentLink(DiscussionBoundBase):
     discussion = relationship(
         Discussion, viewonly=True, uselist=False, secondary=Content.__table__)
 
+    def send_to_changes(self, connection=None, operation=CrudOperation.UPDATE,
+                        discussion_id=None, view_def="changes"):
+        """Also update the discussion counters"""
+        super(IdeaContentLink, self).send_to_changes(
+            connection, operation, discussion_id, view_def)
+        idea_ids = {self.idea_id}
+        if operation == CrudOperation.UPDATE:
+            idea_ids.update(inspect(self).attrs.idea_id.history.deleted)
+        discussion_id = discussion_id or self.get_discussion_id()
+        self.update_discussion_counters(discussion_id, idea_ids)
+        if isinstance(self, IdeaContentPositiveLink):
+            from .keyword_rollup import IdeaKeywordRollup
+            IdeaKeywordRollup.mark_dirty(
+                self.db, discussion_id, idea_ids, connection or self.db.connection())
+
+    @staticmethod
+    def update_discussion_counters(discussion_id, idea_ids):
+        from .path_utils import get_counter_store
+        counter_store = get_counter_store()
+        if counter_store is None:
+            return
+        for idea_id in idea_ids:
+            if idea_id:
+                counter_store.content_links_changed(discussion_id, idea_id)
+
     @classmethod
     def base_conditions(cls, alias=None, alias_maker=None):
         if alias_maker is None:
@@ -125,6 +151,19 @@ def idea_content_link_idea_set_listener(target, value, oldvalue, initiator):
                 ancestor.send_to_changes()
 
 
+@event.listens_for(IdeaContentLink, 'after_delete', propagate=True)
+def idea_content_link_delete_listener(mapper, connection, target):
+    """Deleted links also affect the discussion counters."""
+    if target.idea_id and target.content is not None:
+        IdeaContentLink.update_discussion_counters(
+            target.content.discussion_id, (target.idea_id,))
+        if isinstance(target, IdeaContentPositiveLink):
+            from .keyword_rollup import IdeaKeywordRollup
+            IdeaKeywordRollup.mark_dirty(
+                target.db, target.content.discussion_id, (target.idea_id,),
+                connection)
+
+
 class IdeaContentPositiveLink(IdeaContentLink):
     """
     A normal link between an idea and a Content.
@@ -12,6 +12,10 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     UniqueConstraint,
+    select,
+    intersect,
+    literal,
+    func,
 )
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import join
@@ -21,7 +25,8 @@ from .discussion import Discussion
 from .langstrings import LangString
 from ..auth import (
     CrudPermissions, P_ADMIN_DISC, P_EDIT_SYNTHESIS)
-from .idea import Idea, IdeaLink, RootIdea, IdeaVisitor
+from ..lib.sqla import is_zopish, mark_changed, id_mapping
+from .idea import Idea, IdeaLink, IdeaVisitor
 from assembl.views.traversal import AbstractCollectionDefinition
 
 
@@ -413,54 +418,164 @@ class Synthesis(ExplicitSubGraphView):
         retval.conclusion = self.conclusion.clone(db=db)
         return retval
 
+    def relevant_ideas_query(self, live_links, root_id):
+        """The ideas frozen on publication: the ideas of the synthesis and
+        the ideas on a path between two of them, not through the root,
+        if they are linked.
+
+        A recursive CTE climbs from the synthesis ideas, another descends
+        from them; the ideas between two synthesis ideas are in both.
+
+        :param live_links: the live links of the discussion"""
+        idea = Idea.__table__
+        link = IdeaLink.__table__
+        association = SubGraphIdeaAssociation.__table__
+        # The parent relations, as :py:attr:`Idea.parents`
+        edges = select([link.c.source_id, link.c.target_id]).select_from(
+            link.join(idea, idea.c.id == link.c.source_id)).where(
+            (link.c.tombstone_date == None) &  # noqa: E711
+            (idea.c.tombstone_date == None) &  # noqa: E711
+            (idea.c.discussion_id == self.discussion_id) &
+            (idea.c.id != root_id)).cte('edge')
+        synthesis_ideas = select([association.c.idea_id]).where(
+            association.c.sub_graph_id == self.id)
+        ancestors = select([edges.c.source_id.label('id')]).where(
+            edges.c.target_id.in_(synthesis_ideas)).cte(
+            'ancestor', recursive=True)
+        ancestor = ancestors.alias('a')
+        ancestors = ancestors.union(select([edges.c.source_id]).where(
+            edges.c.target_id == ancestor.c.id))
+        descendants = select([edges.c.target_id.label('id')]).where(
+            edges.c.source_id.in_(synthesis_ideas)).cte(
+            'descendant', recursive=True)
+        descendant = descendants.alias('d')
+        descendants = descendants.union(select([edges.c.target_id]).where(
+            edges.c.source_id == descendant.c.id))
+        between = intersect(
+            select([ancestors.c.id]), select([descendants.c.id]))
+        return select([
+            idea.c.id, idea.c.base_id, idea.c.title_id,
+            idea.c.synthesis_title_id, idea.c.description_id]).where(
+            (idea.c.id.in_(synthesis_ideas) | idea.c.id.in_(between)) &
+            (idea.c.id != root_id) &
+            (idea.c.id.in_(select([live_links.c.source_id])) |
+             idea.c.id.in_(select([live_links.c.target_id]))))
+
     def publish(self):
         """ Publication is the end of a synthesis's lifecycle.
         It creates and returns a frozen copy of its state
-        using tombstones for ideas and links."""
+        using tombstones for ideas and links.
+
+        All the live links of the discussion are copied, as well as the
+        relevant ideas (see :py:meth:`relevant_ideas_query`), each table
+        with an ``INSERT ... SELECT``."""
+        db = self.db
         now = datetime.utcnow()
         frozen_synthesis = self.copy()
-        self.db.add(frozen_synthesis)
-        self.db.flush()
-
-        # Copy tombstoned versions of all idea links and relevant ideas in the current synthesis
-        links = Idea.get_all_idea_links(self.discussion_id)
-        synthesis_idea_ids = {idea.id for idea in self.ideas}
+        db.add(frozen_synthesis)
+        db.flush()
         # Do not copy the root
-        root = self.discussion.root_idea
-        idea_copies = {root.id: root}
-        # Also copies ideas between two synthesis ideas
-        relevant_idea_ids = synthesis_idea_ids.copy()
-
-        def add_ancestors_between(idea, path=None):
-            if isinstance(idea, RootIdea):
-                return
-            path = path[:] if path else []
-            if idea.id in synthesis_idea_ids:
-                relevant_idea_ids.update({i.id for i in path})
-            else:
-                path.append(idea)
-            for parent in idea.parents:
-                add_ancestors_between(parent, path)
-        for idea in self.ideas:
-            for parent in idea.parents:
-                add_ancestors_between(parent)
-        for link in links:
-            new_link = link.copy(tombstone=now)
-            frozen_synthesis.idea_links.append(new_link)
-            if link.source_id in relevant_idea_ids:
-                if link.source_id not in idea_copies:
-                    new_idea = link.source_ts.copy(tombstone=now)
-                    idea_copies[link.source_id] = new_idea
-                    if link.source_id in synthesis_idea_ids:
-                        frozen_synthesis.ideas.append(new_idea)
-                new_link.source_ts = idea_copies[link.source_id]
-            if link.target_id in relevant_idea_ids:
-                if link.target_id not in idea_copies:
-                    new_idea = link.target_ts.copy(tombstone=now)
-                    idea_copies[link.target_id] = new_idea
-                    if link.target_id in synthesis_idea_ids:
-                        frozen_synthesis.ideas.append(new_idea)
-                new_link.target_ts = idea_copies[link.target_id]
+        root_id = self.discussion.root_idea.id
+        idea = Idea.__table__
+        link = IdeaLink.__table__
+        source = idea.alias('source')
+        target = idea.alias('target')
+        # as Idea.get_all_idea_links
+        live_links = select([link]).where(
+            (link.c.source_id == source.c.id) &
+            (link.c.target_id == target.c.id) &
+            (source.c.discussion_id == self.discussion_id) &
+            (target.c.discussion_id == self.discussion_id) &
+            (link.c.tombstone_date == None)).alias('live_link')  # noqa: E711
+        ideas = db.execute(
+            self.relevant_ideas_query(live_links, root_id)).fetchall()
+
+        # Tombstoned copies of the relevant ideas, with their langstrings
+        langstring_clones = LangString.clone_many(db, [
+            langstring_id for row in ideas for langstring_id in (
+                row.title_id, row.synthesis_title_id, row.description_id)
+            if langstring_id])
+        title, synthesis_title, description = [
+            id_mapping(langstring_clones, name) for name in (
+                'title_clone', 'synthesis_title_clone', 'description_clone')]
+        idea_copies = []
+        if ideas:
+            idea_copies = db.execute(idea.insert().from_select(
+                ['id', 'base_id', 'tombstone_date', 'sqla_type',
+                 'discussion_id', 'hidden', 'creation_date', 'title_id',
+                 'synthesis_title_id', 'description_id'],
+                select([Idea.id_sequence.next_value(), idea.c.base_id,
+                        literal(now, DateTime), idea.c.sqla_type,
+                        idea.c.discussion_id, idea.c.hidden,
+                        idea.c.creation_date, title.c.new_id,
+                        synthesis_title.c.new_id, description.c.new_id]
+                       ).select_from(idea.outerjoin(
+                           title, title.c.old_id == idea.c.title_id
+                       ).outerjoin(
+                           synthesis_title, synthesis_title.c.old_id ==
+                           idea.c.synthesis_title_id
+                       ).outerjoin(
+                           description,
+                           description.c.old_id == idea.c.description_id)
+                       ).where(idea.c.id.in_([row.id for row in ideas]))
+            ).returning(idea.c.id, idea.c.base_id, idea.c.sqla_type)
+            ).fetchall()
+        copy_by_base_id = {base_id: id for (id, base_id, _) in idea_copies}
+        copy_ids = {row.id: copy_by_base_id[row.base_id] for row in ideas}
+        # Rows in the tables of joined subclasses (e.g. Question)
+        subclass_ids = defaultdict(list)
+        for (id, base_id, sqla_type) in idea_copies:
+            mapper = Idea.__mapper__.polymorphic_map[sqla_type]
+            for table in mapper.tables:
+                if table is not idea:
+                    subclass_ids[table].append(id)
+        for table, ids in subclass_ids.iteritems():
+            (primary_key,) = table.primary_key.columns
+            db.execute(table.insert().from_select(
+                [primary_key.name],
+                select([idea.c.id]).where(idea.c.id.in_(ids))))
+
+        # Tombstoned copies of all the links, between the idea copies
+        source_copy, target_copy = [
+            id_mapping(copy_ids, name) for name in (
+                'source_copy', 'target_copy')]
+        link_copies = db.execute(link.insert().from_select(
+            ['id', 'base_id', 'tombstone_date', 'order', 'source_id',
+             'target_id'],
+            select([IdeaLink.id_sequence.next_value(), live_links.c.base_id,
+                    literal(now, DateTime), live_links.c.order,
+                    func.coalesce(source_copy.c.new_id,
+                                  live_links.c.source_id),
+                    func.coalesce(target_copy.c.new_id,
+                                  live_links.c.target_id)]
+                   ).select_from(
+                live_links.outerjoin(
+                    source_copy,
+                    source_copy.c.old_id == live_links.c.source_id
+                ).outerjoin(
+                    target_copy,
+                    target_copy.c.old_id == live_links.c.target_id))
+        ).returning(link.c.id)).fetchall()
+
+        # The frozen synthesis has the copies of the synthesis ideas
+        association = SubGraphIdeaAssociation.__table__
+        idea_copy = id_mapping(copy_ids, 'idea_copy')
+        db.execute(association.insert().from_select(
+            ['sub_graph_id', 'idea_id'],
+            select([literal(frozen_synthesis.id, Integer),
+                    idea_copy.c.new_id]).where(
+                idea_copy.c.old_id.in_(
+                    select([association.c.idea_id]).where(
+                        association.c.sub_graph_id == self.id)))))
+        link_association = SubGraphIdeaLinkAssociation.__table__
+        if link_copies:
+            db.execute(link_association.insert().from_select(
+                ['sub_graph_id', 'idea_link_id'],
+                select([literal(frozen_synthesis.id, Integer), link.c.id]
+                       ).where(link.c.id.in_([id for (id,) in link_copies]))))
+        if is_zopish():
+            mark_changed(db)
+        db.expire(frozen_synthesis, ['idea_assocs', 'idealink_assocs'])
         return frozen_synthesis
 
     def as_html(self, jinja_env, lang_prefs):
@@ -0,0 +1,42 @@
+"""The queue of pending changes to the elasticsearch index."""
+from datetime import datetime
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    SmallInteger,
+    Boolean,
+    DateTime,
+    String,
+    Text,
+    Index,
+)
+
+from . import Base
+
+
+class IndexingQueueItem(Base):
+    """An indexing or unindexing action, written in the same transaction
+    as the change to the indexed object, and sent to elasticsearch later
+    by :py:class:`assembl.indexing.indexer.IndexingQueueWorker`."""
+    __tablename__ = 'indexing_queue'
+
+    id = Column(Integer, primary_key=True)
+    uid = Column(String(100), nullable=False)
+    operation = Column(String(10), nullable=False)  # index or delete
+    doc_type = Column(String(20), nullable=False)
+    parent = Column(String(100))
+    # The serialized document, for index operations
+    source = Column(Text)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+    attempts = Column(SmallInteger, nullable=False, default=0)
+    next_attempt = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(Text)
+    # Gave up after too many attempts
+    dead_letter = Column(Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        Index('ix_indexing_queue_next_attempt', 'dead_letter', 'next_attempt'),
+    )
+
+    sent_to_changes = False
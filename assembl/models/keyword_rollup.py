@@ -0,0 +1,282 @@
+"""Materialized keyword clouds of ideas.
+
+:py:meth:`assembl.models.idea.Idea.top_keywords` sums the
+:py:class:`assembl.models.nlp.PostKeywordAnalysis` of all the related posts
+of the idea, and translated missing tag labels inline. The grouped scores
+are now kept in :py:class:`IdeaKeywordRollup` rows, which the GraphQL
+resolvers read with a single indexed lookup.
+
+Ideas are marked in :py:class:`IdeaKeywordRollupState` when the keyword
+analyses of their posts, their related posts or their content links
+change, and :py:func:`assembl.tasks.keywords.refresh_idea_keywords`
+recomputes the marked ideas only, then translates the new tag labels
+in a batch. Changes that cannot be traced to ideas (e.g. the previous
+ancestors of a moved idea) are caught up after
+``idea_keywords_rollup_max_age`` seconds.
+"""
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import transaction
+from sqlalchemy import (
+    Column,
+    Integer,
+    Float,
+    Boolean,
+    DateTime,
+    ForeignKey,
+    Index,
+    UniqueConstraint,
+    and_,
+    or_,
+    select,
+    literal,
+    true,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import joinedload
+
+from . import Base
+from .discussion import Discussion
+from .idea import Idea
+from .langstrings import LangString, LangStringEntry, Locale
+from .nlp import Tag
+from ..lib import config, metrics
+from ..lib.sentry import capture_exception
+from ..lib.sqla import is_zopish, mark_changed
+
+# The number of tags kept per idea
+ROLLUP_SIZE = 100
+
+KeywordResult = namedtuple('KeywordResult', ['value', 'score', 'count'])
+
+
+class IdeaKeywordRollupState(Base):
+    """Whether the keyword rollup of an idea has to be recomputed"""
+    __tablename__ = 'idea_keyword_rollup_state'
+
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    dirty = Column(Boolean, nullable=False, default=True)
+    # When it was last marked dirty
+    changed = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # When the rollup was last computed, None if never
+    refreshed = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_idea_keyword_rollup_state_dirty', 'dirty', 'refreshed'),
+    )
+
+    sent_to_changes = False
+
+
+class IdeaKeywordRollup(Base):
+    """The score and occurences of a tag (group) in the related posts
+    of an idea"""
+    __tablename__ = 'idea_keyword_rollup'
+
+    id = Column(Integer, primary_key=True)
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), nullable=False)
+    tag_id = Column(Integer, ForeignKey(
+        Tag.id, ondelete='CASCADE', onupdate='CASCADE'), nullable=False)
+    score = Column(Float, nullable=False)
+    count = Column(Integer)
+
+    __table_args__ = (
+        UniqueConstraint('idea_id', 'tag_id'),
+        Index('ix_idea_keyword_rollup_idea_score', 'idea_id', 'score'),
+    )
+
+    _pending = threading.local()
+
+    sent_to_changes = False
+
+    @classmethod
+    def mark_dirty(cls, db, discussion_id, idea_ids, connection=None):
+        """Mark the ideas and their ancestors for refresh, and start the
+        refresh task after commit.
+
+        :param connection: the connection of a flush in progress, if any"""
+        idea_ids = {idea_id for idea_id in idea_ids if idea_id}
+        if not idea_ids:
+            return
+        execute = (connection or db).execute
+        ancestors = Idea.get_ancestors_query_cls(
+            list(idea_ids), inclusive=False)
+        idea_ids.update(
+            id for (id,) in execute(select([ancestors.c.id])))
+        # From the idea table, as an idea may be deleted in the same flush
+        stmt = pg_insert(IdeaKeywordRollupState.__table__).from_select(
+            ['idea_id', 'discussion_id', 'dirty', 'changed'],
+            select([Idea.id, Idea.discussion_id, true(),
+                    literal(datetime.utcnow())]
+                   ).where(Idea.id.in_(idea_ids)))
+        execute(stmt.on_conflict_do_update(
+            index_elements=['idea_id'],
+            set_=dict(dirty=True, changed=stmt.excluded.changed)))
+        if connection is None and is_zopish():
+            mark_changed(db)
+        cls.schedule_refresh(discussion_id)
+
+    @classmethod
+    def schedule_refresh(cls, discussion_id):
+        """Start the refresh task of the discussion after commit, once
+        per transaction. Without a transaction manager, the periodic task
+        will refresh it."""
+        if not is_zopish():
+            return
+        txn = transaction.get()
+        pending = getattr(cls._pending, "discussions", None)
+        if pending is None or pending[0] is not txn:
+            pending = cls._pending.discussions = (txn, set())
+            txn.addAfterCommitHook(cls._start_refresh, (pending[1],))
+        pending[1].add(discussion_id)
+
+    @classmethod
+    def _start_refresh(cls, status, discussion_ids):
+        cls._pending.discussions = None
+        if not status:
+            return
+        from ..tasks.keywords import refresh_idea_keywords
+        for discussion_id in discussion_ids:
+            try:
+                refresh_idea_keywords.delay(discussion_id)
+            except Exception:
+                # The periodic task will refresh it anyway
+                capture_exception()
+
+    @classmethod
+    def refresh(cls, db, idea_id):
+        """Recompute the rollup of an idea. Returns the tag ids."""
+        db.query(cls).filter(cls.idea_id == idea_id).delete(
+            synchronize_session=False)
+        idea = Idea.get(idea_id)
+        if idea is None or idea.tombstone_date is not None:
+            return []
+        rows = idea.keyword_scores_query().limit(ROLLUP_SIZE).all()
+        if rows:
+            db.execute(cls.__table__.insert(), [
+                dict(idea_id=idea_id, tag_id=tag_id, score=score,
+                     count=count)
+                for (score, count, tag_id) in rows])
+        return [tag_id for (_, _, tag_id) in rows]
+
+    @staticmethod
+    def mark_unknown(db, discussion_id=None):
+        """Mark the ideas which were never marked, e.g. those created
+        before the rollups, so they get a rollup without marking on read."""
+        state = IdeaKeywordRollupState.__table__
+        condition = ~Idea.id.in_(select([state.c.idea_id]))
+        if discussion_id:
+            condition = and_(condition, Idea.discussion_id == discussion_id)
+        db.execute(pg_insert(state).from_select(
+            ['idea_id', 'discussion_id', 'dirty', 'changed'],
+            select([Idea.id, Idea.discussion_id, true(),
+                    literal(datetime.utcnow())]).where(condition)
+        ).on_conflict_do_nothing(index_elements=['idea_id']))
+        if is_zopish():
+            mark_changed(db)
+
+    @classmethod
+    def refresh_dirty(cls, db, discussion_id=None):
+        """Recompute the rollups of the ideas marked dirty, never marked,
+        or not refreshed for ``idea_keywords_rollup_max_age`` seconds.
+
+        :returns: the tag ids of the rollups, by discussion id"""
+        cls.mark_unknown(db, discussion_id)
+        state = IdeaKeywordRollupState
+        condition = (state.dirty == True)  # noqa: E712
+        max_age = int(config.get('idea_keywords_rollup_max_age', 86400))
+        if max_age:
+            condition = or_(condition, state.refreshed < (
+                datetime.utcnow() - timedelta(seconds=max_age)))
+        query = db.query(
+            state.idea_id, state.discussion_id, state.changed
+        ).filter(condition)
+        if discussion_id:
+            query = query.filter(state.discussion_id == discussion_id)
+        tag_ids = {}
+        for (idea_id, discussion_id, changed) in query.all():
+            tags = cls.refresh(db, idea_id)
+            tag_ids.setdefault(discussion_id, set()).update(tags)
+            # Stays dirty if marked again since we read it
+            db.query(state).filter(
+                state.idea_id == idea_id, state.changed == changed
+            ).update({'dirty': False, 'refreshed': datetime.utcnow()},
+                     synchronize_session=False)
+            metrics.counter("idea_keywords.rollup_refreshed").inc()
+        return tag_ids
+
+    @staticmethod
+    def prefetch_translations(db, discussion_id, tag_ids):
+        """Translate the labels of the tags to the discussion languages
+        and english, in a batch. Returns the number of tags looked at."""
+        discussion = Discussion.get(discussion_id)
+        if discussion is None or not tag_ids:
+            return 0
+        translator = discussion.translation_service()
+        if translator.canTranslate is None:
+            return 0
+        locales = set(discussion.discussion_locales)
+        locales.add('en')
+        tags = db.query(Tag).filter(Tag.id.in_(tag_ids)).options(
+            joinedload(Tag.label).joinedload(LangString.entries)).all()
+        for tag in tags:
+            tag.label.ensure_translations(locales, translator)
+        return len(tags)
+
+    @staticmethod
+    def label_rank(locale_code, display_lang):
+        if locale_code == display_lang:
+            return 0
+        if locale_code.startswith(display_lang + '-x-mtfrom-'):
+            return 1
+        if not Locale.locale_is_machine_translated(locale_code):
+            return 2
+
+    @classmethod
+    def tag_labels(cls, db, tag_ids, display_lang):
+        """The label of each tag in the display language if translated,
+        in its original language otherwise"""
+        if not tag_ids:
+            return {}
+        entries = db.query(
+            Tag.id, LangStringEntry.value, Locale.code
+        ).join(
+            LangStringEntry, LangStringEntry.langstring_id == Tag.label_id
+        ).join(
+            Locale, LangStringEntry.locale_id == Locale.id
+        ).filter(
+            Tag.id.in_(tag_ids),
+            LangStringEntry.tombstone_date == None  # noqa: E711
+        )
+        labels = {}
+        for (tag_id, value, code) in entries:
+            rank = cls.label_rank(code, display_lang)
+            if rank is not None and (
+                    tag_id not in labels or rank < labels[tag_id][0]):
+                labels[tag_id] = (rank, value)
+        return {tag_id: value for (tag_id, (_, value)) in labels.iteritems()}
+
+    @classmethod
+    def top_keywords(cls, db, idea_id, limit=30, display_lang='en'):
+        """The best tags of the idea, as :py:data:`KeywordResult`.
+        None if the rollup of the idea was never computed."""
+        state = db.query(IdeaKeywordRollupState.refreshed).filter(
+            IdeaKeywordRollupState.idea_id == idea_id).first()
+        if state is None or state[0] is None:
+            return None
+        rollup = db.query(cls.tag_id, cls.score, cls.count).filter(
+            cls.idea_id == idea_id).order_by(cls.score.desc())
+        if limit:
+            rollup = rollup.limit(limit)
+        rollup = rollup.all()
+        labels = cls.tag_labels(
+            db, [tag_id for (tag_id, _, _) in rollup], display_lang or 'en')
+        return [KeywordResult(labels[tag_id], score, count)
+                for (tag_id, score, count) in rollup if tag_id in labels]
@@ -1,4 +1,5 @@
 """Classes for multilingual strings, using automatic or manual translation"""
+import threading
 from collections import defaultdict
 from datetime import datetime
 
@@ -14,20 +15,143 @@ from sqlalchemy import (
     event,
     inspect,
     Sequence,
-    literal)
+    literal,
+    select,
+    func)
 from sqlalchemy.sql.expression import case
-from sqlalchemy.orm import relationship, backref, subqueryload, joinedload, aliased
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import (
+    relationship, backref, subqueryload, joinedload, aliased, object_session,
+    scoped_session)
 from sqlalchemy.orm.query import Query
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from ..lib.sqla_types import CoerceUnicode
 import simplejson as json
 
 from . import Base, TombstonableMixin
+from ..lib import metrics
 from ..lib.abc import classproperty
+from ..lib.sqla import (
+    get_session_maker, is_zopish, mark_changed, id_mapping)
 from ..lib.locale import compatible
 from ..auth import CrudPermissions, P_READ, P_ADMIN_DISC, P_SYSADMIN
 
 
+class LocaleRegistry(object):
+    """The known locales, as id->code and code->id dictionaries shared by
+    the threads of the process.
+
+    Locales are created on the fly (e.g. for machine translations) by any
+    process. Their ids come from a sequence, so the highest known id is
+    the version of the registry: when an unknown id or code is asked for,
+    only the locales with a higher id are read, then the missing one alone
+    if it was committed out of order. Locales created by a transaction
+    that is rolled back, or deleted, are forgotten.
+    The dictionaries are replaced rather than modified, as they may be
+    iterated upon in other threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.by_id = {}
+            self.by_code = {}
+            self.subsets = defaultdict(set)
+            self.version = None
+
+    def _add(self, rows):
+        with self._lock:
+            by_id = dict(self.by_id)
+            by_code = dict(self.by_code)
+            subsets = defaultdict(set, self.subsets)
+            for (id, code) in rows:
+                old_id = by_code.get(code, None)
+                if old_id is not None and old_id != id:
+                    by_id.pop(old_id, None)
+                by_id[id] = code
+                by_code[code] = id
+                root = Locale.extract_root_locale(code)
+                subsets[root] = subsets[root] | {code}
+                self.version = max(self.version or 0, id)
+            self.by_id, self.by_code, self.subsets = by_id, by_code, subsets
+
+    def ensure_loaded(self, db):
+        if self.version is None:
+            with self._lock:
+                if self.version is None:
+                    metrics.counter("locales.registry.load").inc()
+                    rows = db.query(Locale.id, Locale.code).all()
+                    self.version = 0
+                    self._add(rows)
+
+    def refresh(self, db):
+        "Read the locales created since the version of the registry"
+        if self.version is None:
+            return self.ensure_loaded(db)
+        with self._lock:
+            rows = db.query(Locale.id, Locale.code).filter(
+                Locale.id > self.version).all()
+            metrics.counter("locales.registry.refresh").inc()
+            metrics.counter("locales.registry.refresh_rows").inc(len(rows))
+            self._add(rows)
+
+    def id_of(self, code, db):
+        "The id of the locale, or None if it does not exist"
+        self.ensure_loaded(db)
+        id = self.by_code.get(code, None)
+        if id is None:
+            self.refresh(db)
+            id = self.by_code.get(code, None)
+            if id is None:
+                metrics.counter("locales.registry.miss").inc()
+                id = db.query(Locale.id).filter_by(code=code).scalar()
+                if id is not None:
+                    self._add([(id, code)])
+        return id
+
+    def code_of(self, id, db):
+        "The code of the locale, or None if it does not exist"
+        self.ensure_loaded(db)
+        code = self.by_id.get(id, None)
+        if code is None:
+            self.refresh(db)
+            code = self.by_id.get(id, None)
+            if code is None:
+                metrics.counter("locales.registry.miss").inc()
+                code = db.query(Locale.code).filter_by(id=id).scalar()
+                if code is not None:
+                    self._add([(id, code)])
+        return code
+
+    def add_created(self, session, rows):
+        """Add the (id, code) of locales created in the session,
+        to be forgotten if the session rolls back."""
+        self._add(rows)
+        session.info.setdefault('created_locale_ids', set()).update(
+            id for (id, code) in rows)
+        metrics.counter("locales.created").inc(len(rows))
+
+    def forget(self, ids):
+        with self._lock:
+            by_id = dict(self.by_id)
+            by_code = dict(self.by_code)
+            subsets = defaultdict(set, self.subsets)
+            for id in ids:
+                code = by_id.pop(id, None)
+                if code is not None and by_code.get(code, None) == id:
+                    del by_code[code]
+                    root = Locale.extract_root_locale(code)
+                    subsets[root] = subsets[root] - {code}
+            self.by_id, self.by_code, self.subsets = by_id, by_code, subsets
+
+
+def _session(db):
+    return db() if isinstance(db, scoped_session) else db
+
+
 class Locale(Base):
     """The name of locales. Follows Posix locale conventions: lang(_Script)(_COUNTRY),
     (eg zh_Hant_HK, but script can be elided (eg fr_CA) if only one script for language,
@@ -37,10 +161,7 @@ class Locale(Base):
     id = Column(Integer, primary_key=True)
     code = Column(String(32), unique=True)
     rtl = Column(Boolean, server_default="0", doc="right-to-left")
-    _locale_collection = None
-    _locale_collection_byid = None
-    _locale_collection_subsets = None
-    _locale_uncommitted = []
+    registry = LocaleRegistry()
     UNDEFINED = "und"
     NON_LINGUISTIC = "zxx"
     MULTILINGUAL = "mul"
@@ -179,9 +300,7 @@ class Locale(Base):
 
     @classmethod
     def reset_cache(cls):
-        cls._locale_collection_byid = None
-        cls._locale_collection = None
-        cls._locale_collection_subsets = None
+        cls.registry.clear()
 
     @classmethod
     def get_locale_object_cache(cls):
@@ -197,57 +316,34 @@ class Locale(Base):
     @classproperty
     def locale_collection_byid(cls):
         "A collection of all known locales, as a dictionary of id->strings"
-        if cls._locale_collection_byid is None:
-            cls._locale_collection_byid = dict(
-                cls.default_db.query(cls.id, cls.code))
-            # Add locales that were created, flushed but not yet committed,
-            # And will not show up in the query
-            uncommitted = [
-                l for l in cls._locale_uncommitted
-                if inspect(l).pending]
-            cls._locale_uncommitted = uncommitted
-            if uncommitted:
-                cls._locale_collection_byid.update(
-                    {l.id: l.code for l in uncommitted})
-        return cls._locale_collection_byid
+        cls.registry.ensure_loaded(cls.default_db)
+        return cls.registry.by_id
 
     @classmethod
     def code_for_id(cls, id):
-        if cls._locale_collection_byid is not None and id not in cls._locale_collection_byid:
-            # may have been created in another process
-            cls.reset_cache()
-        return cls.locale_collection_byid[id]
+        code = cls.registry.code_of(id, cls.default_db)
+        if code is None:
+            raise KeyError(id)
+        return code
 
     @classproperty
     def locale_collection(cls):
         "A collection of all known locales, as a dictionary of string->id"
-        if cls._locale_collection is None:
-            cls._locale_collection = {
-                name: id for (id, name)
-                in cls.locale_collection_byid.iteritems()}
-        return cls._locale_collection
+        cls.registry.ensure_loaded(cls.default_db)
+        return cls.registry.by_code
 
     @classmethod
     def get_id_of(cls, code, create=True):
-        if cls._locale_collection is not None and code not in cls._locale_collection:
-            # may have been created in another process
-            if create:
-                return cls.get_or_create(code).id
-            else:
-                cls.reset_cache()
-        return cls.locale_collection.get(code, None)
+        locale_id = cls.registry.id_of(code, cls.default_db)
+        if locale_id is None and create:
+            locale_id = cls.get_or_create(code).id
+        return locale_id
 
     @classproperty
     def locale_collection_subsets(cls):
         "A dictionary giving all the know locale variants for a base locale"
-        if cls._locale_collection_subsets is None:
-            # This is used often enough to be worth caching
-            collections = cls.locale_collection
-            collection_subsets = defaultdict(set)
-            for locale_code in collections.iterkeys():
-                collection_subsets[cls.extract_root_locale(locale_code)].add(locale_code)
-            cls._locale_collection_subsets = collection_subsets
-        return cls._locale_collection_subsets
+        cls.registry.ensure_loaded(cls.default_db)
+        return cls.registry.subsets
 
     @classmethod
     def get_or_create(cls, locale_code, db=None):
@@ -255,44 +351,49 @@ class Locale(Base):
         locale = locale_object_cache.get(locale_code, None)
         if locale:
             return locale
-        locale_id = cls.locale_collection.get(locale_code, None)
-        if locale_id:
-            locale = Locale.get(locale_id)
-            if locale:
-                locale_object_cache[locale_code] = locale
-                return locale
         db = db or cls.default_db
-        # Maybe exists despite not in cache
-        locale = db.query(cls).filter_by(code=locale_code).first()
-        if locale:
-            cls.reset_cache()
-            locale_object_cache[locale_code] = locale
-            return locale
-        # create it.
-        locale = Locale(
-            code=locale_code, rtl=cls.is_right_to_left_code(locale_code))
-        db.add(locale)
-        db.flush()
-        cls._locale_uncommitted.append(locale)
-        cls.reset_cache()
+        locale_id = cls.registry.id_of(locale_code, db)
+        locale = db.query(cls).get(locale_id) if locale_id else None
+        if locale is None:
+            # create it, or it was deleted since
+            if locale_id:
+                cls.registry.forget([locale_id])
+            locale_id = cls.bulk_get_or_create([locale_code], db)[locale_code]
+            locale = db.query(cls).get(locale_id)
         locale_object_cache[locale_code] = locale
         return locale
 
     @classmethod
     def bulk_get_or_create(cls, locale_codes, db=None):
+        """Make sure that the locales exist, and give their ids by code.
+        Concurrent creations of the same locale do not conflict."""
         db = db or cls.default_db
-        db.execute("lock table %s in exclusive mode" % cls.__table__.name)
-        existing = db.query(cls.code).all()
-        missing = set(locale_codes) - {x for (x,) in existing}
-        if not missing:
-            return
-        stmt = cls.__table__.insert().values([
-            {
-                "code": code,
-                "rtl": cls.is_right_to_left_code(code)
-            } for code in missing
-        ])
-        db.execute(stmt)
+        registry = cls.registry
+        registry.ensure_loaded(db)
+        codes = set(locale_codes)
+        if not codes <= set(registry.by_code):
+            registry.refresh(db)
+        missing = codes - set(registry.by_code)
+        if missing:
+            stmt = pg_insert(cls.__table__).values([
+                {
+                    "code": code,
+                    "rtl": cls.is_right_to_left_code(code)
+                } for code in missing
+            ]).on_conflict_do_nothing(index_elements=['code']).returning(
+                cls.__table__.c.id, cls.__table__.c.code)
+            created = db.execute(stmt).fetchall()
+            session = _session(db)
+            if created:
+                if is_zopish():
+                    mark_changed(session)
+                registry.add_created(session, created)
+            # Created by another transaction since
+            missing -= {code for (id, code) in created}
+            if missing:
+                registry._add(db.query(cls.id, cls.code).filter(
+                    cls.code.in_(missing)))
+        return {code: registry.by_code[code] for code in codes}
 
     @classproperty
     def UNDEFINED_LOCALEID(cls):
@@ -311,12 +412,28 @@ class Locale(Base):
 
 
 @event.listens_for(Locale, 'after_insert', propagate=True)
+def locale_created(mapper, connection, target):
+    Locale.registry.add_created(
+        object_session(target), [(target.id, target.code)])
+
+
 @event.listens_for(Locale, 'after_delete', propagate=True)
-def locale_collection_changed(target, value, oldvalue):
-    # Reset the collections
-    Locale._locale_collection_subsets = None
-    Locale._locale_collection = None
-    Locale._locale_collection_byid = None
+def locale_deleted(mapper, connection, target):
+    Locale.registry.forget([target.id])
+
+
+@event.listens_for(get_session_maker(), "after_commit")
+def keep_created_locales(session):
+    session.info.pop('created_locale_ids', None)
+
+
+@event.listens_for(get_session_maker(), "after_transaction_end")
+def forget_created_locales(session, transaction):
+    # Not committed: rolled back or closed
+    if transaction.parent is None:
+        ids = session.info.pop('created_locale_ids', None)
+        if ids:
+            Locale.registry.forget(ids)
 
 
 class LocaleLabel(Base):
@@ -398,7 +515,6 @@ class LocaleLabel(Base):
         locales = {x[0] for x in names}.union({x[1] for x in names})
         Locale.bulk_get_or_create(locales, db)
         db.flush()
-        Locale.reset_cache()
         db.execute("lock table %s in exclusive mode" % cls.__table__.name)
         existing = set(db.query(
             cls.named_locale_id, cls.locale_id_of_label).all())
@@ -422,6 +538,127 @@ class LocaleLabel(Base):
     crud_permissions = CrudPermissions(P_READ, P_ADMIN_DISC)
 
 
+class LocalePreferenceRanks(object):
+    """The preference of a :py:class:`assembl.models.auth.LanguagePreferenceCollection`
+    for each locale, computed once per locale code, to choose the best
+    entries of many langstrings as :py:meth:`LangString.best_lang` would.
+
+    The best entry of each langstring is memoized with the identity of its
+    entries, so a langstring is resolved again if it was translated since.
+    Use :py:meth:`for_request` to share the table of a request.
+    """
+
+    def __init__(self, user_prefs):
+        self.user_prefs = user_prefs
+        # locale code -> (is machine translated, preference, sort key)
+        self._ranks = {}
+        # (target locale code, locale code) -> compatibility
+        self._compatible = {}
+        # (langstring id, allow_errors) -> (entries identity, best entry)
+        self._best = {}
+
+    @classmethod
+    def for_request(cls, user_prefs, request=None):
+        """The table of the preferences, kept on the request by
+        preference signature"""
+        if request is None:
+            from pyramid.threadlocal import get_current_request
+            request = get_current_request()
+        if request is None:
+            return cls(user_prefs)
+        tables = getattr(request, "locale_preference_ranks", None)
+        if tables is None:
+            tables = request.locale_preference_ranks = {}
+        signature = user_prefs.signature()
+        if signature not in tables:
+            tables[signature] = cls(user_prefs)
+        return tables[signature]
+
+    def rank(self, locale_code):
+        rank = self._ranks.get(locale_code, None)
+        if rank is None:
+            pref = self.user_prefs.find_locale(
+                Locale.extract_base_locale(locale_code))
+            key = None
+            if pref is not None:
+                # as UserLanguagePreference.__cmp__
+                key = (pref.source_of_evidence, pref.preferred_order or 0,
+                       pref.id or 0, id(pref))
+            rank = self._ranks[locale_code] = (
+                Locale.locale_is_machine_translated(locale_code), pref, key)
+        return rank
+
+    def compatible(self, target_locale, locale_code):
+        key = (target_locale, locale_code)
+        result = self._compatible.get(key, None)
+        if result is None:
+            result = self._compatible[key] = compatible(
+                target_locale, Locale.extract_base_locale(locale_code))
+        return result
+
+    def closest_entry(self, entries, target_locale):
+        "As :py:meth:`LangString.closest_entry`"
+        best = None
+        best_len = 0
+        for entry in entries:
+            if entry.error_code:
+                continue
+            common_len = self.compatible(target_locale, entry.locale_code)
+            if common_len > best_len:
+                best, best_len = entry, common_len
+        return best
+
+    def best_entry(self, langstring, allow_errors=True):
+        "As :py:meth:`LangString.best_lang`, memoized"
+        entries = langstring.entries
+        identity = tuple(map(id, entries))
+        key = (langstring.id or id(langstring), allow_errors)
+        memo = self._best.get(key, None)
+        if memo is not None and memo[0] == identity:
+            return memo[1]
+        best = self._best_entry(entries, allow_errors)
+        self._best[key] = (identity, best)
+        return best
+
+    def _best_entry(self, entries, allow_errors):
+        if len(entries) == 1:
+            return entries[0]
+        ranked = [(entry, self.rank(entry.locale_code)) for entry in entries]
+        for use_originals in (True, False):
+            candidates = []
+            entries_by_locale = {}
+            for entry, (is_mt, pref, key) in ranked:
+                if is_mt == use_originals:
+                    continue
+                if not allow_errors and entry.error_code:
+                    continue
+                if pref is not None:
+                    candidates.append((key, pref))
+                    entries_by_locale[pref.locale_code] = entry
+                elif use_originals:
+                    # No pref for original, just return the original entry
+                    return entry
+            candidates.sort(key=lambda c: c[0])
+            for key, pref in candidates:
+                if pref.translate_to:
+                    best = self.closest_entry(entries, pref.translate_to_code)
+                    if best:
+                        return best
+                else:
+                    return entries_by_locale[pref.locale_code]
+        # give up and give first original
+        for entry, (is_mt, pref, key) in ranked:
+            if not is_mt:
+                return entry
+        # or first entry
+        return entries[0]
+
+    def best_entries(self, langstrings, allow_errors=True):
+        "The best entry of each langstring"
+        return [self.best_entry(langstring, allow_errors)
+                for langstring in langstrings]
+
+
 class LangString(Base):
     """A multilingual string, composed of many :py:class:`LangStringEntry`"""
     __tablename__ = "langstring"
@@ -764,18 +1001,26 @@ class LangString(Base):
         # or first entry
         return self.entries[0]
 
-    def best_entry_in_request(self):
+    @classmethod
+    def best_entries_in_request(cls, langstrings, allow_errors=True):
+        """The best entry of each langstring according to the language
+        preferences of the current request, memoized on the request.
+        Resolving the langstrings of a page together shares the work
+        on their locales."""
         from .auth import LanguagePreferenceCollection
         # Use only when a request is in context, eg view_def
-        return self.best_lang(
-            LanguagePreferenceCollection.getCurrent(), False)
+        ranks = LocalePreferenceRanks.for_request(
+            LanguagePreferenceCollection.getCurrent())
+        return ranks.best_entries(langstrings, allow_errors)
+
+    def best_entry_in_request(self):
+        # Use only when a request is in context, eg view_def
+        return self.best_entries_in_request([self], False)[0]
 
     def best_entries_in_request_with_originals(self):
-        from .auth import LanguagePreferenceCollection
         "Give both best and original (for view_def); avoids a roundtrip"
         # Use only when a request is in context, eg view_def
-        prefs = LanguagePreferenceCollection.getCurrent()
-        lang = self.best_lang(prefs)
+        lang = self.best_entries_in_request([self])[0]
         entries = [lang]
         # Punt this.
         # if lang.error_code:
@@ -869,6 +1114,35 @@ class LangString(Base):
         db.add(clone)
         return clone
 
+    @classmethod
+    def clone_many(cls, db, langstring_ids):
+        """Clone langstrings with their live entries, as :py:meth:`clone`,
+        with a few statements whatever their number.
+
+        :returns: a dictionary of the ids of the clones by original id"""
+        langstring_ids = set(langstring_ids)
+        if not langstring_ids:
+            return {}
+        table = cls.__table__
+        new_id = func.nextval(
+            func.pg_get_serial_sequence(table.fullname, 'id'))
+        clone_ids = dict(db.execute(select([table.c.id, new_id]).where(
+            table.c.id.in_(langstring_ids))).fetchall())
+        clones = id_mapping(clone_ids, 'langstring_clone')
+        db.execute(table.insert().from_select(
+            ['id'], select([clones.c.new_id])))
+        entry = LangStringEntry.__table__
+        columns = ['locale_id', 'value', 'locale_identification_data',
+                   'locale_confirmed', 'error_code', 'error_count']
+        db.execute(entry.insert().from_select(
+            ['langstring_id'] + columns,
+            select([clones.c.new_id] + [entry.c[name] for name in columns]
+                   ).where((entry.c.langstring_id == clones.c.old_id) &
+                           (entry.c.tombstone_date == None))))  # noqa: E711
+        if is_zopish():
+            mark_changed(db)
+        return clone_ids
+
     # Those permissions are for an ownerless object. Accept Create before ownership.
     crud_permissions = CrudPermissions(P_READ, P_SYSADMIN, P_SYSADMIN, P_SYSADMIN)
 
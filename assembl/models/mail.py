@@ -6,18 +6,20 @@ import re
 import smtplib
 import os
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from email.header import decode_header as decode_email_header, Header
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import parseaddr, mktime_tz, parsedate_tz
 
 import jwzthreading
+from ..lib import config
 from ..lib.clean_input import sanitize_html
 from pyramid.threadlocal import get_current_registry
 from datetime import datetime
 from imaplib2 import IMAP4_SSL, IMAP4
 import transaction
-from sqlalchemy.orm import joinedload_all, undefer
+from sqlalchemy.orm import joinedload_all, undefer, relationship, backref
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy import (
     Column,
@@ -26,15 +28,17 @@ from sqlalchemy import (
     String,
     UnicodeText,
     Boolean,
+    Index,
 )
 from ..lib.sqla_types import (CoerceUnicode, EmailString)
 
+from . import Base
 from .langstrings import LangString
 from .generic import PostSource
 from .post import ImportedPost
 from .auth import EmailAccount
 from ..tasks.imap import import_mails
-from ..tasks.translate import translate_content
+from ..tasks.translate import translate_discussion
 
 
 class AbstractMailbox(PostSource):
@@ -94,6 +98,26 @@ class AbstractMailbox(PostSource):
             return message_id[1:-1]
         return message_id
 
+    _message_id_re = re.compile(r'<([^<>\s]+)>')
+
+    @classmethod
+    def references_of(cls, parsed_email, message_id=None):
+        """The message ids referenced by the References and In-Reply-To
+        headers of a parsed email, without angle brackets, from the parent
+        to the most distant ancestor (as jwzthreading reads them)"""
+        references = cls._message_id_re.findall(
+            parsed_email.get('References', None) or '')
+        in_reply_to = cls._message_id_re.findall(
+            parsed_email.get('In-Reply-To', None) or '')
+        if in_reply_to and in_reply_to[0] not in references:
+            references.append(in_reply_to[0])
+        result = []
+        for reference in reversed(references):
+            reference = reference.decode('utf-8', 'replace')
+            if reference != message_id and reference not in result:
+                result.append(reference)
+        return result
+
     @staticmethod
     def strip_full_message_quoting_plaintext(message_body):
         """Assumes any encoding conversions have already been done
@@ -311,8 +335,11 @@ class AbstractMailbox(PostSource):
         # Nothing was stripped...
         return html.tostring(doc)
 
-    def parse_email(self, message_string, existing_email=None):
-        """ Creates or replace a email from a string """
+    @staticmethod
+    def parse_message(message_string):
+        """ Parses an email string, without using the database.
+        Returns the values of the email, the parsed email and an error
+        description; :py:meth:`parse_email` creates the Email from them."""
         parsed_email = email.message_from_string(message_string)
         body = None
         error_description = None
@@ -368,7 +395,7 @@ class AbstractMailbox(PostSource):
 
         new_message_id = parsed_email.get('Message-ID', None)
         if new_message_id:
-            new_message_id = self.clean_angle_brackets(
+            new_message_id = AbstractMailbox.clean_angle_brackets(
                 email_header_to_unicode(new_message_id))
         else:
             error_description = "Unable to parse the Message-ID for message string: \n%s" % message_string
@@ -378,17 +405,41 @@ class AbstractMailbox(PostSource):
 
         new_in_reply_to = parsed_email.get('In-Reply-To', None)
         if new_in_reply_to:
-            new_in_reply_to = self.clean_angle_brackets(
+            new_in_reply_to = AbstractMailbox.clean_angle_brackets(
                 email_header_to_unicode(new_in_reply_to))
 
         sender = email_header_to_unicode(parsed_email.get('From'))
+        values = dict(
+            message_id=new_message_id,
+            in_reply_to=new_in_reply_to,
+            sender=sender,
+            creation_date=datetime.utcfromtimestamp(
+                mktime_tz(parsedate_tz(parsed_email['Date']))),
+            subject=email_header_to_unicode(parsed_email['Subject'], False),
+            recipients=email_header_to_unicode(parsed_email['To']),
+            body=body.strip(),
+            body_mime_type=mimeType)
+        return (values, parsed_email, error_description)
+
+    def parse_email(self, message_string, existing_email=None, parsed=None):
+        """ Creates or replace a email from a string
+
+        :param parsed: the result of :py:meth:`parse_message`, if the
+            message was already parsed"""
+        (values, parsed_email, error_description) = (
+            parsed or self.parse_message(message_string))
+        if values is None:
+            return (None, None, error_description)
+        new_message_id = values['message_id']
+        new_in_reply_to = values['in_reply_to']
+        sender = values['sender']
+        creation_date = values['creation_date']
+        subject = values['subject']
+        recipients = values['recipients']
+        body = values['body']
+        mimeType = values['body_mime_type']
         sender_name, sender_email = parseaddr(sender)
         sender_email_account = EmailAccount.get_or_make_profile(self.db, sender_email, sender_name)
-        creation_date = datetime.utcfromtimestamp(
-            mktime_tz(parsedate_tz(parsed_email['Date'])))
-        subject = email_header_to_unicode(parsed_email['Subject'], False)
-        recipients = email_header_to_unicode(parsed_email['To'])
-        body = body.strip()
         # Try/except for a normal situation is an anti-pattern,
         # but sqlalchemy doesn't have a function that returns
         # 0, 1 result or an exception
@@ -456,6 +507,7 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
 """
             raise MultipleResultsFound("ID %s has duplicates in source %d" % (new_message_id, self.id))
         email_object.creator = sender_email_account.profile
+        email_object.index_references(parsed_email)
         # email_object = self.db.merge(email_object)
         email_object.guess_languages()
         return (email_object, parsed_email, error_description)
@@ -465,6 +517,10 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
     """
     @staticmethod
     def thread_mails(emails):
+        """Full rethreading of the emails of a discussion with jwzthreading.
+        It reparses every email: this is a maintenance operation
+        (``assembl-rethread-mails``), imports use :py:meth:`thread_new_mails`.
+        """
         # print('Threading...')
         emails_for_threading = []
         for mail in emails:
@@ -539,6 +595,67 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
 
         update_threading(threaded_emails.values(), debug=False)
 
+    @staticmethod
+    def _reparent_mail(mail, parent):
+        """Change the parent of an email, as :py:meth:`thread_mails`, unless
+        the current parent is not an email or it would create a cycle.
+        Returns whether the parent changed."""
+        current_parent = mail.parent
+        if current_parent is parent or not (
+                current_parent is None or isinstance(current_parent, Email)):
+            return False
+        if parent is None:
+            mail.parent = None
+            mail._set_ancestry("")
+        elif parent.id == mail.id or mail.id in parent.ancestor_ids():
+            return False
+        else:
+            mail.set_parent(parent)
+        return True
+
+    @staticmethod
+    def thread_mail(mail):
+        """Attach an email to its nearest referenced ancestor in the
+        discussion, and attach to it the emails which reference it
+        more closely than their current parent."""
+        db = mail.db
+        parent = db.query(Email).join(
+            EmailReference, EmailReference.message_id == Email.message_id
+        ).filter(
+            EmailReference.email_id == mail.id,
+            Email.discussion_id == mail.discussion_id,
+            Email.id != mail.id
+        ).order_by(EmailReference.depth, Email.id).first()
+        AbstractMailbox._reparent_mail(mail, parent)
+        # Emails imported before their ancestors
+        waiting = db.query(Email, EmailReference.depth).join(
+            EmailReference, EmailReference.email_id == Email.id
+        ).filter(
+            EmailReference.discussion_id == mail.discussion_id,
+            EmailReference.message_id == mail.message_id,
+            Email.id != mail.id)
+        for (child, depth) in waiting:
+            current_parent = child.parent
+            if isinstance(current_parent, Email):
+                current_depth = {
+                    ref.message_id: ref.depth
+                    for ref in child.email_references
+                }.get(current_parent.message_id, None)
+                if current_depth is not None and current_depth <= depth:
+                    continue
+            AbstractMailbox._reparent_mail(child, mail)
+
+    @staticmethod
+    def thread_new_mails(emails):
+        """Thread newly imported emails with the :py:class:`EmailReference`
+        index, without reparsing the other emails of the discussion."""
+        emails = list(emails)
+        if not emails:
+            return
+        emails[0].db.flush()
+        for mail in emails:
+            AbstractMailbox.thread_mail(mail)
+
     def reprocess_content(self):
         """ Allows re-parsing all content as if it were imported for the first time
             but without re-hitting the source, or changing the object ids.
@@ -555,7 +672,8 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
                     email_.imported_blob, email_)
 
         with transaction.manager:
-            self.thread_mails(emails)
+            self.thread_new_mails(session.query(Email).filter(
+                Email.source_id == self.id))
 
     def import_content(self, only_new=True):
         from assembl.lib.config import get_config
@@ -652,6 +770,69 @@ class IMAPMailbox(AbstractMailbox):
         'with_polymorphic': '*'
     }
 
+    @staticmethod
+    def uid_ranges(uids):
+        """The uids as a compact IMAP sequence set, like '1:5,8,10:12'"""
+        ranges = []
+        for uid in sorted(int(uid) for uid in uids):
+            if ranges and ranges[-1][1] == uid - 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        return ','.join(
+            str(first) if first == last else "%d:%d" % (first, last)
+            for (first, last) in ranges)
+
+    _fetch_uid_re = re.compile(r'\bUID (\d+)')
+
+    @classmethod
+    def fetch_messages(cls, mailbox, uids):
+        """Fetch the messages of these uids with a single command.
+        Returns (uid, message string) in the order of the uids"""
+        status, message_data = mailbox.uid(
+            'fetch', cls.uid_ranges(uids), "(UID RFC822)")
+        assert status == 'OK'
+        messages = {}
+        for response_part in message_data:
+            if isinstance(response_part, tuple):
+                match = cls._fetch_uid_re.search(response_part[0])
+                if match:
+                    messages[match.group(1)] = response_part[1]
+        return [(uid, messages[uid]) for uid in uids if uid in messages]
+
+    def fetch_and_parse(self, mailbox, uids, batch_size=100, concurrency=4):
+        """Fetch messages by batches of uids, and parse them on a thread
+        pool. The next batch is fetched while the caller imports the
+        current one.
+
+        Yields lists of (uid, message string, result of
+        :py:meth:`parse_message` or None if not to be imported)."""
+        batches = [uids[start:start + batch_size]
+                   for start in range(0, len(uids), batch_size)]
+        if not batches:
+            return
+
+        def parse(fetched):
+            (uid, message_string) = fetched
+            if not self.message_ok_to_import(message_string):
+                return (uid, message_string, None)
+            return (uid, message_string, self.parse_message(message_string))
+
+        pool = ThreadPool(max(2, concurrency))
+        try:
+            fetching = pool.apply_async(
+                self.fetch_messages, (mailbox, batches[0]))
+            for next_batch in batches[1:] + [None]:
+                messages = fetching.get()
+                if next_batch is not None:
+                    fetching = pool.apply_async(
+                        self.fetch_messages, (mailbox, next_batch))
+                parsed = pool.map(parse, messages)
+                if parsed:
+                    yield parsed
+        finally:
+            pool.terminate()
+
     @staticmethod
     def do_import_content(mbox, only_new=True):
         mbox = mbox.db.merge(mbox)
@@ -700,49 +881,38 @@ class IMAPMailbox(AbstractMailbox):
             assert search_status == 'OK'
             email_ids = search_result[0].split()
 
-        def import_email(mailbox_obj, email_id):
-            session = mailbox_obj.db
-            # print "running fetch for message: "+email_id
-            status, message_data = mailbox.uid('fetch', email_id, "(RFC822)")
-            assert status == 'OK'
-
-            # print repr(message_data)
-            for response_part in message_data:
-                if isinstance(response_part, tuple):
-                    message_string = response_part[1]
-            assert message_string
-            if mailbox_obj.message_ok_to_import(message_string):
-                (email_object, dummy, error) = mailbox_obj.parse_email(message_string)
-                if error:
-                    raise Exception(error)
-                session.add(email_object)
-                translate_content(email_object)  # should delay
-            else:
-                print "Skipped message with imap id %s (bounce or vacation message)" % (email_id)
-            # print "Setting mailbox_obj.last_imported_email_uid to "+email_id
-            mailbox_obj.last_imported_email_uid = email_id
-
+        discussion_id = mbox.discussion_id
+        batch_size = int(config.get('mail_import_batch_size', 100))
+        concurrency = int(config.get('mail_import_concurrency', 4))
         if len(email_ids):
             print "Processing messages from IMAP: %d " % (len(email_ids))
-            for email_id in email_ids:
+            for batch in mbox.fetch_and_parse(
+                    mailbox, email_ids, batch_size, concurrency):
                 with transaction.manager:
-                    import_email(mbox, email_id)
+                    emails = []
+                    for (email_id, message_string, parsed) in batch:
+                        if parsed is None:
+                            print "Skipped message with imap id %s (bounce or vacation message)" % (email_id)
+                            continue
+                        (email_object, dummy, error) = mbox.parse_email(
+                            message_string, parsed=parsed)
+                        if error:
+                            raise Exception(error)
+                        session.add(email_object)
+                        emails.append(email_object)
+                    AbstractMailbox.thread_new_mails(emails)
+                    imported_ids = [email_object.id for email_object in emails]
+                    # Checkpoint: the batch is imported
+                    mbox.last_imported_email_uid = batch[-1][0]
+                if imported_ids:
+                    translate_discussion.delay(
+                        discussion_id, post_ids=imported_ids)
         else:
             print "No IMAP messages to process"
 
-        discussion_id = mbox.discussion_id
         mailbox.close()
         mailbox.logout()
 
-        with transaction.manager:
-            if len(email_ids):
-                # We imported mails, we need to re-thread
-                emails = session.query(Email).filter(
-                    Email.discussion_id == discussion_id,
-                    ).options(joinedload_all(Email.parent))
-
-                AbstractMailbox.thread_mails(emails)
-
     def make_reader(self):
         from assembl.tasks.imaplib2_source_reader import IMAPReader
         return IMAPReader(self.id)
@@ -819,7 +989,6 @@ class MaildirMailbox(AbstractFilesystemMailbox):
         abstract_mbox = abstract_mbox.db.merge(abstract_mbox)
         session = abstract_mbox.db
         session.add(abstract_mbox)
-        discussion_id = abstract_mbox.discussion_id
 
         if not os.path.isdir(abstract_mbox.filesystem_path):
             raise "There is no directory at %s" % abstract_mbox.filesystem_path
@@ -855,18 +1024,19 @@ class MaildirMailbox(AbstractFilesystemMailbox):
                 raise Exception(error)
             with transaction.manager:
                 session.add(email_object)
+                session.flush()
+                imported_ids.append(email_object.id)
             abstract_mbox = AbstractMailbox.get(abstract_mbox.id)
 
+        imported_ids = []
         if len(mails):
             [import_email(abstract_mbox, message_data) for message_data in mails]
 
-            # We imported mails, we need to re-thread
+            # We imported mails, we need to thread them
             with transaction.manager:
-                emails = session.query(Email).filter(
-                    Email.discussion_id == discussion_id,
-                    ).options(joinedload_all(Email.parent))
-
-                AbstractMailbox.thread_mails(emails)
+                AbstractMailbox.thread_new_mails(session.query(Email).filter(
+                    Email.id.in_(imported_ids)).options(
+                    joinedload_all(Email.parent)))
 
 
 class Email(ImportedPost):
@@ -978,3 +1148,48 @@ class Email(ImportedPost):
 
     def get_title(self):
         return self.source.mangle_mail_subject(self.subject)
+
+    def index_references(self, parsed_email=None):
+        """Record the messages referenced by this email in the
+        :py:class:`EmailReference` index"""
+        if parsed_email is None:
+            parsed_email = email.message_from_string(self.imported_blob)
+        discussion_id = self.discussion_id or self.discussion.id
+        self.email_references = [
+            EmailReference(discussion_id=discussion_id, message_id=reference,
+                           depth=depth)
+            for (depth, reference) in enumerate(
+                AbstractMailbox.references_of(
+                    parsed_email,
+                    AbstractMailbox.clean_angle_brackets(
+                        self.source_post_id)), 1)]
+
+
+class EmailReference(Base):
+    """A message referenced by an email, in its References or In-Reply-To
+    headers. Depth is 1 for the parent, 2 for the grandparent, etc.
+    Used to thread emails as they are imported, including the emails
+    that arrive before their ancestors."""
+    __tablename__ = "email_reference"
+
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, ForeignKey(
+        Email.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    discussion_id = Column(Integer, ForeignKey(
+        'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False)
+    # The referenced message id, without angle brackets
+    message_id = Column(CoerceUnicode, nullable=False)
+    depth = Column(Integer, nullable=False)
+
+    email = relationship(Email, backref=backref(
+        'email_references', cascade="all, delete-orphan",
+        order_by=depth))
+
+    __table_args__ = (
+        Index('ix_email_reference_discussion_message_id',
+              'discussion_id', 'message_id'),
+    )
+
+    sent_to_changes = False
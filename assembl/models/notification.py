@@ -20,7 +20,8 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     event,
-    inspect
+    inspect,
+    exists,
 )
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.orm.exc import DetachedInstanceError
@@ -33,10 +34,13 @@ from jinja2 import Environment, PackageLoader
 from . import Base, DiscussionBoundBase
 from ..lib.model_watcher import BaseModelEventWatcher
 from ..lib.decl_enums import DeclEnum
-from ..lib.sqla import get_session_maker
+from ..lib.sqla import get_session_maker, is_zopish, mark_changed
 from ..lib.utils import waiting_get
 from ..lib import config
-from .auth import User, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate
+from ..auth import R_PARTICIPANT
+from .auth import (
+    User, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate, LocalUserRole,
+    Role)
 from .discussion import Discussion
 from .generic import Content
 from .post import Post, SynthesisPost, PublicationStates
@@ -234,15 +238,54 @@ class NotificationSubscription(DiscussionBoundBase):
     def wouldCreateNotification(self, discussion_id, verb, object):
         return discussion_id == object.get_discussion_id() and self.user.is_participant(discussion_id)
 
+    @classmethod
+    def active_subscriptions_query(cls, discussion_id, user=None):
+        """A query of the (id, user_id) of the active subscriptions of
+        exactly this class in the discussion, whose user is a participant,
+        as :py:meth:`wouldCreateNotification` checks"""
+        query = cls.default_db.query(cls.id, cls.user_id).filter(
+            cls.type == cls.__mapper__.polymorphic_identity,
+            cls.status == NotificationSubscriptionStatus.ACTIVE,
+            cls.discussion_id == discussion_id,
+            exists().where(
+                (LocalUserRole.user_id == cls.user_id) &
+                (LocalUserRole.discussion_id == discussion_id) &
+                (LocalUserRole.requested == False) &  # noqa: E712
+                (LocalUserRole.role_id == Role.id) &
+                (Role.name == R_PARTICIPANT)))
+        if user:
+            query = query.filter(cls.user_id == user.id)
+        return query
+
+    @classmethod
+    def applicable_subscription_ids(cls, discussion_id, verb, object, user=None):
+        """
+        Returns the (id, user_id) of the subscriptions that would fire on
+        the object and verb given, as computed by the database.
+
+        Returns None if the subscriptions have to be evaluated one by one
+        with :py:meth:`wouldCreateNotification`. Subclasses which override
+        this must create a single :py:class:`NotificationOnPostCreated` in
+        :py:meth:`process`, as those notifications are created in bulk.
+        """
+        return None
+
     @classmethod
     def findApplicableInstances(cls, discussion_id, verb, object, user=None):
         """
         Returns all subscriptions that would fire on the object, and verb given
 
         This naive implementation instanciates every ACTIVE subscription for every user,
-        and calls "would fire" for each.  It is expected that most subclasses will
-        override this with a more optimal implementation
+        and calls "would fire" for each, unless the subclass implements
+        :py:meth:`applicable_subscription_ids`.
         """
+        subscription_ids = cls.applicable_subscription_ids(
+            discussion_id, verb, object, user)
+        if subscription_ids is not None:
+            if not subscription_ids:
+                return []
+            return cls.default_db.query(cls).filter(cls.id.in_(
+                [id for (id, _) in subscription_ids])).all()
         applicable_subscriptions = []
         subscriptionsQuery = cls.default_db.query(cls)
         subscriptionsQuery = subscriptionsQuery.filter(cls.status == NotificationSubscriptionStatus.ACTIVE)
@@ -628,6 +671,15 @@ class NotificationSubscriptionFollowSyntheses(NotificationSubscriptionGlobal):
             object.publication_state == PublicationStates.PUBLISHED and
             discussion_id == object.get_discussion_id())
 
+    @classmethod
+    def applicable_subscription_ids(cls, discussion_id, verb, object, user=None):
+        if not (verb == CrudVerbs.CREATE and
+                isinstance(object, SynthesisPost) and
+                object.publication_state == PublicationStates.PUBLISHED and
+                discussion_id == object.get_discussion_id()):
+            return []
+        return cls.active_subscriptions_query(discussion_id, user).all()
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         from ..tasks.notify import notify
         assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
@@ -662,6 +714,15 @@ class NotificationSubscriptionFollowAllMessages(NotificationSubscriptionGlobal):
             object.publication_state == PublicationStates.PUBLISHED and
             discussion_id == object.get_discussion_id())
 
+    @classmethod
+    def applicable_subscription_ids(cls, discussion_id, verb, object, user=None):
+        if not (verb == CrudVerbs.CREATE and
+                isinstance(object, Post) and
+                object.publication_state == PublicationStates.PUBLISHED and
+                discussion_id == object.get_discussion_id()):
+            return []
+        return cls.active_subscriptions_query(discussion_id, user).all()
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
         from ..tasks.notify import notify
@@ -699,6 +760,18 @@ class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscrip
             object.parent.creator == self.user
         )
 
+    @classmethod
+    def applicable_subscription_ids(cls, discussion_id, verb, object, user=None):
+        if not (verb == CrudVerbs.CREATE and
+                isinstance(object, Post) and
+                discussion_id == object.get_discussion_id() and
+                object.publication_state == PublicationStates.PUBLISHED and
+                object.parent_id is not None):
+            return []
+        creator_id = object.parent.creator_id
+        return cls.active_subscriptions_query(discussion_id, user).filter(
+            cls.user_id == creator_id).all()
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
         from ..tasks.notify import notify
@@ -733,6 +806,7 @@ class ModelEventWatcherNotificationSubscriptionDispatcher(BaseModelEventWatcher)
     @classmethod
     def createNotifications(cls, objectId):
         from ..lib.utils import get_concrete_subclasses_recursive
+        from ..tasks.notify import notify
         verb = CrudVerbs.CREATE
         objectClass = Content
         assert objectId
@@ -741,20 +815,47 @@ class ModelEventWatcherNotificationSubscriptionDispatcher(BaseModelEventWatcher)
         assert objectInstance.id
         # We need the discussion id
         assert isinstance(objectInstance, DiscussionBoundBase)
+        discussion_id = objectInstance.get_discussion_id()
+        # user_id -> [(priority, subscription class, subscription id or instance)]
         applicableInstancesByUser = defaultdict(list)
         subscriptionClasses = get_concrete_subclasses_recursive(NotificationSubscription)
         for subscriptionClass in subscriptionClasses:
-            applicableInstances = subscriptionClass.findApplicableInstances(objectInstance.get_discussion_id(), CrudVerbs.CREATE, objectInstance)
-            for subscription in applicableInstances:
-                applicableInstancesByUser[subscription.user_id].append(subscription)
-        num_instances = len([v for v in applicableInstancesByUser.itervalues() if v])
+            subscription_ids = subscriptionClass.applicable_subscription_ids(
+                discussion_id, verb, objectInstance)
+            if subscription_ids is None:
+                subscriptions = [
+                    (subscription.id, subscription.user_id, subscription)
+                    for subscription in subscriptionClass.findApplicableInstances(
+                        discussion_id, verb, objectInstance)]
+            else:
+                subscriptions = [
+                    (id, user_id, None) for (id, user_id) in subscription_ids]
+            for (id, user_id, subscription) in subscriptions:
+                applicableInstancesByUser[user_id].append(
+                    (subscriptionClass.priority, subscriptionClass,
+                     subscription or id))
+        num_instances = len(applicableInstancesByUser)
         print "processEvent: %d notifications created for %s %s %d" % (
             num_instances, verb, objectClass.__name__, objectId)
+        notification_ids = []
         with transaction.manager:
+            bulk_subscription_ids = []
             for userId, applicableInstances in applicableInstancesByUser.iteritems():
-                if(len(applicableInstances) > 0):
-                    applicableInstances.sort(cmp=lambda x, y: cmp(x.priority, y.priority))
-                    applicableInstances[0].process(objectInstance.get_discussion_id(), verb, objectInstance, applicableInstances[1:])
+                applicableInstances.sort(key=lambda x: x[0])
+                (_, subscriptionClass, subscription) = applicableInstances[0]
+                if not isinstance(subscription, NotificationSubscription):
+                    bulk_subscription_ids.append(subscription)
+                    continue
+                # Evaluated in python: give it the other subscriptions
+                others = [
+                    s if isinstance(s, NotificationSubscription)
+                    else NotificationSubscription.get(s)
+                    for (_, _, s) in applicableInstances[1:]]
+                subscription.process(discussion_id, verb, objectInstance, others)
+            notification_ids = NotificationOnPostCreated.bulk_create(
+                objectInstance.db, objectInstance.id, bulk_subscription_ids)
+        for notification_id in notification_ids:
+            notify.delay(notification_id)
 
 
 class NotificationPushMethodType(DeclEnum):
@@ -1076,6 +1177,25 @@ class NotificationOnPostCreated(NotificationOnPost):
     def event_source_object(self):
         return NotificationOnPost.event_source_object(self)
 
+    @classmethod
+    def bulk_create(cls, db, post_id, subscription_ids):
+        """Create the email notifications of the post for the subscriptions,
+        in one statement per table. Returns the notification ids."""
+        if not subscription_ids:
+            return []
+        notification_ids = [id for (id,) in db.execute(
+            Notification.__table__.insert().values([
+                dict(sqla_type=NotificationClasses.NOTIFICATION_ON_POST_CREATED,
+                     first_matching_subscription_id=subscription_id,
+                     push_method=NotificationPushMethodType.EMAIL)
+                for subscription_id in subscription_ids]
+            ).returning(Notification.__table__.c.id))]
+        db.execute(NotificationOnPost.__table__.insert(), [
+            dict(id=id, post_id=post_id) for id in notification_ids])
+        if is_zopish():
+            mark_changed(db)
+        return notification_ids
+
     def get_notification_subject(self):
         loc = self.get_localizer()
         subject = "[" + self.first_matching_subscription.discussion.topic + "] "
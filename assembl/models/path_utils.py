@@ -4,8 +4,10 @@
 from functools import total_ordering
 from collections import defaultdict
 from bisect import bisect_right
+import threading
 
-from sqlalchemy import String
+import transaction
+from sqlalchemy import String, case
 from sqlalchemy.orm import (with_polymorphic, aliased)
 from sqlalchemy.sql.expression import or_, union, except_
 from sqlalchemy.sql.functions import count
@@ -20,7 +22,9 @@ from .post import (
 from .annotation import Webpage
 from .idea import IdeaVisitor, Idea, IdeaLink, RootIdea
 from .discussion import Discussion
-from .action import ViewPost
+from .read_status import PostReadSet
+from ..lib import config
+from ..lib.logging import getLogger
 
 # TODO: Write a discussion structure cache manager.
 # This will have caches of parent, children, counts, etc. at need
@@ -348,7 +352,8 @@ class PostPathLocalCollection(object):
         return q
 
     def as_clause(self, db, discussion_id, user_id=None, content=None,
-                  include_deleted=False, include_moderating=None):
+                  include_deleted=False, include_moderating=None,
+                  read_ids=None):
         subq = self.as_clause_base(
             db, include_deleted=include_deleted, include_moderating=include_moderating,
             user_id=user_id if include_moderating else None)
@@ -361,11 +366,11 @@ class PostPathLocalCollection(object):
             ).join(subq, content.id == subq.c.post_id)
 
         if user_id:
-            # subquery?
-            q = q.outerjoin(
-                ViewPost,
-                (ViewPost.post_id == content.id) & (ViewPost.tombstone_date == None) & (ViewPost.actor_id == user_id)  # noqa: E711
-            ).add_columns(ViewPost.id)
+            if read_ids is None:
+                read_ids = PostReadSet.get_read_ids(db, user_id, discussion_id)
+            q = q.add_columns(case([(
+                PostReadSet.read_clause(content.id, read_ids), content.id)]
+            ).label("read_post_id"))
         return q
 
 
@@ -418,8 +423,9 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
     The result is that the as_clause of each PostPathLocalCollections
     in self.paths is globally complete"""
 
-    def __init__(self, discussion):
-        super(PostPathCombiner, self).__init__(discussion)
+    def __init__(self, discussion, load=True):
+        super(PostPathCombiner, self).__init__(discussion if load else None)
+        self.discussion = discussion
         self.postponed_paths = []
 
     def init_from(self, post_path_global_collection):
@@ -427,6 +433,13 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
             self.paths[id] = paths.clone()
         self.discussion = post_path_global_collection.discussion
 
+    def init_from_combined(self, post_path_combiner):
+        """Take the already combined paths of a visited combiner,
+        so this one does not need to visit the ideas again."""
+        for id, paths in post_path_combiner.paths.iteritems():
+            self.paths[id] = paths.clone()
+        self.root_idea_id = post_path_combiner.root_idea_id
+
     def visit_idea(self, idea, level, prev_result):
         if isinstance(idea, Idea):
             idea_id = idea.id
@@ -468,7 +481,7 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
         return result
 
     def orphan_clause(self, user_id=None, content=None, include_deleted=False,
-                      include_moderating=None):
+                      include_moderating=None, read_ids=None):
         root_path = self.paths[self.root_idea_id]
         db = self.discussion.default_db
         subq = root_path.as_clause_base(
@@ -515,25 +528,35 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
         q = q.filter(state_condition)
 
         if user_id:
-            # subquery?
-            q = q.outerjoin(
-                ViewPost,
-                (ViewPost.post_id == content.id) & (ViewPost.tombstone_date == None) & (ViewPost.actor_id == user_id)  # noqa: E711
-            ).add_columns(ViewPost.id)
+            if read_ids is None:
+                read_ids = PostReadSet.get_read_ids(
+                    db, user_id, self.discussion.id)
+            q = q.add_columns(case([(
+                PostReadSet.read_clause(content.id, read_ids), content.id)]
+            ).label("read_post_id"))
         return q
 
 
 class PostPathCounter(PostPathCombiner):
     "Adds the ability to do post counts to PostPathCombiner."
 
-    def __init__(self, discussion, user_id=None, calc_subset=None):
-        super(PostPathCounter, self).__init__(discussion)
+    def __init__(self, discussion, user_id=None, calc_subset=None,
+                 load=True, counter_store=None, discussion_data=None):
+        super(PostPathCounter, self).__init__(discussion, load)
         self.counts = {}
         self.viewed_counts = {}
         self.read_counts = {}
         self.contributor_counts = {}
         self.user_id = user_id
+        self.discussion_data = discussion_data
+        self._read_ids = None
         self.calc_subset = calc_subset
+        self.counter_store = counter_store
+        self.stored_counts = {}
+        self.stored_epoch = None
+        if counter_store is not None:
+            self.stored_epoch, self.stored_counts = \
+                counter_store.get_counts(discussion.id)
 
     def copy_result(self, idea_id, parent_result, child_result):
         # When the parent has no information, and can get it from a single child
@@ -546,10 +569,21 @@ class PostPathCounter(PostPathCombiner):
         self.counts[idea_id] = parent_result.count
         self.viewed_counts[idea_id] = parent_result.viewed_count
 
+    @property
+    def read_ids(self):
+        if self.discussion_data is not None and (
+                self.discussion_data.user_id == self.user_id):
+            return self.discussion_data.read_ids
+        if self._read_ids is None:
+            self._read_ids = PostReadSet.get_read_ids(
+                self.discussion.db, self.user_id, self.discussion.id)
+        return self._read_ids
+
     def get_counts_for_query(self, q):
         # HACKITY HACK
         entities = [
-            x.entity_zero.entity for x in q._entities]
+            x.entity_zero.entity for x in q._entities
+            if x.entity_zero is not None]
         entities = {e.__mapper__.tables[0].name: e for e in entities}
         content_entity = entities['content']
 
@@ -561,11 +595,12 @@ class PostPathCounter(PostPathCombiner):
                   (post.publication_state.in_(countable_publication_states)))
 
         if self.user_id:
-            action_entity = entities['action']
+            read_condition = PostReadSet.read_clause(
+                content_entity.id, self.read_ids)
             return q.with_entities(
                 count(content_entity.id),
                 count(post.creator_id.distinct()),
-                count(action_entity.id)).first()
+                count(case([(read_condition, content_entity.id)]))).first()
         else:
             (post_count, contributor_count) = q.with_entities(
                 count(content_entity.id),
@@ -591,7 +626,8 @@ class PostPathCounter(PostPathCombiner):
             return (0, 0, 0)
         q = path_collection.as_clause(
             self.discussion.db, self.discussion.id, user_id=self.user_id,
-            include_deleted=None, include_moderating=None)
+            include_deleted=None, include_moderating=None,
+            read_ids=self.read_ids if self.user_id else None)
         (
             post_count, contributor_count, viewed_count
         ) = self.get_counts_for_query(q)
@@ -605,11 +641,37 @@ class PostPathCounter(PostPathCombiner):
         self.counts[idea_id] = post_count
         self.viewed_counts[idea_id] = viewed_count
         self.contributor_counts[idea_id] = contributor_count
+        self.store_counts(idea_id, (post_count, contributor_count))
         return (post_count, contributor_count, viewed_count)
 
+    def store_counts(self, key, counts):
+        if self.counter_store is None or key in self.stored_counts:
+            return
+        self.stored_counts[key] = counts
+        self.counter_store.set_counts(
+            self.discussion.id, {key: counts}, self.stored_epoch)
+
+    def get_post_counts(self, idea_id):
+        """The (post, contributor) counts of an idea.
+        Unlike :py:meth:`get_counts`, can be served by the counter store
+        without a query, as it does not depend on the user."""
+        if idea_id in self.stored_counts:
+            return self.stored_counts[idea_id]
+        return self.get_counts(idea_id)[:2]
+
     def get_orphan_counts(self, include_deleted=False):
-        return self.get_counts_for_query(
-            self.orphan_clause(self.user_id, include_deleted=include_deleted))
+        counts = self.get_counts_for_query(
+            self.orphan_clause(
+                self.user_id, include_deleted=include_deleted,
+                read_ids=self.read_ids if self.user_id else None))
+        if not include_deleted:
+            self.store_counts(ORPHANS_KEY, tuple(counts[:2]))
+        return counts
+
+    def get_orphan_post_counts(self):
+        if ORPHANS_KEY in self.stored_counts:
+            return self.stored_counts[ORPHANS_KEY]
+        return self.get_orphan_counts()[:2]
 
     def end_visit(self, idea, level, result, child_results):
         if isinstance(idea, Idea):
@@ -640,6 +702,7 @@ class DiscussionGlobalData(object):
         self._children_dict = None
         self._post_path_collection_raw = None
         self._post_path_counter = None
+        self._read_ids = None
 
     @property
     def discussion(self):
@@ -647,6 +710,15 @@ class DiscussionGlobalData(object):
             self._discussion = Discussion.get(self.discussion_id)
         return self._discussion
 
+    @property
+    def read_ids(self):
+        """The ids of the posts read by the user, see
+        :py:class:`assembl.models.read_status.PostReadSet`"""
+        if self._read_ids is None:
+            self._read_ids = PostReadSet.get_read_ids(
+                self.db, self.user_id, self.discussion_id)
+        return self._read_ids
+
     @property
     def parent_dict(self):
         """dictionary child_idea.id -> parent_idea.id.
@@ -699,10 +771,23 @@ class DiscussionGlobalData(object):
 
     def post_path_counter(self, user_id, calc_all):
         if (self._post_path_counter is None or not isinstance(self._post_path_counter, PostPathCounter)):
-            counter = PostPathCounter(
-                self.discussion, user_id, None if calc_all else ())
-            counter.init_from(self.post_path_collection_raw)
-            self.discussion.root_idea.visit_ideas_depth_first(counter)
+            counter_store = get_counter_store()
+            if counter_store is None:
+                counter = PostPathCounter(
+                    self.discussion, user_id, None if calc_all else (),
+                    load=False, discussion_data=self)
+                counter.init_from(self.post_path_collection_raw)
+                self.discussion.root_idea.visit_ideas_depth_first(counter)
+            else:
+                counter = PostPathCounter(
+                    self.discussion, user_id, None if calc_all else (),
+                    load=False, counter_store=counter_store,
+                    discussion_data=self)
+                counter.init_from_combined(
+                    counter_store.post_path_combiner(self))
+                if calc_all:
+                    for idea_id in list(counter.paths.iterkeys()):
+                        counter.get_post_counts(idea_id)
             self._post_path_counter = counter
         return self._post_path_counter
 
@@ -710,7 +795,301 @@ class DiscussionGlobalData(object):
         self._parent_dict = None
         self._children_dict = None
         self._post_path_counter = None
+        counter_store = get_counter_store()
+        if counter_store is not None:
+            counter_store.hierarchy_changed(self.discussion_id)
 
     def reset_content_links(self):
         self._post_path_collection_raw = None
         self._post_path_counter = None
+        counter_store = get_counter_store()
+        if counter_store is not None:
+            counter_store.content_links_changed(self.discussion_id, None)
+
+
+ORPHANS_KEY = "orphans"
+
+
+class MemoryCounterBackend(object):
+    """Keeps discussion counters in process memory.
+
+    Only coherent if a single process writes to the discussion;
+    use :py:class:`RedisCounterBackend` with multiple workers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(dict)
+        self._epochs = defaultdict(int)
+        self._generations = defaultdict(int)
+
+    def get_counts(self, discussion_id):
+        with self._lock:
+            return (self._epochs[discussion_id],
+                    dict(self._counts[discussion_id]))
+
+    def set_counts(self, discussion_id, counts, epoch):
+        with self._lock:
+            if self._epochs[discussion_id] == epoch:
+                self._counts[discussion_id].update(counts)
+
+    def discard(self, discussion_id, keys):
+        with self._lock:
+            self._epochs[discussion_id] += 1
+            counts = self._counts[discussion_id]
+            for key in keys:
+                counts.pop(key, None)
+
+    def clear(self, discussion_id):
+        with self._lock:
+            self._epochs[discussion_id] += 1
+            self._counts.pop(discussion_id, None)
+
+    def generation(self, discussion_id):
+        return self._generations[discussion_id]
+
+    def bump_generation(self, discussion_id):
+        with self._lock:
+            self._generations[discussion_id] += 1
+
+
+class RedisCounterBackend(object):
+    """Keeps discussion counters in redis, shared by all processes.
+
+    Counts are kept in a hash per discussion. The epoch is bumped on every
+    invalidation, so counts computed before an invalidation are not stored.
+    The generation is bumped when the combined post paths are obsolete."""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def counts_key(discussion_id):
+        return "assembl:counters:%d" % (discussion_id,)
+
+    @staticmethod
+    def epoch_key(discussion_id):
+        return "assembl:counters_epoch:%d" % (discussion_id,)
+
+    @staticmethod
+    def generation_key(discussion_id):
+        return "assembl:counters_generation:%d" % (discussion_id,)
+
+    def get_counts(self, discussion_id):
+        pipe = self.redis.pipeline()
+        pipe.get(self.epoch_key(discussion_id))
+        pipe.hgetall(self.counts_key(discussion_id))
+        epoch, raw_counts = pipe.execute()
+        counts = {}
+        for key, value in raw_counts.iteritems():
+            if key != ORPHANS_KEY:
+                key = int(key)
+            counts[key] = tuple(int(x) for x in value.split(","))
+        return int(epoch or 0), counts
+
+    def set_counts(self, discussion_id, counts, epoch):
+        import redis
+        epoch_key = self.epoch_key(discussion_id)
+        values = {str(key): "%d,%d" % value
+                  for (key, value) in counts.iteritems()}
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(epoch_key)
+                if int(pipe.get(epoch_key) or 0) != epoch:
+                    return
+                pipe.multi()
+                pipe.hmset(self.counts_key(discussion_id), values)
+                pipe.execute()
+            except redis.WatchError:
+                # invalidated concurrently, do not store obsolete counts
+                pass
+
+    def discard(self, discussion_id, keys):
+        pipe = self.redis.pipeline()
+        pipe.incr(self.epoch_key(discussion_id))
+        if keys:
+            pipe.hdel(self.counts_key(discussion_id),
+                      *[str(key) for key in keys])
+        pipe.execute()
+
+    def clear(self, discussion_id):
+        pipe = self.redis.pipeline()
+        pipe.incr(self.epoch_key(discussion_id))
+        pipe.delete(self.counts_key(discussion_id))
+        pipe.execute()
+
+    def generation(self, discussion_id):
+        return int(self.redis.get(self.generation_key(discussion_id)) or 0)
+
+    def bump_generation(self, discussion_id):
+        self.redis.incr(self.generation_key(discussion_id))
+
+
+class DiscussionCounterStore(object):
+    """Post and contributor counts per idea, which outlive the request.
+
+    Counts are invalidated incrementally from the post and idea content link
+    events sent to :py:meth:`assembl.lib.sqla.BaseOps.send_to_changes`,
+    after the transaction commits. The combined post paths of each idea
+    are kept in process memory and are only rebuilt when the content links
+    or the idea hierarchy change. Recomputed counts are then stored lazily
+    by :py:class:`PostPathCounter`."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._combiners = {}
+        self._pending = threading.local()
+
+    def get_counts(self, discussion_id):
+        return self.backend.get_counts(discussion_id)
+
+    def set_counts(self, discussion_id, counts, epoch):
+        self.backend.set_counts(discussion_id, counts, epoch)
+
+    def post_path_combiner(self, discussion_data):
+        """A :py:class:`PostPathCombiner` which has visited the discussion,
+        and the idea parent dictionary used to build it."""
+        discussion_id = discussion_data.discussion_id
+        generation = self.backend.generation(discussion_id)
+        cached = self._combiners.get(discussion_id, None)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        discussion = discussion_data.discussion
+        combiner = PostPathCombiner(discussion, load=False)
+        combiner.init_from(discussion_data.post_path_collection_raw)
+        discussion.root_idea.visit_ideas_depth_first(combiner)
+        combiner.parent_dict = dict(discussion_data.parent_dict)
+        # drop the references to the session
+        combiner.discussion = None
+        combiner.postponed_paths = []
+        self._combiners[discussion_id] = (generation, combiner)
+        return combiner
+
+    def _cached_combiner(self, discussion_id):
+        cached = self._combiners.get(discussion_id, None)
+        if cached is not None and \
+                cached[0] == self.backend.generation(discussion_id):
+            return cached[1]
+
+    def affected_by_post(self, discussion_id, post_path):
+        """The counter keys affected by a change to a post.
+        None if we cannot tell without the combined paths."""
+        combiner = self._cached_combiner(discussion_id)
+        if combiner is None:
+            return None
+        keys = [idea_id for (idea_id, paths) in combiner.paths.iteritems()
+                if paths.includes_post(post_path)]
+        if combiner.root_idea_id not in keys:
+            keys.append(ORPHANS_KEY)
+        return keys
+
+    def affected_by_idea(self, discussion_id, idea_id):
+        """The counter keys affected by a change to the content links
+        of an idea: the idea, its ancestors and the orphans.
+        None if we cannot tell without the combined paths."""
+        combiner = self._cached_combiner(discussion_id)
+        if combiner is None:
+            return None
+        keys = [ORPHANS_KEY]
+        while idea_id:
+            keys.append(idea_id)
+            idea_id = combiner.parent_dict.get(idea_id, None)
+        return keys
+
+    def _schedule(self, discussion_id, change):
+        """Apply the change after the transaction commits, as other requests
+        could otherwise store counts computed from the previous state."""
+        from ..lib.sqla import is_zopish
+        if not is_zopish():
+            self._apply(discussion_id, change)
+            return
+        txn = transaction.get()
+        pending = getattr(self._pending, "changes", None)
+        if pending is None or pending[0] is not txn:
+            pending = self._pending.changes = (txn, [])
+            txn.addAfterCommitHook(self._apply_pending, (pending[1],))
+        pending[1].append((discussion_id, change))
+
+    def _apply_pending(self, status, changes):
+        self._pending.changes = None
+        if not status:
+            return
+        for (discussion_id, change) in changes:
+            try:
+                self._apply(discussion_id, change)
+            except Exception as e:
+                getLogger().error(
+                    "Could not update discussion counters", exc_info=e)
+
+    def _apply(self, discussion_id, change):
+        kind, arg = change
+        if kind == "post":
+            keys = self.affected_by_post(discussion_id, arg)
+        elif kind == "idea_links":
+            keys = None
+            if arg is not None:
+                keys = self.affected_by_idea(discussion_id, arg)
+            self.backend.bump_generation(discussion_id)
+        else:
+            keys = None
+            self.backend.bump_generation(discussion_id)
+        if keys is None:
+            self.backend.clear(discussion_id)
+        else:
+            self.backend.discard(discussion_id, keys)
+
+    def post_changed(self, discussion_id, post_path):
+        """A post was created or changed in a way that affects the counts.
+
+        :param post_path: the post ancestry, including the post id."""
+        self._schedule(discussion_id, ("post", post_path))
+
+    def content_links_changed(self, discussion_id, idea_id):
+        """An idea content link of that idea was created or changed.
+        If idea_id is None, all idea counts are reset."""
+        self._schedule(discussion_id, ("idea_links", idea_id))
+
+    def hierarchy_changed(self, discussion_id):
+        """The idea hierarchy changed, all counts have to be rebuilt."""
+        self._schedule(discussion_id, ("hierarchy", None))
+
+    def check_consistency(self, discussion_data):
+        """Compare the stored counts with a full :py:class:`PostPathCounter`.
+
+        :returns: a dictionary of key -> (stored, computed) for
+            the keys whose stored count is wrong."""
+        discussion = discussion_data.discussion
+        counter = PostPathCounter(discussion, load=False)
+        counter.init_from(discussion_data.post_path_collection_raw)
+        discussion.root_idea.visit_ideas_depth_first(counter)
+        epoch, stored = self.get_counts(discussion.id)
+        errors = {}
+        for key, stored_counts in stored.iteritems():
+            if key == ORPHANS_KEY:
+                computed = counter.get_orphan_counts()[:2]
+            else:
+                computed = counter.get_counts(key)[:2]
+            computed = tuple(computed)
+            if tuple(stored_counts) != computed:
+                errors[key] = (tuple(stored_counts), computed)
+        return errors
+
+
+_counter_store = False
+
+
+def get_counter_store():
+    """The process-wide :py:class:`DiscussionCounterStore`, according to
+    the ``discussion_counters_store`` setting (``memory``, ``redis``);
+    None if counters should only last as long as the request."""
+    global _counter_store
+    if _counter_store is False:
+        backend_name = config.get('discussion_counters_store', None)
+        if backend_name == 'memory':
+            _counter_store = DiscussionCounterStore(MemoryCounterBackend())
+        elif backend_name == 'redis':
+            from ..lib.caching import get_redis_client
+            _counter_store = DiscussionCounterStore(
+                RedisCounterBackend(get_redis_client()))
+        else:
+            _counter_store = None
+    return _counter_store
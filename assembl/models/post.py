@@ -17,7 +17,8 @@ from sqlalchemy import (
     Index,
     or_,
     event,
-    func
+    func,
+    inspect
 )
 from sqlalchemy.orm import (
     relationship, backref, deferred, column_property, with_polymorphic)
@@ -269,6 +270,32 @@ class Post(Content, TaggableEntity):
         else:
             return body
 
+    # Changes to those attributes affect the idea post counts
+    counted_attributes = (
+        'ancestry', 'publication_state', 'hidden', 'tombstone_date',
+        'creator_id')
+
+    def send_to_changes(self, connection=None, operation=CrudOperation.UPDATE,
+                        discussion_id=None, view_def="changes"):
+        """Also update the discussion counters"""
+        super(Post, self).send_to_changes(
+            connection, operation, discussion_id, view_def)
+        from .path_utils import get_counter_store
+        counter_store = get_counter_store()
+        if counter_store is None:
+            return
+        paths = {"%s%d," % (self.ancestry or '', self.id)}
+        if operation == CrudOperation.UPDATE:
+            attrs = inspect(self).attrs
+            if not any(attrs[attr].history.has_changes()
+                       for attr in self.counted_attributes):
+                return
+            for ancestry in attrs.ancestry.history.deleted:
+                paths.add("%s%d," % (ancestry or '', self.id))
+        discussion_id = discussion_id or self.get_discussion_id()
+        for path in paths:
+            counter_store.post_changed(discussion_id, path)
+
     def _set_ancestry(self, new_ancestry):
         self.ancestry = new_ancestry
 
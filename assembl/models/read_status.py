@@ -0,0 +1,240 @@
+"""Compact read status of the posts of a discussion, by user.
+
+Reading a post used to be known only through its
+:py:class:`assembl.models.action.ViewPost` actions, and every unread count
+joined the action table. The ids of the posts a user read in a discussion
+are now also kept in a :py:class:`PostReadSet`, as the bounds of their
+ranges (see :py:class:`assembl.lib.id_ranges.IdRangeSet`), and read counts
+test the post ids against those bounds. Post ids are shared by all the
+discussions, so ranges are merged over the ids of other discussions, and
+the sets only tell about the posts of their discussion.
+
+The ``ViewPost`` actions remain the history of the views; the read set
+follows the live views, whether they are marked in bulk with
+:py:meth:`PostReadSet.mark_read` or created through the ORM.
+"""
+from datetime import datetime
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    ForeignKey,
+    UniqueConstraint,
+    select,
+    exists,
+    literal,
+    cast,
+    false,
+    func,
+    event,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+
+from . import Base
+from .discussion import Discussion
+from .generic import Content
+from .action import Action, ActionOnPost, ViewPost
+from ..lib.id_ranges import IdRangeSet
+from ..lib.sqla import is_zopish, mark_changed, id_mapping
+
+
+class PostReadSet(Base):
+    """The posts of a discussion read by a user, as the bounds of
+    the ranges of their ids"""
+    __tablename__ = 'post_read_set'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey(
+        'user.id', ondelete='CASCADE', onupdate='CASCADE'), nullable=False)
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    bounds = Column(ARRAY(Integer), nullable=False, server_default='{}')
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'discussion_id'),
+    )
+
+    sent_to_changes = False
+
+    @classmethod
+    def get_read_ids(cls, db, user_id, discussion_id):
+        """The ids of the posts of the discussion read by the user.
+        May include ids of posts of other discussions."""
+        bounds = db.query(cls.bounds).filter_by(
+            user_id=user_id, discussion_id=discussion_id).scalar()
+        return IdRangeSet(bounds or ())
+
+    @staticmethod
+    def read_clause(id_column, read_ids):
+        """A condition on a column of post ids: is the post in read_ids,
+        an :py:class:`assembl.lib.id_ranges.IdRangeSet`. Only tells about
+        the posts of the discussion of the read set."""
+        if not read_ids.bounds:
+            return false()
+        # The number of bounds lower or equal to the id, as bisect_right
+        bucket = func.width_bucket(id_column, cast(
+            literal(read_ids.bounds, ARRAY(Integer)), ARRAY(Integer)),
+            type_=Integer)
+        return bucket % 2 == 1
+
+    @classmethod
+    def _update(cls, execute, user_id, discussion_id, add=(), remove=()):
+        """Add and remove ids in the read set of the user, locked until
+        the end of the transaction.
+
+        :returns: the read ids, the added ids, the removed ids"""
+        table = cls.__table__
+        execute(pg_insert(table).values(
+            user_id=user_id, discussion_id=discussion_id
+        ).on_conflict_do_nothing(index_elements=['user_id', 'discussion_id']))
+        condition = ((table.c.user_id == user_id) &
+                     (table.c.discussion_id == discussion_id))
+        read_ids = IdRangeSet(execute(select([table.c.bounds]).where(
+            condition).with_for_update()).scalar())
+        added = read_ids.update(add)
+        removed = read_ids.difference_update(remove)
+        if added or removed:
+            read_ids = cls._merge_gaps(execute, discussion_id, read_ids)
+            execute(table.update().where(condition).values(
+                bounds=read_ids.bounds))
+        return read_ids, added, removed
+
+    @staticmethod
+    def _merge_gaps(execute, discussion_id, read_ids):
+        """Merge the ranges separated by no post of the discussion"""
+        bounds = read_ids.bounds
+        if len(bounds) < 4:
+            return read_ids
+        gap_starts, gap_ends = bounds[1:-1:2], bounds[2::2]
+
+        def ids_array(ids):
+            return cast(literal(ids, ARRAY(Integer)), ARRAY(Integer))
+        gaps = select([
+            func.unnest(ids_array(gap_starts)).label('start_id'),
+            func.unnest(ids_array(gap_ends)).label('end_id')]).alias('gaps')
+        content = Content.__table__
+        kept = {start for (start,) in execute(select([gaps.c.start_id]).where(
+            exists().where((content.c.discussion_id == discussion_id) &
+                           (content.c.id >= gaps.c.start_id) &
+                           (content.c.id < gaps.c.end_id))))}
+        merged = [bounds[0]]
+        for start, end in zip(gap_starts, gap_ends):
+            if start in kept:
+                merged.extend((start, end))
+        merged.append(bounds[-1])
+        return IdRangeSet(merged)
+
+    @staticmethod
+    def _live_view(user_id, post_id_column):
+        action = Action.__table__
+        view = ActionOnPost.__table__
+        return exists().where(
+            (view.c.id == action.c.id) &
+            (view.c.post_id == post_id_column) &
+            (action.c.actor_id == user_id) &
+            (action.c.type == ViewPost.__mapper__.polymorphic_identity) &
+            (action.c.tombstone_date == None))  # noqa: E711
+
+    @classmethod
+    def mark_read(cls, db, user_id, discussion_id, post_ids):
+        """Mark posts of the discussion as read by the user, with a
+        ``ViewPost`` action for each post that was not read, inserted
+        with a single statement.
+
+        :returns: the ids of the posts that were not read, sorted"""
+        post_ids = set(post_ids)
+        if not post_ids:
+            return []
+        read_ids, _, _ = cls._update(db.execute, user_id, discussion_id)
+        post_ids = [id for id in post_ids if id not in read_ids]
+        if not post_ids:
+            return []
+        content = Content.__table__
+        # Posts may have a live view already if the set lagged behind
+        rows = db.execute(select([
+            content.c.id, cls._live_view(user_id, content.c.id)
+        ]).where(content.c.id.in_(post_ids) &
+                 (content.c.discussion_id == discussion_id))).fetchall()
+        post_ids = [id for (id, _) in rows]
+        unviewed_ids = [id for (id, viewed) in rows if not viewed]
+        if unviewed_ids:
+            action = Action.__table__
+            new_id = func.nextval(
+                func.pg_get_serial_sequence(action.fullname, 'id'))
+            view_ids = dict(db.execute(select([content.c.id, new_id]).where(
+                content.c.id.in_(unviewed_ids))).fetchall())
+            views = id_mapping(view_ids, 'view_ids')
+            db.execute(action.insert().from_select(
+                ['id', 'type', 'actor_id', 'creation_date'],
+                select([views.c.new_id,
+                        literal(ViewPost.__mapper__.polymorphic_identity),
+                        literal(user_id), literal(datetime.utcnow())])))
+            db.execute(ActionOnPost.__table__.insert().from_select(
+                ['id', 'post_id'], select([views.c.new_id, views.c.old_id])))
+        _, added, _ = cls._update(
+            db.execute, user_id, discussion_id, add=post_ids)
+        if is_zopish():
+            mark_changed(db)
+        return added
+
+    @classmethod
+    def mark_unread(cls, db, user_id, discussion_id, post_ids):
+        """Mark posts of the discussion as unread by the user, and
+        tombstone their live ``ViewPost`` actions.
+
+        :returns: the ids of the posts that were read, sorted"""
+        post_ids = set(post_ids)
+        if not post_ids:
+            return []
+        content = Content.__table__
+        post_ids = [id for (id,) in db.execute(select([content.c.id]).where(
+            content.c.id.in_(post_ids) &
+            (content.c.discussion_id == discussion_id)))]
+        if not post_ids:
+            return []
+        _, _, removed = cls._update(
+            db.execute, user_id, discussion_id, remove=post_ids)
+        if removed:
+            action = Action.__table__
+            view = ActionOnPost.__table__
+            db.execute(action.update().where(action.c.id.in_(
+                select([view.c.id]).where(view.c.post_id.in_(removed)))
+            ).where(
+                (action.c.actor_id == user_id) &
+                (action.c.type == ViewPost.__mapper__.polymorphic_identity) &
+                (action.c.tombstone_date == None)  # noqa: E711
+            ).values(tombstone_date=datetime.utcnow()))
+        if is_zopish():
+            mark_changed(db)
+        return removed
+
+    @classmethod
+    def resync(cls, db, user_id, post_ids, connection=None):
+        """Make the read sets of the user follow the live views of the
+        posts.
+
+        :param connection: the connection of a flush in progress, if any"""
+        post_ids = {id for id in post_ids if id}
+        if not user_id or not post_ids:
+            return
+        execute = (connection or db).execute
+        content = Content.__table__
+        by_discussion = {}
+        for (post_id, discussion_id, viewed) in execute(select([
+                content.c.id, content.c.discussion_id,
+                cls._live_view(user_id, content.c.id)
+                ]).where(content.c.id.in_(post_ids))):
+            by_discussion.setdefault(discussion_id, ([], []))[
+                0 if viewed else 1].append(post_id)
+        for discussion_id, (add, remove) in by_discussion.iteritems():
+            cls._update(execute, user_id, discussion_id, add, remove)
+        if connection is None and is_zopish():
+            mark_changed(db)
+
+
+@event.listens_for(ViewPost, 'after_insert', propagate=True)
+@event.listens_for(ViewPost, 'after_update', propagate=True)
+@event.listens_for(ViewPost, 'after_delete', propagate=True)
+def resync_post_read_set(mapper, connection, target):
+    PostReadSet.resync(None, target.actor_id, [target.post_id], connection)
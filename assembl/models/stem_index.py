@@ -0,0 +1,318 @@
+"""Stored counts of the stemmed words of posts, for idea word clouds.
+
+:py:meth:`assembl.models.idea.Idea.most_common_words` used to read and
+stem the text of every post related to the idea. The counts of each post
+are now kept in :py:class:`PostStemCount` rows, by stemming language,
+and the word cloud of an idea sums them over its related posts. Posts
+are stemmed when they have no counts yet, or when their original subject
+or body entry changed since (a new entry replaces the edited one);
+other posts are never stemmed again.
+
+The word clouds can also be cached per idea (``idea_keywords_cache``
+setting: ``memory`` or ``redis``), until a post or idea of the discussion
+changes, as seen by :py:class:`KeywordsModelEventWatcher`, or for
+``idea_keywords_cache_ttl`` seconds.
+"""
+from hashlib import sha1
+
+import transaction
+from sqlalchemy import (
+    Column,
+    Integer,
+    Float,
+    String,
+    UnicodeText,
+    ForeignKey,
+    UniqueConstraint,
+    func,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm.util import identity_key
+
+from . import Base
+from .generic import Content
+from .langstrings import LangStringEntry, Locale
+from ..lib import config, metrics
+from ..lib.clean_input import sanitize_text
+from ..lib.logging import getLogger
+from ..lib.model_watcher import BaseModelEventWatcher
+from ..lib.sqla import is_zopish, mark_changed
+
+
+class PostStemIndex(Base):
+    """The stemming of a post in a language; the version of its subject and
+    body tells whether the counts are still current."""
+    __tablename__ = 'post_stem_index'
+    __table_args__ = (UniqueConstraint('post_id', 'lang'), )
+
+    id = Column(Integer, primary_key=True)
+    post_id = Column(Integer, ForeignKey(
+        Content.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    # The stemmer language, '' if none
+    lang = Column(String(20), nullable=False)
+    # The original entries that were stemmed
+    subject_entry_id = Column(Integer)
+    body_entry_id = Column(Integer)
+    # Identical subjects (e.g. "Re: ...") are counted once per idea
+    subject_digest = Column(String(40))
+
+    post = relationship(Content, backref=backref(
+        'stem_indexes', cascade='all, delete-orphan', passive_deletes=True))
+
+    sent_to_changes = False
+
+    @staticmethod
+    def original_entries_query(db):
+        """The latest original entry of each langstring,
+        as (langstring_id, entry_id)"""
+        return db.query(
+            LangStringEntry.langstring_id,
+            func.max(LangStringEntry.id).label('entry_id')
+        ).join(Locale).filter(
+            ~Locale.is_machine_translated,
+            LangStringEntry.tombstone_date == None  # noqa: E711
+        ).group_by(LangStringEntry.langstring_id).subquery()
+
+    @classmethod
+    def current_versions(cls, db, post_ids_query):
+        """The (post_id, subject_entry_id, body_entry_id) of the posts"""
+        entries = cls.original_entries_query(db)
+        subject = entries.alias()
+        body = entries.alias()
+        post_ids = post_ids_query.subquery()
+        return db.query(
+            Content.id, subject.c.entry_id, body.c.entry_id
+        ).join(post_ids, post_ids.c.post_id == Content.id
+        ).outerjoin(subject, subject.c.langstring_id == Content.subject_id
+        ).outerjoin(body, body.c.langstring_id == Content.body_id)
+
+    @classmethod
+    def update_posts(cls, db, post_ids_query, word_counter):
+        """Stem the posts of the query that were not stemmed in the language
+        of the counter, or whose text changed since.
+        Returns the number of posts stemmed."""
+        lang = word_counter.stemmer_lang or ''
+        post_ids = post_ids_query.subquery()
+        indexed = {
+            post_id: (index_id, subject_entry_id, body_entry_id)
+            for (index_id, post_id, subject_entry_id, body_entry_id)
+            in db.query(cls.id, cls.post_id, cls.subject_entry_id,
+                        cls.body_entry_id
+            ).join(post_ids, post_ids.c.post_id == cls.post_id
+            ).filter(cls.lang == lang)}
+        stale = {}
+        for (post_id, subject_entry_id, body_entry_id) in cls.current_versions(
+                db, post_ids_query):
+            index = indexed.get(post_id, None)
+            if index is None or index[1:] != (subject_entry_id, body_entry_id):
+                stale[post_id] = (subject_entry_id, body_entry_id)
+        if not stale:
+            return 0
+        entry_ids = {entry_id for versions in stale.itervalues()
+                     for entry_id in versions if entry_id}
+        texts = dict(db.query(LangStringEntry.id, LangStringEntry.value
+                              ).filter(LangStringEntry.id.in_(entry_ids)))
+        indexes = []
+        counts_by_post_id = {}
+        # In post order, so concurrent updates lock rows in the same order
+        for post_id, (subject_entry_id, body_entry_id) in sorted(
+                stale.iteritems()):
+            subject = sanitize_text(texts.get(subject_entry_id, None) or '')
+            body = sanitize_text(texts.get(body_entry_id, None) or '')
+            indexes.append(dict(
+                post_id=post_id, lang=lang, subject_entry_id=subject_entry_id,
+                body_entry_id=body_entry_id,
+                subject_digest=sha1(subject.encode('utf-8')).hexdigest()))
+            counts = counts_by_post_id[post_id] = {}
+            for (position, text) in ((0, subject), (1, body)):
+                for (stem, word) in word_counter.stems(text):
+                    count = counts.setdefault((stem, word), [0, 0])
+                    count[position] += 1
+        # Concurrent readers of the same idea may stem the same posts
+        stmt = pg_insert(cls.__table__).values(indexes)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['post_id', 'lang'],
+            set_=dict(subject_entry_id=stmt.excluded.subject_entry_id,
+                      body_entry_id=stmt.excluded.body_entry_id,
+                      subject_digest=stmt.excluded.subject_digest)
+        ).returning(cls.__table__.c.id, cls.__table__.c.post_id)
+        index_ids = {post_id: index_id
+                     for (index_id, post_id) in db.execute(stmt)}
+        count_table = PostStemCount.__table__
+        db.execute(count_table.delete().where(
+            count_table.c.index_id.in_(index_ids.values())))
+        values = [
+            dict(index_id=index_ids[post_id], stem=stem, word=word,
+                 subject_count=subject_count, body_count=body_count)
+            for (post_id, counts) in counts_by_post_id.iteritems()
+            for ((stem, word), (subject_count, body_count))
+            in counts.iteritems()]
+        if values:
+            db.execute(count_table.insert(), values)
+        if is_zopish():
+            mark_changed(db)
+        metrics.counter("idea_keywords.posts_stemmed").inc(len(stale))
+        return len(stale)
+
+    @classmethod
+    def add_counts(cls, db, post_ids_query, word_counter,
+                   body_weight=0.5, subject_weight=1.0):
+        """Add the stored counts of the posts to the counter, stemming
+        the posts that need it first."""
+        cls.update_posts(db, post_ids_query, word_counter)
+        lang = word_counter.stemmer_lang or ''
+        post_ids = post_ids_query.subquery()
+        indexes = db.query(cls.id).join(
+            post_ids, post_ids.c.post_id == cls.post_id).filter(
+            cls.lang == lang)
+        word_counter.add_counts(
+            (stem, word, body_count * body_weight)
+            for (stem, word, body_count) in db.query(
+                PostStemCount.stem, PostStemCount.word,
+                func.sum(PostStemCount.body_count)
+            ).filter(PostStemCount.index_id.in_(indexes.subquery())
+            ).group_by(PostStemCount.stem, PostStemCount.word))
+        distinct_subjects = db.query(func.min(cls.id)).join(
+            post_ids, post_ids.c.post_id == cls.post_id).filter(
+            cls.lang == lang).group_by(cls.subject_digest)
+        word_counter.add_counts(
+            (stem, word, subject_count * subject_weight)
+            for (stem, word, subject_count) in db.query(
+                PostStemCount.stem, PostStemCount.word,
+                func.sum(PostStemCount.subject_count)
+            ).filter(
+                PostStemCount.index_id.in_(distinct_subjects.subquery())
+            ).group_by(PostStemCount.stem, PostStemCount.word))
+
+
+class PostStemCount(Base):
+    """How many times a word appears in the subject and body of a post"""
+    __tablename__ = 'post_stem_count'
+
+    id = Column(Integer, primary_key=True)
+    index_id = Column(Integer, ForeignKey(
+        PostStemIndex.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    stem = Column(UnicodeText, nullable=False)
+    word = Column(UnicodeText, nullable=False)
+    subject_count = Column(Float, nullable=False, default=0)
+    body_count = Column(Float, nullable=False, default=0)
+
+    index = relationship(PostStemIndex, backref=backref(
+        'counts', cascade='all, delete-orphan', passive_deletes=True))
+
+    sent_to_changes = False
+
+
+class IdeaKeywordsCache(object):
+    """Caches the word clouds of ideas, keyed by a generation number of
+    their discussion that is incremented when its posts or ideas change.
+    Uses the backends of the permission cache."""
+
+    def __init__(self, backend, ttl=3600):
+        self.backend = backend
+        self.ttl = ttl
+
+    @staticmethod
+    def generation_name(discussion_id):
+        return "idea_keywords:%s" % (discussion_id,)
+
+    def key(self, discussion_id, idea_id, langs, num):
+        generation, = self.backend.generations(
+            [self.generation_name(discussion_id)])
+        return "idea_keywords:%s:%d:%s:%d" % (
+            idea_id, generation, ",".join(langs), num)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, words):
+        self.backend.set(key, words, self.ttl)
+
+    def invalidate(self, discussion_id):
+        names = [self.generation_name(discussion_id)]
+        self._bump(names)
+        if is_zopish():
+            # Again after commit, in case a request cached the previous state
+            transaction.get().addAfterCommitHook(
+                self._bump_after_commit, (names,))
+
+    def _bump_after_commit(self, status, names):
+        if status:
+            self._bump(names)
+
+    def _bump(self, names):
+        try:
+            self.backend.bump_generations(names)
+        except Exception as e:
+            getLogger().error(
+                "Could not invalidate the idea keywords cache", exc_info=e)
+
+
+_keywords_cache = None
+
+
+def get_keywords_cache():
+    """The process-wide :py:class:`IdeaKeywordsCache`, according to the
+    ``idea_keywords_cache`` setting (``memory``, ``redis``; default none)"""
+    global _keywords_cache
+    if _keywords_cache is None:
+        from ..auth.permission_cache import (
+            MemoryPermissionBackend, RedisPermissionBackend)
+        backend_name = config.get('idea_keywords_cache', None)
+        if backend_name == 'memory':
+            backend = MemoryPermissionBackend()
+        elif backend_name == 'redis':
+            from ..lib.caching import get_redis_client
+            backend = RedisPermissionBackend(get_redis_client())
+        else:
+            return None
+        _keywords_cache = IdeaKeywordsCache(
+            backend, int(config.get('idea_keywords_cache_ttl', 3600)))
+    return _keywords_cache
+
+
+class KeywordsModelEventWatcher(BaseModelEventWatcher):
+    """Invalidates the cached word clouds of a discussion
+    when its posts or ideas change"""
+
+    def invalidate(self, cls, id):
+        cache = get_keywords_cache()
+        if cache is None:
+            return
+        discussion_id = self.discussion_id(cls, id)
+        if discussion_id is not None:
+            cache.invalidate(discussion_id)
+
+    @staticmethod
+    def discussion_id(cls, id):
+        """The discussion of a post or idea. Called during the flush (from
+        ``send_to_changes``): read it from the flushed instance, or else
+        only that column, on the flushing connection."""
+        db = cls.default_db
+        instance = db.identity_map.get(identity_key(cls, id))
+        if instance is not None and 'discussion_id' in instance.__dict__:
+            return instance.discussion_id
+        return db.execute(
+            select([cls.discussion_id]).where(cls.id == id)).scalar()
+
+    def processPostCreated(self, id):
+        self.invalidate(Content, id)
+
+    def processPostModified(self, id, state_changed):
+        self.invalidate(Content, id)
+
+    def processIdeaCreated(self, id):
+        from .idea import Idea
+        self.invalidate(Idea, id)
+
+    def processIdeaModified(self, id, version):
+        from .idea import Idea
+        self.invalidate(Idea, id)
+
+    def processIdeaDeleted(self, id):
+        from .idea import Idea
+        self.invalidate(Idea, id)
@@ -0,0 +1,155 @@
+"""The reply tree of the posts of an idea, in the order of the thread view."""
+from collections import defaultdict
+
+from sqlalchemy import desc
+
+from .post import Post, PublicationStates, deleted_publication_states
+
+
+class ThreadTree(object):
+    """The reply tree of a set of posts, as shown in the thread view
+    (the equivalent of transformPosts in pages/idea.jsx.)
+
+    It is built from objects with ``id``, ``parent_id``, ``creation_date``
+    and ``publication_state`` (posts or query rows), without recursion,
+    in linear time apart from sorting siblings. It gives, by post id:
+
+    * ``children``: the ids of the replies, newest first
+    * ``position``: the rank of top posts, by latest live activity
+    * ``indentation``: the path of a published post in the tree,
+      e.g. ``1.2.1`` for the first reply to the second reply to the
+      first top post; ``x`` for other posts
+    * ``latest_date``: the latest creation date of the post and its live
+      descendants
+    """
+
+    def __init__(self, posts):
+        self._parent_id = {}
+        self._creation_date = {}
+        self._publication_state = {}
+        self._children = defaultdict(list)
+        ids = []
+        for post in posts:
+            ids.append(post.id)
+            self._parent_id[post.id] = post.parent_id
+            self._creation_date[post.id] = post.creation_date
+            self._publication_state[post.id] = post.publication_state
+        roots = []
+        for post_id in ids:
+            parent_id = self._parent_id[post_id]
+            if parent_id is None or parent_id not in self._parent_id:
+                roots.append(post_id)
+            else:
+                self._children[parent_id].append(post_id)
+        # Stable sort: keeps the input order for posts created together
+        for siblings in self._children.itervalues():
+            siblings.sort(key=self._creation_date.__getitem__, reverse=True)
+        # Parents before children
+        self._order = traversal = list(roots)
+        for post_id in traversal:
+            traversal.extend(self._children.get(post_id, ()))
+        self._latest_date = self._compute_latest_dates()
+        self.top_post_ids = sorted(
+            [post_id for post_id in roots
+             if self._parent_id[post_id] is None and
+             self._latest_date[post_id] is not None],
+            key=self._latest_date.__getitem__, reverse=True)
+        self._position = {post_id: n + 1
+                          for (n, post_id) in enumerate(self.top_post_ids)}
+        self._path = self._compute_paths(roots)
+
+    def _compute_latest_dates(self):
+        latest_dates = {}
+        for post_id in reversed(self._order):
+            latest = self._creation_date[post_id]
+            children = self._children.get(post_id, None)
+            if children:
+                for child_id in children:
+                    date = latest_dates[child_id]
+                    if date is not None and date > latest:
+                        latest = date
+            elif (self._publication_state[post_id] in
+                    deleted_publication_states):
+                latest = None
+            latest_dates[post_id] = latest
+        return latest_dates
+
+    def _compute_paths(self, roots):
+        paths = {}
+        for post_id in roots:
+            if self._parent_id[post_id] is None:
+                paths[post_id] = str(self._position.get(post_id, 'x'))
+            else:
+                # the parent is not part of the tree
+                paths[post_id] = 'x'
+        for post_id in self._order:
+            path = paths[post_id]
+            for n, child_id in enumerate(self._children.get(post_id, ())):
+                paths[child_id] = '%s.%d' % (path, n + 1)
+        return paths
+
+    def __len__(self):
+        return len(self._parent_id)
+
+    def __contains__(self, post_id):
+        return post_id in self._parent_id
+
+    def children(self, post_id):
+        return self._children.get(post_id, [])
+
+    def number_of_answers(self, post_id):
+        return len(self._children.get(post_id, ()))
+
+    def position(self, post_id):
+        return self._position.get(post_id, None)
+
+    def latest_date(self, post_id):
+        return self._latest_date[post_id]
+
+    def indentation(self, post_id):
+        if self._publication_state[post_id] != PublicationStates.PUBLISHED:
+            return 'x'
+        return self._path[post_id]
+
+    def parent_id(self, post_id):
+        return self._parent_id[post_id]
+
+    def post_ids(self):
+        "All post ids, parents before children"
+        return self._order
+
+    def display_order(self):
+        """The ids of the displayed posts, in the order of the thread view:
+        each top post followed by its replies, depth first."""
+        stack = list(reversed(self.top_post_ids))
+        while stack:
+            post_id = stack.pop()
+            yield post_id
+            stack.extend(reversed(self._children.get(post_id, ())))
+
+    @classmethod
+    def for_idea(cls, idea):
+        """The tree of all the posts of the idea, live or deleted."""
+        related = idea.get_related_posts_query(
+            True, include_moderating=False, include_deleted=None)
+        return cls(Post.default_db.query(
+            Post.id, Post.parent_id, Post.creation_date,
+            Post.publication_state
+        ).join(related, Post.id == related.c.post_id
+        ).order_by(desc(Post.creation_date), Post.id))
+
+    @classmethod
+    def get_for_idea(cls, idea, request=None):
+        """The tree of the idea, kept on the request if there is one,
+        so the exports and the GraphQL resolvers build it once."""
+        if request is None:
+            from pyramid.threadlocal import get_current_request
+            request = get_current_request()
+        if request is None:
+            return cls.for_idea(idea)
+        trees = getattr(request, "thread_trees", None)
+        if trees is None:
+            trees = request.thread_trees = {}
+        if idea.id not in trees:
+            trees[idea.id] = cls.for_idea(idea)
+        return trees[idea.id]
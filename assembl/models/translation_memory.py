@@ -0,0 +1,78 @@
+"""Machine translations of texts, shared by all discussions.
+
+Identical texts (quotes, short answers, repeated titles...) are only sent
+once to a translation service: see
+:py:class:`assembl.nlp.translation_pipeline.TranslationPipeline`.
+"""
+from datetime import datetime
+from hashlib import sha1
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    UnicodeText,
+    DateTime,
+    UniqueConstraint,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from . import Base
+from ..lib.sqla import is_zopish, mark_changed
+
+
+class TranslationMemory(Base):
+    """The translation of a text by a service, identified by a digest
+    of the text and its format."""
+    __tablename__ = 'translation_memory'
+
+    id = Column(Integer, primary_key=True)
+    # The class name of the translation service
+    service = Column(String(60), nullable=False)
+    digest = Column(String(40), nullable=False)
+    source_locale = Column(String(32), nullable=False)
+    target_locale = Column(String(32), nullable=False)
+    value = Column(UnicodeText, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('digest', 'source_locale', 'target_locale', 'service'),
+    )
+
+    sent_to_changes = False
+
+    @staticmethod
+    def digest_of(text, is_html=False):
+        return sha1(("html:" if is_html else "text:") +
+                    text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def lookup(cls, db, service, keys, chunk_size=500):
+        """The known translations of the (digest, source, target) keys,
+        as a dictionary"""
+        keys = set(keys)
+        digests = list({digest for (digest, _, _) in keys})
+        found = {}
+        for start in range(0, len(digests), chunk_size):
+            for (digest, source, target, value) in db.query(
+                    cls.digest, cls.source_locale, cls.target_locale,
+                    cls.value).filter(
+                    cls.service == service,
+                    cls.digest.in_(digests[start:start + chunk_size])):
+                if (digest, source, target) in keys:
+                    found[(digest, source, target)] = value
+        return found
+
+    @classmethod
+    def remember(cls, db, service, translations):
+        """Store translations, given by (digest, source, target) key"""
+        if not translations:
+            return
+        now = datetime.utcnow()
+        db.execute(pg_insert(cls.__table__).values([
+            dict(service=service, digest=digest, source_locale=source,
+                 target_locale=target, value=value, created=now)
+            for ((digest, source, target), value)
+            in translations.iteritems()]).on_conflict_do_nothing())
+        if is_zopish():
+            mark_changed(db)
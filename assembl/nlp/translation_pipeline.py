@@ -0,0 +1,250 @@
+"""Batched machine translation of the posts of a discussion.
+
+:py:func:`assembl.tasks.translate.translate_content` translates one entry
+into one locale at a time, and reloads the entries after each call.
+:py:class:`TranslationPipeline` collects the missing translations of many
+posts at once, looks them up in the
+:py:class:`assembl.models.translation_memory.TranslationMemory`, sends each
+remaining distinct text once, in batches and a few requests at a time
+(:py:class:`BatchTranslator`), and writes the new entries in bulk.
+"""
+from collections import defaultdict, namedtuple
+from multiprocessing.pool import ThreadPool
+
+import simplejson as json
+
+from ..lib import config, metrics
+from ..lib.sqla import is_zopish, mark_changed
+from ..models.langstrings import Locale, LangStringEntry
+from ..models.translation_memory import TranslationMemory
+from .translation_service import LangStringStatus
+
+
+# A missing or failed translation of an original entry in a target locale.
+# existing is the failed translation entry, if any.
+TranslationWork = namedtuple('TranslationWork', [
+    'post_id', 'original', 'target', 'is_html', 'existing'])
+
+
+class BatchTranslator(object):
+    """Translates texts in batches of the service ``max_batch_size``,
+    with at most ``concurrency`` requests at once.
+    Does not use the database."""
+
+    def __init__(self, service, concurrency=4, batch_size=None):
+        self.service = service
+        self.concurrency = max(1, concurrency)
+        self.batch_size = batch_size or service.max_batch_size
+
+    def batches(self, texts):
+        """Group the {key: (text, source, target, is_html)} texts
+        in batches of (source, target, is_html, keys, texts)"""
+        groups = defaultdict(list)
+        for key, (text, source, target, is_html) in texts.iteritems():
+            groups[(source, target, is_html)].append((key, text))
+        for (source, target, is_html), items in groups.iteritems():
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                yield (source, target, is_html,
+                       [key for (key, _) in batch],
+                       [text for (_, text) in batch])
+
+    def translate_batch(self, batch):
+        source, target, is_html, keys, texts = batch
+        try:
+            results = self.service.translate_batch(
+                texts, target, is_html, source)
+        except Exception as e:
+            results = [e] * len(texts)
+        return [(key, result if isinstance(result, Exception) else result[0])
+                for (key, result) in zip(keys, results)]
+
+    def translate(self, texts):
+        """Translate the {key: (text, source, target, is_html)} texts.
+
+        :returns: {key: translation or exception}"""
+        batches = list(self.batches(texts))
+        results = {}
+        if self.concurrency == 1 or len(batches) < 2:
+            for batch in batches:
+                results.update(self.translate_batch(batch))
+        else:
+            pool = ThreadPool(min(self.concurrency, len(batches)))
+            try:
+                for translations in pool.imap_unordered(
+                        self.translate_batch, batches):
+                    results.update(translations)
+            finally:
+                pool.close()
+                pool.join()
+        metrics.counter("translation.batches").inc(len(batches))
+        return results
+
+
+class TranslationPipeline(object):
+    """Translates posts in bulk, according to a translation table
+    (see :py:mod:`assembl.tasks.translate`).
+
+    Posts with entries of undefined language are not translated, as the
+    identification is done entry by entry; they are returned to the caller.
+    """
+
+    def __init__(self, db, service, translation_table, concurrency=None):
+        self.db = db
+        self.service = service
+        self.service_name = service.__class__.__name__
+        self.translation_table = translation_table
+        if concurrency is None:
+            concurrency = int(config.get('translation_concurrency', 4))
+        self.translator = BatchTranslator(service, concurrency)
+
+    def collect_post(self, post):
+        """The translations missing for the post, as
+        :py:data:`TranslationWork`; None if it needs identification."""
+        service = self.service
+        work = []
+        for prop in ("body", "subject"):
+            ls = getattr(post, prop)
+            if not ls:
+                continue
+            entries = {}
+            for entry in ls.entries:
+                entries[service.asKnownLocale(
+                    Locale.extract_base_locale(entry.locale_code))] = entry
+            entries.pop(None, None)
+            is_html = (prop == "body" and
+                       post.get_body_mime_type() == 'text/html')
+            targets = set()
+            for original in ls.non_mt_entries():
+                source = original.locale_code
+                if source == Locale.UNDEFINED:
+                    return None
+                if not original.value or source == Locale.NON_LINGUISTIC:
+                    continue
+                source_loc = service.asKnownLocale(source) or source
+                for dest in self.translation_table.languages_for(
+                        source_loc, self.db):
+                    if dest in targets or Locale.compatible(dest, source_loc):
+                        continue
+                    entry = entries.get(dest, None)
+                    if entry is None or (
+                            entry.error_code and
+                            not service.has_fatal_error(entry)):
+                        targets.add(dest)
+                        work.append(TranslationWork(
+                            post.id, original, dest, is_html, entry))
+        return work
+
+    @staticmethod
+    def key(work):
+        original = work.original
+        return (TranslationMemory.digest_of(original.value, work.is_html),
+                original.locale_code, work.target)
+
+    def translate(self, work):
+        """Translate each distinct text once, unless it is in the
+        translation memory. Returns {key: translation or exception}"""
+        texts = {}
+        for item in work:
+            texts[self.key(item)] = (
+                item.original.value, item.original.locale_code,
+                item.target, item.is_html)
+        results = {}
+        for key, (_, source, target, _) in texts.items():
+            if not self.service.canTranslate(source, target):
+                results[key] = None
+                del texts[key]
+        known = TranslationMemory.lookup(self.db, self.service_name, texts)
+        for key in known:
+            del texts[key]
+        translated = self.translator.translate(texts)
+        TranslationMemory.remember(self.db, self.service_name, {
+            key: value for (key, value) in translated.iteritems()
+            if value is not None and not isinstance(value, Exception)})
+        metrics.counter("translation.memory_hits").inc(len(known))
+        metrics.counter("translation.texts").inc(len(texts))
+        results.update(known)
+        results.update(translated)
+        return results
+
+    def entry_values(self, original, result):
+        """The columns of the translation entry of the original,
+        for a result of :py:meth:`translate`"""
+        if result is None:
+            error_code, description = (
+                LangStringStatus.CANNOT_TRANSLATE, "cannot translate")
+        elif isinstance(result, Exception):
+            error_code, description = self.service.decode_exception(result)
+        elif result.strip() == original.value.strip():
+            return dict(value=result, error_count=1,
+                        error_code=LangStringStatus.IDENTICAL_TRANSLATION.value,
+                        locale_identification_data=json.dumps(
+                            dict(service=self.service_name)))
+        else:
+            return dict(value=result, error_count=0, error_code=None,
+                        locale_identification_data=json.dumps(
+                            dict(service=self.service_name)))
+        return dict(value=None, error_count=1, error_code=error_code.value,
+                    locale_identification_data=json.dumps(
+                        dict(error_desc=description)))
+
+    def write(self, work, results):
+        """Create the new translation entries in bulk, and update
+        the failed ones"""
+        locale_ids = Locale.bulk_get_or_create({
+            self.service.get_mt_name(item.original.locale_code, item.target)
+            for item in work}, self.db)
+        rows = []
+        for item in work:
+            result = results[self.key(item)]
+            existing = item.existing
+            if existing is None:
+                values = self.entry_values(item.original, result)
+                values['langstring_id'] = item.original.langstring_id
+                values['locale_id'] = locale_ids[self.service.get_mt_name(
+                    item.original.locale_code, item.target)]
+                rows.append(values)
+            elif result is None or isinstance(result, Exception):
+                # counts the errors, as translate_lse
+                error_code, description = (
+                    (LangStringStatus.CANNOT_TRANSLATE, "cannot translate")
+                    if result is None else
+                    self.service.decode_exception(result))
+                self.service.set_error(existing, error_code, description)
+                existing.value = None
+            else:
+                for name, value in self.entry_values(
+                        item.original, result).iteritems():
+                    if name == 'locale_identification_data':
+                        existing.locale_identification_data_json = \
+                            json.loads(value)
+                    else:
+                        setattr(existing, name, value)
+        if rows:
+            self.db.execute(LangStringEntry.__table__.insert(), rows)
+            if is_zopish():
+                mark_changed(self.db)
+
+    def translate_posts(self, posts):
+        """Translate the posts.
+
+        :returns: the ids of the posts which got new translations, and the
+            posts that need identification"""
+        work = []
+        unidentified = []
+        for post in posts:
+            post_work = self.collect_post(post)
+            if post_work is None:
+                unidentified.append(post)
+            else:
+                work.extend(post_work)
+        if not work:
+            return set(), unidentified
+        self.write(work, self.translate(work))
+        changed = {item.post_id for item in work}
+        for post in posts:
+            if post.id in changed:
+                for ls in (post.subject, post.body):
+                    if ls is not None:
+                        self.db.expire(ls, ["entries"])
+        return changed, unidentified
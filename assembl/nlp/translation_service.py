@@ -3,6 +3,7 @@ from abc import abstractmethod
 import urllib2
 from traceback import print_exc
 import re
+import threading
 from collections import defaultdict
 from math import log
 
@@ -178,6 +179,8 @@ class LanguageIdentificationService(object):
 class AbstractTranslationService(LanguageIdentificationService):
     # Should we identify before translating?
     distinct_identify_step = True
+    # How many texts to give to translate_batch at once
+    max_batch_size = 20
 
     def serviceData(self):
         return {"translation_notice": "Machine-translated",
@@ -209,6 +212,20 @@ class AbstractTranslationService(LanguageIdentificationService):
             source = Locale.get_or_create(source, db)
         return text, lang
 
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        """Translate texts from the same (known) source locale.
+        Does not use the database, so batches can be sent from threads.
+
+        :returns: a list with a (translation, source locale) pair, or the
+            exception raised, for each text"""
+        results = []
+        for text in texts:
+            try:
+                results.append(self.translate(text, target, is_html, source))
+            except Exception as e:
+                results.append(e)
+        return results
+
     def get_mt_name(self, source_name, target_name):
         return Locale.create_mt_code(source_name, target_name)
 
@@ -469,15 +486,27 @@ class DummyGoogleTranslationService(AbstractTranslationService):
 
 class GoogleTranslationService(DummyGoogleTranslationService):
     distinct_identify_step = False
+    # The API accepts up to 128 segments per request
+    max_batch_size = 100
 
     def __init__(self, discussion, apikey=None):
         super(GoogleTranslationService, self).__init__(discussion)
-        import apiclient.discovery
         # Look it up in config. TODO: Admin property of discussion
-        apikey = config.get("google.server_api_key")
+        self.apikey = config.get("google.server_api_key")
         self._known_locales = None
-        self.client = apiclient.discovery.build(
-            'translate', 'v2', developerKey=apikey) if apikey else None
+        # The http client is not thread-safe
+        self._clients = threading.local()
+
+    @property
+    def client(self):
+        if not self.apikey:
+            return None
+        client = getattr(self._clients, "client", None)
+        if client is None:
+            import apiclient.discovery
+            client = self._clients.client = apiclient.discovery.build(
+                'translate', 'v2', developerKey=self.apikey)
+        return client
 
     @staticmethod
     def unescape_text(text):
@@ -552,6 +581,23 @@ class GoogleTranslationService(DummyGoogleTranslationService):
         translated = self.unescape_string(translated, is_html)
         return translated, source
 
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        if not self.client:
+            from googleapiclient.http import HttpError
+            raise HttpError(401, '{"error":"Please define server_api_key"}')
+        r = self.client.translations().list(
+            q=list(texts),
+            format="html" if is_html else "text",
+            target=self.asKnownLocale(target),
+            source=self.asKnownLocale(source) if source else None).execute()
+        results = []
+        for translation in r[u"translations"]:
+            lang = source or self.asPosixLocale(
+                translation[u'detectedSourceLanguage'])
+            results.append((self.unescape_string(
+                translation[u'translatedText'], is_html), lang))
+        return results
+
     def decode_exception(self, exception, identify_phase=False):
         from googleapiclient.http import HttpError
         import socket
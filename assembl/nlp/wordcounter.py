@@ -34,13 +34,17 @@ class WordCounter(defaultdict):
         self.langs = []
         # We will base stemmer on first known language.
         stemmer = None
+        self.stemmer_lang = None
         stopwords = set()
         for locale in langs:
             lang = locale_to_lang(locale)
             if lang in known_languages:
                 stopwords.update(get_stop_words(lang))
             self.langs.append(lang)
-            stemmer = stemmer or get_stemmer(lang, False)
+            if stemmer is None:
+                stemmer = get_stemmer(lang, False)
+                if stemmer is not None:
+                    self.stemmer_lang = lang
         self.stemmer = stemmer or get_stemmer(None)
         self.stop_words = stopwords
 
@@ -56,6 +60,19 @@ class WordCounter(defaultdict):
         stemmed = self.stemmer.stemWord(word.lower())
         self[stemmed].add(word, weight)
 
+    def stems(self, text):
+        """The (stem, word) of the words of the text, stop words included,
+        as stored by :py:class:`assembl.models.stem_index.PostStemCount`"""
+        for word in self.non_words.split(text):
+            if len(word) >= self.min_len:
+                yield (self.stemmer.stemWord(word.lower()), word)
+
+    def add_counts(self, counts):
+        "Add (stem, word, weight) counts, as given by stems()"
+        for (stem, word, weight) in counts:
+            if word.lower() not in self.stop_words:
+                self[stem].add(word, weight)
+
     def best(self, num=10):
         all_words = self.values()
         all_words.sort(key=lambda x: x.counter, reverse=True)
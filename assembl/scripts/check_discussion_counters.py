@@ -0,0 +1,65 @@
+"""Compare the persistent discussion counters with a full count."""
+import sys
+import logging.config
+import argparse
+
+from pyramid.paster import get_appsettings, bootstrap
+import transaction
+
+from assembl.lib.sqla import (
+    configure_engine, get_session_maker)
+from assembl.lib.zmqlib import configure_zmq
+from assembl.lib.config import set_config
+
+
+def check_discussion(db, discussion, counter_store, fix=False):
+    from assembl.models.path_utils import DiscussionGlobalData
+    discussion_data = DiscussionGlobalData(
+        db, discussion.id, None, discussion)
+    errors = counter_store.check_consistency(discussion_data)
+    for key, (stored, computed) in sorted(errors.items()):
+        print "discussion %s: %s stored %s, computed %s" % (
+            discussion.slug, key, stored, computed)
+    if errors and fix:
+        counter_store.backend.discard(discussion.id, errors.keys())
+    return not errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "configuration",
+        help="configuration file")
+    parser.add_argument(
+        "-d", "--discussion", action="append",
+        help="slug of the discussion to check (default: all)")
+    parser.add_argument(
+        "--fix", action="store_true",
+        help="discard the counters that do not match")
+    args = parser.parse_args()
+    env = bootstrap(args.configuration)
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    logging.config.fileConfig(args.configuration)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    from assembl.models import Discussion
+    from assembl.models.path_utils import get_counter_store
+    counter_store = get_counter_store()
+    if counter_store is None:
+        print "discussion_counters_store is not configured"
+        sys.exit(0)
+    db = get_session_maker()()
+    ok = True
+    with transaction.manager:
+        discussions = db.query(Discussion)
+        if args.discussion:
+            discussions = discussions.filter(
+                Discussion.slug.in_(args.discussion))
+        for discussion in discussions:
+            ok = check_discussion(db, discussion, counter_store, args.fix) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
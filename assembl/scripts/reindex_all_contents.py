@@ -20,6 +20,20 @@ def main():
     parser.add_argument(
         "configuration",
         help="configuration file with destination database configuration")
+    parser.add_argument(
+        "-p", "--processes", type=int, default=None,
+        help="number of indexing processes (default: 1)")
+    parser.add_argument(
+        "-c", "--chunk-size", type=int, default=5000,
+        help="number of contents read at a time")
+    parser.add_argument(
+        "--checkpoint",
+        help="file where progress is saved; an interrupted reindex "
+        "is resumed from it")
+    parser.add_argument(
+        "--new-index", action="store_true",
+        help="reindex in a new index, and point the "
+        "elasticsearch_index alias to it when done")
     args = parser.parse_args()
     env = bootstrap(args.configuration)
     settings = get_appsettings(args.configuration, 'assembl')
@@ -30,8 +44,12 @@ def main():
     configure_engine(settings, True)
     session = get_session_maker()()
     try:
-        reindex_all_contents(session)
+        errors = reindex_all_contents(
+            session, processes=args.processes, chunk_size=args.chunk_size,
+            checkpoint_path=args.checkpoint, new_index=args.new_index)
         transaction.commit()
+        if errors:
+            exit(1)
     except Exception as e:
         traceback.print_exc()
         pdb.post_mortem()
@@ -0,0 +1,63 @@
+"""Rethread all the emails of discussions with jwzthreading.
+
+Imports thread emails incrementally; this reparses every email, and is
+meant for maintenance, e.g. after a change of the threading rules."""
+import logging.config
+import argparse
+
+from pyramid.paster import get_appsettings, bootstrap
+from sqlalchemy.orm import joinedload_all, undefer
+import transaction
+
+from assembl.lib.sqla import (
+    configure_engine, get_session_maker)
+from assembl.lib.zmqlib import configure_zmq
+from assembl.lib.config import set_config
+
+
+def rethread_discussion(db, discussion, reindex=False):
+    from assembl.models import AbstractMailbox, Email
+    emails = db.query(Email).filter(
+        Email.discussion_id == discussion.id).options(
+        joinedload_all(Email.parent), undefer(Email.imported_blob)).all()
+    if reindex:
+        for mail in emails:
+            mail.index_references()
+    AbstractMailbox.thread_mails(emails)
+    print "discussion %s: %d emails rethreaded" % (
+        discussion.slug, len(emails))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "configuration",
+        help="configuration file")
+    parser.add_argument(
+        "-d", "--discussion", action="append",
+        help="slug of the discussion to rethread (default: all)")
+    parser.add_argument(
+        "--reindex", action="store_true",
+        help="also rebuild the index of the messages referenced by emails")
+    args = parser.parse_args()
+    env = bootstrap(args.configuration)
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    logging.config.fileConfig(args.configuration)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    from assembl.models import Discussion
+    db = get_session_maker()()
+    with transaction.manager:
+        discussion_ids = db.query(Discussion.id)
+        if args.discussion:
+            discussion_ids = discussion_ids.filter(
+                Discussion.slug.in_(args.discussion))
+        discussion_ids = [id for (id,) in discussion_ids]
+    for discussion_id in discussion_ids:
+        with transaction.manager:
+            rethread_discussion(db, Discussion.get(discussion_id), args.reindex)
+
+
+if __name__ == '__main__':
+    main()
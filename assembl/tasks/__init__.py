@@ -65,6 +65,26 @@ CELERYBEAT_SCHEDULE = {
             'exchange': 'notify'
         }
     },
+    # Actions left over by a missed or failed notification of the indexer
+    'process-indexing-queue': {
+        'task': 'assembl.tasks.indexing.process_indexing_queue',
+        'schedule': timedelta(seconds=30),
+    },
+    # Export jobs and artifacts older than export_job_cache_max_age
+    'purge-export-jobs': {
+        'task': 'assembl.tasks.export.purge_export_jobs',
+        'schedule': timedelta(hours=6),
+    },
+    # Idea keyword rollups left over by a missed refresh, or too old
+    'refresh-idea-keywords': {
+        'task': 'assembl.tasks.keywords.refresh_idea_keywords',
+        'schedule': timedelta(minutes=10),
+    },
+    # Keeps the time series analytics requests short
+    'refresh-daily-activity': {
+        'task': 'assembl.tasks.analytics.refresh_daily_activity',
+        'schedule': timedelta(hours=1),
+    },
 }
 
 # Minimum delay between emails sent to a domain.
@@ -137,7 +157,11 @@ class CeleryWithConfig(Celery):
                     continue
                 SMTP_DOMAIN_DELAYS[name[len(SETTINGS_SMTP_DELAY):]] = val
         getLogger().info("SMTP_DOMAIN_DELAYS", delays=SMTP_DOMAIN_DELAYS)
+        import assembl.tasks.analytics
+        import assembl.tasks.export
         import assembl.tasks.imap
+        import assembl.tasks.indexing
+        import assembl.tasks.keywords
         import assembl.tasks.notify
         import assembl.tasks.notification_dispatch
         import assembl.tasks.translate
@@ -0,0 +1,34 @@
+"""Celery task keeping the daily activity rollups of discussions current.
+
+See :py:mod:`assembl.models.activity_rollup`."""
+import transaction
+
+from . import celery
+from ..lib.logging import getLogger
+from ..lib.sentry import capture_exception
+
+
+logger = getLogger()
+
+
+@celery.task(ignore_result=True, shared=False)
+def refresh_daily_activity(discussion_id=None):
+    """Recompute the days with new events (of a discussion, or all)"""
+    from ..models import Discussion
+    from ..models.activity_rollup import DailyActivity
+    db = DailyActivity.default_db
+    if discussion_id:
+        discussion_ids = [discussion_id]
+    else:
+        with transaction.manager:
+            discussion_ids = [id for (id,) in db.query(Discussion.id)]
+    for discussion_id in discussion_ids:
+        try:
+            with transaction.manager:
+                days = DailyActivity.refresh(db, discussion_id)
+            if days != 0:
+                logger.info("Refreshed daily activity",
+                            discussion_id=discussion_id, days=days)
+        except Exception:
+            # Will be caught up next time, or by the analytics request
+            capture_exception()
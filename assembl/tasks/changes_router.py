@@ -1,25 +1,33 @@
 """This process obtains JSON representations of modified, created or deleted
 database objects through ZeroMQ, and feeds them to browser clients
-through a websocket."""
+through a websocket.
+
+The router can run as many worker processes sharing the websocket port
+(``changes_router_processes``). A forwarding device process receives the
+changes on ``changes_socket`` and republishes them on
+``changes_router_internal_socket``. Each worker holds a single upstream
+subscription, and an index of its SockJS connections by discussion,
+so each changeset is received once per worker and broadcast to all
+the connections of its discussion."""
 import signal
 import time
 import sys
+from collections import defaultdict
 from os import makedirs, access, R_OK, W_OK
 from os.path import exists, dirname
 import ConfigParser
-import traceback
 from time import sleep
 
 import simplejson as json
 import zmq
+import zmq.devices
 from zmq.eventloop import ioloop
 from zmq.eventloop import zmqstream
-import requests
-from tornado import web
+from tornado import web, process, netutil
+from tornado.httpclient import AsyncHTTPClient
 from sockjs.tornado import SockJSRouter, SockJSConnection
 from tornado.httpserver import HTTPServer
 
-from assembl.lib.zmqlib import INTERNAL_SOCKET
 from assembl.lib.sentry import capture_exception
 from assembl.lib.web_token import decode_token, TokenInvalid
 
@@ -32,12 +40,22 @@ if len(sys.argv) != 2:
 
 SECTION = 'app:assembl'
 
-settings = ConfigParser.ConfigParser({'changes_prefix': ''})
+settings = ConfigParser.ConfigParser({
+    'changes_prefix': '',
+    'changes_router_processes': '1',
+    'changes_router_internal_socket': '',
+    'changes_router_log_messages': 'false'})
 settings.read(sys.argv[-1])
 CHANGES_SOCKET = settings.get(SECTION, 'changes_socket')
 CHANGES_PREFIX = settings.get(SECTION, 'changes_prefix')
 TOKEN_SECRET = settings.get(SECTION, 'session.secret')
 WEBSERVER_PORT = settings.getint(SECTION, 'changes_websocket_port')
+NUM_PROCESSES = settings.getint(SECTION, 'changes_router_processes')
+LOG_MESSAGES = settings.getboolean(SECTION, 'changes_router_log_messages')
+# Where the forwarding device republishes changes for the workers
+INTERNAL_SOCKET = settings.get(
+    SECTION, 'changes_router_internal_socket') or (
+    'ipc:///tmp/assembl_changes_router/%d' % (WEBSERVER_PORT,))
 # NOTE: Not sure those are always what we want.
 SERVER_HOST = settings.get(SECTION, 'public_hostname')
 SERVER_PORT = settings.getint(SECTION, 'public_port')
@@ -48,21 +66,70 @@ if REQUIRES_SECURE and SERVER_PORT == 80:
     SERVER_PORT = 443
 SERVER_URL = "%s://%s:%d" % (SERVER_PROTOCOL, SERVER_HOST, SERVER_PORT)
 
-context = zmq.Context.instance()
-ioloop.install()
-io_loop = ioloop.IOLoop.instance()  # ZMQ loop
+# Created after forking, in each worker
+context = None
+io_loop = None
+index = None
+sockjs_router = None
+
+
+class DiscussionIndex(object):
+    """The SockJS connections of this worker, by discussion.
 
-if CHANGES_SOCKET.startswith('ipc://'):
-    dir = dirname(CHANGES_SOCKET[6:])
-    if not exists(dir):
-        makedirs(dir)
+    Holds the single upstream subscription of the worker, subscribed to
+    the discussions which have at least one connection."""
 
-td = zmq.devices.ThreadDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
-td.bind_in(CHANGES_SOCKET)
-td.bind_out(INTERNAL_SOCKET)
-td.setsockopt_in(zmq.IDENTITY, 'XSUB')
-td.setsockopt_out(zmq.IDENTITY, 'XPUB')
-td.start()
+    def __init__(self, socket):
+        self.socket = socket
+        self.connections = defaultdict(set)
+        self.socket.setsockopt(zmq.SUBSCRIBE, '*')
+        self.stream = zmqstream.ZMQStream(socket, io_loop=io_loop)
+        self.stream.on_recv(self.dispatch)
+
+    def add(self, discussion, connection):
+        if discussion not in self.connections:
+            self.socket.setsockopt(zmq.SUBSCRIBE, discussion)
+        self.connections[discussion].add(connection)
+
+    def remove(self, discussion, connection):
+        connections = self.connections.get(discussion, None)
+        if connections is None:
+            return
+        connections.discard(connection)
+        if not connections:
+            del self.connections[discussion]
+            self.socket.setsockopt(zmq.UNSUBSCRIBE, discussion)
+
+    def dispatch(self, msg):
+        try:
+            discussion, data = msg[0], msg[-1]
+            if LOG_MESSAGES:
+                print msg
+            if discussion == '*':
+                targets = set()
+                for connections in self.connections.itervalues():
+                    targets.update(connections)
+            else:
+                # Subscriptions are prefixes, "1" also receives "12"
+                targets = self.connections.get(discussion, None)
+            if not targets:
+                return
+            if '@private' not in data:
+                sockjs_router.broadcast(targets, data)
+                return
+            # Decode once, filter once per user
+            jsondata = json.loads(data)
+            by_user = defaultdict(list)
+            for connection in targets:
+                by_user[connection.userId].append(connection)
+            for user_id, connections in by_user.iteritems():
+                user_data = [x for x in jsondata
+                             if x.get('@private', user_id) == user_id]
+                if user_data:
+                    sockjs_router.broadcast(
+                        connections, json.dumps(user_data))
+        except Exception:
+            capture_exception()
 
 
 class ZMQRouter(SockJSConnection):
@@ -70,40 +137,25 @@ class ZMQRouter(SockJSConnection):
     token = None
     discussion = None
     userId = None
+    subscribed = False
 
     def on_open(self, request):
         self.valid = True
         self.closing = False
-
-    def on_recv(self, data):
-        try:
-            data = data[-1]
-            if '@private' in data:
-                jsondata = json.loads(data)
-                jsondata = [x for x in jsondata
-                            if x.get('@private', self.userId) == self.userId]
-                if not jsondata:
-                    return
-                data = json.dumps(jsondata)
-            self.send(data)
-        except Exception:
-            capture_exception()
-            self.do_close()
+        self.checking = False
 
     def do_close(self):
         self.closing = True
+        if self.subscribed:
+            index.remove(self.discussion, self)
+            self.subscribed = False
         self.close()
-        self.socket = None
-        if getattr(self, "loop", None):
-            self.loop.stop_on_recv()
-            self.loop.close()
-            self.loop = None
 
     def on_message(self, msg):
         try:
-            if getattr(self, 'socket', None):
+            if self.subscribed:
                 print "closing old socket"
-                self.loop.add_callback(self.do_close)
+                io_loop.add_callback(self.do_close)
                 return
             if msg.startswith('discussion:') and self.valid:
                 self.discussion = msg.split(':', 1)[1]
@@ -115,23 +167,27 @@ class ZMQRouter(SockJSConnection):
                         self.token['userId'])
                 except TokenInvalid:
                     pass
-            if self.token and self.discussion:
+            if self.token and self.discussion and not self.checking:
                 # Check if token authorizes discussion
-                r = requests.get(
+                self.checking = True
+                AsyncHTTPClient().fetch(
                     '%s/api/v1/discussion/%s/permissions/read/u/%s' %
                     (SERVER_URL, self.discussion,
-                        self.token['userId']))
-                print r.text
-                if r.text != 'true':
-                    return
-                self.socket = context.socket(zmq.SUB)
-                self.socket.connect(INTERNAL_SOCKET)
-                self.socket.setsockopt(zmq.SUBSCRIBE, '*')
-                self.socket.setsockopt(zmq.SUBSCRIBE, str(self.discussion))
-                self.loop = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
-                self.loop.on_recv(self.on_recv)
-                print "connected"
-                self.send('[{"@type":"Connection"}]')
+                        self.token['userId']),
+                    callback=self.on_permission, raise_error=False)
+        except Exception:
+            capture_exception()
+            self.do_close()
+
+    def on_permission(self, response):
+        self.checking = False
+        try:
+            if self.closing or response.body != 'true':
+                return
+            index.add(str(self.discussion), self)
+            self.subscribed = True
+            print "connected"
+            self.send('[{"@type":"Connection"}]')
         except Exception:
             capture_exception()
             self.do_close()
@@ -147,48 +203,81 @@ class ZMQRouter(SockJSConnection):
             raise
 
 
-def logger(msg):
-    print msg
+def ensure_ipc_dir(socket_name):
+    if socket_name.startswith('ipc://'):
+        dir = dirname(socket_name[6:])
+        if not exists(dir):
+            makedirs(dir)
+
+
+def check_ipc_socket(socket_name):
+    if socket_name.startswith('ipc://'):
+        sname = socket_name[6:]
+        for i in range(5):
+            if exists(sname):
+                break
+            sleep(0.1)
+        else:
+            raise RuntimeError("could not create socket " + sname)
+        if not access(sname, R_OK | W_OK):
+            raise RuntimeError(sname + " cannot be accessed")
 
 
-def log_queue():
+def start_device():
+    """Forward changes from the backends to the router workers,
+    in a separate process."""
+    ensure_ipc_dir(CHANGES_SOCKET)
+    ensure_ipc_dir(INTERNAL_SOCKET)
+    device = zmq.devices.ProcessDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
+    device.bind_in(CHANGES_SOCKET)
+    device.bind_out(INTERNAL_SOCKET)
+    device.setsockopt_in(zmq.IDENTITY, 'XSUB')
+    device.setsockopt_out(zmq.IDENTITY, 'XPUB')
+    device.daemon = True
+    device.start()
+    check_ipc_socket(CHANGES_SOCKET)
+    check_ipc_socket(INTERNAL_SOCKET)
+    return device
+
+
+def start_worker(sockets):
+    global context, io_loop, index, sockjs_router
+    context = zmq.Context.instance()
+    ioloop.install()
+    io_loop = ioloop.IOLoop.instance()  # ZMQ loop
     socket = context.socket(zmq.SUB)
     socket.connect(INTERNAL_SOCKET)
-    socket.setsockopt(zmq.SUBSCRIBE, '')
-    loop = zmqstream.ZMQStream(socket, io_loop=io_loop)
-    loop.on_recv(logger)
+    index = DiscussionIndex(socket)
+    sockjs_router = SockJSRouter(
+        ZMQRouter, prefix=CHANGES_PREFIX, io_loop=io_loop,
+        user_settings={"websocket_allow_origin": SERVER_URL})
+    web_app = web.Application(sockjs_router.urls, debug=False)
+    web_server = HTTPServer(web_app)
+    web_server.add_sockets(sockets)
 
-log_queue()
+    def term(*_ignore):
+        web_server.stop()
+        io_loop.add_timeout(time.time() + 0.3, io_loop.stop)
 
-sockjs_router = SockJSRouter(
-    ZMQRouter, prefix=CHANGES_PREFIX, io_loop=io_loop,
-    user_settings={"websocket_allow_origin": SERVER_URL})
-routes = sockjs_router.urls
-web_app = web.Application(routes, debug=False)
+    signal.signal(signal.SIGTERM, term)
+    try:
+        io_loop.start()
+    except KeyboardInterrupt:
+        term()
 
 
-def term(*_ignore):
-    web_server.stop()
-    io_loop.add_timeout(time.time() + 0.3, io_loop.stop)
+def main():
+    start_device()
+    # Bind before forking, so workers share the port
+    sockets = netutil.bind_sockets(WEBSERVER_PORT)
+    if NUM_PROCESSES != 1:
+        # 0 means one per core
+        process.fork_processes(NUM_PROCESSES)
+    start_worker(sockets)
 
-signal.signal(signal.SIGTERM, term)
 
-web_server = HTTPServer(web_app)
-web_server.listen(WEBSERVER_PORT)
 try:
-    if CHANGES_SOCKET.startswith('ipc://'):
-        sname = CHANGES_SOCKET[6:]
-        for i in range(5):
-            if exists(sname):
-                break
-            sleep(0.1)
-        else:
-            raise RuntimeError("could not create socket " + sname)
-        if not access(sname, R_OK | W_OK):
-            raise RuntimeError(sname + " cannot be accessed")
-    io_loop.start()
-except KeyboardInterrupt:
-    term()
+    main()
 except Exception:
     capture_exception()
     raise
@@ -0,0 +1,35 @@
+"""Celery tasks running background exports.
+
+See :py:mod:`assembl.views.api2.export_jobs`."""
+import transaction
+
+from ..lib.logging import getLogger
+from ..lib.sentry import capture_exception
+from . import celery
+
+
+logger = getLogger()
+
+
+@celery.task(ignore_result=True, shared=False)
+def run_export_job(job_id):
+    from ..views.api2.export_jobs import process_export_job
+    try:
+        process_export_job(job_id)
+    except Exception:
+        capture_exception()
+        raise
+
+
+@celery.task(ignore_result=True, shared=False)
+def purge_export_jobs():
+    from ..models import ExportJob
+    from ..views.api2.export_jobs import cache_max_age
+    try:
+        with transaction.manager:
+            count = ExportJob.purge(cache_max_age())
+        if count:
+            logger.info("Purged export jobs", num_jobs=count)
+    except Exception:
+        capture_exception()
+        raise
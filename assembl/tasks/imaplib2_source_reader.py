@@ -114,6 +114,7 @@ class IMAPReader(SourceReader):
                     if error:
                         raise ReaderError(error)
                     self.source.db.add(email_object)
+                    self.source.thread_new_mails([email_object])
                 else:
                     print "Skipped message with imap id %s (bounce or vacation message)" % (email_id)
                 # print "Setting self.source.last_imported_email_uid to "+email_id
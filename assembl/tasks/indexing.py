@@ -0,0 +1,24 @@
+"""Celery task sending the indexing queue to elasticsearch.
+
+See :py:mod:`assembl.indexing.indexer`."""
+from ..lib.logging import getLogger
+from ..lib.sentry import capture_exception
+from . import celery
+
+
+logger = getLogger()
+
+
+@celery.task(ignore_result=True, shared=False)
+def process_indexing_queue():
+    from ..indexing import indexing_active
+    from ..indexing.indexer import get_indexing_queue_worker
+    if not indexing_active():
+        return
+    try:
+        count = get_indexing_queue_worker().run()
+        if count:
+            logger.info("Processed indexing queue", num_actions=count)
+    except Exception:
+        capture_exception()
+        raise
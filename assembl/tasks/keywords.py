@@ -0,0 +1,75 @@
+"""Celery tasks refreshing the keyword rollups of ideas.
+
+See :py:mod:`assembl.models.keyword_rollup`."""
+import transaction
+
+from . import celery
+from ..lib.logging import getLogger
+from ..lib.model_watcher import BaseModelEventWatcher
+from ..lib.sentry import capture_exception
+from ..lib.utils import waiting_get
+
+
+logger = getLogger()
+
+
+@celery.task(ignore_result=True, shared=False)
+def refresh_idea_keywords(discussion_id=None):
+    """Recompute the marked rollups (of a discussion, or all), then
+    translate the labels of their tags"""
+    from ..models.keyword_rollup import IdeaKeywordRollup
+    with transaction.manager:
+        tag_ids = IdeaKeywordRollup.refresh_dirty(
+            IdeaKeywordRollup.default_db, discussion_id)
+    for discussion_id, tags in tag_ids.iteritems():
+        try:
+            with transaction.manager:
+                IdeaKeywordRollup.prefetch_translations(
+                    IdeaKeywordRollup.default_db, discussion_id, tags)
+        except Exception:
+            # The labels are shown untranslated meanwhile
+            capture_exception()
+    if tag_ids:
+        logger.info("Refreshed idea keywords",
+                    discussion_ids=sorted(tag_ids.keys()))
+
+
+@celery.task(ignore_result=True, shared=False)
+def post_keywords_changed(post_id):
+    """The ideas showing the post have to be refreshed"""
+    from ..models import Content, Idea
+    from ..models.keyword_rollup import IdeaKeywordRollup
+    with transaction.manager:
+        post = waiting_get(Content, post_id)
+        if post is None:
+            return
+        IdeaKeywordRollup.mark_dirty(
+            post.db, post.discussion_id,
+            Idea.get_idea_ids_showing_post(post_id))
+
+
+@celery.task(ignore_result=True, shared=False)
+def idea_keywords_changed(idea_id):
+    """The idea and its ancestors have to be refreshed"""
+    from ..models import Idea
+    from ..models.keyword_rollup import IdeaKeywordRollup
+    with transaction.manager:
+        idea = waiting_get(Idea, idea_id)
+        if idea is None:
+            return
+        IdeaKeywordRollup.mark_dirty(
+            idea.db, idea.discussion_id, [idea_id])
+
+
+class ModelEventWatcherCelerySender(BaseModelEventWatcher):
+    """A IModelEventWatcher that marks the keyword rollups of the ideas
+    affected by post and idea changes through Celery_"""
+
+    def processPostModified(self, id, state_changed):
+        post_keywords_changed.delay(id)
+
+    def processIdeaCreated(self, id):
+        idea_keywords_changed.delay(id)
+
+    def processIdeaModified(self, id, version):
+        idea_keywords_changed.delay(id)
@@ -1,5 +1,6 @@
 """Celery task for sending :py:class:`assembl.models.notification.Notification` to users."""
 import sys
+from collections import defaultdict
 from time import sleep
 from datetime import datetime, timedelta
 
@@ -7,6 +8,8 @@ import transaction
 from pyramid.settings import asbool
 
 from ..lib import config
+from ..lib.mail_delivery import (
+    OutgoingMail, deliver, domain_rule, get_token_buckets)
 from ..lib.sentry import capture_exception
 from ..lib.logging import getLogger
 from . import celery, SMTP_DOMAIN_DELAYS
@@ -14,36 +17,26 @@ from . import celery, SMTP_DOMAIN_DELAYS
 
 logger = getLogger()
 
-# When was a mail last sent by notifications to a given domain?
-# Propagates to superdomains.
-DOMAIN_LAST_SENT = {}
-
-
-def email_was_sent(email):
-    domain = email.split("@")[-1].lower().split('.')
-    now = datetime.utcnow()
-    for i in range(len(domain) + 1):
-        dom = '.'.join(domain[i:])
-        DOMAIN_LAST_SENT[dom] = now
-
 
 def wait_if_necessary(email):
-    domain = email.split("@")[-1].lower().split('.')
-    # Look for most specific delay rule
-    for i in range(len(domain) + 1):
-        dom = '.'.join(domain[i:])
-        if dom in SMTP_DOMAIN_DELAYS:
-            delay = SMTP_DOMAIN_DELAYS[dom]
-            break
-    else:
-        return
-    # Not looking at superdomains. make delays as generic as needed
-    last_sent = DOMAIN_LAST_SENT.get(dom, None)
-    if last_sent is None:
+    """Wait for the delay of the most specific rule of the email domain.
+    The delays are shared with :py:func:`process_pending_notifications`."""
+    rule = domain_rule(email, SMTP_DOMAIN_DELAYS)
+    if rule is None or rule[1].total_seconds() <= 0:
         return
-    elapsed = datetime.utcnow() - last_sent
-    if elapsed < delay:
-        sleep((delay - elapsed).total_seconds())
+    wait = get_token_buckets().acquire(
+        rule[0], rule[1].total_seconds(), reserve=True)
+    if wait > 0:
+        sleep(wait)
+
+
+def delivery_failure_state(exception):
+    """The delivery state of a notification that could not be sent"""
+    from ..models.notification import NotificationDeliveryStateType
+    import smtplib
+    if isinstance(exception, smtplib.SMTPRecipientsRefused):
+        return NotificationDeliveryStateType.DELIVERY_FAILURE
+    return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
 
 
 def process_notification(notification):
@@ -76,7 +69,6 @@ def process_notification(notification):
 
         notification.delivery_state = \
             NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
-        email_was_sent(recipient)
     except UnverifiedEmailException as e:
         capture_exception()
         logger.exception("Not sending to unverified email")
@@ -133,18 +125,70 @@ def notify(id):
         process_notification(notification)
 
 
+def process_notifications(notification_ids):
+    """Render the notifications in one transaction, send them concurrently
+    (see :py:mod:`assembl.lib.mail_delivery`), and record their delivery
+    states in bulk."""
+    from ..models.notification import (
+        Notification, NotificationDeliveryStateType)
+    retryable = NotificationDeliveryStateType.getRetryableDeliveryStates()
+    db = Notification.default_db
+    states = {}
+    mails = []
+    with transaction.manager:
+        notifications = db.query(Notification).filter(
+            Notification.id.in_(notification_ids),
+            Notification.delivery_state.in_(retryable))
+        if asbool(config.get('disable_notifications', False)):
+            logger.debug("Notifications disabled, setting to obsolete")
+            notifications.update(
+                {'delivery_state': NotificationDeliveryStateType.OBSOLETED},
+                synchronize_session=False)
+            return
+        for notification in notifications:
+            try:
+                email = notification.render_to_message()
+                if not email:
+                    raise ValueError("Empty notification")
+                mails.append(OutgoingMail(
+                    notification.id, email,
+                    notification.get_to_email_address()))
+            except Exception as e:
+                capture_exception()
+                logger.exception(
+                    "Could not render notification %d" % notification.id)
+                states[notification.id] = delivery_failure_state(e)
+    for notification_id, error in deliver(
+            mails, celery.mailer, SMTP_DOMAIN_DELAYS).iteritems():
+        if error is None:
+            states[notification_id] = \
+                NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
+        else:
+            logger.error("Could not send notification %d: %r" % (
+                notification_id, error))
+            states[notification_id] = delivery_failure_state(error)
+    by_state = defaultdict(list)
+    for notification_id, state in states.iteritems():
+        by_state[state].append(notification_id)
+    with transaction.manager:
+        for state, ids in by_state.iteritems():
+            db.query(Notification).filter(Notification.id.in_(ids)).update(
+                {'delivery_state': state}, synchronize_session=False)
+
+
 @celery.task(shared=False)
-def process_pending_notifications():
+def process_pending_notifications(chunk_size=100):
     """ Can be triggered by http://localhost:6543/data/Notification/process_now """
     from ..models.notification import (
         Notification, NotificationDeliveryStateType)
     logger.debug("process_pending_notifications called")
-    retryable_notifications = Notification.default_db.query(Notification.id).filter(
-        Notification.delivery_state.in_(
-            NotificationDeliveryStateType.getRetryableDeliveryStates()))
-    for (notification_id,) in retryable_notifications:
+    with transaction.manager:
+        notification_ids = [id for (id,) in Notification.default_db.query(
+            Notification.id).filter(Notification.delivery_state.in_(
+                NotificationDeliveryStateType.getRetryableDeliveryStates())
+        ).order_by(Notification.id)]
+    for start in range(0, len(notification_ids), chunk_size):
         try:
-            with transaction.manager:
-                process_notification(Notification.get(notification_id))
+            process_notifications(notification_ids[start:start + chunk_size])
         except Exception as e:
             capture_exception()
@@ -1,6 +1,8 @@
 """A celery process that translate messages as soon as they are created. Causes deadlocks, not used"""
 from abc import abstractmethod
 
+import transaction
+
 from . import celery
 from ..lib.utils import waiting_get
 from ..lib.sentry import capture_exception
@@ -176,18 +178,51 @@ def translate_content_task(content_id):
 def translate_discussion(
         discussion_id, translation_table=None,
         constrain_to_discussion_languages=True,
-        send_to_changes=False):
-    from ..models import Discussion
-    discussion = Discussion.get(discussion_id)
-    service = discussion.translation_service()
-    if service.canTranslate is None:
-        return
-    if translation_table is None:
-        translation_table = DiscussionPreloadTranslationTable(
+        send_to_changes=False, chunk_size=200, post_ids=None):
+    """Translate the posts of the discussion through a
+    :py:class:`assembl.nlp.translation_pipeline.TranslationPipeline`,
+    by chunks of posts, each in its own transaction.
+    If post_ids are given, only those posts."""
+    from ..models import Discussion, Post
+    from ..indexing.reindex import reindex_content
+    from ..nlp.translation_pipeline import TranslationPipeline
+
+    def load_pipeline():
+        discussion = Discussion.get(discussion_id)
+        service = discussion.translation_service()
+        if service.canTranslate is None:
+            return None, None
+        table = translation_table or DiscussionPreloadTranslationTable(
             service, discussion)
+        return TranslationPipeline(
+            discussion.db, service, table), table
+
+    with transaction.manager:
+        pipeline, table = load_pipeline()
+        if pipeline is None:
+            return False
+        if post_ids is None:
+            post_ids = [id for (id,) in Post.default_db.query(Post.id).filter(
+                Post.discussion_id == discussion_id).order_by(Post.id)]
     changed = False
-    for post in discussion.posts:
-        changed |= translate_content(
-            post, translation_table, service,
-            constrain_to_discussion_languages, send_to_changes)
+    for start in range(0, len(post_ids), chunk_size):
+        with transaction.manager:
+            # The previous transaction closed the session
+            pipeline, table = load_pipeline()
+            db = pipeline.db
+            posts = db.query(Post).filter(
+                Post.id.in_(post_ids[start:start + chunk_size])).options(
+                *Post.subqueryload_options()).all()
+            changed_ids, unidentified = pipeline.translate_posts(posts)
+            for post in posts:
+                if post.id in changed_ids:
+                    reindex_content(post)
+                    if send_to_changes:
+                        post.send_to_changes()
+            # Identification is done entry by entry
+            for post in unidentified:
+                changed |= translate_content(
+                    post, table, pipeline.service,
+                    constrain_to_discussion_languages, send_to_changes)
+            changed |= bool(changed_ids)
     return changed
@@ -75,6 +75,7 @@ def do_watson_computation(id):
         api_key = config.get("watson_api_key")
         assert api_key
         endpoint = get_endpoint(api_key)
+        keywords_changed = False
         for computation in post.computations:
             if computation.status != "pending":
                 log.debug('skipping computation %d in state %s' % (
@@ -110,6 +111,7 @@ def do_watson_computation(id):
                             post=post, source=computation,
                             value=tag, score=keyword['relevance'],
                             occurences=keyword['count']))
+                        keywords_changed = True
                     for category in result.get('categories', ()):
                         tag = Tag.getOrCreateTag(
                             category['label'], lse.locale, post.db)
@@ -149,6 +151,13 @@ def do_watson_computation(id):
                     computation.result = traceback.format_exc()
                     computation.status = "failure"
                     computation.retries = (computation.retries or 0) + 1
+        if keywords_changed:
+            from ..models import Idea
+            from ..models.keyword_rollup import IdeaKeywordRollup
+            post.db.flush()
+            IdeaKeywordRollup.mark_dirty(
+                post.db, post.discussion_id,
+                Idea.get_idea_ids_showing_post(post.id))
 
 
 def get_or_create_computation_on_post(post, process_name, parameters):
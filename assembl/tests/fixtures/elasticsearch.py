@@ -0,0 +1,95 @@
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import simplejson as json
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    """Answers the bulk API like elasticsearch, failing the actions
+    on the documents listed in ``server.failing_ids``, and the alias
+    existence checks for ``server.aliases``."""
+
+    def do_HEAD(self):
+        server = self.server
+        if server.unavailable:
+            status = 503
+        elif self.path.split('?')[0].split('/')[-1] in server.aliases:
+            status = 200
+        else:
+            status = 404
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        lines = [l for l in self.rfile.read(length).split('\n') if l]
+        server = self.server
+        if server.unavailable:
+            self.send_response(503)
+            self.end_headers()
+            return
+        items = []
+        i = 0
+        while i < len(lines):
+            action = json.loads(lines[i])
+            i += 1
+            op_type, info = action.items()[0]
+            source = None
+            if op_type != 'delete':
+                source = json.loads(lines[i])
+                i += 1
+            doc_id = info['_id']
+            if doc_id in server.failing_ids:
+                status = 500
+                result = {'_id': doc_id, 'status': status,
+                          'error': {'type': 'fake_error'}}
+            elif op_type == 'delete' and doc_id not in server.documents:
+                result = {'_id': doc_id, 'status': 404, 'found': False}
+            else:
+                if op_type == 'delete':
+                    del server.documents[doc_id]
+                else:
+                    server.documents[doc_id] = source
+                result = {'_id': doc_id, 'status': 200}
+            server.requests.append((op_type, doc_id))
+            server.index_requests.append((info['_index'], doc_id))
+            items.append({op_type: result})
+        body = json.dumps({
+            'took': 1,
+            'errors': any(x.values()[0]['status'] >= 300 for x in items),
+            'items': items})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="function")
+def fake_elasticsearch(request):
+    """A local HTTP server answering the elasticsearch bulk API,
+    with an elasticsearch client connected to it."""
+    from elasticsearch.client import Elasticsearch
+    server = HTTPServer(('localhost', 0), FakeElasticsearchHandler)
+    server.documents = {}
+    server.requests = []
+    server.index_requests = []
+    server.aliases = set()
+    server.failing_ids = set()
+    server.unavailable = False
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.client = Elasticsearch(
+        'localhost:%d' % (server.server_port,), max_retries=0)
+
+    def fin():
+        server.shutdown()
+        server.server_close()
+    request.addfinalizer(fin)
+    return server
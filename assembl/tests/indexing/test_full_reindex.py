@@ -0,0 +1,39 @@
+# -*- coding=utf-8 -*-
+from assembl.indexing.full_reindex import SOURCES, Checkpoint, plan_chunks
+
+
+def test_plan_chunks(
+        test_session, discussion, root_post_1, reply_post_1, reply_post_2,
+        extract_submitted_in_post_related_to_sub_idea_1_1_1):
+    chunks = plan_chunks(test_session, 2)
+    assert set(doc_type for (doc_type, _, _) in chunks) == set(SOURCES)
+    for doc_type, source in SOURCES.items():
+        # chunks of a doc type cover all its contents, once
+        ids = []
+        for (chunk_type, after_id, last_id) in chunks:
+            if chunk_type == doc_type:
+                chunk_ids = [x.id for x in source.chunk(
+                    test_session, after_id, last_id)]
+                assert len(chunk_ids) <= 2 or last_id is None
+                ids.extend(chunk_ids)
+        entity = source.entity()
+        expected = [x.id for x in source.filter(
+            test_session.query(entity), entity).order_by(entity.id)]
+        assert ids == expected
+    post_ids = [x.id for x in SOURCES['post'].chunk(test_session, None, None)]
+    assert root_post_1.id in post_ids
+
+
+def test_checkpoint(tmpdir):
+    path = str(tmpdir.join('reindex.json'))
+    assert Checkpoint.load(path) is None
+    chunks = [('idea', None, 10), ('idea', 10, None), ('post', None, None)]
+    checkpoint = Checkpoint(path, 'assembl_1', chunks)
+    checkpoint.done.add(1)
+    checkpoint.save()
+    resumed = Checkpoint.load(path)
+    assert resumed.index_name == 'assembl_1'
+    assert resumed.chunks == chunks
+    assert resumed.pending() == [(0, chunks[0]), (2, chunks[2])]
+    resumed.remove()
+    assert Checkpoint.load(path) is None
@@ -0,0 +1,62 @@
+# -*- coding=utf-8 -*-
+import datetime
+
+from assembl.indexing.indexer import (
+    IndexingQueueWorker, enqueue, queue_stats, queue_table)
+
+
+def test_indexing_queue_worker(test_session, fake_elasticsearch):
+    now = datetime.datetime.utcnow()
+    enqueue(test_session, {
+        'post:1': {'id': 1, 'body': u'old', '_parent': 'user:2'},
+        'idea:3': {'id': 3, 'creation_date': now},
+    }, {
+        'idea:4': {'doc_type': 'idea', '_parent': None},
+    })
+    # a later change to the same document
+    enqueue(test_session, {
+        'post:1': {'id': 1, 'body': u'new', '_parent': 'user:2'}}, {})
+    fake_elasticsearch.failing_ids.add('idea:3')
+    worker = IndexingQueueWorker(
+        fake_elasticsearch.client, 'assembl', max_attempts=2, retry_delay=0)
+    try:
+        assert worker.process_batch(test_session) == 4
+        # only the last version was sent
+        assert fake_elasticsearch.requests.count(('index', 'post:1')) == 1
+        assert fake_elasticsearch.documents['post:1']['body'] == u'new'
+        # deleting an unindexed document is not an error
+        stats = queue_stats(test_session)
+        assert stats['pending'] == 1
+        assert stats['dead_letter'] == 0
+        # the failed action is retried, and given up
+        assert worker.process_batch(test_session) == 1
+        stats = queue_stats(test_session)
+        assert stats['pending'] == 0
+        assert stats['dead_letter'] == 1
+        assert worker.process_batch(test_session) == 0
+        # until requeued
+        fake_elasticsearch.failing_ids.clear()
+        worker.requeue_dead_letters(test_session)
+        assert worker.process_batch(test_session) == 1
+        assert 'idea:3' in fake_elasticsearch.documents
+        # an unavailable elasticsearch does not lose actions
+        fake_elasticsearch.unavailable = True
+        enqueue(test_session, {'idea:5': {'id': 5}}, {})
+        assert worker.process_batch(test_session) == 1
+        assert queue_stats(test_session)['pending'] == 1
+    finally:
+        test_session.execute(queue_table().delete())
+
+
+def test_indexing_queue_worker_building_index(test_session, fake_elasticsearch):
+    enqueue(test_session, {'idea:6': {'id': 6}}, {})
+    fake_elasticsearch.aliases.add('assembl_building')
+    worker = IndexingQueueWorker(fake_elasticsearch.client, 'assembl')
+    try:
+        assert worker.process_batch(test_session) == 1
+        # also sent to the index being built
+        assert fake_elasticsearch.index_requests == [
+            ('assembl', 'idea:6'), ('assembl_building', 'idea:6')]
+        assert queue_stats(test_session)['pending'] == 0
+    finally:
+        test_session.execute(queue_table().delete())
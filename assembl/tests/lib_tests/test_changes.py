@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+import mock
+from anyjson import dumps, loads
+
+from assembl.lib import changes
+
+
+def test_chunk_changes_by_count():
+    data = [dumps({"@id": "local:Post/%d" % i}) for i in range(5)]
+    chunks = list(changes.chunk_changes(data, 2, 100000))
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    assert sum(chunks, []) == data
+
+
+def test_chunk_changes_by_size():
+    data = [dumps({"@id": "local:Post/%d" % i, "body": "x" * 100})
+            for i in range(4)]
+    chunks = list(changes.chunk_changes(data, 100, 250))
+    assert [len(c) for c in chunks] == [2, 2]
+
+
+def test_publisher_sends_chunks():
+    publisher = changes.ChangesPublisher(max_batch=2)
+    collected = OrderedDict(
+        (("local:Post/%d" % i, "changes"),
+         ("1" if i < 3 else "2", {"@id": "local:Post/%d" % i}))
+        for i in range(4))
+    with mock.patch.object(changes, 'send_changes') as send_changes:
+        publisher.publish(None, (collected, []))
+    sent = sorted((args[1], len(loads(args[2])))
+                  for (args, kwargs) in send_changes.call_args_list)
+    assert sent == [("1", 1), ("1", 2), ("2", 1)]
+
+
+def test_serialize_changes_without_id():
+    class Change(object):
+        def generic_json(self, view_def):
+            return {"@type": "Change"}
+    results = changes.serialize_changes(None, [
+        ("local:Change/1", "1", "changes", Change()),
+        ("local:Change/2", "1", "changes", Change())])
+    # keyed by object, not by the json
+    assert results.keys() == [
+        ("local:Change/1", "changes"), ("local:Change/2", "changes")]
@@ -0,0 +1,45 @@
+import random
+
+from assembl.lib.id_ranges import IdRangeSet
+
+
+def test_id_range_set_bounds():
+    ids = IdRangeSet.from_ids([7, 3, 4, 5, 10, 4])
+    assert ids.bounds == [3, 6, 7, 8, 10, 11]
+    assert ids.ranges() == [(3, 6), (7, 8), (10, 11)]
+    assert list(ids) == [3, 4, 5, 7, 10]
+    assert len(ids) == 5
+    assert 4 in ids and 7 in ids and 10 in ids
+    assert 2 not in ids and 6 not in ids and 11 not in ids
+    assert repr(ids) == "<IdRangeSet 3-5 7 10>"
+
+
+def test_id_range_set_update():
+    ids = IdRangeSet.from_ids([3, 4, 5, 10])
+    assert ids.update([6, 7, 4, 12]) == [6, 7, 12]
+    assert ids.bounds == [3, 8, 10, 11, 12, 13]
+    assert ids.update([11]) == [11]
+    assert ids.bounds == [3, 8, 10, 13]
+    assert ids.update([3, 10]) == []
+    assert ids.difference_update([5, 9, 12]) == [5, 12]
+    assert ids.bounds == [3, 5, 6, 8, 10, 12]
+    assert ids.difference_update([3, 4, 6, 7, 10, 11]) == [3, 4, 6, 7, 10, 11]
+    assert ids.bounds == []
+    assert IdRangeSet() == ids
+
+
+def test_id_range_set_random():
+    rand = random.Random(0)
+    ids = IdRangeSet()
+    expected = set()
+    for _ in range(200):
+        batch = [rand.randint(0, 300) for _ in range(rand.randint(0, 20))]
+        if rand.random() < 0.7:
+            assert ids.update(batch) == sorted(set(batch) - expected)
+            expected.update(batch)
+        else:
+            assert ids.difference_update(batch) == sorted(
+                set(batch) & expected)
+            expected.difference_update(batch)
+        assert list(ids) == sorted(expected)
+        assert ids == IdRangeSet.from_ids(expected)
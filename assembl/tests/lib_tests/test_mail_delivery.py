@@ -0,0 +1,107 @@
+import asyncore
+import smtpd
+import threading
+from datetime import timedelta
+from time import time
+
+import mock
+import pytest
+from pyramid_mailer.message import Message
+
+from assembl.lib.mail_delivery import (
+    DomainDispatcher, MemoryTokenBuckets, OutgoingMail, SMTPConnectionPool,
+    SMTPPoolTransport, domain_rule)
+
+
+class CountingSMTPServer(smtpd.SMTPServer):
+    """Counts the connections and the received mails"""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.connections = 0
+        self.received = []
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((rcpttos, time()))
+
+
+@pytest.fixture
+def smtp_server(request):
+    server = CountingSMTPServer()
+    thread = threading.Thread(
+        target=asyncore.loop, kwargs=dict(timeout=0.05, map=server._map))
+    thread.daemon = True
+    thread.start()
+
+    def fin():
+        server.close()
+        thread.join(1)
+    request.addfinalizer(fin)
+    return server
+
+
+def test_domain_rule():
+    delays = {'': timedelta(0), 'example.com': timedelta(seconds=1)}
+    assert domain_rule('a@mail.example.com', delays)[0] == 'example.com'
+    assert domain_rule('a@example.org', delays)[0] == ''
+    assert domain_rule('a@example.org', {}) is None
+
+
+def test_memory_token_buckets():
+    buckets = MemoryTokenBuckets()
+    assert buckets.acquire('example.com', 10) == 0
+    wait = buckets.acquire('example.com', 10)
+    assert 9 < wait <= 10
+    # Not taken: the next caller waits as long
+    assert buckets.acquire('example.com', 10, reserve=True) <= wait
+    # Taken: the next caller waits one more interval
+    assert buckets.acquire('example.com', 10) > 19
+    assert buckets.acquire('example.org', 10) == 0
+
+
+def test_pooled_delivery(smtp_server):
+    pool = SMTPConnectionPool('127.0.0.1', smtp_server.socket.getsockname()[1],
+                              size=2)
+    delays = {'': timedelta(0), 'slow.example.com': timedelta(seconds=0.1)}
+    recipients = ['user%d@example.com' % i for i in range(12)] + [
+        'user%d@slow.example.com' % i for i in range(3)]
+    mails = [OutgoingMail(n, Message(
+        subject="Test", sender="assembl@example.com", recipients=[recipient],
+        body="Hello"), recipient) for (n, recipient) in enumerate(recipients)]
+    dispatcher = DomainDispatcher(
+        SMTPPoolTransport(pool), delays, MemoryTokenBuckets(), concurrency=2)
+    outcome = dispatcher.send(mails)
+    pool.close_all()
+    assert outcome == {n: None for n in range(len(recipients))}
+    assert len(smtp_server.received) == len(recipients)
+    # Connections are kept between mails
+    assert smtp_server.connections <= 2
+    slow = sorted(received for (rcpttos, received) in smtp_server.received
+                  if rcpttos[0].endswith('@slow.example.com'))
+    assert slow[-1] - slow[0] >= 0.15
+
+
+def test_pool_starttls():
+    with mock.patch('smtplib.SMTP') as smtp:
+        connection = smtp.return_value
+        connection.has_extn.return_value = True
+        SMTPConnectionPool(username='user', password='pass').connect()
+        assert connection.starttls.called
+        # Upgraded before the credentials are sent
+        assert [name for (name, args, kwargs) in connection.method_calls
+                if name in ('starttls', 'login')] == ['starttls', 'login']
+
+        connection.reset_mock()
+        SMTPConnectionPool(no_tls=True).connect()
+        assert not connection.starttls.called
+
+        connection.reset_mock()
+        connection.has_extn.return_value = False
+        SMTPConnectionPool().connect()
+        assert not connection.starttls.called
+        with pytest.raises(RuntimeError):
+            SMTPConnectionPool(force_tls=True).connect()
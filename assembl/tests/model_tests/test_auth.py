@@ -146,3 +146,67 @@ def test_count_posts_in_discussion_all_profiles(test_app, discussion, admin_user
 
 def test_count_posts_in_discussion(test_app, discussion, admin_user, proposals):
     assert admin_user.count_posts_in_discussion(discussion.id) == 15
+
+
+def test_permission_cache(
+        test_session, discussion_with_default_data, participant2_user,
+        monkeypatch):
+    from assembl.auth import R_ADMINISTRATOR, P_ADMIN_DISC
+    from assembl.auth import permission_cache
+    from assembl.auth.util import get_permissions, user_has_permission
+    from assembl.models import LocalUserRole, Role
+    from assembl.lib import metrics
+    discussion = discussion_with_default_data
+    cache = permission_cache.PermissionCache(
+        permission_cache.MemoryPermissionBackend())
+    monkeypatch.setattr(permission_cache, '_permission_cache', cache)
+    # no request layer, so the shared layer is used
+    monkeypatch.setattr(
+        permission_cache.PermissionCache, 'request_cache',
+        staticmethod(lambda create=True: None))
+    hits = metrics.counter("permissions.cache_hit.shared").value
+    assert not user_has_permission(
+        discussion.id, participant2_user.id, P_ADMIN_DISC)
+    permissions = get_permissions(participant2_user.id, discussion.id)
+    assert metrics.counter("permissions.cache_hit.shared").value == hits + 1
+    assert P_ADMIN_DISC not in permissions
+    # a new local role invalidates the cache
+    lur = LocalUserRole(
+        user=participant2_user, discussion=discussion,
+        role=Role.get_role(R_ADMINISTRATOR, test_session))
+    test_session.add(lur)
+    test_session.flush()
+    assert user_has_permission(
+        discussion.id, participant2_user.id, P_ADMIN_DISC)
+    test_session.delete(lur)
+    test_session.flush()
+    assert not user_has_permission(
+        discussion.id, participant2_user.id, P_ADMIN_DISC)
+
+
+def test_permission_cache_sees_unflushed_roles(
+        test_session, discussion_with_default_data, participant2_user,
+        monkeypatch):
+    from assembl.auth import R_ADMINISTRATOR, P_ADMIN_DISC
+    from assembl.auth import permission_cache
+    from assembl.auth.util import user_has_permission
+    from assembl.models import LocalUserRole, Role
+    discussion = discussion_with_default_data
+    cache = permission_cache.PermissionCache()
+    monkeypatch.setattr(permission_cache, '_permission_cache', cache)
+    request_cache = {}
+    monkeypatch.setattr(
+        permission_cache.PermissionCache, 'request_cache',
+        staticmethod(lambda create=True: request_cache))
+    assert not user_has_permission(
+        discussion.id, participant2_user.id, P_ADMIN_DISC)
+    assert request_cache
+    # not flushed yet
+    lur = LocalUserRole(
+        user=participant2_user, discussion=discussion,
+        role=Role.get_role(R_ADMINISTRATOR, test_session))
+    test_session.add(lur)
+    assert user_has_permission(
+        discussion.id, participant2_user.id, P_ADMIN_DISC)
+    test_session.delete(lur)
+    test_session.flush()
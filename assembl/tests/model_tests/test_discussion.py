@@ -145,3 +145,61 @@ def test_adding_a_discussion_automatically_adds_participant_user_template_for_no
     participant_role = test_session.query(Role).filter_by(name=R_PARTICIPANT).one()
     user_templates_for_role_participant = test_session.query(UserTemplate).filter_by(discussion=discussion, for_role=participant_role).all()
     assert len(user_templates_for_role_participant) > 0
+
+
+def test_daily_activity_time_series(
+        test_session, discussion, root_post_1, reply_post_1, reply_post_2):
+    from datetime import datetime, timedelta
+    from assembl.models import Post
+    from assembl.models.activity_rollup import (
+        DailyActivity, DailyActivityState, RESCAN_DELAY, day_boundaries)
+    posts = test_session.query(Post).filter_by(discussion_id=discussion.id).all()
+    days = sorted({post.creation_date.date() for post in posts})
+    start = datetime.combine(days[0], datetime.min.time())
+    end = datetime.combine(days[-1], datetime.min.time()) + timedelta(days=1)
+    boundaries = day_boundaries(start, end, timedelta(days=1))
+    assert boundaries[0] == days[0] and boundaries[-1] == days[-1] + timedelta(days=1)
+    assert day_boundaries(start, end, timedelta(hours=6)) is None
+    # a single interval is not a whole day either
+    assert day_boundaries(
+        start, start + timedelta(hours=4), timedelta(hours=6)) is None
+
+    assert DailyActivity.refresh(test_session, discussion.id) is None
+    # nothing new since a recent refresh: nothing scanned
+    assert DailyActivity.refresh(test_session, discussion.id) == 0
+    # later, the last ids are scanned again, without counting them twice
+    test_session.query(DailyActivityState).get(
+        discussion.id).refreshed -= RESCAN_DELAY
+    test_session.flush()
+    assert DailyActivity.refresh(test_session, discussion.id) == len(days)
+    series = DailyActivity.time_series(test_session, discussion.id, boundaries)
+    assert len(series) == len(boundaries) - 1
+    last = series[-1]
+    assert last['count_cumulative_posts'] == len(posts)
+    assert sum(r['count_posts'] for r in series) == len(posts)
+    assert last['count_cumulative_top_posts'] == len(
+        [post for post in posts if post.parent_id is None])
+    assert last['count_cumulative_post_authors'] == len(
+        {post.creator_id for post in posts})
+
+    # A post imported with a past date is counted on its day
+    new_post = Post(
+        discussion=discussion, creator=root_post_1.creator,
+        subject=LangString.create(u"an imported post"),
+        body=LangString.create(u"post body"), moderator=None,
+        creation_date=start - timedelta(days=2),
+        type="post", message_id="daily_activity@example.com")
+    test_session.add(new_post)
+    test_session.flush()
+    assert DailyActivity.refresh(test_session, discussion.id) == len(days) + 1
+    series = DailyActivity.time_series(
+        test_session, discussion.id, [days[0] - timedelta(days=2)] + boundaries[1:])
+    assert series[0]['count_posts'] == 1 + len(
+        [post for post in posts if post.creation_date.date() == days[0]])
+    assert series[-1]['count_cumulative_posts'] == len(posts) + 1
+    # a hard deletion makes the next refresh recompute all days
+    test_session.delete(new_post)
+    test_session.flush()
+    assert DailyActivity.refresh(test_session, discussion.id) is None
+    series = DailyActivity.time_series(test_session, discussion.id, boundaries)
+    assert series[-1]['count_cumulative_posts'] == len(posts)
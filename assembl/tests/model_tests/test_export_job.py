@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+
+def test_discussion_watermark(discussion, test_session):
+    from assembl.models import ExportJob, Idea, LangString
+    watermark = ExportJob.discussion_watermark(discussion.id)
+    assert watermark == ExportJob.discussion_watermark(discussion.id)
+    idea = Idea(title=LangString.create(u"A new idea", 'en'),
+                discussion=discussion)
+    test_session.add(idea)
+    test_session.flush()
+    try:
+        assert ExportJob.discussion_watermark(discussion.id) != watermark
+    finally:
+        test_session.delete(idea)
+        test_session.flush()
+
+
+def test_find_reusable_export_job(discussion, test_session):
+    from assembl.models import ExportJob, ExportJobStatus
+    params = ExportJob.canonical_params({'lang': 'fr'})
+    cache_key = ExportJob.make_cache_key(
+        discussion.id, 'phase', params, 'watermark')
+    assert cache_key == ExportJob.make_cache_key(
+        discussion.id, 'phase', ExportJob.canonical_params({'lang': 'fr'}),
+        'watermark')
+    failed = ExportJob(
+        discussion_id=discussion.id, export_type='phase', params=params,
+        watermark='watermark', cache_key=cache_key,
+        status=ExportJobStatus.FAILED)
+    test_session.add(failed)
+    test_session.flush()
+    try:
+        assert ExportJob.find_reusable(cache_key, 3600, 3600) is None
+        pending = ExportJob(
+            discussion_id=discussion.id, export_type='phase', params=params,
+            watermark='watermark', cache_key=cache_key)
+        test_session.add(pending)
+        test_session.flush()
+        assert ExportJob.find_reusable(cache_key, 3600, 3600) == pending
+        # lost jobs are not reused
+        pending.created = datetime.utcnow() - timedelta(hours=2)
+        test_session.flush()
+        assert ExportJob.find_reusable(cache_key, 3600, 3600) is None
+    finally:
+        test_session.query(ExportJob).filter_by(
+            cache_key=cache_key).delete()
+        test_session.flush()
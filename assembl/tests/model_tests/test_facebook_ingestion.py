@@ -0,0 +1,180 @@
+import json
+import os
+from urllib import urlencode
+
+import mock
+import pytest
+
+
+class FakeGraphAPI(object):
+    """Serves recorded Graph API responses, by path and query"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def _get(self, path, args):
+        key = path
+        if args:
+            key += "?" + urlencode(sorted(args.items()))
+        self.requests.append(key)
+        return self.pages.get(
+            key, {'error': {'message': 'not recorded: ' + key}})
+
+    def get_connections(self, id, connection_name, **args):
+        return self._get("%s/%s" % (id, connection_name), args)
+
+    def get_object(self, id, **args):
+        return self._get(id, args)
+
+
+class FakeFacebookAPI(object):
+    app_id = 'fake_app'
+
+    def __init__(self, graph_api):
+        self.graph_api = graph_api
+
+    def api_caller(self):
+        return self.graph_api
+
+
+@pytest.fixture(scope="function")
+def facebook_page_source(request, test_session, discussion):
+    from assembl.models.facebook_integration import (
+        FacebookPagePostsSource, FacebookPost)
+    from assembl.models import PostAttachment, Document, SocialAuthAccount
+    source = FacebookPagePostsSource.create_from(
+        discussion, 'page1', None, 'https://www.facebook.com/page1',
+        'Facebook page')
+    test_session.add(source)
+    test_session.flush()
+    # The ingestion commits, which closes the session
+    (source_id, discussion_id) = (source.id, discussion.id)
+
+    def fin():
+        posts = test_session.query(FacebookPost).filter_by(
+            source_id=source_id).order_by(FacebookPost.id.desc()).all()
+        profiles = set()
+        for post in posts:
+            for attachment in post.attachments:
+                test_session.delete(attachment)
+            profiles.add(post.creator)
+        test_session.flush()
+        for post in posts:
+            test_session.delete(post)
+        test_session.flush()
+        for document in test_session.query(Document).filter_by(
+                discussion_id=discussion_id, uri_id='https://example.com/article'):
+            test_session.delete(document)
+        for account in test_session.query(SocialAuthAccount).filter(
+                SocialAuthAccount.uid.in_(('1001', '1002'))):
+            test_session.delete(account)
+        for profile in profiles:
+            test_session.delete(profile)
+        test_session.delete(
+            test_session.query(FacebookPagePostsSource).get(source_id))
+        test_session.flush()
+    request.addfinalizer(fin)
+    return source
+
+
+def page_ingestion(source, **kwargs):
+    from assembl.models.facebook_integration import FacebookParser
+    from assembl.models.facebook_ingestion import FacebookIngestion
+    with open(os.path.join(
+            os.path.dirname(__file__), os.pardir, 'fixtures',
+            'facebook_graph', 'page_posts.json')) as f:
+        graph_api = FakeGraphAPI(json.load(f))
+    parser = FacebookParser(FakeFacebookAPI(graph_api))
+    ingestion = FacebookIngestion(
+        source, parser, concurrency=2, batch_size=1, calls_per_second=1000,
+        **kwargs)
+    return ingestion, parser, graph_api
+
+
+def test_facebook_ingestion(test_session, discussion, facebook_page_source):
+    from assembl.models.facebook_integration import FacebookPost
+    from assembl.models import SocialAuthAccount
+    source_id = facebook_page_source.id
+
+    def ingest():
+        ingestion, parser, graph_api = page_ingestion(facebook_page_source)
+        with mock.patch(
+                'assembl.tasks.translate.translate_discussion.delay'
+                ) as translate:
+            created = ingestion.ingest(parser.get_posts_paginated('page1'))
+        return created, graph_api, translate
+
+    created, graph_api, translate = ingest()
+    assert len(created) == 4
+    # One batch per top-level post
+    assert translate.call_count == 2
+    posts = {post.source_post_id: post for post in test_session.query(
+        FacebookPost).filter_by(source_id=source_id)}
+    assert set(posts) == {'page1_1', 'page1_1_c1', 'page1_1_c2', 'page1_2'}
+    assert posts['page1_1'].parent_id is None
+    assert posts['page1_1_c1'].parent_id == posts['page1_1'].id
+    assert posts['page1_1_c2'].ancestor_ids() == [
+        posts['page1_1'].id, posts['page1_1_c1'].id]
+    assert posts['page1_1'].body.first_original().value == "First post"
+    assert [a.document.uri_id for a in posts['page1_1'].attachments] == [
+        'https://example.com/article']
+    assert not posts['page1_2'].attachments
+    accounts = test_session.query(SocialAuthAccount).filter(
+        SocialAuthAccount.uid.in_(('1001', '1002'))).all()
+    assert len(accounts) == 2
+    assert posts['page1_1_c2'].creator_id == posts['page1_1'].creator_id
+
+    # Incremental: known posts are not written again, and their
+    # attachments are not fetched
+    created, graph_api_2, translate = ingest()
+    assert created == []
+    assert not translate.called
+    assert not [key for key in graph_api_2.requests if 'attachment' in key]
+    assert len(graph_api_2.requests) < len(graph_api.requests)
+
+
+def test_facebook_ingestion_stop(
+        test_session, discussion, facebook_page_source):
+    from assembl.models.facebook_integration import FacebookPost
+    source_id = facebook_page_source.id
+    ingestion, parser, graph_api = page_ingestion(
+        facebook_page_source, should_stop=lambda: bool(ingestion.created_ids))
+    with mock.patch('assembl.tasks.translate.translate_discussion.delay'):
+        created = ingestion.ingest(parser.get_posts_paginated('page1'))
+    # Stopped after the first batch
+    assert len(created) == 3
+    assert {id for (id,) in test_session.query(
+        FacebookPost.source_post_id).filter_by(source_id=source_id)} == {
+        'page1_1', 'page1_1_c1', 'page1_1_c2'}
+
+
+def test_facebook_ingestion_translation(
+        request, test_session, discussion, facebook_page_source,
+        monkeypatch):
+    from assembl.models import (
+        Discussion, LangStringEntry, Locale, TranslationMemory)
+    from assembl.models.facebook_integration import FacebookPost
+    from assembl.nlp.translation_service import (
+        DummyTranslationServiceTwoSteps)
+    from assembl.tasks.translate import translate_discussion
+    monkeypatch.setattr(
+        Discussion, 'translation_service',
+        lambda self: DummyTranslationServiceTwoSteps(self))
+    request.addfinalizer(
+        lambda: test_session.query(TranslationMemory).delete())
+    source_id = facebook_page_source.id
+    ingestion, parser, graph_api = page_ingestion(facebook_page_source)
+    # The queued task runs after the commit of the batch
+    with mock.patch(
+            'assembl.tasks.translate.translate_discussion.delay',
+            side_effect=translate_discussion) as translate:
+        created = ingestion.ingest(parser.get_posts_paginated('page1'))
+    assert translate.call_count == 2
+    body_ids = {id for (id,) in test_session.query(
+        FacebookPost.body_id).filter(FacebookPost.source_id == source_id)}
+    assert len(body_ids) == len(created) == 4
+    translated = test_session.query(LangStringEntry.langstring_id).join(
+        Locale).filter(LangStringEntry.langstring_id.in_(body_ids),
+                       Locale.code.like('%-x-mtfrom-%'))
+    assert {id for (id,) in translated} == body_ids
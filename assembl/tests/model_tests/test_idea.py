@@ -31,3 +31,169 @@ def test_idea_copy_and_commit(subidea_1_1, test_session):
         test_session.delete(entry)
     test_session.delete(boba_fett)
     test_session.commit()
+
+
+def test_post_stem_index(post_related_to_sub_idea_1, test_session):
+    from assembl.models import Content, PostStemIndex
+    from assembl.nlp.wordcounter import WordCounter
+    post = post_related_to_sub_idea_1
+    post_ids = test_session.query(Content.id.label('post_id')).filter(
+        Content.id == post.id)
+
+    def stored_counts():
+        counter = WordCounter(('en',))
+        PostStemIndex.add_counts(test_session, post_ids, counter)
+        return {stem: word.counter for (stem, word) in counter.items()}
+
+    def direct_counts(subject, body):
+        counter = WordCounter(('en',))
+        counter.add_text(subject)
+        counter.add_text(body, 0.5)
+        return {stem: word.counter for (stem, word) in counter.items()}
+
+    subject = post.subject.first_original().value
+    assert stored_counts() == direct_counts(
+        subject, post.body.first_original().value)
+    # up to date: not stemmed again
+    assert PostStemIndex.update_posts(
+        test_session, post_ids, WordCounter(('en',))) == 0
+    post.body.add_value(u"An edited body about tomatoes", 'en')
+    test_session.flush()
+    assert stored_counts() == direct_counts(
+        subject, u"An edited body about tomatoes")
+
+
+def test_keywords_watcher_invalidation(
+        post_related_to_sub_idea_1, subidea_1, test_session):
+    import mock
+    from assembl.models.stem_index import KeywordsModelEventWatcher
+    post = post_related_to_sub_idea_1
+    watcher = KeywordsModelEventWatcher()
+    with mock.patch('assembl.models.stem_index.get_keywords_cache') as cache:
+        watcher.processPostModified(post.id, 0)
+        watcher.processIdeaModified(subidea_1.id, 0)
+        # Expired: only the column is read
+        test_session.expire(subidea_1)
+        watcher.processIdeaDeleted(subidea_1.id)
+        watcher.processPostCreated(0)
+    assert [args for (args, kwargs) in
+            cache.return_value.invalidate.call_args_list] == [
+        (post.discussion_id,)] * 3
+
+
+def test_idea_keyword_rollup(
+        post_related_to_sub_idea_1, subidea_1, root_idea, test_session):
+    from assembl.models import (
+        Locale, Tag, PostKeywordAnalysis, IdeaKeywordRollup,
+        IdeaKeywordRollupState)
+    tag = Tag.getOrCreateTag(
+        u"tomato", Locale.get_or_create('en', test_session), test_session)
+    analysis = PostKeywordAnalysis(
+        post=post_related_to_sub_idea_1, value=tag, score=0.9, occurences=3)
+    test_session.add(analysis)
+    test_session.flush()
+    assert IdeaKeywordRollup.top_keywords(test_session, subidea_1.id) is None
+    # reading does not mark the idea
+    assert [tuple(r) for r in subidea_1.rolled_up_keywords()] == [
+        (u"tomato", 0.9, 3)]
+    assert test_session.query(IdeaKeywordRollupState).filter(
+        IdeaKeywordRollupState.idea_id == subidea_1.id).count() == 0
+    IdeaKeywordRollup.mark_dirty(
+        test_session, subidea_1.discussion_id, [subidea_1.id])
+    IdeaKeywordRollup.refresh_dirty(test_session, subidea_1.discussion_id)
+    result = IdeaKeywordRollup.top_keywords(test_session, subidea_1.id)
+    assert [tuple(r) for r in result] == [(u"tomato", 0.9, 3)]
+    # the ancestors were marked and refreshed too
+    assert IdeaKeywordRollup.top_keywords(test_session, root_idea.id) == result
+    assert subidea_1.rolled_up_keywords() == result
+    test_session.query(IdeaKeywordRollupState).filter(
+        IdeaKeywordRollupState.discussion_id == subidea_1.discussion_id
+    ).delete(synchronize_session=False)
+    test_session.query(IdeaKeywordRollup).filter(
+        IdeaKeywordRollup.tag_id == tag.id).delete(synchronize_session=False)
+    test_session.delete(analysis)
+    test_session.delete(tag)
+    test_session.flush()
+
+
+def former_frozen_graph(synthesis):
+    """The frozen graph of a synthesis, as computed by the former,
+    object by object, publication: the links by base id, with the base
+    ids of their ends and whether those are copies, and the base ids of
+    the copied synthesis ideas."""
+    from assembl.models import Idea, RootIdea
+    links = Idea.get_all_idea_links(synthesis.discussion_id)
+    synthesis_idea_ids = {idea.id for idea in synthesis.ideas}
+    relevant_idea_ids = synthesis_idea_ids.copy()
+
+    def add_ancestors_between(idea, path=None):
+        if isinstance(idea, RootIdea):
+            return
+        path = path[:] if path else []
+        if idea.id in synthesis_idea_ids:
+            relevant_idea_ids.update({i.id for i in path})
+        else:
+            path.append(idea)
+        for parent in idea.parents:
+            add_ancestors_between(parent, path)
+    for idea in synthesis.ideas:
+        for parent in idea.parents:
+            add_ancestors_between(parent)
+
+    def end(idea):
+        return (idea.base_id, idea.id in relevant_idea_ids and
+                not isinstance(idea, RootIdea))
+    frozen_links = {(link.base_id, end(link.source_ts), end(link.target_ts))
+                    for link in links}
+    frozen_ideas = {idea.base_id for link in links
+                    for idea in (link.source_ts, link.target_ts)
+                    if idea.id in synthesis_idea_ids and
+                    not isinstance(idea, RootIdea)}
+    return frozen_links, frozen_ideas
+
+
+def test_synthesis_publish(
+        synthesis_1, subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_2, subidea_2, test_session):
+    from assembl.models import Idea, SubGraphIdeaAssociation
+    # subidea_1_1 and subidea_1_1_1 are between two synthesis ideas
+    association = SubGraphIdeaAssociation(
+        sub_graph=synthesis_1, idea=subidea_1_1_1_1)
+    test_session.add(association)
+    test_session.flush()
+    expected_links, expected_ideas = former_frozen_graph(synthesis_1)
+    frozen = synthesis_1.publish()
+    links = frozen.get_idea_links()
+    ideas = frozen.get_ideas()
+    copies = {idea for link in links
+              for idea in (link.source_ts, link.target_ts)
+              if idea.is_tombstone}
+    try:
+        def end(idea):
+            return (idea.base_id, idea.is_tombstone)
+        assert {(link.base_id, end(link.source_ts), end(link.target_ts))
+                for link in links} == expected_links
+        assert {idea.base_id for idea in ideas} == expected_ideas
+        assert {idea.base_id for idea in copies} == {
+            idea.base_id for idea in (
+                subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1)}
+        assert set(ideas) <= copies
+        assert len({item.tombstone_date for item in links + list(copies)}) == 1
+        for copy in copies:
+            original = Idea.get(copy.base_id)
+            assert copy.title_id != original.title_id
+            assert ({(e.locale_code, e.value) for e in copy.title.entries} ==
+                    {(e.locale_code, e.value)
+                     for e in original.title.entries})
+            assert (copy.description.first_original().value ==
+                    original.description.first_original().value)
+    finally:
+        test_session.delete(frozen)
+        test_session.flush()
+        for link in links:
+            test_session.delete(link)
+        test_session.flush()
+        for copy in copies:
+            test_session.delete(copy)
+        test_session.delete(association)
+        test_session.flush()
@@ -673,3 +673,138 @@ def test_clone_langstring_has_same_content_as_original(
     test_session.delete(boba_fett)
     test_session.commit()
 
+
+
+def test_locale_registry_refresh(test_session, locale_cache):
+    from assembl.lib import metrics
+    from assembl.models import Locale
+    Locale.reset_cache()
+    assert Locale.get_id_of(Locale.UNDEFINED, False)
+    loads = metrics.counter("locales.registry.load").value
+    refreshes = metrics.counter("locales.registry.refresh").value
+    # As if created by another process
+    test_session.execute(Locale.__table__.insert().values(
+        code="xx-x-mtfrom-yy", rtl=False))
+    locale_id = test_session.query(Locale.id).filter_by(
+        code="xx-x-mtfrom-yy").scalar()
+    assert Locale.code_for_id(locale_id) == "xx-x-mtfrom-yy"
+    assert "xx-x-mtfrom-yy" in Locale.locale_collection_subsets["xx"]
+    assert Locale.registry.version >= locale_id
+    assert metrics.counter("locales.registry.load").value == loads
+    assert metrics.counter("locales.registry.refresh").value == refreshes + 1
+    ids = Locale.bulk_get_or_create(["xx-x-mtfrom-yy", "xx_ZZ"])
+    assert ids["xx-x-mtfrom-yy"] == locale_id
+    assert Locale.get_or_create("xx_ZZ").id == ids["xx_ZZ"]
+    assert metrics.counter("locales.registry.load").value == loads
+    for locale in test_session.query(Locale).filter(
+            Locale.id.in_(ids.values())):
+        test_session.delete(locale)
+    test_session.flush()
+    assert Locale.get_id_of("xx_ZZ", False) is None
+
+
+def test_best_entries_in_request(
+        admin_user, langstring_body, test_adminuser_webrequest,
+        user_language_preference_fr_cookie,
+        user_language_preference_en_mtfrom_fr,
+        user_language_preference_en_explicit,
+        fr_from_en_langstring_entry, en_locale, fr_locale):
+    from assembl.models import LangString, LangStringEntry
+    from assembl.models.auth import LanguagePreferenceCollection
+    prefs = LanguagePreferenceCollection.getCurrent()
+    best = langstring_body.best_lang(prefs, False)
+    assert best.locale.id == en_locale.id
+    assert LangString.best_entries_in_request(
+        [langstring_body], False) == [best]
+    assert langstring_body.best_entry_in_request() is best
+    assert len(test_adminuser_webrequest.locale_preference_ranks) == 1
+    assert langstring_body.best_entry_in_request() is best
+    # Resolved again when the entries change
+    entry = LangStringEntry(
+        langstring=langstring_body, locale=fr_locale, value=u"Bonjour")
+    assert LangString.best_entries_in_request(
+        [langstring_body], False) == [langstring_body.best_lang(prefs, False)]
+    langstring_body.entries.remove(entry)
+
+
+def test_translation_pipeline(
+        request, test_session, discussion, participant1_user):
+    from assembl.models import Post, LangString, TranslationMemory
+    from assembl.nlp.translation_service import (
+        DummyTranslationServiceTwoSteps)
+    from assembl.nlp.translation_pipeline import TranslationPipeline
+    from assembl.tasks.translate import LanguagesTranslationTable
+    posts = [Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"Subject %d" % n, 'en'),
+        body=LangString.create(u"The same body in every post", 'en'),
+        type="post", message_id="pipeline%d@example.com" % n)
+        for n in range(3)]
+    test_session.add_all(posts)
+    test_session.flush()
+
+    def fin():
+        test_session.query(TranslationMemory).delete()
+        for post in posts:
+            test_session.delete(post)
+        test_session.flush()
+    request.addfinalizer(fin)
+
+    service = DummyTranslationServiceTwoSteps(discussion)
+    pipeline = TranslationPipeline(
+        test_session, service, LanguagesTranslationTable(service, ['fr']), 2)
+    changed, unidentified = pipeline.translate_posts(posts)
+    assert changed == {post.id for post in posts}
+    assert not unidentified
+    for post in posts:
+        entries = {e.locale.code: e.value for e in post.body.entries}
+        assert entries['fr-x-mtfrom-en'] == \
+            u"Pseudo-translation from en to fr of: The same body in every post"
+        assert 'fr-x-mtfrom-en' in {e.locale.code for e in post.subject.entries}
+    # The body was translated once
+    assert test_session.query(TranslationMemory).filter_by(
+        service=service.__class__.__name__).count() == 4
+    # Nothing left to translate
+    assert pipeline.translate_posts(posts) == (set(), [])
+
+
+def test_translate_discussion_task(
+        request, test_session, discussion, participant1_user, monkeypatch):
+    import transaction
+    from assembl.models import (
+        Discussion, Post, LangString, LangStringEntry, Locale,
+        TranslationMemory)
+    from assembl.nlp.translation_service import (
+        DummyTranslationServiceTwoSteps)
+    from assembl.tasks.translate import translate_discussion
+    monkeypatch.setattr(
+        Discussion, 'translation_service',
+        lambda self: DummyTranslationServiceTwoSteps(self))
+    posts = [Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"Subject %d" % n, 'en'),
+        body=LangString.create(u"Body of post %d" % n, 'en'),
+        type="post", message_id="translate_task%d@example.com" % n)
+        for n in range(3)]
+    test_session.add_all(posts)
+    test_session.flush()
+    post_ids = [post.id for post in posts]
+    body_ids = [post.body_id for post in posts]
+    discussion_id = discussion.id
+    transaction.commit()
+
+    def fin():
+        test_session.query(TranslationMemory).delete()
+        for post in test_session.query(Post).filter(Post.id.in_(post_ids)):
+            test_session.delete(post)
+        test_session.flush()
+    request.addfinalizer(fin)
+
+    # as queued by the mail and facebook imports, in chunks
+    assert translate_discussion(
+        discussion_id, post_ids=post_ids, chunk_size=2)
+    # committed: the session was closed since
+    translated = test_session.query(LangStringEntry.langstring_id).join(
+        Locale).filter(LangStringEntry.langstring_id.in_(body_ids),
+                       Locale.code == 'fr-x-mtfrom-en').all()
+    assert sorted(id for (id,) in translated) == sorted(body_ids)
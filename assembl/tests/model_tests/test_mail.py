@@ -6,7 +6,7 @@ from urllib import urlencode, quote_plus
 import lxml.html
 
 from assembl.models import (
-    AbstractMailbox, Email
+    AbstractMailbox, Email, IMAPMailbox
 )
 
 def check_striping_plaintext(original, expected, fail_msg):
@@ -448,4 +448,66 @@ Yes!
 
     check_striping_plaintext(original, expected, "Gmail plaintext, circa 2012")
 
-    
\ No newline at end of file
+    
+
+def test_incremental_threading(test_session, discussion, mailbox):
+    emails = []
+
+    def import_mail(message_id, references=()):
+        headers = [
+            "Message-ID: <%s>" % message_id,
+            "From: Tester <tester@example.com>",
+            "To: list@example.com",
+            "Subject: Re: threading",
+            "Date: Thu, 18 Oct 2018 10:00:00 +0000"]
+        if references:
+            headers.append("References: " + " ".join(
+                "<%s>" % ref for ref in references))
+            headers.append("In-Reply-To: <%s>" % references[-1])
+        (email_object, dummy, error) = mailbox.parse_email(
+            "\n".join(headers) + "\n\nHello\n")
+        assert not error
+        test_session.add(email_object)
+        AbstractMailbox.thread_new_mails([email_object])
+        emails.append(email_object)
+        return email_object
+
+    try:
+        # Replies imported before the messages they answer
+        grandchild = import_mail(
+            "c@example.com", ["a@example.com", "b@example.com"])
+        assert [ref.message_id for ref in grandchild.email_references] == [
+            "b@example.com", "a@example.com"]
+        assert grandchild.parent is None
+        root = import_mail("a@example.com")
+        assert root.parent is None
+        assert grandchild.parent is root
+        child = import_mail("b@example.com", ["a@example.com"])
+        assert child.parent is root
+        assert grandchild.parent is child
+        assert grandchild.ancestor_ids() == [root.id, child.id]
+    finally:
+        creator = emails[0].creator
+        for email_object in reversed(emails):
+            test_session.delete(email_object)
+        test_session.flush()
+        test_session.delete(creator)
+        test_session.flush()
+
+
+def test_imap_batch_fetch():
+    assert IMAPMailbox.uid_ranges(['7', '1', '2', '3', '5', '8']) == "1:3,5,7:8"
+
+    class FakeIMAP(object):
+        commands = []
+
+        def uid(self, command, sequence_set, query):
+            self.commands.append((command, sequence_set, query))
+            return 'OK', [
+                ('1 (UID 3 RFC822 {3}', 'bar'), ')',
+                ('2 (UID 1 RFC822 {3}', 'foo'), ')']
+
+    mailbox = FakeIMAP()
+    assert IMAPMailbox.fetch_messages(mailbox, ['1', '2', '3']) == [
+        ('1', 'foo'), ('3', 'bar')]
+    assert mailbox.commands == [('fetch', "1:3", "(UID RFC822)")]
@@ -18,7 +18,8 @@ from assembl.models import (
 )
 
 from assembl.models.notification import (
-    ModelEventWatcherNotificationSubscriptionDispatcher)
+    ModelEventWatcherNotificationSubscriptionDispatcher, CrudVerbs,
+    NotificationOnPostCreated, NotificationDeliveryStateType)
 
 
 def test_subscribe_notification(test_session, discussion, participant1_user,
@@ -269,5 +270,34 @@ def test_notification_multiple_subscriptions_create_single_notification(
     notification_count = test_session.query(Notification).count()
     assert notification_count == initial_notification_count + 1
 
+
+def test_notification_set_based_matching(
+        test_session, discussion, participant1_user, participant2_user,
+        root_post_1, reply_post_1, test_app):
+    # participant2_user has no local participant role in the discussion
+    test_session.flush()
+    subscriptions = [NotificationSubscriptionFollowAllMessages(
+        discussion=discussion,
+        user=user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED,
+    ) for user in (participant1_user, participant2_user)]
+    test_session.add_all(subscriptions)
+    test_session.flush()
+    ids = NotificationSubscriptionFollowAllMessages.applicable_subscription_ids(
+        discussion.id, CrudVerbs.CREATE, reply_post_1)
+    assert ids == [(subscriptions[0].id, participant1_user.id)]
+    assert NotificationSubscriptionFollowSyntheses.applicable_subscription_ids(
+        discussion.id, CrudVerbs.CREATE, reply_post_1) == []
+
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    dispatcher.processPostCreated(reply_post_1.id)
+    notifications = test_session.query(NotificationOnPostCreated).filter_by(
+        first_matching_subscription_id=subscriptions[0].id).all()
+    assert len(notifications) == 1
+    assert notifications[0].post_id == reply_post_1.id
+    assert notifications[0].delivery_state == \
+        NotificationDeliveryStateType.QUEUED
+    assert not participant2_user.notifications
+
 # def test_subscribe_notification_access_control
 # TODO: Check that other subscriptions are passed to process method
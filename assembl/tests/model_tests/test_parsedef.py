@@ -60,3 +60,17 @@ def test_load_mailbox(
         test_webrequest, discussion, admin_user, jack_layton_mailbox):
     _test_load_fixture(
         test_webrequest, discussion, admin_user, jack_layton_mailbox)
+
+
+def test_view_def_plan_reuse(test_webrequest, discussion, root_post_1):
+    from assembl import view_def
+    plan = root_post_1.view_def_plan('default')
+    if view_def.view_defs_cached():
+        assert root_post_1.view_def_plan('default') is plan
+    json = root_post_1.generic_json()
+    assert json['@id'] == root_post_1.uri()
+    assert json['@view'] == 'default'
+    # a reloaded view_def gives a new plan
+    view_def._def_cache.pop('default', None)
+    assert root_post_1.view_def_plan('default') is not plan
+    assert root_post_1.generic_json() == json
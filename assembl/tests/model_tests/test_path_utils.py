@@ -158,3 +158,33 @@ def test_delete_posts(
     assert reply_post_2.publication_state == PublicationStates.DELETED_BY_ADMIN
     assert reply_post_2.is_tombstone
     assert reply_post_1.is_tombstone
+
+
+def test_counter_store(
+        test_session, test_webrequest, discussion, root_idea,
+        reply_deleted_post_4, subidea_1_1, reply_to_deleted_post_5,
+        extract_post_1_to_subidea_1_1, monkeypatch):
+    from assembl.models import path_utils
+    counter_store = path_utils.DiscussionCounterStore(
+        path_utils.MemoryCounterBackend())
+    monkeypatch.setattr(path_utils, '_counter_store', counter_store)
+    test_webrequest.discussion_data = None
+    assert subidea_1_1.num_posts == 2
+    epoch, stored = counter_store.get_counts(discussion.id)
+    (num_posts, num_contributors) = stored[subidea_1_1.id]
+    assert num_posts == 2
+    discussion_data = path_utils.DiscussionGlobalData(
+        test_session, discussion.id, None, discussion)
+    assert not counter_store.check_consistency(discussion_data)
+    # a wrong count is detected
+    counter_store.set_counts(
+        discussion.id, {subidea_1_1.id: (3, num_contributors)}, epoch)
+    errors = counter_store.check_consistency(discussion_data)
+    assert errors == {subidea_1_1.id: (
+        (3, num_contributors), (2, num_contributors))}
+    # and discarded by a change to a post of that idea
+    counter_store.post_changed(
+        discussion.id, "%s%d," % (
+            reply_to_deleted_post_5.ancestry, reply_to_deleted_post_5.id))
+    epoch, stored = counter_store.get_counts(discussion.id)
+    assert subidea_1_1.id not in stored
@@ -0,0 +1,54 @@
+def test_mark_posts_read(test_session, discussion, participant2_user,
+                         root_post_1, discussion2_root_post_1,
+                         reply_post_1, reply_post_2):
+    from assembl.models import Post, ViewPost, PostReadSet
+    user_id = participant2_user.id
+    post_ids = sorted([root_post_1.id, reply_post_1.id, reply_post_2.id])
+
+    def live_views():
+        return sorted(view.post_id for view in test_session.query(
+            ViewPost).filter_by(actor_id=user_id, tombstone_date=None))
+
+    try:
+        assert PostReadSet.mark_read(
+            test_session, user_id, discussion.id,
+            [root_post_1.id, reply_post_1.id]) == sorted(
+                [root_post_1.id, reply_post_1.id])
+        # Already read posts are not viewed again
+        assert PostReadSet.mark_read(
+            test_session, user_id, discussion.id, post_ids) == [
+                reply_post_2.id]
+        assert live_views() == post_ids
+        assert sorted(discussion.read_post_ids(user_id)) == post_ids
+        # The posts of other discussions do not split the ranges
+        read_ids = PostReadSet.get_read_ids(
+            test_session, user_id, discussion.id)
+        assert len(read_ids.ranges()) == 1
+
+        assert PostReadSet.mark_unread(
+            test_session, user_id, discussion.id,
+            [reply_post_1.id]) == [reply_post_1.id]
+        assert PostReadSet.mark_unread(
+            test_session, user_id, discussion.id, [reply_post_1.id]) == []
+        read_ids = PostReadSet.get_read_ids(
+            test_session, user_id, discussion.id)
+        assert reply_post_1.id not in read_ids
+        assert len(read_ids.ranges()) == 2
+        assert live_views() == sorted([root_post_1.id, reply_post_2.id])
+
+        # Views created through the ORM are followed
+        test_session.add(ViewPost(post=reply_post_1, actor_id=user_id))
+        test_session.flush()
+        assert sorted(discussion.read_post_ids(user_id)) == post_ids
+        read_ids = PostReadSet.get_read_ids(
+            test_session, user_id, discussion.id)
+        assert sorted(id for (id,) in test_session.query(Post.id).filter(
+            Post.discussion_id == discussion.id,
+            PostReadSet.read_clause(Post.id, read_ids))) == post_ids
+    finally:
+        for view in test_session.query(ViewPost).filter_by(
+                actor_id=user_id):
+            test_session.delete(view)
+        test_session.flush()
+        test_session.query(PostReadSet).filter_by(user_id=user_id).delete()
+        test_session.flush()
@@ -0,0 +1,57 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+Row = namedtuple('Row', ['id', 'parent_id', 'creation_date', 'publication_state'])
+
+
+def make_rows(posts):
+    """Rows from (id, parent_id, minutes, state), in the order of the
+    export query (newest first)"""
+    from assembl.models import PublicationStates
+    start = datetime(2018, 1, 1)
+    rows = [Row(id, parent_id, start + timedelta(minutes=minutes),
+                state or PublicationStates.PUBLISHED)
+            for (id, parent_id, minutes, state) in posts]
+    rows.sort(key=lambda r: (-(r.creation_date - start).total_seconds(), r.id))
+    return rows
+
+
+def test_thread_tree():
+    from assembl.models import ThreadTree, PublicationStates
+    deleted = PublicationStates.DELETED_BY_USER
+    tree = ThreadTree(make_rows([
+        (1, None, 0, None),
+        (2, None, 10, None),
+        (3, 1, 20, None),   # reply to 1, makes it the most active thread
+        (4, 1, 15, None),
+        (5, 3, 25, deleted),
+        (6, None, 30, deleted),  # deleted without replies: not shown
+        (7, 4, 16, None),
+    ]))
+    assert tree.top_post_ids == [1, 2]
+    assert tree.position(1) == 1
+    assert tree.position(6) is None
+    assert tree.children(1) == [3, 4]
+    assert tree.number_of_answers(1) == 2
+    assert tree.indentation(1) == '1'
+    assert tree.indentation(2) == '2'
+    assert tree.indentation(3) == '1.1'
+    assert tree.indentation(4) == '1.2'
+    assert tree.indentation(7) == '1.2.1'
+    assert tree.indentation(5) == 'x'
+    assert tree.indentation(6) == 'x'
+    # deleted leaves do not count as activity
+    assert tree.latest_date(1) == tree.latest_date(3)
+    assert tree.latest_date(5) is None
+    assert list(tree.display_order()) == [1, 3, 5, 4, 7, 2]
+
+
+def test_thread_tree_deep():
+    from assembl.models import ThreadTree
+    # deeper than the recursion limit
+    depth = 2000
+    tree = ThreadTree(make_rows(
+        [(1, None, 0, None)] +
+        [(i, i - 1, i, None) for i in range(2, depth + 1)]))
+    assert tree.indentation(depth) == '.'.join(['1'] * depth)
+    assert tree.latest_date(1) == tree.latest_date(depth)
@@ -152,6 +152,30 @@ def test_get_ideas(discussion, test_app, synthesis_1,
     assert subidea_1_1_1_id not in syn_ideas
 
 
+def test_get_ideas_by_page(discussion, test_app, subidea_1_1_1, test_session):
+    url = '/data/Discussion/%d/ideas' % (discussion.id,)
+    all_ideas = test_app.get(url + '?view=id_only').json
+    assert len(all_ideas) > 2
+    paged_ideas = []
+    next_url = url + '?view=id_only&limit=2'
+    while next_url:
+        page = test_app.get(next_url)
+        assert page.status_code == 200
+        assert len(page.json) <= 2
+        paged_ideas.extend(page.json)
+        next_url = page.headers.get('Link', None)
+        if next_url:
+            assert next_url.endswith('>; rel="next"')
+            next_url = next_url[1:-len('>; rel="next"')]
+    assert paged_ideas == sorted(
+        all_ideas, key=lambda uri: Idea.get_database_id(uri))
+    first_page = test_app.get(url + '?limit=2&order=creation_date').json
+    assert len(first_page) == 2
+    assert first_page[0]['@type']
+    test_app.get(url + '?limit=0', status=400)
+    test_app.get(url + '?limit=2&after=invalid', status=400)
+
+
 def test_add_idea_in_synthesis(
         discussion, test_app, test_session, subidea_1_1):
     synthesis = discussion.next_synthesis
@@ -1304,3 +1328,15 @@ class TestResources(object):
         assert expected['bundle_hash'] == resources_hash['bundle_hash']
         assert expected['theme_hash'] == resources_hash['theme_hash']
         assert expected['bundle_css_hash'] == resources_hash['bundle_css_hash']
+
+
+def test_csv_response_streams_rows():
+    from assembl.views.api2.discussion import csv_response, CSV_MIMETYPE
+    rows = ({'a': str(i), 'b': 'x'} for i in range(1000))
+    response = csv_response(rows, CSV_MIMETYPE, ['a', 'b'])
+    body = b''.join(response.app_iter)
+    assert response.content_length == len(body)
+    lines = body.splitlines()
+    assert len(lines) == 1001
+    assert lines[0] == u'\ufeff'.encode('utf-8') + b'a;b'
+    assert lines[1] == b'0;x'
@@ -68,4 +68,88 @@ def test_mutation_add_extract_comment_reply(admin_user, graphql_request, idea_in
         """ % (idea_id, extract_id, comment_id), context_value=graphql_request)
 
     assert res.data['createPost']['post']['parentExtractId'] == extract_id
-    assert res.data['createPost']['post']['parentId'] == comment_id
\ No newline at end of file
+    assert res.data['createPost']['post']['parentId'] == comment_id
+
+
+def test_query_thread_posts_number_of_queries(
+        graphql_request, test_session, discussion, subidea_1, admin_user,
+        participant1_user, participant2_user):
+    from sqlalchemy import event
+    from assembl.models import (
+        Post, LangString, IdeaRelatedPostLink, LikeSentimentOfPost)
+    num_posts = 50
+    users = [admin_user, participant1_user, participant2_user]
+    posts = []
+    for n in range(num_posts):
+        post = Post(
+            discussion=discussion, creator=users[n % len(users)],
+            subject=LangString.create(u"Post %d" % n),
+            body=LangString.create(u"Body of post %d" % n),
+            parent=posts[n // 2] if n else None,
+            type='post', message_id="msg%d@example.com" % n)
+        test_session.add(post)
+        posts.append(post)
+    link = IdeaRelatedPostLink(
+        idea=subidea_1, creator=admin_user, content=posts[0])
+    sentiment = LikeSentimentOfPost(
+        post=posts[1], discussion=discussion, actor=admin_user)
+    test_session.add(link)
+    test_session.add(sentiment)
+    test_session.flush()
+    # as in a new request
+    test_session.expire_all()
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = test_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        res = schema.execute(u"""
+query ThreadPosts($id: ID!) {
+  idea: node(id: $id) {
+    ... on Idea {
+      posts {
+        edges {
+          node {
+            ... on Post {
+              id
+              subject
+              body
+              creator { name }
+              parentPostCreator { name }
+              sentimentCounts { like }
+              mySentiment
+              extracts { id tags { value } }
+              tags { value }
+              attachments { id }
+              indirectIdeaContentLinks { idea { id } }
+              publicationState
+            }
+          }
+        }
+      }
+    }
+  }
+}""", context_value=graphql_request,
+            variable_values={'id': subidea_1.graphene_id()})
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+    try:
+        assert res.errors is None
+        nodes = [edge['node'] for edge in res.data['idea']['posts']['edges']]
+        assert len(nodes) == num_posts
+        by_subject = {node['subject']: node for node in nodes}
+        assert by_subject[u"Post 1"]['mySentiment'] == 'LIKE'
+        assert by_subject[u"Post 1"]['sentimentCounts']['like'] == 1
+        assert by_subject[u"Post 3"]['creator']['name'] == admin_user.name
+        assert by_subject[u"Post 3"]['parentPostCreator']['name'] == participant1_user.name
+        # The related objects are loaded in batches, not post by post
+        assert len(statements) < num_posts
+    finally:
+        test_session.delete(sentiment)
+        test_session.delete(link)
+        for post in reversed(posts):
+            test_session.delete(post)
+        test_session.flush()
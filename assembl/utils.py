@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from sqlalchemy import desc
 from sqlalchemy.orm import contains_eager, joinedload, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from assembl import models
 from assembl.models.idea import MessageView
@@ -36,6 +37,42 @@ def get_posts(idea, start=None, end=None, include_deleted=None):
     return query
 
 
+def load_creators(posts):
+    """Load the creators of these posts and their accounts, in one query.
+    @param: posts list of Post
+    """
+    AgentProfile = models.AgentProfile
+    creator_ids = {post.creator_id for post in posts}
+    if not creator_ids:
+        return
+    creators = {creator.id: creator for creator in posts[0].db.query(
+        AgentProfile).filter(AgentProfile.id.in_(creator_ids)).options(
+        subqueryload(AgentProfile.accounts))}
+    for post in posts:
+        set_committed_value(post, 'creator', creators.get(post.creator_id))
+
+
+def stream_posts(query, chunk_size=100):
+    """Iterate on the posts of a query by chunks, without loading them all.
+    Eager loading is not compatible with yield_per, so it is disabled,
+    and the creators of each chunk, which get_posts loads eagerly, are
+    loaded with :py:func:`load_creators` instead.
+    @param: query A query of posts, e.g. from get_posts
+    @param: chunk_size int
+    """
+    chunk = []
+    for post in query.enable_eagerloads(False).yield_per(chunk_size):
+        chunk.append(post)
+        if len(chunk) == chunk_size:
+            load_creators(chunk)
+            for loaded in chunk:
+                yield loaded
+            chunk = []
+    load_creators(chunk)
+    for loaded in chunk:
+        yield loaded
+
+
 def get_published_top_posts(idea, start=None, end=None):
     Post = models.Post
     query = get_posts(idea, start, end, include_deleted=False)
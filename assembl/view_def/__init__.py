@@ -54,6 +54,11 @@ def get_view_def(name):
         except:
             traceback.print_exc()
 
+def view_defs_cached():
+    "Whether view_defs are read once, or reloaded on each use"
+    return _use_cache
+
+
 def includeme(config):
     global _use_cache
     _use_cache = asbool(config.registry.settings.get('cache_viewdefs', True))
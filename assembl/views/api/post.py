@@ -14,7 +14,7 @@ from sqlalchemy import String, text
 
 from sqlalchemy.orm import (
     joinedload_all, aliased, subqueryload_all, undefer)
-from sqlalchemy.sql.expression import bindparam, and_
+from sqlalchemy.sql.expression import bindparam
 from sqlalchemy.sql import cast, column
 from sqlalchemy.sql.functions import count
 
@@ -33,9 +33,10 @@ from assembl.tasks.translate import (
     PrefCollectionTranslationTable)
 from assembl.models import (
     get_database_id, Post, AssemblPost, SynthesisPost,
-    Synthesis, Discussion, Content, Idea, ViewPost, User,
+    Synthesis, Discussion, Content, Idea, User,
     IdeaRelatedPostLink, AgentProfile, LangString,
-    DummyContext, LanguagePreferenceCollection, SentimentOfPost)
+    DummyContext, LanguagePreferenceCollection, SentimentOfPost,
+    PostReadSet)
 from assembl.models.post import deleted_publication_states
 from assembl.lib.sentry import capture_message
 
@@ -52,6 +53,10 @@ post_read = Service(name='post_read', path=API_DISCUSSION_PREFIX + '/post_read/{
                description="Signal that a post was read",
                renderer='json')
 
+posts_read = Service(name='posts_read', path=API_DISCUSSION_PREFIX + '/post_read',
+                     description="Signal that many posts were read",
+                     renderer='json')
+
 _ = TranslationStringFactory('assembl')
 
 
@@ -323,28 +328,23 @@ def get_posts(request):
     is_unread = request.GET.get('is_unread')
     translations = None
     if user_id != Everyone:
-        # This is horrible, but the join creates complex subqueries that
-        # virtuoso cannot decode properly.
-        read_posts = {v.post_id for v in discussion.db.query(
-            ViewPost).filter(
-                ViewPost.tombstone_condition(),
-                ViewPost.actor_id == user_id,
-                *ViewPost.get_discussion_conditions(discussion_id))}
+        discussion_data = Idea.get_discussion_data(discussion_id)
+        if discussion_data.user_id == user_id:
+            read_posts = discussion_data.read_ids
+        else:
+            read_posts = PostReadSet.get_read_ids(
+                discussion.db, user_id, discussion_id)
         my_sentiments = {l.post_id: l for l in discussion.db.query(
             SentimentOfPost).filter(
                 SentimentOfPost.tombstone_condition(),
                 SentimentOfPost.actor_id == user_id,
                 *SentimentOfPost.get_discussion_conditions(discussion_id))}
         if is_unread != None:
-            posts = posts.outerjoin(
-                ViewPost, and_(
-                    ViewPost.actor_id==user_id,
-                    ViewPost.post_id==PostClass.id,
-                    ViewPost.tombstone_date == None))
+            is_read = PostReadSet.read_clause(PostClass.id, read_posts)
             if is_unread == "true":
-                posts = posts.filter(ViewPost.id == None)
+                posts = posts.filter(~is_read)
             elif is_unread == "false":
-                posts = posts.filter(ViewPost.id != None)
+                posts = posts.filter(is_read)
         user = AgentProfile.get(user_id)
         service = discussion.translation_service()
         if service.canTranslate is not None:
@@ -472,11 +472,8 @@ def get_posts(request):
             no_of_posts_viewed_by_user += 1
         elif user_id != Everyone and root_post is not None and root_post.id == post.id:
             # Mark post read, we requested it explicitely
-            viewed_post = ViewPost(
-                actor_id=user_id,
-                post=root_post
-                )
-            discussion.db.add(viewed_post)
+            PostReadSet.mark_read(
+                discussion.db, user_id, discussion_id, [root_post.id])
             serializable_post['read'] = True
         else:
             serializable_post['read'] = False
@@ -552,22 +549,13 @@ def mark_post_read(request):
         raise HTTPUnauthorized()
     read_data = json.loads(request.body)
     db = discussion.db
-    change = False
     with transaction.manager:
         if read_data.get('read', None) is False:
-            view = db.query(ViewPost).filter_by(
-                post_id=post_id, actor_id=user_id,
-                tombstone_date=None).first()
-            if view:
-                change = True
-                view.is_tombstone = True
+            change = PostReadSet.mark_unread(
+                db, user_id, discussion_id, [post_id])
         else:
-            count = db.query(ViewPost).filter_by(
-                post_id=post_id, actor_id=user_id,
-                tombstone_date=None).count()
-            if not count:
-                change = True
-                db.add(ViewPost(post=post, actor_id=user_id))
+            change = PostReadSet.mark_read(
+                db, user_id, discussion_id, [post_id])
 
     new_counts = []
     if change:
@@ -579,6 +567,44 @@ def mark_post_read(request):
         } for (idea_id, read_posts) in new_counts] }
 
 
+@posts_read.put(permission=P_READ)
+def mark_posts_read(request):
+    """Mark many posts as un/read, given as {"ids": [...], "read": bool}.
+    Return the posts that changed, and the read post count for all affected ideas."""
+    localizer = request.localizer
+    discussion_id = int(request.matchdict['discussion_id'])
+    discussion = Discussion.get_instance(discussion_id)
+    if not discussion:
+        raise HTTPNotFound(localizer.translate(
+            _("No discussion found with id=%s")) % discussion_id)
+    user_id = request.authenticated_userid
+    if not user_id:
+        raise HTTPUnauthorized()
+    read_data = json.loads(request.body)
+    post_ids = [get_database_id("Post", id)
+                for id in read_data.get('ids', None) or ()]
+    if None in post_ids:
+        raise HTTPBadRequest(localizer.translate(_("Invalid post id")))
+    db = discussion.db
+    with transaction.manager:
+        if read_data.get('read', None) is False:
+            changed = PostReadSet.mark_unread(
+                db, user_id, discussion_id, post_ids)
+        else:
+            changed = PostReadSet.mark_read(
+                db, user_id, discussion_id, post_ids)
+
+    new_counts = []
+    if changed:
+        new_counts = Idea.ideas_read_counts(discussion_id, changed, user_id)
+
+    return {"ok": True,
+            "posts": [Post.uri_generic(id) for id in changed],
+            "ideas": [{"@id": Idea.uri_generic(idea_id),
+                       "num_read_posts": read_posts}
+                      for (idea_id, read_posts) in new_counts]}
+
+
 @posts.post(permission=P_ADD_POST)
 def create_post(request):
     """
@@ -39,16 +39,18 @@ The structure of those collection URLs will have to be reconstructed (from the P
 import os
 import datetime
 import inspect as pyinspect
+import urllib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 
 
-from sqlalchemy import inspect
+from sqlalchemy import inspect, tuple_
 from pyramid.view import view_config
 from pyramid.httpexceptions import (
     HTTPBadRequest, HTTPNotImplemented, HTTPUnauthorized, HTTPNotFound)
 from pyramid.security import Everyone
 from pyramid.response import Response
 from pyramid.settings import asbool
-from simplejson import dumps
+from simplejson import dumps, loads
 
 from assembl.lib.sqla import ObjectNotUniqueError
 from ..traversal import (
@@ -59,6 +61,7 @@ from assembl.auth.util import get_permissions
 from assembl.models import (
     User, Discussion, TombstonableMixin)
 from assembl.lib.decl_enums import DeclEnumType
+from assembl.lib.json import JSONArrayStream
 from .. import JSONError
 
 FIXTURE_DIR = os.path.join(
@@ -68,6 +71,10 @@ API_PREFIX = '/data/'
 FORM_HEADER = "Content-Type:(application/x-www-form-urlencoded)|(multipart/form-data)"
 JSON_HEADER = "Content-Type:application/(.*\+)?json"
 MULTIPART_HEADER = "Content-Type:multipart/form-data"
+MAX_PAGE_SIZE = 1000
+# Rows read at a time by unpaged lists
+STREAM_CHUNK_SIZE = 100
+CURSOR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
 
 def check_permissions(
@@ -90,6 +97,157 @@ class CreationResponse(Response):
             location=uri, status_code=201)
 
 
+class KeysetPage(object):
+    """Opt-in keyset pagination of the class and collection views.
+
+    ``?limit=<n>`` gives the first n items ordered by id, or by creation
+    date and id with ``&order=creation_date``. If there may be more, a
+    ``Link: <...>; rel="next"`` header gives the URL of the next page,
+    with an opaque ``after`` cursor. The body is the same JSON array as
+    without paging. Unlike offsets, the cursor stays valid when items are
+    added or removed before it.
+    """
+
+    def __init__(self, request, alias):
+        self.request = request
+        self.alias = alias
+        try:
+            self.limit = int(request.GET['limit'])
+        except ValueError:
+            raise HTTPBadRequest("Invalid limit")
+        if self.limit < 1:
+            raise HTTPBadRequest("Invalid limit")
+        self.limit = min(self.limit, MAX_PAGE_SIZE)
+        self.order = request.GET.get('order', 'id')
+        if self.order == 'id':
+            self.columns = (alias.id, )
+        elif (self.order == 'creation_date' and
+                'creation_date' in inspect(alias).mapper.columns):
+            self.columns = (alias.creation_date, alias.id)
+        else:
+            raise HTTPBadRequest("Cannot order by %s" % (self.order, ))
+        self.after = None
+        if request.GET.get('after', None):
+            self.after = self.decode_cursor(request.GET['after'])
+        self.last_key = None
+        self.has_next = False
+
+    @classmethod
+    def from_request(cls, request, alias):
+        "The page asked for by the request, if any"
+        if 'limit' in request.GET:
+            return cls(request, alias)
+
+    def decode_cursor(self, cursor):
+        try:
+            key = loads(urlsafe_b64decode(cursor.encode('ascii')))
+            assert isinstance(key, list) and len(key) == len(self.columns)
+            if self.order == 'creation_date':
+                key[0] = datetime.datetime.strptime(
+                    key[0], CURSOR_DATE_FORMAT)
+            return key
+        except Exception:
+            raise HTTPBadRequest("Invalid cursor")
+
+    def encode_cursor(self, key):
+        if self.order == 'creation_date':
+            key = [key[0].strftime(CURSOR_DATE_FORMAT)] + key[1:]
+        return urlsafe_b64encode(dumps(key))
+
+    def keys(self, query):
+        """The keys of the items of the page, (other key columns..., id).
+        Distinct, as the joins of collections may repeat items."""
+        query = query.with_entities(*self.columns).distinct()
+        if self.after is not None:
+            if len(self.columns) == 1:
+                query = query.filter(self.columns[0] > self.after[0])
+            else:
+                query = query.filter(
+                    tuple_(*self.columns) > tuple_(*self.after))
+        # One more key tells if there is a next page
+        keys = query.order_by(None).order_by(*self.columns).limit(
+            self.limit + 1).all()
+        if len(keys) > self.limit:
+            keys = keys[:self.limit]
+            self.has_next = True
+        if keys:
+            self.last_key = list(keys[-1])
+        if self.has_next:
+            self.request.response.headers['Link'] = \
+                '<%s>; rel="next"' % (self.next_url(), )
+        return keys
+
+    def rows(self, query, id_only):
+        "The rows of the page. The Link header is set when they are read."
+        ids = [key[-1] for key in self.keys(query)]
+        if id_only:
+            return [(id, ) for id in ids]
+        if not ids:
+            return []
+        rows_by_id = {row.id: row for row in query.filter(
+            self.alias.id.in_(ids))}
+        return [rows_by_id[id] for id in ids if id in rows_by_id]
+
+    def next_url(self):
+        params = self.request.GET.copy()
+        params['after'] = self.encode_cursor(self.last_key)
+        return "%s?%s" % (self.request.path_url, urllib.urlencode(
+            [(k, v.encode('utf-8') if isinstance(v, unicode) else v)
+             for (k, v) in params.items()]))
+
+
+def eager_loads_collections(alias):
+    "Whether the class (or a subclass) eagerly loads a collection"
+    return any(
+        relationship.uselist and relationship.lazy in (
+            'joined', 'subquery', 'selectin')
+        for mapper in inspect(alias).mapper.self_and_descendants
+        for relationship in mapper.relationships)
+
+
+def stream_rows(query, alias, id_only, chunk_size=STREAM_CHUNK_SIZE):
+    """All the rows of the query, in its own order, read a chunk at a time
+    unless the class eagerly loads collections, which yield_per does not
+    allow."""
+    if not id_only and eager_loads_collections(alias):
+        rows = query.all()
+    else:
+        rows = query.yield_per(chunk_size)
+    if id_only:
+        return rows
+    return unique_rows(rows)
+
+
+def unique_rows(rows):
+    """Rows without repeats, which the joins of collections may give
+    across chunks"""
+    seen = set()
+    for row in rows:
+        if row.id not in seen:
+            seen.add(row.id)
+            yield row
+
+
+def list_view_results(request, query, view, uri_generic, user_id, permissions):
+    """The results of the class and collection views: the requested page,
+    or all the results, streamed as they are read."""
+    id_only = view == 'id_only'
+    alias = request.context.get_target_alias()
+    page = KeysetPage.from_request(request, alias)
+    if page is not None:
+        rows = page.rows(query, id_only)
+    else:
+        rows = stream_rows(query, alias, id_only)
+    if id_only:
+        results = (uri_generic(row[0]) for row in rows)
+    else:
+        results = (i.generic_json(view, user_id, permissions) for i in rows)
+        results = (x for x in results if x is not None)
+    if page is not None:
+        return list(results)
+    return JSONArrayStream(results)
+
+
 @view_config(context=ClassContext, renderer='json',
              request_method='GET', permission=P_READ)
 def class_view(request):
@@ -105,11 +263,8 @@ def class_view(request):
         if user_id == Everyone:
             raise HTTPUnauthorized()
         q = ctx.get_target_class().restrict_to_owners(q, user_id)
-    if view == 'id_only':
-        return [ctx._class.uri_generic(x) for (x,) in q.all()]
-    else:
-        r = [i.generic_json(view, user_id, permissions) for i in q.all()]
-        return [x for x in r if x is not None]
+    return list_view_results(
+        request, q, view, ctx._class.uri_generic, user_id, permissions)
 
 
 @view_config(context=InstanceContext, renderer='json',
@@ -143,11 +298,9 @@ def collection_view(request, default_view='default'):
         if user_id == Everyone:
             raise HTTPUnauthorized()
         q = ctx.get_target_class().restrict_to_owners(q, user_id)
-    if view == 'id_only':
-        return [ctx.collection_class.uri_generic(x) for (x,) in q.all()]
-    else:
-        res = [i.generic_json(view, user_id, permissions) for i in q.all()]
-        return [x for x in res if x is not None]
+    return list_view_results(
+        request, q, view, ctx.collection_class.uri_generic, user_id,
+        permissions)
 
 
 def collection_add(request, args):
@@ -17,6 +17,7 @@ from pyisemail import is_email
 
 from graphql_relay.node.node import from_global_id
 from assembl.lib.sqla_types import EmailString
+from assembl.lib.json import JSONArrayStream
 from ...lib import config
 from ...lib.exceptions import LocalizableError
 from assembl.auth import (
@@ -258,10 +259,17 @@ def view_profile_collection(request):
             from assembl.models import Post, AgentProfile
             num_posts_per_user = \
                 AgentProfile.count_posts_in_discussion_all_profiles(discussion)
-            for x in content:
+
+            def add_post_count(x):
                 id = AgentProfile.get_database_id(x['@id'])
                 if id in num_posts_per_user:
                     x['post_count'] = num_posts_per_user[id]
+                return x
+            if isinstance(content, JSONArrayStream):
+                content = JSONArrayStream(
+                    add_post_count(x) for x in content)
+            else:
+                content = [add_post_count(x) for x in content]
     return content
 
 
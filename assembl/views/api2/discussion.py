@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import csv
 import tempfile
-from cStringIO import StringIO
 from os import urandom
 from os.path import join, dirname
 from collections import defaultdict
@@ -62,7 +61,7 @@ from assembl.utils import (
     get_thread_ideas, get_survey_ideas, get_multicolumns_ideas,
     get_bright_mirror_ideas, get_vote_session_ideas,
     get_deleted_posts, get_related_extracts, get_posts,
-    get_published_posts, get_published_top_posts)
+    get_published_posts, get_published_top_posts, stream_posts)
 from assembl.models.social_data_extraction import (
     get_social_columns_from_user, load_social_columns_info, get_provider_id_for_discussion)
 from ..traversal import InstanceContext, ClassContext
@@ -70,9 +69,10 @@ from . import (JSON_HEADER, FORM_HEADER, CreationResponse)
 from ..api.discussion import etalab_discussions, API_ETALAB_DISCUSSIONS_PREFIX
 from assembl.models import LanguagePreferenceCollection, Locale, PublicationStates
 from assembl.models.idea_content_link import ExtractStates
-from assembl.models.post import deleted_publication_states
 from assembl.models.timeline import Phases, get_phase_by_identifier
 from assembl.models.idea import MessageView
+from assembl.models.thread_tree import ThreadTree
+from assembl.models.activity_rollup import DailyActivity, day_boundaries
 
 no_thematic_associated = "no thematic associated"
 
@@ -176,314 +176,327 @@ def get_time_series_timing(request, force_bounds=False):
     return (start, end, interval)
 
 
-@view_config(context=InstanceContext, name="time_series_analytics",
-             ctx_instance_class=Discussion, request_method='GET',
-             permission=P_DISC_STATS)
-def get_time_series_analytics(request):
-    start, end, interval = get_time_series_timing(request)
-    discussion = request.context._instance
-    user_id = request.authenticated_userid or Everyone
-    format = get_format(request)
-    results = []
-
-    with transaction.manager:
-        bind = discussion.db.connection()
-        metadata = MetaData(discussion.db.get_bind())  # make sure we are using the same connexion
-
-        intervals_table = Table('temp_table_intervals_' + str(user_id), metadata,
-                                Column('interval_id', Integer, primary_key=True),
-                                Column('interval_start', DateTime, nullable=False),
-                                Column('interval_end', DateTime, nullable=False),
-                                prefixes=['TEMPORARY']
-                                )
-        intervals_table.drop(bind=bind, checkfirst=True)
-        intervals_table.create(bind=bind)
-        interval_start = start
-        intervals = []
-        while interval_start < end:
-            interval_end = min(interval_start + interval, end)
-            intervals.append({'interval_start': interval_start, 'interval_end': interval_end})
-            interval_start = interval_start + interval
-        # pprint.pprint(intervals)
-        discussion.db.execute(intervals_table.insert(), intervals)
-
-        from assembl.models import (
-            Post, AgentProfile, AgentStatusInDiscussion, ViewPost, Idea,
-            AbstractIdeaVote, Action, ActionOnPost, ActionOnIdea, Content)
+def raw_time_series_analytics(discussion, start, end, interval, user_id):
+    """The time series statistics computed from the posts, votes, actions
+    and agent statuses, for intervals that are not whole days"""
+    bind = discussion.db.connection()
+    metadata = MetaData(discussion.db.get_bind())  # make sure we are using the same connexion
+
+    intervals_table = Table('temp_table_intervals_' + str(user_id), metadata,
+                            Column('interval_id', Integer, primary_key=True),
+                            Column('interval_start', DateTime, nullable=False),
+                            Column('interval_end', DateTime, nullable=False),
+                            prefixes=['TEMPORARY']
+                            )
+    intervals_table.drop(bind=bind, checkfirst=True)
+    intervals_table.create(bind=bind)
+    interval_start = start
+    intervals = []
+    while interval_start < end:
+        interval_end = min(interval_start + interval, end)
+        intervals.append({'interval_start': interval_start, 'interval_end': interval_end})
+        interval_start = interval_start + interval
+    # pprint.pprint(intervals)
+    discussion.db.execute(intervals_table.insert(), intervals)
 
-        # The posters
-        post_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                            func.count(distinct(Post.id)).label('count_posts'),
-                                            func.count(distinct(Post.creator_id)).label('count_post_authors'),
+    from assembl.models import (
+        Post, AgentProfile, AgentStatusInDiscussion, ViewPost, Idea,
+        AbstractIdeaVote, Action, ActionOnPost, ActionOnIdea, Content)
+
+    # The posters
+    post_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                        func.count(distinct(Post.id)).label('count_posts'),
+                                        func.count(distinct(Post.creator_id)).label('count_post_authors'),
+                                        # func.DB.DBA.BAG_AGG(Post.creator_id).label('post_authors'),
+                                        # func.DB.DBA.BAG_AGG(Post.id).label('post_ids'),
+                                        )
+    post_subquery = post_subquery.outerjoin(Post, and_(
+        Post.creation_date >= intervals_table.c.interval_start,
+        Post.creation_date < intervals_table.c.interval_end,
+        Post.discussion_id == discussion.id))
+    post_subquery = post_subquery.group_by(intervals_table.c.interval_id)
+    post_subquery = post_subquery.subquery()
+
+    # The cumulative posters
+    cumulative_posts_aliased = aliased(Post)
+    cumulative_posts_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                                    func.count(distinct(cumulative_posts_aliased.id)).label('count_cumulative_posts'),
+                                                    func.count(distinct(cumulative_posts_aliased.creator_id)).label('count_cumulative_post_authors')
+                                                    # func.DB.DBA.BAG_AGG(cumulative_posts_aliased.id).label('cumulative_post_ids')
+                                                    )
+    cumulative_posts_subquery = cumulative_posts_subquery.outerjoin(cumulative_posts_aliased, and_(
+        cumulative_posts_aliased.creation_date < intervals_table.c.interval_end,
+        cumulative_posts_aliased.discussion_id == discussion.id))
+    cumulative_posts_subquery = cumulative_posts_subquery.group_by(intervals_table.c.interval_id)
+    cumulative_posts_subquery = cumulative_posts_subquery.subquery()
+
+    # The top posters
+    top_post_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                            func.count(distinct(Post.id)).label('count_top_posts'),
+                                            func.count(distinct(Post.creator_id)).label('count_top_post_authors'),
                                             # func.DB.DBA.BAG_AGG(Post.creator_id).label('post_authors'),
                                             # func.DB.DBA.BAG_AGG(Post.id).label('post_ids'),
                                             )
-        post_subquery = post_subquery.outerjoin(Post, and_(
-            Post.creation_date >= intervals_table.c.interval_start,
-            Post.creation_date < intervals_table.c.interval_end,
-            Post.discussion_id == discussion.id))
-        post_subquery = post_subquery.group_by(intervals_table.c.interval_id)
-        post_subquery = post_subquery.subquery()
-
-        # The cumulative posters
-        cumulative_posts_aliased = aliased(Post)
-        cumulative_posts_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                                        func.count(distinct(cumulative_posts_aliased.id)).label('count_cumulative_posts'),
-                                                        func.count(distinct(cumulative_posts_aliased.creator_id)).label('count_cumulative_post_authors')
-                                                        # func.DB.DBA.BAG_AGG(cumulative_posts_aliased.id).label('cumulative_post_ids')
+    top_post_subquery = top_post_subquery.outerjoin(Post, and_(
+        Post.creation_date >= intervals_table.c.interval_start,
+        Post.creation_date < intervals_table.c.interval_end,
+        Post.parent_id == None,
+        Post.discussion_id == discussion.id))
+    top_post_subquery = top_post_subquery.group_by(intervals_table.c.interval_id)
+    top_post_subquery = top_post_subquery.subquery()
+
+    # The cumulative posters
+    cumulative_top_posts_aliased = aliased(Post)
+    cumulative_top_posts_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                                        func.count(distinct(cumulative_top_posts_aliased.id)).label('count_cumulative_top_posts'),
+                                                        func.count(distinct(cumulative_top_posts_aliased.creator_id)
+                                                                   ).label('count_cumulative_top_post_authors')
+                                                        # func.DB.DBA.BAG_AGG(cumulative_top_posts_aliased.id).label('cumulative_post_ids')
                                                         )
-        cumulative_posts_subquery = cumulative_posts_subquery.outerjoin(cumulative_posts_aliased, and_(
-            cumulative_posts_aliased.creation_date < intervals_table.c.interval_end,
-            cumulative_posts_aliased.discussion_id == discussion.id))
-        cumulative_posts_subquery = cumulative_posts_subquery.group_by(intervals_table.c.interval_id)
-        cumulative_posts_subquery = cumulative_posts_subquery.subquery()
-
-        # The top posters
-        top_post_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                                func.count(distinct(Post.id)).label('count_top_posts'),
-                                                func.count(distinct(Post.creator_id)).label('count_top_post_authors'),
-                                                # func.DB.DBA.BAG_AGG(Post.creator_id).label('post_authors'),
-                                                # func.DB.DBA.BAG_AGG(Post.id).label('post_ids'),
+    cumulative_top_posts_subquery = cumulative_top_posts_subquery.outerjoin(cumulative_top_posts_aliased, and_(
+        cumulative_top_posts_aliased.creation_date < intervals_table.c.interval_end,
+        cumulative_top_posts_aliased.parent_id == None,
+        cumulative_top_posts_aliased.discussion_id == discussion.id))
+    cumulative_top_posts_subquery = cumulative_top_posts_subquery.group_by(intervals_table.c.interval_id)
+    cumulative_top_posts_subquery = cumulative_top_posts_subquery.subquery()
+
+    # The post viewers
+    postViewers = aliased(ViewPost)
+    viewedPosts = aliased(Post)
+    post_viewers_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                                func.count(distinct(postViewers.actor_id)).label('UNRELIABLE_count_post_viewers')
                                                 )
-        top_post_subquery = top_post_subquery.outerjoin(Post, and_(
-            Post.creation_date >= intervals_table.c.interval_start,
-            Post.creation_date < intervals_table.c.interval_end,
-            Post.parent_id == None,
-            Post.discussion_id == discussion.id))
-        top_post_subquery = top_post_subquery.group_by(intervals_table.c.interval_id)
-        top_post_subquery = top_post_subquery.subquery()
-
-        # The cumulative posters
-        cumulative_top_posts_aliased = aliased(Post)
-        cumulative_top_posts_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                                            func.count(distinct(cumulative_top_posts_aliased.id)).label('count_cumulative_top_posts'),
-                                                            func.count(distinct(cumulative_top_posts_aliased.creator_id)
-                                                                       ).label('count_cumulative_top_post_authors')
-                                                            # func.DB.DBA.BAG_AGG(cumulative_top_posts_aliased.id).label('cumulative_post_ids')
-                                                            )
-        cumulative_top_posts_subquery = cumulative_top_posts_subquery.outerjoin(cumulative_top_posts_aliased, and_(
-            cumulative_top_posts_aliased.creation_date < intervals_table.c.interval_end,
-            cumulative_top_posts_aliased.parent_id == None,
-            cumulative_top_posts_aliased.discussion_id == discussion.id))
-        cumulative_top_posts_subquery = cumulative_top_posts_subquery.group_by(intervals_table.c.interval_id)
-        cumulative_top_posts_subquery = cumulative_top_posts_subquery.subquery()
-
-        # The post viewers
-        postViewers = aliased(ViewPost)
-        viewedPosts = aliased(Post)
-        post_viewers_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                                    func.count(distinct(postViewers.actor_id)).label('UNRELIABLE_count_post_viewers')
+    post_viewers_subquery = post_viewers_subquery.outerjoin(postViewers, and_(
+        postViewers.creation_date >= intervals_table.c.interval_start,
+        postViewers.creation_date < intervals_table.c.interval_end)
+    ).outerjoin(viewedPosts, and_(
+        postViewers.post_id == viewedPosts.id,
+        viewedPosts.discussion_id == discussion.id))
+    post_viewers_subquery = post_viewers_subquery.group_by(intervals_table.c.interval_id)
+    post_viewers_subquery = post_viewers_subquery.subquery()
+
+    # The cumulative visitors
+    cumulativeVisitorAgent = aliased(AgentStatusInDiscussion)
+    cumulative_visitors_query = discussion.db.query(intervals_table.c.interval_id,
+                                                    func.count(distinct(cumulativeVisitorAgent.id)).label('count_cumulative_logged_in_visitors'),
+                                                    # func.DB.DBA.BAG_AGG(cumulativeVisitorAgent.id).label('first_time_visitors')
                                                     )
-        post_viewers_subquery = post_viewers_subquery.outerjoin(postViewers, and_(
-            postViewers.creation_date >= intervals_table.c.interval_start,
-            postViewers.creation_date < intervals_table.c.interval_end)
-        ).outerjoin(viewedPosts, and_(
-            postViewers.post_id == viewedPosts.id,
-            viewedPosts.discussion_id == discussion.id))
-        post_viewers_subquery = post_viewers_subquery.group_by(intervals_table.c.interval_id)
-        post_viewers_subquery = post_viewers_subquery.subquery()
-
-        # The cumulative visitors
-        cumulativeVisitorAgent = aliased(AgentStatusInDiscussion)
-        cumulative_visitors_query = discussion.db.query(intervals_table.c.interval_id,
-                                                        func.count(distinct(cumulativeVisitorAgent.id)).label('count_cumulative_logged_in_visitors'),
-                                                        # func.DB.DBA.BAG_AGG(cumulativeVisitorAgent.id).label('first_time_visitors')
-                                                        )
-        cumulative_visitors_query = cumulative_visitors_query.outerjoin(cumulativeVisitorAgent, and_(
-            cumulativeVisitorAgent.first_visit < intervals_table.c.interval_end,
-            cumulativeVisitorAgent.discussion_id == discussion.id))
-        cumulative_visitors_query = cumulative_visitors_query.group_by(intervals_table.c.interval_id)
-        cumulative_visitors_subquery = cumulative_visitors_query.subquery()
-        # query = cumulative_visitors_query
-
-        # The members (can go up and down...)  Assumes that first_subscribed is available
-        memberAgentStatus = aliased(AgentStatusInDiscussion)
-        members_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                               func.count(memberAgentStatus.id).label('count_approximate_members')
-                                               )
-        members_subquery = members_subquery.outerjoin(memberAgentStatus, ((memberAgentStatus.last_unsubscribed >= intervals_table.c.interval_end) | (memberAgentStatus.last_unsubscribed.is_(
-            None))) & ((memberAgentStatus.first_subscribed < intervals_table.c.interval_end) | (memberAgentStatus.first_subscribed.is_(None))) & (memberAgentStatus.discussion_id == discussion.id))
-        members_subquery = members_subquery.group_by(intervals_table.c.interval_id)
-        members_subquery = members_subquery.subquery()
-
-        subscribersAgentStatus = aliased(AgentStatusInDiscussion)
-        subscribers_query = discussion.db.query(intervals_table.c.interval_id,
-                                                func.sum(
-                                                    case([
-                                                        (subscribersAgentStatus.last_visit == None, 0),
-                                                        (and_(subscribersAgentStatus.last_visit < intervals_table.c.interval_end,
-                                                              subscribersAgentStatus.last_visit >= intervals_table.c.interval_start), 1)
-                                                    ], else_=0)
-                                                ).label('retention_count_last_visit_in_period'),
-                                                func.sum(
-                                                    case([
-                                                        (subscribersAgentStatus.first_visit == None, 0),
-                                                        (and_(subscribersAgentStatus.first_visit < intervals_table.c.interval_end,
-                                                              subscribersAgentStatus.first_visit >= intervals_table.c.interval_start), 1)
-                                                    ], else_=0)
-                                                ).label('recruitment_count_first_visit_in_period'),
-                                                func.sum(
-                                                    case([
-                                                        (subscribersAgentStatus.first_subscribed == None, 0),
-                                                        (and_(subscribersAgentStatus.first_subscribed < intervals_table.c.interval_end,
-                                                              subscribersAgentStatus.first_subscribed >= intervals_table.c.interval_start), 1)
-                                                    ], else_=0)
-                                                ).label('recruitment_count_first_subscribed_in_period'),
-                                                func.sum(
-                                                    case([
-                                                        (subscribersAgentStatus.last_unsubscribed == None, 0),
-                                                        (and_(subscribersAgentStatus.last_unsubscribed < intervals_table.c.interval_end,
-                                                              subscribersAgentStatus.last_unsubscribed >= intervals_table.c.interval_start), 1)
-                                                    ], else_=0)
-                                                ).label('retention_count_last_unsubscribed_in_period'),
-                                                )
-        subscribers_query = subscribers_query.outerjoin(subscribersAgentStatus, subscribersAgentStatus.discussion_id == discussion.id)
-        subscribers_query = subscribers_query.group_by(intervals_table.c.interval_id)
-        subscribers_subquery = subscribers_query.subquery()
-        #query = subscribers_query
-
-        # The votes
-        votes_aliased = aliased(AbstractIdeaVote)
-        votes_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                             func.count(distinct(votes_aliased.id)).label('count_votes'),
-                                             func.count(distinct(votes_aliased.voter_id)).label('count_voters'),
-                                             )
-        votes_subquery = votes_subquery.outerjoin(Idea, Idea.discussion_id == discussion.id)
-        votes_subquery = votes_subquery.outerjoin(votes_aliased, and_(
-            votes_aliased.vote_date >= intervals_table.c.interval_start,
-            votes_aliased.vote_date < intervals_table.c.interval_end,
-            votes_aliased.idea_id == Idea.id))
-        votes_subquery = votes_subquery.group_by(intervals_table.c.interval_id)
-        votes_subquery = votes_subquery.subquery()
-
-        # The cumulative posters
-        cumulative_votes_aliased = aliased(AbstractIdeaVote)
-        cumulative_votes_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                                        func.count(cumulative_votes_aliased.id).label('count_cumulative_votes'),
-                                                        func.count(distinct(cumulative_votes_aliased.voter_id)).label('count_cumulative_voters')
-                                                        )
-        cumulative_votes_subquery = cumulative_votes_subquery.outerjoin(Idea, Idea.discussion_id == discussion.id)
-        cumulative_votes_subquery = cumulative_votes_subquery.outerjoin(cumulative_votes_aliased, and_(
-            cumulative_votes_aliased.vote_date < intervals_table.c.interval_end,
-            cumulative_votes_aliased.idea_id == Idea.id))
-        cumulative_votes_subquery = cumulative_votes_subquery.group_by(intervals_table.c.interval_id)
-        cumulative_votes_subquery = cumulative_votes_subquery.subquery()
+    cumulative_visitors_query = cumulative_visitors_query.outerjoin(cumulativeVisitorAgent, and_(
+        cumulativeVisitorAgent.first_visit < intervals_table.c.interval_end,
+        cumulativeVisitorAgent.discussion_id == discussion.id))
+    cumulative_visitors_query = cumulative_visitors_query.group_by(intervals_table.c.interval_id)
+    cumulative_visitors_subquery = cumulative_visitors_query.subquery()
+    # query = cumulative_visitors_query
+
+    # The members (can go up and down...)  Assumes that first_subscribed is available
+    memberAgentStatus = aliased(AgentStatusInDiscussion)
+    members_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                           func.count(memberAgentStatus.id).label('count_approximate_members')
+                                           )
+    members_subquery = members_subquery.outerjoin(memberAgentStatus, ((memberAgentStatus.last_unsubscribed >= intervals_table.c.interval_end) | (memberAgentStatus.last_unsubscribed.is_(
+        None))) & ((memberAgentStatus.first_subscribed < intervals_table.c.interval_end) | (memberAgentStatus.first_subscribed.is_(None))) & (memberAgentStatus.discussion_id == discussion.id))
+    members_subquery = members_subquery.group_by(intervals_table.c.interval_id)
+    members_subquery = members_subquery.subquery()
+
+    subscribersAgentStatus = aliased(AgentStatusInDiscussion)
+    subscribers_query = discussion.db.query(intervals_table.c.interval_id,
+                                            func.sum(
+                                                case([
+                                                    (subscribersAgentStatus.last_visit == None, 0),
+                                                    (and_(subscribersAgentStatus.last_visit < intervals_table.c.interval_end,
+                                                          subscribersAgentStatus.last_visit >= intervals_table.c.interval_start), 1)
+                                                ], else_=0)
+                                            ).label('retention_count_last_visit_in_period'),
+                                            func.sum(
+                                                case([
+                                                    (subscribersAgentStatus.first_visit == None, 0),
+                                                    (and_(subscribersAgentStatus.first_visit < intervals_table.c.interval_end,
+                                                          subscribersAgentStatus.first_visit >= intervals_table.c.interval_start), 1)
+                                                ], else_=0)
+                                            ).label('recruitment_count_first_visit_in_period'),
+                                            func.sum(
+                                                case([
+                                                    (subscribersAgentStatus.first_subscribed == None, 0),
+                                                    (and_(subscribersAgentStatus.first_subscribed < intervals_table.c.interval_end,
+                                                          subscribersAgentStatus.first_subscribed >= intervals_table.c.interval_start), 1)
+                                                ], else_=0)
+                                            ).label('recruitment_count_first_subscribed_in_period'),
+                                            func.sum(
+                                                case([
+                                                    (subscribersAgentStatus.last_unsubscribed == None, 0),
+                                                    (and_(subscribersAgentStatus.last_unsubscribed < intervals_table.c.interval_end,
+                                                          subscribersAgentStatus.last_unsubscribed >= intervals_table.c.interval_start), 1)
+                                                ], else_=0)
+                                            ).label('retention_count_last_unsubscribed_in_period'),
+                                            )
+    subscribers_query = subscribers_query.outerjoin(subscribersAgentStatus, subscribersAgentStatus.discussion_id == discussion.id)
+    subscribers_query = subscribers_query.group_by(intervals_table.c.interval_id)
+    subscribers_subquery = subscribers_query.subquery()
+    #query = subscribers_query
+
+    # The votes
+    votes_aliased = aliased(AbstractIdeaVote)
+    votes_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                         func.count(distinct(votes_aliased.id)).label('count_votes'),
+                                         func.count(distinct(votes_aliased.voter_id)).label('count_voters'),
+                                         )
+    votes_subquery = votes_subquery.outerjoin(Idea, Idea.discussion_id == discussion.id)
+    votes_subquery = votes_subquery.outerjoin(votes_aliased, and_(
+        votes_aliased.vote_date >= intervals_table.c.interval_start,
+        votes_aliased.vote_date < intervals_table.c.interval_end,
+        votes_aliased.idea_id == Idea.id))
+    votes_subquery = votes_subquery.group_by(intervals_table.c.interval_id)
+    votes_subquery = votes_subquery.subquery()
+
+    # The cumulative posters
+    cumulative_votes_aliased = aliased(AbstractIdeaVote)
+    cumulative_votes_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                                    func.count(cumulative_votes_aliased.id).label('count_cumulative_votes'),
+                                                    func.count(distinct(cumulative_votes_aliased.voter_id)).label('count_cumulative_voters')
+                                                    )
+    cumulative_votes_subquery = cumulative_votes_subquery.outerjoin(Idea, Idea.discussion_id == discussion.id)
+    cumulative_votes_subquery = cumulative_votes_subquery.outerjoin(cumulative_votes_aliased, and_(
+        cumulative_votes_aliased.vote_date < intervals_table.c.interval_end,
+        cumulative_votes_aliased.idea_id == Idea.id))
+    cumulative_votes_subquery = cumulative_votes_subquery.group_by(intervals_table.c.interval_id)
+    cumulative_votes_subquery = cumulative_votes_subquery.subquery()
+
+    content = with_polymorphic(
+        Content, [], Content.__table__,
+        aliased=False, flat=True)
+
+    # The actions
+    actions_on_post = discussion.db.query(
+        intervals_table.c.interval_id.label('interval_id'), ActionOnPost.actor_id.label('actor_id'))
+    actions_on_post = actions_on_post.outerjoin(content, content.discussion_id == discussion.id)
+    actions_on_post = actions_on_post.outerjoin(ActionOnPost, and_(
+        ActionOnPost.post_id == content.id,
+        or_(and_(
+            ActionOnPost.creation_date >= intervals_table.c.interval_start,
+            ActionOnPost.creation_date < intervals_table.c.interval_end),
+            and_(
+                ActionOnPost.tombstone_date >= intervals_table.c.interval_start,
+                ActionOnPost.tombstone_date < intervals_table.c.interval_end))))
+
+    actions_on_idea = discussion.db.query(
+        intervals_table.c.interval_id.label('interval_id'), ActionOnIdea.actor_id.label('actor_id'))
+    actions_on_idea = actions_on_idea.outerjoin(Idea, Idea.discussion_id == discussion.id)
+    actions_on_idea = actions_on_idea.outerjoin(ActionOnIdea, and_(
+        ActionOnIdea.idea_id == Idea.id,
+        or_(and_(
+            ActionOnIdea.creation_date >= intervals_table.c.interval_start,
+            ActionOnIdea.creation_date < intervals_table.c.interval_end),
+            and_(
+                ActionOnIdea.tombstone_date >= intervals_table.c.interval_start,
+                ActionOnIdea.tombstone_date < intervals_table.c.interval_end))))
+
+    posts = discussion.db.query(
+        intervals_table.c.interval_id.label('interval_id'),
+        Post.creator_id.label('actor_id'))
+    posts = posts.outerjoin(Post, and_(
+        Post.discussion_id == discussion.id,
+        Post.creation_date >= intervals_table.c.interval_start,
+        Post.creation_date < intervals_table.c.interval_end))
+
+    actions_union_subquery = actions_on_post.union(actions_on_idea, posts).subquery()
+    actions_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                           func.count(distinct(actions_union_subquery.c.actor_id)).label('count_actors')
+                                           ).outerjoin(actions_union_subquery, actions_union_subquery.c.interval_id == intervals_table.c.interval_id
+                                                       ).group_by(intervals_table.c.interval_id).subquery()
+
+    # The actions
+    cumulative_actions_on_post = discussion.db.query(
+        intervals_table.c.interval_id.label('interval_id'), ActionOnPost.actor_id.label('actor_id'))
+    cumulative_actions_on_post = cumulative_actions_on_post.outerjoin(content, content.discussion_id == discussion.id)
+    cumulative_actions_on_post = cumulative_actions_on_post.outerjoin(ActionOnPost, and_(
+        ActionOnPost.post_id == content.id,
+        or_(ActionOnPost.creation_date < intervals_table.c.interval_end,
+            ActionOnPost.tombstone_date < intervals_table.c.interval_end)))
+
+    cumulative_actions_on_idea = discussion.db.query(
+        intervals_table.c.interval_id.label('interval_id'), ActionOnIdea.actor_id.label('actor_id'))
+    cumulative_actions_on_idea = cumulative_actions_on_idea.outerjoin(Idea, Idea.discussion_id == discussion.id)
+    cumulative_actions_on_idea = cumulative_actions_on_idea.outerjoin(ActionOnIdea, and_(
+        ActionOnIdea.idea_id == Idea.id,
+        or_(ActionOnIdea.creation_date < intervals_table.c.interval_end,
+            ActionOnIdea.tombstone_date < intervals_table.c.interval_end)))
+
+    posts = discussion.db.query(
+        intervals_table.c.interval_id.label('interval_id'),
+        Post.creator_id.label('actor_id'))
+    posts = posts.outerjoin(Post, and_(
+        Post.discussion_id == discussion.id,
+        Post.creation_date < intervals_table.c.interval_end))
+
+    cumulative_actions_union_subquery = cumulative_actions_on_post.union(cumulative_actions_on_idea, posts).subquery()
+    cumulative_actions_subquery = discussion.db.query(intervals_table.c.interval_id,
+                                                      func.count(distinct(cumulative_actions_union_subquery.c.actor_id)).label('count_cumulative_actors')
+                                                      ).outerjoin(cumulative_actions_union_subquery, cumulative_actions_union_subquery.c.interval_id == intervals_table.c.interval_id
+                                                                  ).group_by(intervals_table.c.interval_id).subquery()
+
+    combined_query = discussion.db.query(intervals_table,
+                                         post_subquery,
+                                         cumulative_posts_subquery,
+                                         top_post_subquery,
+                                         cumulative_top_posts_subquery,
+                                         post_viewers_subquery,
+                                         cumulative_visitors_subquery,
+                                         votes_subquery,
+                                         cumulative_votes_subquery,
+                                         members_subquery,
+                                         actions_subquery,
+                                         cumulative_actions_subquery,
+                                         case([
+                                             (cumulative_posts_subquery.c.count_cumulative_post_authors == 0, None),
+                                             (cumulative_posts_subquery.c.count_cumulative_post_authors != 0, (cast(post_subquery.c.count_post_authors,
+                                                                                                                    Float) / cast(cumulative_posts_subquery.c.count_cumulative_post_authors, Float)))
+                                         ]).label('fraction_cumulative_authors_who_posted_in_period'),
+                                         case([
+                                             (cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors == 0, None),
+                                             (cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors != 0, (cast(
+                                                 post_subquery.c.count_post_authors, Float) / cast(cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors, Float)))
+                                         ]).label('fraction_cumulative_logged_in_visitors_who_posted_in_period'),
+                                         subscribers_subquery,
+                                         )
+    combined_query = combined_query.join(post_subquery, post_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(cumulative_posts_subquery, cumulative_posts_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(top_post_subquery, top_post_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(cumulative_top_posts_subquery, cumulative_top_posts_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(post_viewers_subquery, post_viewers_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(cumulative_visitors_subquery, cumulative_visitors_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(members_subquery, members_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(subscribers_subquery, subscribers_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(votes_subquery, votes_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(cumulative_votes_subquery, cumulative_votes_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(actions_subquery, actions_subquery.c.interval_id == intervals_table.c.interval_id)
+    combined_query = combined_query.join(cumulative_actions_subquery, cumulative_actions_subquery.c.interval_id == intervals_table.c.interval_id)
+
+    query = combined_query
+    query = query.order_by(intervals_table.c.interval_id)
+    results = query.all()
+
+    intervals_table.drop(bind=bind)
+    return [r._asdict() for r in results]
 
-        content = with_polymorphic(
-            Content, [], Content.__table__,
-            aliased=False, flat=True)
 
-        # The actions
-        actions_on_post = discussion.db.query(
-            intervals_table.c.interval_id.label('interval_id'), ActionOnPost.actor_id.label('actor_id'))
-        actions_on_post = actions_on_post.outerjoin(content, content.discussion_id == discussion.id)
-        actions_on_post = actions_on_post.outerjoin(ActionOnPost, and_(
-            ActionOnPost.post_id == content.id,
-            or_(and_(
-                ActionOnPost.creation_date >= intervals_table.c.interval_start,
-                ActionOnPost.creation_date < intervals_table.c.interval_end),
-                and_(
-                    ActionOnPost.tombstone_date >= intervals_table.c.interval_start,
-                    ActionOnPost.tombstone_date < intervals_table.c.interval_end))))
-
-        actions_on_idea = discussion.db.query(
-            intervals_table.c.interval_id.label('interval_id'), ActionOnIdea.actor_id.label('actor_id'))
-        actions_on_idea = actions_on_idea.outerjoin(Idea, Idea.discussion_id == discussion.id)
-        actions_on_idea = actions_on_idea.outerjoin(ActionOnIdea, and_(
-            ActionOnIdea.idea_id == Idea.id,
-            or_(and_(
-                ActionOnIdea.creation_date >= intervals_table.c.interval_start,
-                ActionOnIdea.creation_date < intervals_table.c.interval_end),
-                and_(
-                    ActionOnIdea.tombstone_date >= intervals_table.c.interval_start,
-                    ActionOnIdea.tombstone_date < intervals_table.c.interval_end))))
-
-        posts = discussion.db.query(
-            intervals_table.c.interval_id.label('interval_id'),
-            Post.creator_id.label('actor_id'))
-        posts = posts.outerjoin(Post, and_(
-            Post.discussion_id == discussion.id,
-            Post.creation_date >= intervals_table.c.interval_start,
-            Post.creation_date < intervals_table.c.interval_end))
-
-        actions_union_subquery = actions_on_post.union(actions_on_idea, posts).subquery()
-        actions_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                               func.count(distinct(actions_union_subquery.c.actor_id)).label('count_actors')
-                                               ).outerjoin(actions_union_subquery, actions_union_subquery.c.interval_id == intervals_table.c.interval_id
-                                                           ).group_by(intervals_table.c.interval_id).subquery()
-
-        # The actions
-        cumulative_actions_on_post = discussion.db.query(
-            intervals_table.c.interval_id.label('interval_id'), ActionOnPost.actor_id.label('actor_id'))
-        cumulative_actions_on_post = cumulative_actions_on_post.outerjoin(content, content.discussion_id == discussion.id)
-        cumulative_actions_on_post = cumulative_actions_on_post.outerjoin(ActionOnPost, and_(
-            ActionOnPost.post_id == content.id,
-            or_(ActionOnPost.creation_date < intervals_table.c.interval_end,
-                ActionOnPost.tombstone_date < intervals_table.c.interval_end)))
-
-        cumulative_actions_on_idea = discussion.db.query(
-            intervals_table.c.interval_id.label('interval_id'), ActionOnIdea.actor_id.label('actor_id'))
-        cumulative_actions_on_idea = cumulative_actions_on_idea.outerjoin(Idea, Idea.discussion_id == discussion.id)
-        cumulative_actions_on_idea = cumulative_actions_on_idea.outerjoin(ActionOnIdea, and_(
-            ActionOnIdea.idea_id == Idea.id,
-            or_(ActionOnIdea.creation_date < intervals_table.c.interval_end,
-                ActionOnIdea.tombstone_date < intervals_table.c.interval_end)))
-
-        posts = discussion.db.query(
-            intervals_table.c.interval_id.label('interval_id'),
-            Post.creator_id.label('actor_id'))
-        posts = posts.outerjoin(Post, and_(
-            Post.discussion_id == discussion.id,
-            Post.creation_date < intervals_table.c.interval_end))
-
-        cumulative_actions_union_subquery = cumulative_actions_on_post.union(cumulative_actions_on_idea, posts).subquery()
-        cumulative_actions_subquery = discussion.db.query(intervals_table.c.interval_id,
-                                                          func.count(distinct(cumulative_actions_union_subquery.c.actor_id)).label('count_cumulative_actors')
-                                                          ).outerjoin(cumulative_actions_union_subquery, cumulative_actions_union_subquery.c.interval_id == intervals_table.c.interval_id
-                                                                      ).group_by(intervals_table.c.interval_id).subquery()
-
-        combined_query = discussion.db.query(intervals_table,
-                                             post_subquery,
-                                             cumulative_posts_subquery,
-                                             top_post_subquery,
-                                             cumulative_top_posts_subquery,
-                                             post_viewers_subquery,
-                                             cumulative_visitors_subquery,
-                                             votes_subquery,
-                                             cumulative_votes_subquery,
-                                             members_subquery,
-                                             actions_subquery,
-                                             cumulative_actions_subquery,
-                                             case([
-                                                 (cumulative_posts_subquery.c.count_cumulative_post_authors == 0, None),
-                                                 (cumulative_posts_subquery.c.count_cumulative_post_authors != 0, (cast(post_subquery.c.count_post_authors,
-                                                                                                                        Float) / cast(cumulative_posts_subquery.c.count_cumulative_post_authors, Float)))
-                                             ]).label('fraction_cumulative_authors_who_posted_in_period'),
-                                             case([
-                                                 (cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors == 0, None),
-                                                 (cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors != 0, (cast(
-                                                     post_subquery.c.count_post_authors, Float) / cast(cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors, Float)))
-                                             ]).label('fraction_cumulative_logged_in_visitors_who_posted_in_period'),
-                                             subscribers_subquery,
-                                             )
-        combined_query = combined_query.join(post_subquery, post_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(cumulative_posts_subquery, cumulative_posts_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(top_post_subquery, top_post_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(cumulative_top_posts_subquery, cumulative_top_posts_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(post_viewers_subquery, post_viewers_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(cumulative_visitors_subquery, cumulative_visitors_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(members_subquery, members_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(subscribers_subquery, subscribers_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(votes_subquery, votes_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(cumulative_votes_subquery, cumulative_votes_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(actions_subquery, actions_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(cumulative_actions_subquery, cumulative_actions_subquery.c.interval_id == intervals_table.c.interval_id)
-
-        query = combined_query
-        query = query.order_by(intervals_table.c.interval_id)
-        results = query.all()
+@view_config(context=InstanceContext, name="time_series_analytics",
+             ctx_instance_class=Discussion, request_method='GET',
+             permission=P_DISC_STATS)
+def get_time_series_analytics(request):
+    start, end, interval = get_time_series_timing(request)
+    discussion = request.context._instance
+    user_id = request.authenticated_userid or Everyone
+    format = get_format(request)
+    boundaries = day_boundaries(start, end, interval)
 
-        intervals_table.drop(bind=bind)
+    with transaction.manager:
+        if boundaries is None:
+            results = raw_time_series_analytics(
+                discussion, start, end, interval, user_id)
+        else:
+            DailyActivity.refresh(discussion.db, discussion.id)
+            results = DailyActivity.time_series(
+                discussion.db, discussion.id, boundaries)
 
     if format == JSON_MIMETYPE:
             # json default
@@ -520,13 +533,19 @@ def get_time_series_analytics(request):
         "UNRELIABLE_count_post_viewers",
     ]
     # otherwise assume csv
-    return csv_response([r._asdict() for r in results], format, fieldnames)
+    return csv_response(results, format, fieldnames)
 
 
 @view_config(context=InstanceContext, name="extract_csv_taxonomy",
              ctx_instance_class=Discussion, request_method='GET',
              permission=P_DISC_STATS)
 def extract_taxonomy_csv(request):
+    fieldnames, extract_list = extract_taxonomy_rows(request)
+    return csv_response(extract_list, CSV_MIMETYPE, fieldnames, content_disposition='attachment; filename="extract_taxonomies.csv"')
+
+
+def extract_taxonomy_rows(request):
+    """The fieldnames and rows of the extract taxonomy export."""
     import assembl.models as m
     discussion = request.context._instance
     db = discussion.db
@@ -647,13 +666,20 @@ def extract_taxonomy_csv(request):
             {tag_name: tags[index].encode('utf-8') if len_tags > index else "" for index, tag_name in enumerate(tags_names)})
         extract_list.append(extract_info)
 
-    return csv_response(extract_list, CSV_MIMETYPE, fieldnames, content_disposition='attachment; filename="extract_taxonomies.csv"')
+    return fieldnames, extract_list
 
 
 @view_config(context=InstanceContext, name="multi-module-export",
              ctx_instance_class=Discussion, request_method='GET',
              permission=P_DISC_STATS)
 def multi_module_csv_export(request):
+    fieldnames, results = multi_module_sheets(request)
+    return csv_response_multiple_sheets(results, fieldnames)
+
+
+def multi_module_sheets(request):
+    """The fieldnames and rows of each sheet of the multi-module export,
+    by sheet name."""
     results = {sheet_name: None for sheet_name in sheet_names}
     fieldnames = {sheet_name: None for sheet_name in sheet_names}
     fieldnames['export_phase'], results['export_phase'] = phase_csv_export(request)
@@ -663,7 +689,7 @@ def multi_module_csv_export(request):
     fieldnames['vote_users_data'], results['vote_users_data'] = voters_csv_export(request)
     fieldnames['export_module_bright_mirror'], results['export_module_bright_mirror'] = bright_mirror_csv_export(request)
     fieldnames['export_module_vote'], results['export_module_vote'] = global_votes_csv_export(request)
-    return csv_response_multiple_sheets(results, fieldnames)
+    return fieldnames, results
 
 
 def transform_fieldname(fn):
@@ -672,24 +698,17 @@ def transform_fieldname(fn):
     return fn
 
 
-def csv_response(results, format, fieldnames=None, content_disposition=None):
-    output = StringIO()
-    if format == CSV_MIMETYPE:
-        from csv import writer
-        # include BOM for Excel to open the file in UTF-8 properly
-        output.write(u'\ufeff'.encode('utf-8'))
-        csv = writer(output, dialect='excel', delimiter=';')
-        writerow = csv.writerow
-        empty = ''
-    elif format == XSLX_MIMETYPE:
-        from zipfile import ZipFile, ZIP_DEFLATED
-        from openpyxl.workbook import Workbook
-        workbook = Workbook(True)
-        archive = ZipFile(output, 'w', ZIP_DEFLATED, allowZip64=True)
-        worksheet = workbook.create_sheet()
-        writerow = worksheet.append
-        empty = None
+def export_response(output, content_type, content_disposition=None):
+    """Stream the content of a temporary export file,
+    which is deleted once sent."""
+    length = output.tell()
+    output.seek(0)
+    return Response(
+        app_iter=FileIter(output), content_type=content_type,
+        content_length=length, content_disposition=content_disposition)
 
+
+def write_rows(writerow, results, fieldnames=None, empty=None):
     if fieldnames:
         writerow([transform_fieldname(fn) for fn in fieldnames])
         for r in results:
@@ -698,48 +717,70 @@ def csv_response(results, format, fieldnames=None, content_disposition=None):
         for r in results:
             writerow(r)
 
-    if format == XSLX_MIMETYPE:
+
+def write_export(output, results, format, fieldnames=None):
+    """Write the results, which can be an iterator, to a file
+    as CSV or XLSX."""
+    if format == CSV_MIMETYPE:
+        from csv import writer
+        # include BOM for Excel to open the file in UTF-8 properly
+        output.write(u'\ufeff'.encode('utf-8'))
+        csv = writer(output, dialect='excel', delimiter=';')
+        write_rows(csv.writerow, results, fieldnames, '')
+    elif format == XSLX_MIMETYPE:
+        from zipfile import ZipFile, ZIP_DEFLATED
+        from openpyxl.workbook import Workbook
         from openpyxl.writer.excel import ExcelWriter
+        # write-only workbooks keep their rows in temporary files
+        workbook = Workbook(write_only=True)
+        archive = ZipFile(output, 'w', ZIP_DEFLATED, allowZip64=True)
+        worksheet = workbook.create_sheet()
+        write_rows(worksheet.append, results, fieldnames)
         writer = ExcelWriter(workbook, archive)
         writer.save('')
-
-    output.seek(0)
-    return Response(body_file=output, content_type=format, content_disposition=content_disposition)
+        output.seek(0, 2)
 
 
-def csv_response_multiple_sheets(results, fieldnames=None, content_disposition='attachment; filename=multimodule_excel_export.xlsx'):
+def write_export_sheets(output, results, fieldnames):
     """
-    Return a multiple sheets excel file
-    @param: results  A dict of lists. Each list contains dicts.
+    Write a multiple sheets excel file
+    @param: results  A dict of iterables. Each iterable yields dicts.
     @param: fieldnames A dict of lists. Each list contains a string.
     """
-    output = StringIO()
     from zipfile import ZipFile, ZIP_DEFLATED
     from openpyxl.workbook import Workbook
-    workbook = Workbook(True)
-    empty=None
+    from openpyxl.writer.excel import ExcelWriter
+    workbook = Workbook(write_only=True)
     archive = ZipFile(output, 'w', ZIP_DEFLATED, allowZip64=True)
     for sheet_name in sheet_names:
-        workbook.create_sheet(sheet_name)
-
-    for worksheet in workbook.worksheets:
-        writerow = worksheet.append
-        if fieldnames[worksheet.title] is not None:
-            writerow([transform_fieldname(fn) for fn in fieldnames[worksheet.title]])
-            if results[worksheet.title] is not None:
-                for r in results[worksheet.title]:
-                    writerow([r.get(f, empty) for f in fieldnames[worksheet.title]])
-        else:
-            if results[worksheet.title] is not None:
-                for r in results[worksheet.title]:
-                    writerow(r)
+        worksheet = workbook.create_sheet(sheet_name)
+        if fieldnames[sheet_name] is not None or results[sheet_name] is not None:
+            write_rows(worksheet.append, results[sheet_name] or (),
+                       fieldnames[sheet_name])
 
-    from openpyxl.writer.excel import ExcelWriter
     writer = ExcelWriter(workbook, archive)
     writer.save('')
+    output.seek(0, 2)
 
-    output.seek(0)
-    return Response(body_file=output, content_type=XSLX_MIMETYPE, content_disposition=content_disposition)
+
+def csv_response(results, format, fieldnames=None, content_disposition=None):
+    """Return a CSV or XLSX file of the results, which can be an iterator.
+
+    Rows are written to a temporary file as they come, rather than in memory."""
+    output = tempfile.TemporaryFile()
+    write_export(output, results, format, fieldnames)
+    return export_response(output, format, content_disposition)
+
+
+def csv_response_multiple_sheets(results, fieldnames=None, content_disposition='attachment; filename=multimodule_excel_export.xlsx'):
+    """
+    Return a multiple sheets excel file
+    @param: results  A dict of iterables. Each iterable yields dicts.
+    @param: fieldnames A dict of lists. Each list contains a string.
+    """
+    output = tempfile.TemporaryFile()
+    write_export_sheets(output, results, fieldnames)
+    return export_response(output, XSLX_MIMETYPE, content_disposition)
 
 
 @view_config(context=InstanceContext, name="contribution_count",
@@ -1503,6 +1544,25 @@ def convert_to_utf8(rowdict):
     return row
 
 
+def add_keyword_columns(ideas, fieldnames):
+    """Add the keyword columns of the ideas to fieldnames, which must be
+    complete before rows are written, and return the keywords by idea id."""
+    keywords = {}
+    for idea in ideas:
+        top_key_words = keywords[idea.id] = idea.top_keywords()
+        for index, key_word in enumerate(top_key_words):
+            # already utf-8
+            column_name = "Mots clés {}".format(index + 1)
+            if column_name not in fieldnames:
+                fieldnames.append(column_name)
+    return keywords
+
+
+def keyword_columns(top_key_words):
+    return {"Mots clés {}".format(index + 1): key_word.encode('utf-8')
+            for index, key_word in enumerate(top_key_words)}
+
+
 def get_entries_locale_original(lang_string):
     if lang_string is None:
         return {
@@ -1878,153 +1938,74 @@ def multicolumn_csv_export(request):
         fieldnames[i:i] = ['sentiment ' + name.encode('utf-8') for (name, path) in extra_columns_info]
 
     ideas = get_multicolumns_ideas(discussion)
-    rows = []
-    for idea in ideas:
-        row = {}
-        top_key_words = idea.top_keywords()
-        for index, key_word in enumerate(top_key_words):
-            column_name = "Mots clés {}".format(index + 1)
-            if column_name not in fieldnames:
-                fieldnames.append(column_name.encode('utf-8'))
-            row[column_name] = key_word.encode('utf-8')
-
-        row.update(get_idea_parents_titles(idea, user_prefs))
-        posts = get_published_posts(idea, start, end)
-        # WATSON sentiment to be implemented later
-        # row[WATSON_SENTIMENT] = idea.sentiments()
-        for post in posts:
-            if has_lang:
-                post.maybe_translate(target_locales=[language])
-
-            body = get_entries_locale_original(post.body)
-            row[POST_BODY] = sanitize_text(body.get('entry'))
-            row[WORD_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
-            idea_message_columns = idea.message_columns
-            idea_message_column = [i for i in idea_message_columns if i.message_classifier == post.message_classifier]
-            row[POST_CLASSIFIER] = idea_message_column[0].title.best_lang(user_prefs).value if idea_message_column else post.message_classifier
-            if not has_anon:
-                row[POST_CREATOR_NAME] = post.creator.real_name()
-                row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
-            else:
-                row[POST_CREATOR_NAME] = post.creator.anonymous_name()
-                row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
-            row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
-            row[POST_CREATION_DATE] = format_date(post.creation_date)
-            row[MESSAGE_URL] = post.get_url()
-            if extra_columns_info and not has_anon:
-                if post.creator_id not in column_info_per_user:
-                    column_info_per_user[post.creator_id] = get_social_columns_from_user(
-                        post.creator, extra_columns_info, provider_id)
-                extra_info = column_info_per_user[post.creator_id]
-                for num, (name, path) in enumerate(extra_columns_info):
-                    row[name] = extra_info[num]
-
-            row[SHARE_COUNT] = post.share_count
-            if post.sentiments:
-                row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
-                row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
-                row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
-                row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
-                for sentiment in post.sentiments:
-                    if not has_anon:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
-                    else:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
-                    row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
-                    row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
-                    if extra_columns_info and not has_anon:
-                        if sentiment.actor_id not in column_info_per_user:
-                            column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
-                                sentiment.actor, extra_columns_info, provider_id)
-                        extra_info = column_info_per_user[sentiment.actor_id]
-                        for num, (name, path) in enumerate(extra_columns_info):
-                            row['sentiment ' + name.encode('utf-8')] = extra_info[num]
-                    rows.append(convert_to_utf8(row))
-            else:
-                row[POST_LIKE] = 0
-                row[POST_DISAGREE] = 0
-                row[POST_DONT_UNDERSTAND] = 0
-                row[POST_MORE_INFO_PLEASE] = 0
-                row[SENTIMENT_ACTOR_NAME] = u''
-                row[SENTIMENT_ACTOR_EMAIL] = u''
-                row[SENTIMENT_CREATION_DATE] = u''
-                rows.append(convert_to_utf8(row))
-    return fieldnames, rows
-
-
-def get_latest_date(post):
-    """From a post, get the latest creation_date of live descendants and self.
-    """
-    max_date = post.creation_date
-    if len(post._children) == 0:
-        if post.publication_state in deleted_publication_states:
-            return None
-        return max_date
+    keywords = add_keyword_columns(ideas, fieldnames)
 
-    for p in post._children:
-        date = get_latest_date(p)
-        if date and date > max_date:
-            max_date = date
-
-    return max_date
+    def rows():
+        for idea in ideas:
+            row = keyword_columns(keywords[idea.id])
 
+            row.update(get_idea_parents_titles(idea, user_prefs))
+            posts = stream_posts(get_published_posts(idea, start, end))
+            # WATSON sentiment to be implemented later
+            # row[WATSON_SENTIMENT] = idea.sentiments()
+            for post in posts:
+                if has_lang:
+                    post.maybe_translate(target_locales=[language])
 
-# This is the equivalent of transformPosts in pages/idea.jsx to create the tree
-def create_tree(posts):
-    """Augment each post with _children and _indentation attributes.
-    """
-    posts_by_parent = {}
-    posts_by_id = {p.id: p for p in posts}
-    for p in posts:
-        posts_by_parent.setdefault(p.parent_id, []).append(p)
-
-    def get_post_indentation(post, ident=None):
-        """Return post indentation with the form 1.2.1
-        (first reply of the second post of the first top post)
-        """
-        if ident is None:
-            ident = []
-
-        if post.parent_id is None:
-            try:
-                pos = post._position
-            except AttributeError:
-                pos = 'x'
-            ident[0:0] = [pos]
-            return '.'.join([str(e) for e in ident])
-
-        parent_post = posts_by_id[post.parent_id]
-        parent_post_children = parent_post._children
-        ident[0:0] = [parent_post_children.index(post) + 1]
-        return get_post_indentation(parent_post, ident)
-
-    def get_children(post_id):
-        new_posts = []
-        for p in posts_by_parent.get(post_id, ()):
-            p._children = get_children(p.id)
-            new_posts.append(p)
-        new_posts.sort(key=lambda p: p.creation_date, reverse=True)
-        return new_posts
-
-    top_posts = []
-    for p in posts_by_parent.get(None, ()):
-        p._children = get_children(p.id)
-        top_posts.append(p)
-
-    top_posts = [p for p in top_posts
-        if not (p.publication_state in deleted_publication_states and len(p._children) == 0)]
-
-    top_posts.sort(key=lambda p: get_latest_date(p), reverse=True)
-    for idx, p in enumerate(top_posts):
-        p._position = idx + 1
-
-    for p in posts:
-        if p.publication_state == PublicationStates.PUBLISHED:
-            p._indentation = get_post_indentation(p)
-        else:
-            p._indentation = 'x'
+                body = get_entries_locale_original(post.body)
+                row[POST_BODY] = sanitize_text(body.get('entry'))
+                row[WORD_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
+                idea_message_columns = idea.message_columns
+                idea_message_column = [i for i in idea_message_columns if i.message_classifier == post.message_classifier]
+                row[POST_CLASSIFIER] = idea_message_column[0].title.best_lang(user_prefs).value if idea_message_column else post.message_classifier
+                if not has_anon:
+                    row[POST_CREATOR_NAME] = post.creator.real_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
+                else:
+                    row[POST_CREATOR_NAME] = post.creator.anonymous_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
+                row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
+                row[POST_CREATION_DATE] = format_date(post.creation_date)
+                row[MESSAGE_URL] = post.get_url()
+                if extra_columns_info and not has_anon:
+                    if post.creator_id not in column_info_per_user:
+                        column_info_per_user[post.creator_id] = get_social_columns_from_user(
+                            post.creator, extra_columns_info, provider_id)
+                    extra_info = column_info_per_user[post.creator_id]
+                    for num, (name, path) in enumerate(extra_columns_info):
+                        row[name] = extra_info[num]
 
-    return top_posts
+                row[SHARE_COUNT] = post.share_count
+                if post.sentiments:
+                    row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
+                    row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
+                    row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
+                    row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
+                    for sentiment in post.sentiments:
+                        if not has_anon:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
+                        else:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
+                        row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
+                        row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
+                        if extra_columns_info and not has_anon:
+                            if sentiment.actor_id not in column_info_per_user:
+                                column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
+                                    sentiment.actor, extra_columns_info, provider_id)
+                            extra_info = column_info_per_user[sentiment.actor_id]
+                            for num, (name, path) in enumerate(extra_columns_info):
+                                row['sentiment ' + name.encode('utf-8')] = extra_info[num]
+                        yield convert_to_utf8(row)
+                else:
+                    row[POST_LIKE] = 0
+                    row[POST_DISAGREE] = 0
+                    row[POST_DONT_UNDERSTAND] = 0
+                    row[POST_MORE_INFO_PLEASE] = 0
+                    row[SENTIMENT_ACTOR_NAME] = u''
+                    row[SENTIMENT_ACTOR_EMAIL] = u''
+                    row[SENTIMENT_CREATION_DATE] = u''
+                    yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 def thread_csv_export(request):
@@ -2090,95 +2071,86 @@ def thread_csv_export(request):
         fieldnames[i:i] = ['sentiment ' + name.encode('utf-8') for (name, path) in extra_columns_info]
 
     ideas = get_thread_ideas(discussion)
-    rows = []
-    for idea in ideas:
-        row = {}
-        top_key_words = idea.top_keywords()
-        for index, key_word in enumerate(top_key_words):
-            column_name = "Mots clés {}".format(index + 1)
-            if column_name not in fieldnames:
-                fieldnames.append(column_name.encode('utf-8'))
-            row[column_name] = key_word.encode('utf-8')
-
-        children = idea.get_children()
-        row.update(get_idea_parents_titles(idea, user_prefs))
-        # We need to use get_posts without date filtering
-        # instead of get_published_posts to create the tree.
-        posts = get_posts(idea, None, None).all()
-        # WATSON sentiment to be impemented later
-        # row[WATSON_SENTIMENT] = idea.sentiments()
-        create_tree(posts)  # this calculate p._indentation and p._children for each post
-        for post in posts:
-            if post.publication_state != PublicationStates.PUBLISHED:
-                continue
-
-            if post.creation_date < start or post.creation_date > end:
-                continue
-
-            if has_lang:
-                post.maybe_translate(target_locales=[language])
+    keywords = add_keyword_columns(ideas, fieldnames)
+
+    def rows():
+        for idea in ideas:
+            row = keyword_columns(keywords[idea.id])
+
+            children = idea.get_children()
+            row.update(get_idea_parents_titles(idea, user_prefs))
+            # The tree is built from all posts, without date filtering,
+            # and only holds the data needed for indentation.
+            tree = ThreadTree.get_for_idea(idea, request)
+            # WATSON sentiment to be impemented later
+            # row[WATSON_SENTIMENT] = idea.sentiments()
+            posts = stream_posts(get_posts(idea, start, end).filter(
+                Post.publication_state == PublicationStates.PUBLISHED))
+            for post in posts:
+                if has_lang:
+                    post.maybe_translate(target_locales=[language])
 
-            subject = get_entries_locale_original(post.subject)
-            body = get_entries_locale_original(post.body)
-            row[POST_SUBJECT] = subject.get('entry')
-            top_post = post.get_top_post_in_thread()
-            top_post_body = get_entries_locale_original(top_post.get_body())  # use get_body() instead of body, top post may be deleted
-            top_post_title = get_entries_locale_original(top_post.get_subject())
-            row[TOP_POST] = sanitize_text(top_post_body.get('entry'))
-            row[TOP_POST_TITLE] = sanitize_text(top_post_title.get('entry'))
-            row[TOP_POST_WORD_COUNT] = str(len(row[TOP_POST].split())) if row[TOP_POST] else "0"
-            row[POST_BODY] = sanitize_text(body.get('entry'))
-            row[POST_BODY_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
-            row[NUMBER_OF_ANSWERS] = len(post._children)
-            row[MESSAGE_INDENTATION] = post._indentation
-            row[MESSAGE_URL] = post.get_url()
-            if not has_anon:
-                row[POST_CREATOR_NAME] = post.creator.real_name()
-                row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
-            else:
-                row[POST_CREATOR_NAME] = post.creator.anonymous_name()
-                row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
-            row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
-            row[POST_CREATION_DATE] = format_date(post.creation_date)
-            if extra_columns_info and not has_anon:
-                if post.creator_id not in column_info_per_user:
-                    column_info_per_user[post.creator_id] = get_social_columns_from_user(
-                        post.creator, extra_columns_info, provider_id)
-                extra_info = column_info_per_user[post.creator_id]
-                for num, (name, path) in enumerate(extra_columns_info):
-                    row[name] = extra_info[num]
+                subject = get_entries_locale_original(post.subject)
+                body = get_entries_locale_original(post.body)
+                row[POST_SUBJECT] = subject.get('entry')
+                top_post = post.get_top_post_in_thread()
+                top_post_body = get_entries_locale_original(top_post.get_body())  # use get_body() instead of body, top post may be deleted
+                top_post_title = get_entries_locale_original(top_post.get_subject())
+                row[TOP_POST] = sanitize_text(top_post_body.get('entry'))
+                row[TOP_POST_TITLE] = sanitize_text(top_post_title.get('entry'))
+                row[TOP_POST_WORD_COUNT] = str(len(row[TOP_POST].split())) if row[TOP_POST] else "0"
+                row[POST_BODY] = sanitize_text(body.get('entry'))
+                row[POST_BODY_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
+                row[NUMBER_OF_ANSWERS] = tree.number_of_answers(post.id)
+                row[MESSAGE_INDENTATION] = tree.indentation(post.id)
+                row[MESSAGE_URL] = post.get_url()
+                if not has_anon:
+                    row[POST_CREATOR_NAME] = post.creator.real_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
+                else:
+                    row[POST_CREATOR_NAME] = post.creator.anonymous_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
+                row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
+                row[POST_CREATION_DATE] = format_date(post.creation_date)
+                if extra_columns_info and not has_anon:
+                    if post.creator_id not in column_info_per_user:
+                        column_info_per_user[post.creator_id] = get_social_columns_from_user(
+                            post.creator, extra_columns_info, provider_id)
+                    extra_info = column_info_per_user[post.creator_id]
+                    for num, (name, path) in enumerate(extra_columns_info):
+                        row[name] = extra_info[num]
 
-            row[SHARE_COUNT] = post.share_count
-            if post.sentiments:
-                row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
-                row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
-                row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
-                row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
-                for sentiment in post.sentiments:
-                    if not has_anon:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
-                    else:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
-                    row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
-                    row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
-                    if extra_columns_info and not has_anon:
-                        if sentiment.actor_id not in column_info_per_user:
-                            column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
-                                sentiment.actor, extra_columns_info, provider_id)
-                        extra_info = column_info_per_user[sentiment.actor_id]
-                        for num, (name, path) in enumerate(extra_columns_info):
-                            row['sentiment ' + name.encode('utf-8')] = extra_info[num]
-                    rows.append(convert_to_utf8(row))
-            else:
-                row[POST_LIKE] = 0
-                row[POST_DISAGREE] = 0
-                row[POST_DONT_UNDERSTAND] = 0
-                row[POST_MORE_INFO_PLEASE] = 0
-                row[SENTIMENT_ACTOR_NAME] = u''
-                row[SENTIMENT_ACTOR_EMAIL] = u''
-                row[SENTIMENT_CREATION_DATE] = u''
-                rows.append(convert_to_utf8(row))
-    return fieldnames, rows
+                row[SHARE_COUNT] = post.share_count
+                if post.sentiments:
+                    row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
+                    row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
+                    row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
+                    row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
+                    for sentiment in post.sentiments:
+                        if not has_anon:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
+                        else:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
+                        row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
+                        row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
+                        if extra_columns_info and not has_anon:
+                            if sentiment.actor_id not in column_info_per_user:
+                                column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
+                                    sentiment.actor, extra_columns_info, provider_id)
+                            extra_info = column_info_per_user[sentiment.actor_id]
+                            for num, (name, path) in enumerate(extra_columns_info):
+                                row['sentiment ' + name.encode('utf-8')] = extra_info[num]
+                        yield convert_to_utf8(row)
+                else:
+                    row[POST_LIKE] = 0
+                    row[POST_DISAGREE] = 0
+                    row[POST_DONT_UNDERSTAND] = 0
+                    row[POST_MORE_INFO_PLEASE] = 0
+                    row[SENTIMENT_ACTOR_NAME] = u''
+                    row[SENTIMENT_ACTOR_EMAIL] = u''
+                    row[SENTIMENT_CREATION_DATE] = u''
+                    yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 def bright_mirror_csv_export(request):
@@ -2357,18 +2329,18 @@ def global_votes_csv_export(request):
             if fieldname not in fieldnames:
                 fieldnames.append(fieldname)
 
-    rows = []
-    for idea in ideas:
-        if not idea.vote_session:
-            continue
-        votes = votes_exports.get(idea.id)
-        idea_levels = get_idea_parents_titles(idea, user_prefs)
-        for vote_row in votes:
-            row = {}
-            row.update(idea_levels)
-            row.update(vote_row)
-            rows.append(convert_to_utf8(row))
-    return fieldnames, rows
+    def rows():
+        for idea in ideas:
+            if not idea.vote_session:
+                continue
+            votes = votes_exports.get(idea.id)
+            idea_levels = get_idea_parents_titles(idea, user_prefs)
+            for vote_row in votes:
+                row = {}
+                row.update(idea_levels)
+                row.update(vote_row)
+                yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 def voters_csv_export(request):
@@ -2418,26 +2390,26 @@ def voters_csv_export(request):
         column_info_per_user = {}
         provider_id = get_provider_id_for_discussion(discussion)
 
-    rows = []
-    for idea in ideas:
-        if not idea.vote_session:
-            continue
-        votes = votes_exports.get(idea.id)
-        idea_levels = get_idea_parents_titles(idea, user_prefs)
-        for vote_row in votes:
-            row = {}
-            row.update(idea_levels)
-            row.update(vote_row)
-            rows.append(convert_to_utf8(row))
-            if extra_columns_info and not has_anon:
-                voter = vote_row['voter']
-                if voter.id not in column_info_per_user:
-                    column_info_per_user[voter.id] = get_social_columns_from_user(
-                        voter, extra_columns_info, provider_id)
-                extra_info = column_info_per_user[voter.id]
-                for num, (name, path) in enumerate(extra_columns_info):
-                    row[name] = extra_info[num]
-    return fieldnames, rows
+    def rows():
+        for idea in ideas:
+            if not idea.vote_session:
+                continue
+            votes = votes_exports.get(idea.id)
+            idea_levels = get_idea_parents_titles(idea, user_prefs)
+            for vote_row in votes:
+                row = {}
+                row.update(idea_levels)
+                row.update(vote_row)
+                if extra_columns_info and not has_anon:
+                    voter = vote_row['voter']
+                    if voter.id not in column_info_per_user:
+                        column_info_per_user[voter.id] = get_social_columns_from_user(
+                            voter, extra_columns_info, provider_id)
+                    extra_info = column_info_per_user[voter.id]
+                    for num, (name, path) in enumerate(extra_columns_info):
+                        row[name] = extra_info[num]
+                yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 @view_config(context=InstanceContext, name="update_notification_subscriptions",
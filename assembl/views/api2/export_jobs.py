@@ -0,0 +1,243 @@
+"""Background export jobs for the heavy discussion reports.
+
+``POST /data/Discussion/<id>/export_jobs?type=<export type>&<params>``
+starts an export in celery (:py:func:`assembl.tasks.export.run_export_job`),
+or returns the job of an identical export, which may already be done if
+the discussion did not change since (same watermark.)
+``GET /data/Discussion/<id>/export_jobs?id=<job id>`` gives the status
+and progress of the job, and ``export_job_file?id=<job id>`` its artifact.
+"""
+import tempfile
+import urllib
+from collections import namedtuple
+from datetime import datetime
+
+import transaction
+from pyramid.view import view_config
+from pyramid.request import Request
+from pyramid.response import Response, FileIter, _BLOCK_SIZE
+from pyramid.httpexceptions import (
+    HTTPBadRequest, HTTPNotFound, HTTPConflict)
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_registry, manager
+
+from assembl.lib import config
+from assembl.lib.attachment_service import AttachmentService
+from assembl.lib.sentry import capture_exception
+from assembl.auth import P_DISC_STATS
+from assembl.models import Discussion, ExportJob, ExportJobStatus
+from ..traversal import InstanceContext
+from .attachments import disposition
+from .discussion import (
+    CSV_MIMETYPE, XSLX_MIMETYPE, write_export, write_export_sheets,
+    multi_module_sheets, phase_csv_export, survey_csv_export,
+    bright_mirror_csv_export, extract_taxonomy_rows)
+
+
+ExportType = namedtuple('ExportType', ['write', 'mime_type', 'filename'])
+
+
+def write_multi_module(request, output, count):
+    fieldnames, results = multi_module_sheets(request)
+    write_export_sheets(output, {
+        name: (count(rows) if rows is not None else None)
+        for (name, rows) in results.iteritems()}, fieldnames)
+
+
+def single_sheet(get_rows, format=XSLX_MIMETYPE):
+    def write(request, output, count):
+        fieldnames, rows = get_rows(request)
+        write_export(output, count(rows), format, fieldnames)
+    return write
+
+
+EXPORT_TYPES = {
+    'multi-module': ExportType(
+        write_multi_module, XSLX_MIMETYPE, u'multimodule_excel_export.xlsx'),
+    'phase': ExportType(
+        single_sheet(phase_csv_export), XSLX_MIMETYPE, u'export_phase.xlsx'),
+    'survey': ExportType(
+        single_sheet(survey_csv_export), XSLX_MIMETYPE,
+        u'export_module_survey.xlsx'),
+    'bright_mirror': ExportType(
+        single_sheet(bright_mirror_csv_export), XSLX_MIMETYPE,
+        u'export_module_bright_mirror.xlsx'),
+    'extract_taxonomy': ExportType(
+        single_sheet(extract_taxonomy_rows, CSV_MIMETYPE), CSV_MIMETYPE,
+        u'extract_taxonomies.csv'),
+}
+
+
+def cache_max_age():
+    return int(config.get('export_job_cache_max_age', 86400))
+
+
+def job_timeout():
+    return int(config.get('export_job_timeout', 3600))
+
+
+class ProgressCounter(object):
+    """Counts the rows written by an export, and saves the count
+    on the job every so many rows."""
+
+    def __init__(self, job_id, every=500):
+        self.job_id = job_id
+        self.every = every
+        self.rows = 0
+
+    def count(self, rows):
+        for row in rows:
+            yield row
+            self.rows += 1
+            if self.rows % self.every == 0:
+                ExportJob.update_state(self.job_id, progress=self.rows)
+
+
+def export_request(discussion, params):
+    """A request for the export views, outside of a web request."""
+    query = urllib.urlencode({
+        k: (v.encode('utf-8') if isinstance(v, unicode) else v)
+        for (k, v) in params.iteritems()})
+    request = Request.blank(
+        '/?' + query, base_url=discussion.get_base_url())
+    request.registry = get_current_registry()
+    request.context = InstanceContext(None, discussion)
+    return request
+
+
+def process_export_job(job_id):
+    """Run the export of the job, and save its artifact."""
+    with transaction.manager:
+        job = ExportJob.get(job_id)
+        if job is None:
+            return
+        export_type = EXPORT_TYPES[job.export_type]
+        discussion_id = job.discussion_id
+        params = job.parameters
+    # Another worker may have taken the job
+    if not ExportJob.update_state(
+            job_id, from_status=ExportJobStatus.PENDING,
+            status=ExportJobStatus.RUNNING, started=datetime.utcnow()):
+        return
+    counter = ProgressCounter(job_id)
+    output = tempfile.TemporaryFile()
+    try:
+        with transaction.manager:
+            request = export_request(Discussion.get(discussion_id), params)
+            manager.push({'request': request, 'registry': request.registry})
+            try:
+                export_type.write(request, output, counter.count)
+            finally:
+                manager.pop()
+        file_size = output.tell()
+        output.seek(0)
+        file_identity = AttachmentService.get_service().put_file(output)
+        ExportJob.update_state(
+            job_id, status=ExportJobStatus.DONE, progress=counter.rows,
+            file_identity=file_identity, file_size=file_size,
+            mime_type=export_type.mime_type, filename=export_type.filename,
+            finished=datetime.utcnow())
+    except Exception as e:
+        ExportJob.update_state(
+            job_id, status=ExportJobStatus.FAILED, progress=counter.rows,
+            error=repr(e)[:10000], finished=datetime.utcnow())
+        raise
+    finally:
+        output.close()
+
+
+def start_export_job(committed, job_id):
+    if not committed:
+        return
+    from assembl.tasks.export import run_export_job
+    try:
+        run_export_job.delay(job_id)
+    except Exception:
+        # The job will be considered lost after export_job_timeout
+        capture_exception()
+
+
+def export_job_json(job):
+    data = job.as_json()
+    if job.status == ExportJobStatus.DONE:
+        data['download_url'] = '/data/Discussion/%d/export_job_file?id=%d' % (
+            job.discussion_id, job.id)
+    return data
+
+
+def get_job(request):
+    try:
+        job_id = int(request.GET['id'])
+    except (KeyError, ValueError):
+        raise HTTPBadRequest("Missing or invalid job id")
+    job = ExportJob.get(job_id)
+    if job is None or job.discussion_id != request.context._instance.id:
+        raise HTTPNotFound("No such export job")
+    return job
+
+
+@view_config(context=InstanceContext, name="export_jobs",
+             ctx_instance_class=Discussion, request_method='POST',
+             permission=P_DISC_STATS, renderer='json')
+def create_export_job(request):
+    discussion = request.context._instance
+    params = dict(request.params)
+    export_type = params.pop('type', None)
+    if export_type not in EXPORT_TYPES:
+        raise HTTPBadRequest("Unknown export type: %s" % (export_type,))
+    refresh = asbool(params.pop('refresh', False))
+    params = ExportJob.canonical_params(params)
+    watermark = ExportJob.discussion_watermark(discussion.id)
+    cache_key = ExportJob.make_cache_key(
+        discussion.id, export_type, params, watermark)
+    job = None
+    if not refresh:
+        job = ExportJob.find_reusable(cache_key, cache_max_age(), job_timeout())
+    if job is None:
+        job = ExportJob(
+            discussion_id=discussion.id, export_type=export_type,
+            params=params, watermark=watermark, cache_key=cache_key,
+            requester_id=request.authenticated_userid)
+        ExportJob.default_db.add(job)
+        ExportJob.default_db.flush()
+        transaction.get().addAfterCommitHook(start_export_job, (job.id,))
+        request.response.status_code = 202
+    return export_job_json(job)
+
+
+@view_config(context=InstanceContext, name="export_jobs",
+             ctx_instance_class=Discussion, request_method='GET',
+             permission=P_DISC_STATS, renderer='json')
+def get_export_jobs(request):
+    if 'id' in request.GET:
+        return export_job_json(get_job(request))
+    jobs = ExportJob.default_db.query(ExportJob).filter_by(
+        discussion_id=request.context._instance.id).order_by(
+        ExportJob.id.desc()).limit(20)
+    return [export_job_json(job) for job in jobs]
+
+
+@view_config(context=InstanceContext, name="export_job_file",
+             ctx_instance_class=Discussion, request_method='GET',
+             permission=P_DISC_STATS)
+def get_export_job_file(request):
+    job = get_job(request)
+    if job.status != ExportJobStatus.DONE:
+        raise HTTPConflict("The export is %s" % (job.status,))
+    service = AttachmentService.get_service()
+    handoff_to_nginx = asbool(config.get('handoff_to_nginx', False))
+    if handoff_to_nginx:
+        kwargs = dict(body='')
+    else:
+        kwargs = dict(app_iter=FileIter(
+            service.get_file_stream(job.file_identity), _BLOCK_SIZE))
+    r = Response(
+        content_length=job.file_size,
+        content_type=str(job.mime_type),
+        last_modified=job.finished,
+        content_disposition=disposition(job.filename),
+        **kwargs)
+    if handoff_to_nginx:
+        r.headers[b'X-Accel-Redirect'] = service.get_file_url(
+            job.file_identity)
+    return r
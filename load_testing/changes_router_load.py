@@ -0,0 +1,151 @@
+"""Load test for the changes router.
+
+Opens many simulated SockJS clients against a local changes router,
+publishes changesets on its ``changes_socket`` and measures how long it
+takes for every client to receive them.
+
+The router checks read permission with the assembl server at
+``public_hostname:public_port``; this harness answers those requests
+itself, so run the router with an ini file where ``public_hostname`` is
+localhost, ``public_port`` is the ``--permission-port`` below and
+``require_secure_connection`` is false. Then:
+
+    python assembl/tasks/changes_router.py load_test.ini
+    python load_testing/changes_router_load.py load_test.ini -c 5000 -d 10
+
+Requires tornado, pyzmq and PyJWT, like the router.
+"""
+import argparse
+import ConfigParser
+import json
+import random
+import string
+import time
+from datetime import datetime
+
+import jwt
+import zmq
+from zmq.eventloop import ioloop
+from tornado import gen, web
+from tornado.httpserver import HTTPServer
+from tornado.websocket import websocket_connect
+
+SECTION = 'app:assembl'
+
+
+class PermissionHandler(web.RequestHandler):
+    "Stand-in for the assembl read permission check"
+    def get(self, discussion, user):
+        self.write('true')
+
+
+def make_token(secret, user_id):
+    return jwt.encode({
+        'userId': user_id,
+        'issuedAt': datetime.utcnow().isoformat() + 'Z'}, secret)
+
+
+def random_session():
+    return ''.join(random.choice(string.ascii_lowercase) for i in range(8))
+
+
+class Stats(object):
+    def __init__(self, num_clients):
+        self.num_clients = num_clients
+        self.connected = 0
+        self.failed = 0
+        self.received = {}
+        self.sent = {}
+
+    def report(self):
+        print "connected: %d, failed: %d" % (self.connected, self.failed)
+        for order, sent_at in sorted(self.sent.items()):
+            times = self.received.get(order, [])
+            if not times:
+                print "message %d: not received" % (order,)
+                continue
+            times.sort()
+            print "message %d: %d/%d clients, median %.3fs, max %.3fs" % (
+                order, len(times), self.connected,
+                times[len(times) // 2] - sent_at, times[-1] - sent_at)
+
+
+@gen.coroutine
+def run_client(url, discussion, token, stats):
+    """A SockJS client, using the raw websocket transport."""
+    try:
+        conn = yield websocket_connect(
+            '%s/%d/%s/websocket' % (url, random.randint(0, 999), random_session()))
+    except Exception:
+        stats.failed += 1
+        return
+    conn.write_message(json.dumps(['discussion:%s' % (discussion,)]))
+    conn.write_message(json.dumps(['token:%s' % (token,)]))
+    while True:
+        msg = yield conn.read_message()
+        if msg is None:
+            return
+        if not msg.startswith('a'):
+            # open and heartbeat frames
+            continue
+        for frame in json.loads(msg[1:]):
+            for change in json.loads(frame):
+                if change.get('@type') == 'Connection':
+                    stats.connected += 1
+                elif change.get('@type') == 'LoadTest':
+                    stats.received.setdefault(
+                        change['order'], []).append(time.time())
+
+
+@gen.coroutine
+def publish(socket, discussion, num_messages, interval, stats):
+    for order in range(num_messages):
+        yield gen.sleep(interval)
+        stats.sent[order] = time.time()
+        socket.send_multipart([
+            str(discussion), str(order),
+            json.dumps([{'@type': 'LoadTest', 'order': order}])])
+
+
+@gen.coroutine
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="router configuration file")
+    parser.add_argument("-c", "--clients", type=int, default=1000)
+    parser.add_argument("-d", "--discussions", type=int, default=1)
+    parser.add_argument("-m", "--messages", type=int, default=10)
+    parser.add_argument("-i", "--interval", type=float, default=1.0)
+    parser.add_argument("--permission-port", type=int, default=6543)
+    parser.add_argument("--connect-rate", type=int, default=500,
+                        help="new connections per second")
+    args = parser.parse_args()
+    settings = ConfigParser.ConfigParser({'changes_prefix': ''})
+    settings.read(args.configuration)
+    secret = settings.get(SECTION, 'session.secret')
+    url = 'ws://localhost:%d%s' % (
+        settings.getint(SECTION, 'changes_websocket_port'),
+        settings.get(SECTION, 'changes_prefix'))
+    server = HTTPServer(web.Application([
+        (r'/api/v1/discussion/([^/]+)/permissions/read/u/([^/]+)',
+         PermissionHandler)]))
+    server.listen(args.permission_port)
+    socket = zmq.Context.instance().socket(zmq.PUB)
+    socket.connect(settings.get(SECTION, 'changes_socket'))
+
+    stats = Stats(args.clients)
+    for n in range(args.clients):
+        run_client(url, (n % args.discussions) + 1,
+                   make_token(secret, n + 1), stats)
+        if n % args.connect_rate == args.connect_rate - 1:
+            yield gen.sleep(1)
+    yield gen.sleep(2)
+    print "%d clients connected" % (stats.connected,)
+    for discussion in range(1, args.discussions + 1):
+        publish(socket, discussion, args.messages, args.interval, stats)
+    yield gen.sleep(args.messages * args.interval + 5)
+    stats.report()
+
+
+if __name__ == '__main__':
+    ioloop.install()
+    ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,345 @@
+"""Benchmark of the serialization of posts with view_defs.
+
+Serializes posts of a discussion with :py:meth:`BaseOps.generic_json`,
+which follows a :py:class:`assembl.lib.sqla.ViewDefPlan` compiled once
+per class and view_def, and with the previous implementation, which
+interpreted the view_def for every object. Both give the same JSON.
+The posts are loaded first, so only the serialization is timed:
+
+    python load_testing/generic_json_benchmark.py local.ini -d 1 -n 10000
+"""
+import argparse
+import types
+from collections import Iterable
+from datetime import datetime
+import inspect as pyinspect
+import time
+
+from anyjson import loads
+from pyramid.paster import get_appsettings, bootstrap
+from sqlalchemy.orm.interfaces import MANYTOONE
+import transaction
+
+from assembl.auth import (
+    CrudPermissions, Everyone, P_READ, P_SYSADMIN)
+from assembl.lib import sqla
+from assembl.lib.config import set_config
+from assembl.lib.decl_enums import EnumSymbol
+from assembl.lib.sqla import configure_engine
+from assembl.view_def import get_view_def, view_defs_cached
+
+VIEW_DEFS = ('default', 'changes', 'extended')
+
+
+def legacy_generic_json(
+        self, view_def_name='default', user_id=None,
+        permissions=(P_READ, ), base_uri='local:'):
+    """The previous BaseOps.generic_json, which interpreted the view_def
+    for every object, for comparison."""
+    user_id = user_id or Everyone
+    if not self.user_can(user_id, CrudPermissions.READ, permissions):
+        return None
+    view_def = get_view_def(view_def_name or 'default')
+    my_typename = self.external_typename()
+    result = {}
+    local_view = self.expand_view_def(view_def)
+    if not local_view:
+        return None
+    mapper = self.__class__.__mapper__
+    relns = {r.key: r for r in mapper.relationships}
+    cols = {c.key: c for c in mapper.columns}
+    fkeys = {c for c in mapper.columns if c.foreign_keys}
+    reln_of_fkeys = {
+        frozenset(r._calculated_foreign_keys): r
+        for r in mapper.relationships
+    }
+    fkey_of_reln = {r.key: r._calculated_foreign_keys
+                    for r in mapper.relationships}
+    methods = dict(pyinspect.getmembers(
+        self.__class__, lambda m: pyinspect.ismethod(m)
+        and m.func_code.co_argcount == 1))
+    properties = dict(pyinspect.getmembers(
+        self.__class__, lambda p: pyinspect.isdatadescriptor(p)))
+    known = set()
+    for name, spec in local_view.iteritems():
+        if name == "_default":
+            continue
+        elif spec is False:
+            known.add(name)
+            continue
+        elif type(spec) is list:
+            if not spec:
+                spec = [True]
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(list) > 1" % (
+                    view_def_name, my_typename, name)
+            subspec = spec[0]
+        elif type(spec) is dict:
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(dict) > 1" % (
+                    view_def_name, my_typename, name)
+            assert "@id" in spec,\
+                "in viewdef %s, class %s, name %s, key should be '@id'" % (
+                    view_def_name, my_typename, name)
+            subspec = spec["@id"]
+        else:
+            subspec = spec
+        if subspec is True:
+            prop_name = name
+            view_name = None
+        else:
+            assert isinstance(subspec, types.StringTypes),\
+                "in viewdef %s, class %s, name %s, spec not a string" % (
+                    view_def_name, my_typename, name)
+            if subspec[0] == "'":
+                # literals.
+                result[name] = loads(subspec[1:])
+                continue
+            if ':' in subspec:
+                prop_name, view_name = subspec.split(':', 1)
+                if not view_name:
+                    view_name = view_def_name
+                if not prop_name:
+                    prop_name = name
+            else:
+                prop_name = subspec
+                view_name = None
+        if view_name:
+            assert get_view_def(view_name),\
+                "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
+                    view_def_name, my_typename, name, view_name)
+        #print prop_name, name, view_name
+
+        def translate_to_json(v):
+            if isinstance(v, sqla.Base):
+                p = getattr(v, 'user_can', None)
+                if p and not v.user_can(
+                        user_id, CrudPermissions.READ, permissions):
+                    return None
+                if view_name:
+                    return legacy_generic_json(
+                        v, view_name, user_id, permissions, base_uri)
+                else:
+                    return v.uri(base_uri)
+            elif isinstance(v, (
+                    str, unicode, int, long, float, bool, types.NoneType)):
+                return v
+            elif isinstance(v, EnumSymbol):
+                return v.name
+            elif isinstance(v, datetime):
+                return v.isoformat() + "Z"
+            elif isinstance(v, dict):
+                v = {translate_to_json(k): translate_to_json(val)
+                     for k, val in v.items()}
+                return {k: val for (k, val) in v.items()
+                        if val is not None}
+            elif isinstance(v, Iterable):
+                v = [translate_to_json(i) for i in v]
+                return [x for x in v if x is not None]
+            else:
+                raise NotImplementedError("Cannot translate", v)
+
+        if prop_name == 'self':
+            if view_name:
+                r = legacy_generic_json(
+                    self, view_name, user_id, permissions, base_uri)
+                if r is not None:
+                    result[name] = r
+            else:
+                result[name] = self.uri()
+            continue
+        elif prop_name == '@view':
+            result[name] = view_def_name
+            continue
+        elif prop_name[0] == '&':
+            prop_name = prop_name[1:]
+            assert prop_name in methods,\
+                "in viewdef %s, class %s, name %s, unknown method %s" % (
+                    view_def_name, my_typename, name, prop_name)
+            # Function call. PLEASE RETURN JSON, Base objects,
+            # or list or dicts thereof
+            val = getattr(self, prop_name)()
+            result[name] = translate_to_json(val)
+            continue
+        elif prop_name in cols:
+            assert not view_name,\
+                "in viewdef %s, class %s, viewdef for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, list),\
+                "in viewdef %s, class %s, list for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, dict),\
+                "in viewdef %s, class %s, dict for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            known.add(prop_name)
+            val = getattr(self, prop_name)
+            if val is not None:
+                val = translate_to_json(val)
+            if val is not None:
+                result[name] = val
+            continue
+        elif prop_name in properties:
+            known.add(prop_name)
+            if view_name or (prop_name not in fkey_of_reln) or (
+                    relns[prop_name].direction != MANYTOONE):
+                val = getattr(self, prop_name)
+                if val is not None:
+                    val = translate_to_json(val)
+                if val is not None:
+                    result[name] = val
+            else:
+                fkeys = list(fkey_of_reln[prop_name])
+                assert(len(fkeys) == 1)
+                fkey = fkeys[0]
+                result[name] = relns[prop_name].mapper.class_.uri_generic(
+                    getattr(self, fkey.key))
+
+            continue
+        assert prop_name in relns,\
+                "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
+                    view_def_name, my_typename, prop_name)
+        known.add(prop_name)
+        # Add derived prop?
+        reln = relns[prop_name]
+        if reln.uselist:
+            vals = getattr(self, prop_name)
+            if view_name:
+                if isinstance(spec, dict):
+                    result[name] = {
+                        ob.uri(base_uri):
+                        legacy_generic_json(
+                            ob, view_name, user_id, permissions, base_uri)
+                        for ob in vals
+                        if ob.user_can(
+                            user_id, CrudPermissions.READ, permissions)}
+                else:
+                    result[name] = [
+                        legacy_generic_json(
+                            ob, view_name, user_id, permissions, base_uri)
+                        for ob in vals
+                        if ob.user_can(
+                            user_id, CrudPermissions.READ, permissions)]
+            else:
+                assert not isinstance(spec, dict),\
+                    "in viewdef %s, class %s, dict without viewname for %s" % (
+                        view_def_name, my_typename, name)
+                result[name] = [
+                    ob.uri(base_uri) for ob in vals
+                    if ob.user_can(
+                        user_id, CrudPermissions.READ, permissions)]
+            continue
+        assert not isinstance(spec, dict),\
+            "in viewdef %s, class %s, dict for non-list relation %s" % (
+                view_def_name, my_typename, prop_name)
+        if view_name:
+            ob = getattr(self, prop_name)
+            if ob and ob.user_can(
+                    user_id, CrudPermissions.READ, permissions):
+                val = legacy_generic_json(
+                    ob, view_name, user_id, permissions, base_uri)
+                if val is not None:
+                    if isinstance(spec, list):
+                        result[name] = [val]
+                    else:
+                        result[name] = val
+            else:
+                if isinstance(spec, list):
+                    result[name] = []
+                else:
+                    result[name] = None
+        else:
+            uri = None
+            if len(reln._calculated_foreign_keys) == 1 \
+                    and reln._calculated_foreign_keys < fkeys:
+                # shortcut, avoid fetch
+                fkey = list(reln._calculated_foreign_keys)[0]
+                ob_id = getattr(self, fkey.name)
+                if ob_id:
+                    uri = reln.mapper.class_.uri_generic(
+                        ob_id, base_uri)
+            else:
+                ob = getattr(self, prop_name)
+                if ob:
+                    uri = ob.uri(base_uri)
+            if uri:
+                if isinstance(spec, list):
+                    result[name] = [uri]
+                else:
+                    result[name] = uri
+            else:
+                if isinstance(spec, list):
+                    result[name] = []
+                else:
+                    result[name] = None
+
+    if local_view.get('_default') is not False:
+        for name, col in cols.items():
+            if name in known:
+                continue  # already done
+            as_rel = reln_of_fkeys.get(frozenset((col, )))
+            if as_rel:
+                name = as_rel.key
+                if name in known:
+                    continue
+                else:
+                    ob_id = getattr(self, col.key)
+                    if ob_id:
+                        result[name] = as_rel.mapper.class_.uri_generic(
+                            ob_id, base_uri)
+                    else:
+                        result[name] = None
+            else:
+                ob = getattr(self, name)
+                if ob:
+                    if type(ob) == datetime:
+                        ob = ob.isoformat() + "Z"
+                    result[name] = ob
+                else:
+                    result[name] = None
+    return result
+
+
+def timed(function, posts, view_def_name):
+    start = time.time()
+    result = [function(post, view_def_name, None, (P_SYSADMIN, ))
+              for post in posts]
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        "configuration", help="configuration file of the database")
+    parser.add_argument('-d', '--discussion', type=int, required=True)
+    parser.add_argument('-n', '--num-posts', type=int, default=10000)
+    parser.add_argument('-v', '--view-def', choices=VIEW_DEFS,
+                        action='append')
+    args = parser.parse_args()
+    bootstrap(args.configuration)
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    configure_engine(settings, True)
+    if not view_defs_cached():
+        print "Warning: cache_viewdefs is false, view_defs are reloaded " \
+            "for each object"
+    from assembl.models import Post
+    with transaction.manager:
+        posts = Post.default_db.query(Post).filter_by(
+            discussion_id=args.discussion).order_by(Post.id).limit(
+            args.num_posts).all()
+        for view_def_name in args.view_def or VIEW_DEFS:
+            # warm up the session and the view_def caches
+            timed(Post.generic_json, posts, view_def_name)
+            timed(legacy_generic_json, posts, view_def_name)
+            new, elapsed = timed(Post.generic_json, posts, view_def_name)
+            old, legacy_elapsed = timed(
+                legacy_generic_json, posts, view_def_name)
+            assert new == old
+            print "%-8s %6d posts: plan %7.3fs, legacy %7.3fs (%.1fx)" % (
+                view_def_name, len(posts), elapsed, legacy_elapsed,
+                legacy_elapsed / max(elapsed, 1e-6))
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Benchmark of the fetching and parsing of an IMAP import.
+
+Serves a mailbox of synthetic messages from an in-process IMAP stand-in,
+each command taking a simulated round trip, and fetches and parses them
+either one message per command as
+:py:meth:`assembl.models.mail.IMAPMailbox.do_import_content` did, or by
+batches of uids with
+:py:meth:`assembl.models.mail.IMAPMailbox.fetch_and_parse`.
+The database part of the import is not measured. No database is needed,
+but assembl must be importable:
+
+    python load_testing/imap_import_benchmark.py -n 100000 --latency 0.002
+    python load_testing/imap_import_benchmark.py -n 100000 --skip-serial
+"""
+import argparse
+import random
+import time
+
+from assembl.models.mail import IMAPMailbox
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+class FakeIMAP(object):
+    """Serves n synthetic messages with uids 1 to n.
+    Each command takes ``latency`` seconds."""
+
+    def __init__(self, n, latency, seed=0):
+        self.n = n
+        self.latency = latency
+        self.seed = seed
+        self.commands = 0
+
+    def message(self, uid):
+        rand = random.Random(self.seed * 1000003 + uid)
+        headers = [
+            "Message-ID: <%d@bench.example.com>" % uid,
+            "From: User %d <user%d@example.com>" % (
+                uid % 97, uid % 97),
+            "To: list@example.com",
+            "Subject: Re: topic %d" % (uid % 500),
+            "Date: Thu, 18 Oct 2018 10:00:00 +0000"]
+        if uid > 1 and rand.random() < 0.7:
+            parent = rand.randint(max(1, uid - 200), uid - 1)
+            headers.append("In-Reply-To: <%d@bench.example.com>" % parent)
+            headers.append("References: <%d@bench.example.com>" % parent)
+        body = " ".join(rand.choice(WORDS)
+                        for _ in range(rand.randint(20, 400)))
+        if rand.random() < 0.5:
+            headers.append('Content-Type: text/html; charset="utf-8"')
+            body = "<html><body><p>%s</p></body></html>" % body
+        else:
+            headers.append('Content-Type: text/plain; charset="utf-8"')
+        return "\r\n".join(headers) + "\r\n\r\n" + body + "\r\n"
+
+    @staticmethod
+    def uids_of(sequence_set):
+        for part in sequence_set.split(','):
+            if ':' in part:
+                first, last = part.split(':')
+                for uid in range(int(first), int(last) + 1):
+                    yield uid
+            else:
+                yield int(part)
+
+    def uid(self, command, sequence_set, query):
+        assert command == 'fetch'
+        self.commands += 1
+        time.sleep(self.latency)
+        data = []
+        for uid in self.uids_of(sequence_set):
+            if 1 <= uid <= self.n:
+                message = self.message(uid)
+                data.append(('%d (UID %d RFC822 {%d}' % (
+                    uid, uid, len(message)), message))
+                data.append(')')
+        return 'OK', data
+
+
+def serial(mbox, mailbox, uids):
+    for uid in uids:
+        status, message_data = mailbox.uid('fetch', uid, "(RFC822)")
+        for response_part in message_data:
+            if isinstance(response_part, tuple):
+                message_string = response_part[1]
+        if mbox.message_ok_to_import(message_string):
+            mbox.parse_message(message_string)
+
+
+def pipelined(mbox, mailbox, uids, batch_size, concurrency):
+    for batch in mbox.fetch_and_parse(mailbox, uids, batch_size, concurrency):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--num-messages', type=int, default=100000)
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help="seconds per IMAP command")
+    parser.add_argument('-b', '--batch-size', type=int, default=100)
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('--skip-serial', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    uids = [str(uid) for uid in range(1, args.num_messages + 1)]
+    mbox = IMAPMailbox(name="benchmark", host="localhost", port=143,
+                       username="benchmark", password="benchmark")
+    if not args.skip_serial:
+        mailbox = FakeIMAP(args.num_messages, args.latency, args.seed)
+        start = time.time()
+        serial(mbox, mailbox, uids)
+        elapsed = time.time() - start
+        print "serial:    %6d commands %8.3fs %8.1f messages/s" % (
+            mailbox.commands, elapsed, len(uids) / elapsed)
+    mailbox = FakeIMAP(args.num_messages, args.latency, args.seed)
+    start = time.time()
+    pipelined(mbox, mailbox, uids, args.batch_size, args.concurrency)
+    elapsed = time.time() - start
+    print "pipelined: %6d commands %8.3fs %8.1f messages/s" % (
+        mailbox.commands, elapsed, len(uids) / elapsed)
+
+
+if __name__ == '__main__':
+    main()
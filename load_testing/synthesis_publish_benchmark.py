@@ -0,0 +1,153 @@
+"""Benchmark of the publication of a synthesis on a large idea graph.
+
+Builds a random idea graph in a discussion, with a synthesis of some of
+its ideas, and publishes the synthesis with
+:py:meth:`assembl.models.idea_graph_view.Synthesis.publish`, which copies
+the graph with a few set-based statements, and with the previous
+implementation, which copied it object by object. Both frozen graphs are
+compared. Everything is rolled back at the end:
+
+    python load_testing/synthesis_publish_benchmark.py local.ini -d 1
+    python load_testing/synthesis_publish_benchmark.py local.ini -d 1 \\
+        -n 5000 --synthesis-ideas 200
+"""
+import argparse
+import random
+import time
+from datetime import datetime
+
+from pyramid.paster import get_appsettings, bootstrap
+import transaction
+
+from assembl.lib.config import set_config
+from assembl.lib.sqla import configure_engine
+from assembl.lib.zmqlib import configure_zmq
+
+
+def legacy_publish(synthesis):
+    """The previous Synthesis.publish, for comparison."""
+    from assembl.models import Idea, RootIdea
+    now = datetime.utcnow()
+    frozen_synthesis = synthesis.copy()
+    synthesis.db.add(frozen_synthesis)
+    synthesis.db.flush()
+    links = Idea.get_all_idea_links(synthesis.discussion_id)
+    synthesis_idea_ids = {idea.id for idea in synthesis.ideas}
+    root = synthesis.discussion.root_idea
+    idea_copies = {root.id: root}
+    relevant_idea_ids = synthesis_idea_ids.copy()
+
+    def add_ancestors_between(idea, path=None):
+        if isinstance(idea, RootIdea):
+            return
+        path = path[:] if path else []
+        if idea.id in synthesis_idea_ids:
+            relevant_idea_ids.update({i.id for i in path})
+        else:
+            path.append(idea)
+        for parent in idea.parents:
+            add_ancestors_between(parent, path)
+    for idea in synthesis.ideas:
+        for parent in idea.parents:
+            add_ancestors_between(parent)
+    for link in links:
+        new_link = link.copy(tombstone=now)
+        frozen_synthesis.idea_links.append(new_link)
+        for end in ('source', 'target'):
+            end_id = getattr(link, end + '_id')
+            if end_id in relevant_idea_ids:
+                if end_id not in idea_copies:
+                    new_idea = getattr(link, end + '_ts').copy(tombstone=now)
+                    idea_copies[end_id] = new_idea
+                    if end_id in synthesis_idea_ids:
+                        frozen_synthesis.ideas.append(new_idea)
+                setattr(new_link, end + '_ts', idea_copies[end_id])
+    synthesis.db.flush()
+    return frozen_synthesis
+
+
+def frozen_graph(frozen_synthesis):
+    """The frozen graph by base ids, with the copied ends marked."""
+    def end(idea):
+        return (idea.base_id, idea.is_tombstone)
+    links = {(link.base_id, end(link.source_ts), end(link.target_ts))
+             for link in frozen_synthesis.get_idea_links()}
+    ideas = {idea.base_id for idea in frozen_synthesis.get_ideas()}
+    return links, ideas
+
+
+def build_graph(db, discussion, num_ideas, num_synthesis_ideas, rand):
+    """A random tree of ideas under the root, with a few extra parents,
+    and a synthesis of some of them"""
+    from assembl.models import (
+        Idea, IdeaLink, LangString, Synthesis, SubGraphIdeaAssociation)
+    ideas = [discussion.root_idea]
+    for n in range(num_ideas):
+        idea = Idea(
+            discussion=discussion,
+            title=LangString.create(u"Idea %d" % n, 'en'),
+            description=LangString.create(u"Description of idea %d" % n, 'en'))
+        parents = {rand.choice(ideas)}
+        if len(ideas) > 10 and rand.random() < 0.05:
+            parents.add(rand.choice(ideas[1:]))
+        for order, parent in enumerate(parents):
+            db.add(IdeaLink(source=parent, target=idea, order=order))
+        ideas.append(idea)
+    synthesis = Synthesis(
+        discussion=discussion,
+        subject=LangString.create(u"Benchmark synthesis", 'en'),
+        introduction=LangString.create(u"Introduction", 'en'),
+        conclusion=LangString.create(u"Conclusion", 'en'))
+    db.add(synthesis)
+    for idea in rand.sample(ideas[1:], num_synthesis_ideas):
+        db.add(SubGraphIdeaAssociation(sub_graph=synthesis, idea=idea))
+    db.flush()
+    return synthesis
+
+
+def timed(publish, synthesis):
+    start = time.time()
+    frozen_synthesis = publish(synthesis)
+    synthesis.db.flush()
+    return frozen_synthesis, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        "configuration", help="configuration file of the database")
+    parser.add_argument('-d', '--discussion', type=int, required=True)
+    parser.add_argument('-n', '--num-ideas', type=int, default=5000)
+    parser.add_argument('-s', '--synthesis-ideas', type=int, default=100)
+    parser.add_argument('--skip-legacy', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    bootstrap(args.configuration)
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    from assembl.models import Discussion, Synthesis
+    txn = transaction.begin()
+    try:
+        discussion = Discussion.get(args.discussion)
+        db = discussion.db
+        synthesis = build_graph(
+            db, discussion, args.num_ideas, args.synthesis_ideas,
+            random.Random(args.seed))
+        frozen, elapsed = timed(Synthesis.publish, synthesis)
+        graph = frozen_graph(frozen)
+        print "set-based: %5d links, %4d ideas %8.3fs" % (
+            len(graph[0]), len(graph[1]), elapsed)
+        if not args.skip_legacy:
+            frozen, legacy_elapsed = timed(legacy_publish, synthesis)
+            assert frozen_graph(frozen) == graph
+            print "legacy:    %5d links, %4d ideas %8.3fs (%.1fx)" % (
+                len(graph[0]), len(graph[1]), legacy_elapsed,
+                legacy_elapsed / max(elapsed, 1e-6))
+    finally:
+        txn.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Benchmark of the thread tree used by the thread exports and GraphQL.
+
+Builds :py:class:`assembl.models.thread_tree.ThreadTree` on synthetic
+threads, and optionally compares it with the previous recursive
+``create_tree`` of the thread CSV export, which is quadratic on long
+flat threads. No database is needed, but assembl must be importable:
+
+    python load_testing/thread_tree_benchmark.py -n 100000
+    python load_testing/thread_tree_benchmark.py -n 20000 --compare
+"""
+import argparse
+import random
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from assembl.models.post import PublicationStates, deleted_publication_states
+from assembl.models.thread_tree import ThreadTree
+
+Row = namedtuple('Row', ['id', 'parent_id', 'creation_date', 'publication_state'])
+
+
+class LegacyNode(object):
+    def __init__(self, row):
+        self.id, self.parent_id, self.creation_date, self.publication_state = row
+
+
+def legacy_create_tree(posts):
+    """The previous implementation, for comparison."""
+    def get_latest_date(post):
+        max_date = post.creation_date
+        if len(post._children) == 0:
+            if post.publication_state in deleted_publication_states:
+                return None
+            return max_date
+        for p in post._children:
+            date = get_latest_date(p)
+            if date and date > max_date:
+                max_date = date
+        return max_date
+
+    posts_by_parent = {}
+    posts_by_id = {p.id: p for p in posts}
+    for p in posts:
+        posts_by_parent.setdefault(p.parent_id, []).append(p)
+
+    def get_post_indentation(post, ident=None):
+        if ident is None:
+            ident = []
+        if post.parent_id is None:
+            try:
+                pos = post._position
+            except AttributeError:
+                pos = 'x'
+            ident[0:0] = [pos]
+            return '.'.join([str(e) for e in ident])
+        parent_post = posts_by_id[post.parent_id]
+        ident[0:0] = [parent_post._children.index(post) + 1]
+        return get_post_indentation(parent_post, ident)
+
+    def get_children(post_id):
+        new_posts = []
+        for p in posts_by_parent.get(post_id, ()):
+            p._children = get_children(p.id)
+            new_posts.append(p)
+        new_posts.sort(key=lambda p: p.creation_date, reverse=True)
+        return new_posts
+
+    top_posts = []
+    for p in posts_by_parent.get(None, ()):
+        p._children = get_children(p.id)
+        top_posts.append(p)
+    top_posts = [p for p in top_posts
+                 if not (p.publication_state in deleted_publication_states and
+                         len(p._children) == 0)]
+    top_posts.sort(key=lambda p: get_latest_date(p), reverse=True)
+    for idx, p in enumerate(top_posts):
+        p._position = idx + 1
+    for p in posts:
+        if p.publication_state == PublicationStates.PUBLISHED:
+            p._indentation = get_post_indentation(p)
+        else:
+            p._indentation = 'x'
+    return top_posts
+
+
+def flat_thread(n, rand):
+    "A few top posts, with most posts replying directly to them"
+    top = max(1, n // 1000)
+    parents = [None] * top
+    for i in range(top, n):
+        parents.append(rand.randrange(top) + 1)
+    return parents
+
+
+def bushy_thread(n, rand):
+    "Replies to random earlier posts"
+    parents = [None]
+    for i in range(1, n):
+        parents.append(None if rand.random() < 0.05 else rand.randrange(i) + 1)
+    return parents
+
+
+def chatty_thread(n, rand):
+    "Long conversations, each post likely replying to the previous one"
+    parents = [None]
+    for i in range(1, n):
+        if rand.random() < 0.01:
+            parents.append(None)
+        elif rand.random() < 0.9:
+            parents.append(i)
+        else:
+            parents.append(rand.randrange(i) + 1)
+    return parents
+
+
+SHAPES = {
+    'flat': flat_thread,
+    'bushy': bushy_thread,
+    'chatty': chatty_thread,
+}
+
+
+def make_rows(parents, rand, deleted_ratio=0.02):
+    start = datetime(2018, 1, 1)
+    rows = []
+    for i, parent_id in enumerate(parents):
+        state = (PublicationStates.DELETED_BY_USER
+                 if rand.random() < deleted_ratio
+                 else PublicationStates.PUBLISHED)
+        rows.append(Row(i + 1, parent_id, start + timedelta(seconds=i), state))
+    # the order of the export query
+    rows.reverse()
+    return rows
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--num-posts', type=int, default=100000)
+    parser.add_argument('-s', '--shape', choices=sorted(SHAPES),
+                        action='append')
+    parser.add_argument('--compare', action='store_true',
+                        help="also time and check the previous implementation")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+    for shape in args.shape or sorted(SHAPES):
+        rand = random.Random(args.seed)
+        rows = make_rows(SHAPES[shape](args.num_posts, rand), rand)
+        tree, elapsed = timed(ThreadTree, rows)
+        print "%-7s %7d posts: ThreadTree %8.3fs" % (
+            shape, len(rows), elapsed)
+        if args.compare:
+            nodes = [LegacyNode(row) for row in rows]
+            top_posts, legacy_elapsed = timed(legacy_create_tree, nodes)
+            assert [p.id for p in top_posts] == tree.top_post_ids
+            for node in nodes:
+                assert node._indentation == tree.indentation(node.id), node.id
+                assert len(node._children) == tree.number_of_answers(node.id)
+            print "%-7s %7d posts: create_tree %7.3fs (%.1fx)" % (
+                shape, len(rows), legacy_elapsed,
+                legacy_elapsed / max(elapsed, 1e-6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Benchmark of the batched machine translation of a discussion.
+
+Translates a synthetic corpus with
+:py:class:`assembl.nlp.translation_service.DummyTranslationServiceTwoSteps`,
+each service request taking a simulated latency, either one text at a time
+as :py:func:`assembl.tasks.translate.translate_content` did, or through the
+:py:class:`assembl.nlp.translation_pipeline.BatchTranslator` after removing
+the duplicate texts. No database is needed, but assembl must be importable:
+
+    python load_testing/translation_benchmark.py -n 2000 --latency 0.05
+    python load_testing/translation_benchmark.py -n 2000 --batched-service
+"""
+import argparse
+import random
+import time
+from collections import namedtuple
+
+from assembl.nlp.translation_pipeline import BatchTranslator
+from assembl.nlp.translation_service import DummyTranslationServiceTwoSteps
+
+FakeDiscussion = namedtuple('FakeDiscussion', ['id'])
+
+WORDS = (u"lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         u"eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+# Frequent short texts, as in real discussions
+REPEATED = [u"+1", u"Merci !", u"Je suis d'accord.", u"Re: Proposition",
+            u"Bonne idée", u"Pas du tout d'accord."]
+
+
+class LatencyTranslationService(DummyTranslationServiceTwoSteps):
+    """Each request to the service takes ``latency`` seconds.
+    If ``batched``, a batch of texts is a single request."""
+
+    def __init__(self, latency, batched=False):
+        super(LatencyTranslationService, self).__init__(FakeDiscussion(0))
+        self.latency = latency
+        self.batched = batched
+        self.requests = 0
+
+    def translate(self, text, target, is_html=False, source=None, db=None):
+        self.requests += 1
+        time.sleep(self.latency)
+        return super(LatencyTranslationService, self).translate(
+            text, target, is_html, source, db)
+
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        if not self.batched:
+            return super(LatencyTranslationService, self).translate_batch(
+                texts, target, is_html, source)
+        self.requests += 1
+        time.sleep(self.latency)
+        return [DummyTranslationServiceTwoSteps.translate(
+                self, text, target, is_html, source) for text in texts]
+
+
+def make_corpus(n, rand, repeated_ratio):
+    """(text, source locale) of n entries"""
+    corpus = []
+    for i in range(n):
+        if rand.random() < repeated_ratio:
+            corpus.append((rand.choice(REPEATED), 'fr'))
+        else:
+            corpus.append((u" ".join(
+                rand.choice(WORDS) for _ in range(rand.randint(5, 60))),
+                rand.choice(('fr', 'en'))))
+    return corpus
+
+
+def serial(service, corpus, targets):
+    for (text, source) in corpus:
+        for target in targets:
+            if target != source:
+                service.translate(text, target, source=source)
+
+
+def pipelined(service, corpus, targets, concurrency):
+    texts = {}
+    for (text, source) in corpus:
+        for target in targets:
+            if target != source:
+                texts[(text, source, target)] = (text, source, target, False)
+    BatchTranslator(service, concurrency).translate(texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--num-entries', type=int, default=1000)
+    parser.add_argument('-t', '--target', action='append',
+                        help="target locales (default: fr, en, de)")
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="seconds per service request")
+    parser.add_argument('--repeated', type=float, default=0.3,
+                        help="ratio of frequently repeated texts")
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('--batched-service', action='store_true',
+                        help="the service translates a batch in one request")
+    parser.add_argument('--skip-serial', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    targets = args.target or ['fr', 'en', 'de']
+    corpus = make_corpus(
+        args.num_entries, random.Random(args.seed), args.repeated)
+    if not args.skip_serial:
+        service = LatencyTranslationService(args.latency)
+        start = time.time()
+        serial(service, corpus, targets)
+        print "serial:    %5d requests %8.3fs" % (
+            service.requests, time.time() - start)
+    service = LatencyTranslationService(args.latency, args.batched_service)
+    start = time.time()
+    pipelined(service, corpus, targets, args.concurrency)
+    print "pipelined: %5d requests %8.3fs" % (
+        service.requests, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
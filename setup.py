@@ -108,6 +108,8 @@ setup(name='assembl',
               "assembl-pshell  = assembl.scripts.pshell:main",
               "assembl-pserve   = assembl.scripts.pserve:main",
               "assembl-reindex-all-contents  = assembl.scripts.reindex_all_contents:main",
+              "assembl-check-discussion-counters  = assembl.scripts.check_discussion_counters:main",
+              "assembl-rethread-mails  = assembl.scripts.rethread_mails:main",
               "assembl-graphql-schema-json = assembl.scripts.export_graphql_schema:main"
           ],
           "paste.app_factory": [